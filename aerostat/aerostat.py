@@ -10,23 +10,24 @@ is seeking an update to its name resolution (/etc/hosts).
 
 import logging
 import os
-import pymongo
+import sys
 import time
-import urllib2
 
 from optparse import OptionParser
 
-import registrar
-import updater
+import logs
 
-LEVELS = {'debug': logging.DEBUG,
-          'info': logging.INFO,
-          'warning': logging.WARNING,
-          'error': logging.ERROR,
-          'critical': logging.CRITICAL}
+# pymongo, urllib2, storage, registrar, updater and configurer are imported
+# where they are used, so that each subcommand only pays for the modules it
+# needs. The client is run from hooks and cron often enough for startup time
+# to matter.
+
+LEVELS = logs.LEVELS
 
 INFO_URL = 'http://169.254.169.254/latest/meta-data/%s'
 
+log = logs.get_logger('client')
+
 
 def get_mongo_info():
     """Get mongodb connection information (if any) from ENV."""
@@ -36,22 +37,26 @@ def get_mongo_info():
     return (server, port)
 
 
-def db_connect(host, port):
+def db_connect(host, port, lazy=False):
     """Connect to MongoDB.
 
     Args:
         host: str, hostname of mongodb server.
         port: int, port number for mongodb; defaults to 27017.
+        lazy: bool, connect on first use, so an unreachable server raises
+        AutoReconnect from the first query rather than from here.
     Returns:
         returns pymongo.Connection instance.
     """
-    logging.debug('Connecting to mongo on host %s and port %s.' % (host, port))
-    return pymongo.Connection(host, port)
+    import pymongo
+
+    log.debug('Connecting to mongo on host %s and port %s.', host, port)
+    return pymongo.Connection(host, port, _connect=not lazy)
 
 
 def db_disconnect(conn):
     """Disconnect Mongodb Connection."""
-    logging.debug('Disconnecting from mongodb.')
+    log.debug('Disconnecting from mongodb.')
     conn.disconnect()
 
 
@@ -64,35 +69,60 @@ def get_aws_data(offline=False):
     if offline:
         return ('test-instance', 'test_local_ip')
 
+    import urllib2
+
     while instance_id is None or local_ip is None:
         instance_id = urllib2.urlopen(INFO_URL % 'instance-id').read()
-        logging.debug('Recieved instance id from AWS: %s.' % instance_id)
+        log.debug('Recieved instance id from AWS: %s.', instance_id)
         local_ip = urllib2.urlopen(INFO_URL % 'local-ipv4').read()
-        logging.debug('Recieved local_ip from AWS: %s.' % local_ip)
+        log.debug('Recieved local_ip from AWS: %s.', local_ip)
 
     return (instance_id, local_ip)
 
 
 def hostname_exists(db, hostname):
     """Check if a hostname exists."""
-    results = db.servers.find({'hostname': hostname}).count()
-    if results > 0:
-        logging.info('Hostname %s exists' % hostname)
+    import storage
+
+    if storage.get(db).exists('hostname', hostname):
+        log.info('Hostname %s exists', hostname)
         return True
     else:
-        logging.info('Hostname %s doesn\'t exist' % hostname)
+        log.info('Hostname %s doesn\'t exist', hostname)
         return False
 
 
 def get_hostname(db, inst_id):
     """Get the hostname for an instnace."""
+    import storage
 
-    result = db.servers.find_one({'instance_id': inst_id})
+    result = storage.get(db).first('instance_id', inst_id)
     if result:
         return result['hostname']
     else:
         return None
 
+def hostname_number(service, hostname):
+    """Return the position of a hostname within its service.
+
+    Iterative names are numbered from 0 (<service>-N); masterful names count
+    the master as 0 and slaves from 1 (<service>-slave-N).
+
+    Args:
+        service: str, name of the service the hostname belongs to.
+        hostname: str, hostname to parse.
+    Returns:
+        int, or None if the hostname doesn't follow the naming scheme.
+    """
+    if hostname == '%s-master' % service:
+        return 0
+    for prefix in ('%s-slave-' % service, '%s-' % service):
+        suffix = hostname[len(prefix):]
+        if hostname.startswith(prefix) and suffix.isdigit():
+            return int(suffix)
+
+    return None
+
 def get_master(db, service):
     """Get the master instance_id for a service.
 
@@ -103,11 +133,15 @@ def get_master(db, service):
         str, master instance_id for service.
     """
 
+    import storage
+
     master_id = None
-    res = list(db.servers.find(
-            {'hostname': '%s-master' % service}))
+    res = storage.get(db).master(service)
+    # Mongo's masters view holds one master per service, so there
+    # duplicates are left to --fsck; SQLite, and services not in the view
+    # yet, are looked up by hostname and can still turn up several.
     if len(res) > 1:
-        logging.error('Multiple masters listed for %s service. Aborting' % service)
+        log.error('Multiple masters listed for %s service. Aborting', service)
         return None
     if res:
         master_id = res[0]['instance_id']
@@ -130,6 +164,18 @@ def check_master(db, service, inst_id):
     return cur_master == inst_id
 
 
+def write_metrics(path):
+    """Write the metrics registry for a textfile collector, if asked to."""
+    if not path:
+        return
+    import metrics
+
+    try:
+        metrics.REGISTRY.write_textfile(path)
+    except (IOError, OSError), e:
+        log.error('Unable to write metrics to %s: %s', path, e)
+
+
 def main():
     usage = 'usage: %prog [options] arg1 arg2'
     parser = OptionParser(usage=usage)
@@ -145,12 +191,20 @@ def main():
     parser.add_option(
             '--server', action='store', dest='server',
             help='hostname of aerostat/mongo server to connect to.')
+    parser.add_option(
+            '--storage', action='store', dest='storage', default=None,
+            help='Use this storage instead of mongo, e.g. '
+                 'sqlite:///var/lib/aerostat/aerostat.db.')
     parser.add_option(
             '--daemon', action='store_true', dest='daemon',
             help='Whether or not to run service (update) as a daemon.')
     parser.add_option(
             '--loglevel', action='store', dest='loglevel',
-            help='Which severity of log to display.')
+            help='Which severity of log to display, optionally per component '
+                 'e.g. info,updater=debug.')
+    parser.add_option(
+            '--log-sample', action='store', dest='log_sample', type='int',
+            default=1, help='Keep one in this many per-host debug lines.')
     parser.add_option(
             '--legacy-updater', action='store', dest='legacy',
             help='Specify path. Run legacy naming service prior to aerostat.')
@@ -166,34 +220,161 @@ def main():
     parser.add_option(
             '--configs', action='store', dest='configs', default=None,
             help='specific configs to update (space sep in quotes)')
+    parser.add_option(
+            '--template-repo', action='store', dest='template_repo',
+            default=None, help='git repo holding config templates.')
+    parser.add_option(
+            '--template-dir', action='store', dest='template_dir',
+            default='/var/lib/aerostat/templates',
+            help='Where to keep the local copy of the template repo.')
+    parser.add_option(
+            '--template-branch', action='store', dest='template_branch',
+            default='master', help='Branch of the template repo to follow.')
+    parser.add_option(
+            '--render-workers', action='store', dest='render_workers',
+            type='int', default=4, help='Configs to render at once.')
+    parser.add_option(
+            '--atomic-configs', action='store_true', dest='atomic_configs',
+            default=False, help='Write no configs if any one can\'t be '
+            'written.')
+    parser.add_option(
+            '--fsck', action='store_true', dest='fsck', default=False,
+            help='Check the servers collection for duplicates, missing '
+            'slots and other broken invariants.')
+    parser.add_option(
+            '--repair', action='store_true', dest='repair', default=False,
+            help='With --fsck, repair what it finds.')
+    parser.add_option(
+            '--subscriptions', action='store', dest='subscriptions',
+            default=None, help='Only write hosts subscribed to in this file '
+            '(default $AEROSTAT_SUBSCRIPTIONS or /etc/aerostat_subscriptions).')
+    parser.add_option(
+            '--snapshot-cache', action='store', dest='snapshot_cache',
+            default=None, help='Cache the server set here, for updates while '
+            'mongo is unreachable.')
+    parser.add_option(
+            '--generations', action='store_true', dest='generations',
+            default=False, help='Follow the server set generations aerostatd '
+            'publishes, fetching patches instead of every server.')
+    parser.add_option(
+            '--gossip-key-file', action='store', dest='gossip_key_file',
+            default=None, help='Swap signed snapshots with peers instead of '
+            'all reading mongo, checking them with the key in this file. '
+            'Needs --daemon.')
+    parser.add_option(
+            '--gossip-port', action='store', dest='gossip_port', type='int',
+            default=8649, help='Port to serve snapshots to peers on.')
+    parser.add_option(
+            '--gossip-peers', action='store', dest='gossip_peers',
+            default=None, help='Comma separated host:port peers (default '
+            'every host in the snapshot).')
+    parser.add_option(
+            '--metrics-textfile', action='store', dest='metrics_textfile',
+            default=None, help='Write metrics here for a textfile collector.')
+    parser.add_option(
+            '--profile-slow-ms', action='store', dest='profile_slow_ms',
+            type='float', default=None,
+            help='Profile mongo operations, logging those slower than this.')
+    parser.add_option(
+            '--profile-sample-rate', action='store', dest='profile_sample_rate',
+            type='float', default=1.0,
+            help='Fraction of mongo operations to total when profiling.')
+    parser.add_option(
+            '--profile-log', action='store', dest='profile_log', default=None,
+            help='Append slow mongo operations here as JSON lines.')
 
 
     (options, args) = parser.parse_args()
 
     if len(args) > 1:
         parser.error('Please supply some arguments')
+    if options.repair and not options.fsck:
+        parser.error('--repair needs --fsck.')
 
-    level = LEVELS.get(options.loglevel, logging.NOTSET)
-    logging.basicConfig(level=level)
+    try:
+        level, component_levels = logs.parse_levels(options.loglevel)
+    except ValueError, e:
+        parser.error(str(e))
+    logging.basicConfig(level=level or logging.NOTSET)
+    logs.set_levels(component_levels)
+    logs.set_sample_every(options.log_sample)
 
     mserver, mport = get_mongo_info()
 
     if options.server:
         mserver = options.server
 
-    conn = db_connect(mserver, mport)
-    db = conn.aerostat
+    conn = None
+    if options.storage:
+        if (options.update_configs or options.generations or
+                options.gossip_key_file or options.fsck):
+            parser.error('--update-configs, --generations, '
+                    '--gossip-key-file and --fsck need mongo.')
+        import storage
+
+        try:
+            db = storage.open_storage(options.storage)
+        except ValueError, e:
+            parser.error(str(e))
+    else:
+        # An update with a snapshot cache falls back to the cache when mongo
+        # is down, so it mustn't fail on connecting.
+        conn = db_connect(mserver, mport, lazy=bool(options.snapshot_cache))
+        db = conn.aerostat
+    if options.profile_slow_ms is not None and conn is None:
+        parser.error('--profile-slow-ms needs mongo.')
+    if options.profile_slow_ms is not None:
+        import profiler
+        db = profiler.profile(db, options.profile_sample_rate,
+                options.profile_slow_ms, options.profile_log)
 
     if options.register or options.change_master:
+        import registrar
         reg= registrar.Registrar()
         reg.do_registrar(db, options.dry_run,
                 options.change_master, options.offline)
+    elif options.fsck:
+        import fsck
+        checker = fsck.Fsck(db)
+        report = checker.scan()
+        problems = checker.log_report(report)
+        if problems and options.repair:
+            checker.repair(report, options.dry_run)
+        if problems and (not options.repair or options.dry_run):
+            # Let health checks fail on a dirty collection.
+            sys.exit(1)
     elif options.update_configs:
+        import configurer
         conf_db = conn.configs
-        config = configurer.Configurer()
-        config.do_update(conf_db, config_names=options.configs.split())
+        template_repo = None
+        if options.template_repo:
+            import repository
+            template_repo = repository.Repository(options.template_repo,
+                    options.template_dir, options.template_branch)
+        config = configurer.Configurer(db, repository=template_repo,
+                workers=options.render_workers, atomic=options.atomic_configs)
+        config.do_update(conf_db, config_names=(options.configs or '').split(),
+                dry_run=options.dry_run)
     else:
-        update = updater.Updater()
+        import pymongo
+        import subscriptions
+        import updater
+        try:
+            subscription = subscriptions.load(options.subscriptions)
+        except ValueError, e:
+            parser.error(str(e))
+        node = None
+        if options.gossip_key_file:
+            if not options.daemon:
+                parser.error('--gossip-key-file needs --daemon.')
+            import gossip
+            node = gossip.Node(gossip.read_key(options.gossip_key_file),
+                    peers=options.gossip_peers and
+                        options.gossip_peers.split(','),
+                    port=options.gossip_port)
+            node.serve()
+        update = updater.Updater(subscription, options.snapshot_cache,
+                options.generations, node)
 
         if not options.daemon:
             update.do_update(db, options.dry_run, options.legacy)
@@ -202,12 +383,17 @@ def main():
                 try:
                     update.do_update(db, options.dry_run, options.legacy)
                 except pymongo.errors.AutoReconnect:
-                    logging.error('Unable to connect to database %s:%s. '
-                        'Sleeping.' % (mserver, str(mport)))
+                    log.error('Unable to connect to database %s:%s. '
+                        'Sleeping.', mserver, mport)
+                write_metrics(options.metrics_textfile)
 
                 time.sleep(60)
 
-    db_disconnect(conn)
+    write_metrics(options.metrics_textfile)
+    if options.profile_slow_ms is not None:
+        db.profiler.log_summary()
+    if conn is not None:
+        db_disconnect(conn)
 
 if __name__ == '__main__':
     main()
@@ -10,35 +10,266 @@ that the data on this server are up-to-date with EC2 running instances.
 This module is meant to be run as a daemon -- most likely controlled through
 supervisord.
 """
+import collections
 import os
 import datetime
 import logging
 import time
 
 import aerostat
+import events
+import logs
+import masters
+import metrics
+import reconciler
+import storage
 from _version import __version__
-import yaml
 
-from boto.ec2.connection import EC2Connection
 from optparse import OptionParser
 
+# yaml and boto are imported where they are used; --offline runs never need
+# boto at all.
+
 
 logging.basicConfig(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         level=logging.INFO
     )
 
+log = logs.get_logger('server')
+
+
+RECONCILE_SECONDS = metrics.histogram(
+        'aerostatd_reconcile_seconds', 'Time taken by a reconcile sweep.')
+AWS_FETCH_SECONDS = metrics.histogram('aerostatd_aws_fetch_seconds',
+        'Time taken to list the instances in a target.', ['target'])
+AWS_FETCH_FAILURES = metrics.counter('aerostatd_aws_fetch_failures_total',
+        'Target listings that failed or timed out.', ['target'])
+AWS_INSTANCES = metrics.gauge('aerostatd_aws_instances',
+        'Running instances found in a target.', ['target'])
+MONGO_OP_SECONDS = metrics.histogram('aerostatd_mongo_op_seconds',
+        'Time taken by aerostatd\'s Mongo reads and writes.', ['op'])
+CHANGES = metrics.counter('aerostatd_changes_total',
+        'Changes written to Mongo.', ['kind', 'source'])
+EVENTS = metrics.counter(
+        'aerostatd_events_total', 'Instance state-change events received.')
+
+# DescribeInstances accepts between 5 and 1000 results per page.
+DEFAULT_EC2_PAGE_SIZE = 1000
+
+# Seconds a target may take to list its instances, per cycle.
+DEFAULT_EC2_TIMEOUT = 30
+
+# Targets fetched at the same time.
+DEFAULT_EC2_WORKERS = 8
+
+# Seconds between inventory sweeps. With an event source configured, the sweep
+# is only a safety net and backs off towards the maximum while events keep it
+# up to date.
+DEFAULT_SWEEP_INTERVAL = 60
+DEFAULT_SWEEP_MAX_INTERVAL = 600
+
+# With coordination, how often (in sweeps) the leader reconciles every target.
+DEFAULT_GLOBAL_SWEEP_EVERY = 10
+
+# How often (in sweeps) tombstones are compacted.
+DEFAULT_COMPACT_EVERY = 60
+
+# How often (in sweeps) the masters view is checked against servers.
+DEFAULT_MASTERS_REBUILD_EVERY = 10
+
+# How often (in sweeps) the profiler's query totals are logged.
+DEFAULT_PROFILE_SUMMARY_EVERY = 60
+
+# Instance states fetched from EC2 by default. Stopped instances count as
+# present, so they keep their names and their new ips are picked up when
+# they start again.
+DEFAULT_EC2_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+# Event states that mean an instance's name should be freed. Stopped
+# instances keep theirs (see DEFAULT_EC2_STATES).
+TERMINATED_STATES = frozenset(['shutting-down', 'terminated'])
+
+# Instance ids cleared per multi-document update.
+DEFAULT_MONGO_BATCH_SIZE = 500
+
+# Config sections for features built on Mongo collections other than servers.
+MONGO_ONLY_SECTIONS = ('profile', 'coordination', 'name_pool', 'generations')
+
+# The only instance attributes aerostatd needs from EC2.
+AwsInstance = collections.namedtuple('AwsInstance', 'id ip state tags')
+
 
 class Aerostatd(object):
 
     def __init__(self, offline=False):
         self.offline = offline
-        if not self.offline:
-            self.aws_conn = self.aws_connect()
+        self.conf = {}
+        self.read_aerostatd_conf()
+
+        self.targets = self.get_targets()
+        self.aws_conns = {}
+        # instance_id -> name of the target it was last seen running in.
+        self.instance_targets = {}
+        self.pool = None
+        self.in_flight = {}
+        self.reconciler = reconciler.Reconciler(self.conf.get(
+                'mongo_full_sync_every', reconciler.DEFAULT_FULL_SYNC_EVERY))
+        self.event_source = events.get_event_source(self.conf.get('events'))
+        self.coordinator = None
+        self.pool_filler = None
+        self.compactor = None
+        self.masters = None
+        self.publisher = None
+        self.metrics_server = None
+        if (self.conf.get('metrics') or {}).get('port'):
+            self.metrics_server = metrics.REGISTRY.serve(
+                    self.conf['metrics']['port'],
+                    self.conf['metrics'].get('host', '127.0.0.1'))
+        self.sweep_interval = self.conf.get(
+                'sweep_interval', DEFAULT_SWEEP_INTERVAL)
+        self.next_sweep = 0
+        self.sweeps = 0
+
+        if not self.offline and self.conf.get('storage'):
+            self.aerostat_db = self.get_storage()
+        elif not self.offline:
             self.mongo_conn = aerostat.db_connect('localhost', 27017)
             self.aerostat_db = self.mongo_conn.aerostat
+            if self.conf.get('profile'):
+                self.aerostat_db = self.get_profiled_db(self.aerostat_db)
+            self.masters = masters.Masters(self.aerostat_db)
+            self.ensure_indexes()
+            # Catch up with writes made while no aerostatd was running.
+            self.masters.rebuild()
+            if self.conf.get('coordination'):
+                self.coordinator = self.get_coordinator()
+            if self.conf.get('name_pool'):
+                self.pool_filler = self.get_pool_filler()
+                self.pool_filler.start()
+            self.compactor = self.get_compactor()
+            if self.conf.get('generations'):
+                self.publisher = self.get_publisher()
+
+    def get_storage(self):
+        """Open the non-Mongo storage named by 'storage', e.g. sqlite:///path.
+
+        Sections for features that need Mongo are dropped, with a warning.
+        """
+        for section in MONGO_ONLY_SECTIONS:
+            if self.conf.get(section):
+                log.warning('Ignoring %s: it needs Mongo storage.', section)
+                del self.conf[section]
+
+        return storage.open_storage(self.conf['storage'])
+
+    def ensure_indexes(self):
+        """Create the indexes aerostatd's and its clients' queries rely on."""
+        self.aerostat_db.servers.ensure_index('instance_id')
+        # For clients that subscribe to a few services or aliases.
+        self.aerostat_db.servers.ensure_index('service')
+        self.aerostat_db.servers.ensure_index('aliases')
+        self.masters.ensure_indexes()
+
+    def get_profiled_db(self, db):
+        """Wrap db in the profiler described by the 'profile' section."""
+        import profiler
+
+        conf = self.conf['profile']
+
+        return profiler.profile(db,
+                sample_rate=conf.get('sample_rate',
+                    profiler.DEFAULT_SAMPLE_RATE),
+                slow_ms=conf.get('slow_ms', profiler.DEFAULT_SLOW_MS),
+                slow_log=conf.get('slow_log'))
+
+    def get_coordinator(self):
+        """Join the replica set described by the 'coordination' section."""
+        import coordinator
+
+        conf = self.conf['coordination']
+        coord = coordinator.Coordinator(self.aerostat_db,
+                replica_id=conf.get('replica_id'),
+                lease_seconds=conf.get('lease_seconds',
+                    coordinator.DEFAULT_LEASE_SECONDS))
+        coord.ensure_indexes()
+
+        return coord
+
+    def get_pool_filler(self):
+        """Set up name pools as described by the 'name_pool' section.
+
+        Pools are only filled by the leader when replicas are coordinated.
+        """
+        import namepool
 
-        self.read_aerostatd_conf()
+        conf = self.conf['name_pool']
+        pool = namepool.NamePool(self.aerostat_db,
+                size=conf.get('size', namepool.DEFAULT_POOL_SIZE),
+                claim_ttl=conf.get('claim_ttl', namepool.DEFAULT_CLAIM_TTL))
+        pool.ensure_indexes()
+
+        return namepool.PoolFiller(pool,
+                interval=conf.get('refill_interval',
+                    namepool.DEFAULT_REFILL_INTERVAL),
+                active=lambda: self.coordinator is None or
+                    self.coordinator.leader)
+
+    def get_compactor(self):
+        """Set up tombstone compaction from the 'compaction' section."""
+        import compactor
+
+        conf = self.conf.get('compaction') or {}
+        comp = compactor.Compactor(self.aerostat_db,
+                history_ttl=conf.get('history_ttl',
+                    compactor.DEFAULT_HISTORY_TTL),
+                batch_size=self.conf.get('mongo_batch_size',
+                    DEFAULT_MONGO_BATCH_SIZE))
+        comp.ensure_indexes()
+
+        return comp
+
+    def get_publisher(self):
+        """Publish server set generations as the 'generations' section says."""
+        import generations
+
+        conf = self.conf['generations']
+
+        key = None
+        if conf.get('key_file'):
+            import gossip
+            key = gossip.read_key(conf['key_file'])
+
+        return generations.Publisher(self.aerostat_db,
+                keep=conf.get('keep', generations.DEFAULT_KEEP_GENERATIONS),
+                compression=conf.get('compression', 'zlib'), key=key)
+
+    def publish(self, instance_ids=None):
+        """Publish a new generation if this replica is the one to do it.
+
+        Args:
+            instance_ids: iterable of str, the only instances that changed,
+            e.g. in a batch of events; None compares every server.
+        """
+        if self.publisher is None or self.offline:
+            return None
+        if self.coordinator is not None and not self.coordinator.leader:
+            return None
+
+        return self.publisher.publish(instance_ids)
+
+    def compact(self, dry_run=False):
+        """Archive unneeded tombstones and refresh the affected name pools.
+
+        Returns:
+            dict, the compaction report.
+        """
+        report = self.compactor.compact(dry_run)
+        if self.pool_filler is not None and not dry_run:
+            self.pool_filler.mark_dirty([service for service, (kept, archived)
+                    in report['services'].iteritems() if archived])
+
+        return report
 
     def read_aerostatd_conf(self):
         """Read data in from aerostat.conf, if it exists, and update values.
@@ -51,9 +282,11 @@ class Aerostatd(object):
         conf_path = os.environ.get('AEROSTATD_CONF', '/etc/aerostatd.conf')
         conf = None
         if not os.path.exists(conf_path):
-            logging.warn('No aerostatd.conf to read, using defaults.')
+            log.warn('No aerostatd.conf to read, using defaults.')
             return False
 
+        import yaml
+
         try:
             conf_file = open(conf_path, 'r')
             conf = yaml.load(conf_file.read())
@@ -63,6 +296,7 @@ class Aerostatd(object):
             return False
 
         #TODO(gavin): read out mongo connection, port information.
+        self.conf = conf or {}
 
         return True
 
@@ -83,70 +317,627 @@ class Aerostatd(object):
 
         return key_id, key_sec, keypair_name
 
-    def aws_connect(self):
-        """Return connection cursor from EC2."""
+    def get_targets(self):
+        """Build the list of (account, region) targets to reconcile.
 
-        key_id, key_sec, keypair_name = self._read_creds()
-        return EC2Connection(key_id, key_sec)
+        Targets come from the 'targets' list in aerostatd.conf. Each entry may
+        set account, region, endpoint, port, is_secure, creds (path to a
+        credentials file), timeout, page_size and states; anything unset falls
+        back to the top level ec2_* values. Without a 'targets' list there is a
+        single target built from the top level values.
+
+        Returns:
+            list of dict, one per target, each with a unique 'name'.
+        Raises:
+            ValueError: if two targets have the same name.
+        """
+        defaults = {
+            'region': self.conf.get('ec2_region'),
+            'endpoint': self.conf.get('ec2_endpoint'),
+            'port': self.conf.get('ec2_port'),
+            'is_secure': self.conf.get('ec2_is_secure'),
+            'creds': self.conf.get('ec2_creds'),
+            'timeout': self.conf.get('ec2_timeout', DEFAULT_EC2_TIMEOUT),
+            'page_size': self.conf.get('ec2_page_size', DEFAULT_EC2_PAGE_SIZE),
+            'states': self.conf.get('ec2_states', DEFAULT_EC2_STATES),
+        }
+
+        targets = []
+        for entry in self.conf.get('targets') or [{'name': 'default'}]:
+            target = dict(defaults)
+            target.update(entry)
+            if not target.get('name'):
+                target['name'] = '%s/%s' % (
+                        target.get('account') or 'default',
+                        target.get('region') or 'default')
+            if target['name'] in [known['name'] for known in targets]:
+                # Names key failures and instance ownership.
+                raise ValueError('Target name %r is used twice in '
+                        'aerostatd.conf.' % target['name'])
+            targets.append(target)
+
+        return targets
+
+    def aws_connect(self, target=None):
+        """Return connection cursor from EC2.
+
+        Args:
+            target: dict, as returned by get_targets; defaults to the first
+            target. Its region, endpoint, port and is_secure override the
+            defaults, e.g. to point at a local fake EC2 service for testing.
+        """
+        from boto.ec2.connection import EC2Connection
+        from boto.ec2.regioninfo import RegionInfo
+
+        target = target or self.targets[0]
+        key_id, key_sec, keypair_name = self._read_creds(target.get('creds'))
+        kwargs = {}
+        if target.get('region') or target.get('endpoint'):
+            kwargs['region'] = RegionInfo(
+                    name=target.get('region') or 'us-east-1',
+                    endpoint=target.get('endpoint') or
+                        'ec2.%s.amazonaws.com' % target['region'])
+        if target.get('port') is not None:
+            kwargs['port'] = int(target['port'])
+        if target.get('is_secure') is not None:
+            kwargs['is_secure'] = bool(target['is_secure'])
+
+        return EC2Connection(key_id, key_sec, **kwargs)
+
+    def get_aws_conn(self, target):
+        """Return the (cached) EC2 connection for a target."""
+        if target['name'] not in self.aws_conns:
+            self.aws_conns[target['name']] = self.aws_connect(target)
+
+        return self.aws_conns[target['name']]
 
     def get_mongo_instance_ids(self):
         """Return a list of instance_ids that mongo knows about."""
 
-        return [result['instance_id'] for result in self.aerostat_db.servers.find()]
+        return storage.get(self.aerostat_db).instance_ids()
+
+    def get_mongo_instances(self, instance_ids=None):
+        """Yield (instance_id, ip) for registered instances.
+
+        Args:
+            instance_ids: list of str, only look these ids up; by default every
+            document with an instance attached is read.
+        Yields:
+            tuple of (str, str), instance id and ip.
+        """
+        return storage.get(self.aerostat_db).instances(instance_ids,
+                self.conf.get('mongo_batch_size', DEFAULT_MONGO_BATCH_SIZE))
+
+    def iter_aws_pages(self, conn, states=None, page_size=None):
+        """Stream instances from EC2, one page of reservations at a time.
+
+        Filtering on state happens server side, and each boto instance is cut
+        down to an AwsInstance as soon as its page arrives, so only one page of
+        full boto objects is held in memory at a time.
+
+        Args:
+            conn: boto EC2Connection to fetch from.
+            states: list of str, instance states to fetch; defaults to
+            ec2_states from aerostatd.conf, or DEFAULT_EC2_STATES.
+            page_size: int, instances per DescribeInstances call; defaults to
+            ec2_page_size from aerostatd.conf.
+        Yields:
+            list of AwsInstance, one per instance in a matching state, a page
+            at a time.
+        """
+        states = states or self.conf.get('ec2_states', DEFAULT_EC2_STATES)
+        page_size = page_size or self.conf.get(
+                'ec2_page_size', DEFAULT_EC2_PAGE_SIZE)
+
+        next_token = None
+        pages = 0
+        while True:
+            reservations = conn.get_all_reservations(
+                    filters={'instance-state-name': states},
+                    max_results=page_size, next_token=next_token)
+            pages += 1
+            yield [AwsInstance(instance.id, instance.private_ip_address,
+                               instance.state, instance.tags)
+                   for reservation in reservations
+                   for instance in reservation.instances]
+
+            next_token = getattr(reservations, 'next_token', None)
+            if not next_token:
+                break
+
+        log.debug('Fetched %s pages of instances from EC2.', pages)
+
+    def iter_aws_instances(self, conn, states=None, page_size=None):
+        """Stream instances from EC2; see iter_aws_pages.
+
+        Yields:
+            AwsInstance, one per instance in a matching state.
+        """
+        for page in self.iter_aws_pages(conn, states, page_size):
+            for instance in page:
+                yield instance
+
+    def fetch_target(self, target):
+        """Stream the instances running in a single target.
+
+        Yields:
+            list of AwsInstance, a page at a time (see iter_aws_pages).
+        """
+        with AWS_FETCH_SECONDS.time(target=target['name']):
+            conn = self.get_aws_conn(target)
+            for page in self.iter_aws_pages(
+                    conn, target['states'], target['page_size']):
+                yield page
+
+    def stream_target(self, target, pages):
+        """Put a target's pages on a queue as they arrive, in a worker.
+
+        Each page goes on as (name, page, None), followed by (name, None,
+        None) once the target is done or (name, None, error) if it failed.
+        """
+        try:
+            for page in self.fetch_target(target):
+                pages.put((target['name'], page, None))
+        except Exception, e:
+            pages.put((target['name'], None, e))
+            return
+        pages.put((target['name'], None, None))
+
+    def fetch_targets(self, targets=None):
+        """Fetch every target concurrently in a bounded worker pool.
+
+        Pages are merged into the inventory as they arrive from any target,
+        so the merge keeps pace with the fetch rather than waiting for the
+        last page of the slowest target. Each target has its own timeout,
+        counted from the start of the cycle, and its own error handling: a
+        target that fails or times out is reported in the second return value
+        and does not hold up the others. The pages it did send are still
+        merged (those instances are running), but its instances aren't
+        recorded as its own. A target whose fetch from a previous cycle is
+        still running is not started again.
+
+        Args:
+            targets: list of dict, targets to fetch; defaults to all of them.
+        Returns:
+            tuple of (dict of instance_id -> (ip, state), running instances
+            seen this cycle; set of str, names of targets that failed).
+        """
+        from multiprocessing.pool import ThreadPool
+        import Queue
+
+        if self.pool is None:
+            self.pool = ThreadPool(min(len(self.targets), self.conf.get(
+                    'ec2_workers', DEFAULT_EC2_WORKERS)))
+
+        start = time.time()
+        failed = set()
+        # A fresh queue per cycle: a timed out worker can't leak into the next.
+        pages = Queue.Queue()
+        # name -> deadline, for targets still sending pages.
+        deadlines = {}
+        # name -> ids seen in the target so far.
+        seen = {}
+        if targets is None:
+            targets = self.targets
+        for target in targets:
+            previous = self.in_flight.get(target['name'])
+            if previous is not None and not previous.ready():
+                log.error('Target %s is still fetching from a previous '
+                        'cycle; skipping it.', target['name'])
+                AWS_FETCH_FAILURES.inc(target=target['name'])
+                failed.add(target['name'])
+                continue
+            self.in_flight[target['name']] = self.pool.apply_async(
+                    self.stream_target, (target, pages))
+            deadlines[target['name']] = start + target['timeout']
+            seen[target['name']] = []
+
+        aws = {}
+        while deadlines:
+            try:
+                name, page, error = pages.get(
+                        timeout=max(min(deadlines.values()) - time.time(), 0))
+            except Queue.Empty:
+                name, page, error = None, None, None
+            now = time.time()
+            for late in [late for late, deadline in deadlines.iteritems()
+                         if deadline <= now and late != name]:
+                log.error('Fetching instances from %s timed out.', late)
+                AWS_FETCH_FAILURES.inc(target=late)
+                failed.add(late)
+                del deadlines[late]
+            if name not in deadlines:
+                continue
+
+            if error is not None:
+                log.error('Fetching instances from %s failed: %r',
+                        name, error)
+                AWS_FETCH_FAILURES.inc(target=name)
+                failed.add(name)
+                del deadlines[name]
+            elif page is not None:
+                for instance in page:
+                    aws[instance.id] = (instance.ip, instance.state)
+                seen[name].extend(instance.id for instance in page)
+            else:
+                del deadlines[name]
+                log.info('Fetched %s instances from %s in %.2fs.',
+                        len(seen[name]), name, now - start)
+                AWS_INSTANCES.set(len(seen[name]), target=name)
+                self.forget_target(name)
+                for instance_id in seen[name]:
+                    self.instance_targets[instance_id] = name
+
+        return aws, failed
+
+    def forget_target(self, name):
+        """Drop what we know about which instances run in a target."""
+        for instance_id, target_name in self.instance_targets.items():
+            if target_name == name:
+                del self.instance_targets[instance_id]
 
     def get_aws_instance_ids(self):
         """Return a list of instance_ids that EC2 knows about, and are running."""
-        aws_reqs = self.aws_conn.get_all_instances()
-        instances = []
-        [instances.extend(req.instances) for req in aws_reqs]
-        instance_ids = []
-        for instance in instances:
-            if instance.state == 'running':
-                instance_ids.append(instance.id)
 
-        return instance_ids
+        return self.fetch_targets()[0].keys()
 
-    def get_mongo_aws_diff(self, mongo_ids, aws_ids):
-        """Calculate the difference between Amazon and Aerostat's instances."""
-        mongo_ids = set(mongo_ids)
-        aws_ids = set(aws_ids)
+    def get_mongo_aws_diff(self, mongo_ids, aws_ids, failed_targets=None):
+        """Calculate the difference between Amazon and Aerostat's instances.
 
-        return mongo_ids - aws_ids
+        aws_ids may be any iterable of ids, such as the dict fetch_targets
+        returns; it is walked once and never copied.
+
+        When some targets failed, an id missing from aws_ids may only be
+        missing because its target could not be asked. Such ids are kept out
+        of the diff unless they were last seen in a target that answered.
+
+        Args:
+            mongo_ids: iterable of str, instance ids Aerostat knows about.
+            aws_ids: iterable of str, instance ids running in EC2.
+            failed_targets: set of str, names of targets that failed this cycle.
+        Returns:
+            set of str, instance ids that are no longer running.
+        """
+        diff = set(mongo_ids)
+        for aws_id in aws_ids:
+            diff.discard(aws_id)
+
+        if failed_targets:
+            unverified = set(instance_id for instance_id in diff
+                    if self.instance_targets.get(instance_id) in
+                        failed_targets or
+                    instance_id not in self.instance_targets)
+            if unverified:
+                log.warn('Holding back %s ids that may belong to failed '
+                        'targets %s.', len(unverified),
+                            ', '.join(sorted(failed_targets)))
+            diff -= unverified
+
+        for instance_id in diff:
+            self.instance_targets.pop(instance_id, None)
+
+        return diff
 
     def update_mongo(self, diff_ids):
         """Remove diff_ids from mongodb.
 
+        Ids are blanked with one multi-document $in update per batch rather
+        than one round trip per id. Batch size comes from mongo_batch_size
+        in aerostatd.conf, and mongo_write_concern (e.g. {w: 1, wtimeout:
+        5000}) is passed through to every update.
+
         Args:
             diff_ids: list of str, ids which differ between aerostat and aws.
+        Returns:
+            list of (int, int, float) tuples, one per batch: ids sent, documents
+            updated (None when writes are unacknowledged) and seconds taken.
         """
-        for diff_id in diff_ids:
+        # Empty ids are hostnames already waiting for reuse; nothing to clear.
+        diff_ids = sorted(diff_id for diff_id in diff_ids if diff_id)
+        batch_size = self.conf.get('mongo_batch_size', DEFAULT_MONGO_BATCH_SIZE)
+        write_concern = self.conf.get('mongo_write_concern') or {}
+
+        batches = []
+        for i in range(0, len(diff_ids), batch_size):
+            batch = diff_ids[i:i + batch_size]
+            if self.pool_filler is not None:
+                # These services get gaps; their pools need re-ranking.
+                self.pool_filler.mark_dirty(
+                        storage.get(self.aerostat_db).services_of(batch))
+            start = time.time()
             # Just remove the instance_id field. We'll save the hostname for later.
-            self.aerostat_db.servers.update(
-                    {'instance_id': diff_id}, {
-                        '$set':{'instance_id': '', 'ip': ''}})
+            updated = storage.get(self.aerostat_db).clear_instances(
+                    batch, write_concern)
+            elapsed = time.time() - start
+            MONGO_OP_SECONDS.observe(elapsed, op='clear_instances')
+            log.info('Cleared batch of %s ids (%s documents) in %.1fms.',
+                    len(batch), updated, elapsed * 1000)
+            batches.append((len(batch), updated, elapsed))
+
+        return batches
+
+    def update_ips(self, ip_changes):
+        """Write new private ips for instances that moved.
+
+        Args:
+            ip_changes: dict of instance_id -> ip.
+        Returns:
+            list of (int, float) tuples, one per batch: updates sent and
+            seconds taken.
+        """
+        batch_size = self.conf.get('mongo_batch_size', DEFAULT_MONGO_BATCH_SIZE)
+        write_concern = self.conf.get('mongo_write_concern') or {}
+        changes = sorted(ip_changes.items())
+
+        batches = []
+        for i in range(0, len(changes), batch_size):
+            start = time.time()
+            storage.get(self.aerostat_db).update_ips(
+                    dict(changes[i:i + batch_size]), write_concern)
+            elapsed = time.time() - start
+            MONGO_OP_SECONDS.observe(elapsed, op='update_ips')
+            count = len(changes[i:i + batch_size])
+            log.info('Updated %s ips in %.1fms.', count, elapsed * 1000)
+            batches.append((count, elapsed))
+
+        return batches
+
+    def reconcile(self, targets=None):
+        """Run one reconcile cycle, writing only what changed.
+
+        EC2 is always listed in full, but Mongo is only read in full every
+        mongo_full_sync_every cycles. In between, only instances that are new
+        or changed in EC2 are looked up, so Mongo reads and the comparison
+        work follow churn rather than fleet size.
+
+        Args:
+            targets: list of dict, the targets this replica should reconcile;
+            defaults to all of them. Instances that may belong to the other
+            targets are left alone, just as if those targets had failed.
+        Returns:
+            tuple of (set of str, ids blanked; dict of instance_id -> ip, ips
+            updated).
+        """
+        if targets is None:
+            targets = self.targets
+        if not targets:
+            return set(), {}
+
+        with RECONCILE_SECONDS.time():
+            removed, ip_changes = self._reconcile(targets)
+        CHANGES.inc(len(removed), kind='removed', source='sweep')
+        CHANGES.inc(len(ip_changes), kind='ip_changed', source='sweep')
+
+        return removed, ip_changes
+
+    def _reconcile(self, targets):
+        """reconcile, without the timing."""
+        rec = self.reconciler
+        aws, failed = self.fetch_targets(targets)
+        failed.update(set(target['name'] for target in self.targets) -
+                      set(target['name'] for target in targets))
+
+        if rec.needs_full_sync():
+            with MONGO_OP_SECONDS.time(op='read_all'):
+                rec.load_mongo(self.get_mongo_instances(), full=True)
+            checked_ids = None
+        else:
+            checked_ids = rec.changed_aws_ids(aws)
+            with MONGO_OP_SECONDS.time(op='read_changed'):
+                rec.load_mongo(self.get_mongo_instances(checked_ids))
+
+        gone, ip_changes = rec.plan(aws, checked_ids)
+        removed = self.get_mongo_aws_diff(gone, aws, failed)
+
+        if removed:
+            self.update_mongo(removed)
+        if ip_changes:
+            self.update_ips(ip_changes)
+        rec.commit(aws, removed, ip_changes)
+        log.info('Reconciled %s instances: %s removed, %s ips changed.',
+                len(aws), len(removed), len(ip_changes))
+
+        return removed, ip_changes
+
+    def apply_events(self, state_changes):
+        """Apply instance state-change events straight away.
+
+        Instances that are terminating are blanked; running instances whose
+        ip differs from what Aerostat has get their ip rewritten. Stopping
+        and stopped instances keep their names and are only noted, so their
+        new ip is written when they run again. Pending is left to the sweep.
+        Only the last event per instance counts.
+
+        Args:
+            state_changes: list of events.StateChange.
+        Returns:
+            tuple of (set of str, ids blanked; dict of instance_id -> ip, ips
+            updated).
+        """
+        rec = self.reconciler
+        latest = {}
+        for change in state_changes:
+            latest[change.instance_id] = change
+
+        aws_changes = {}
+        removed = set()
+        ip_changes = {}
+        for instance_id, change in latest.iteritems():
+            if change.state == 'running':
+                aws_changes[instance_id] = (change.ip, change.state)
+                if change.ip and rec.mongo.get(instance_id) not in (
+                        None, change.ip):
+                    ip_changes[instance_id] = change.ip
+            elif change.state in ('stopping', 'stopped'):
+                aws_changes[instance_id] = (change.ip, change.state)
+            elif change.state in TERMINATED_STATES:
+                aws_changes[instance_id] = None
+                removed.add(instance_id)
+                self.instance_targets.pop(instance_id, None)
+
+        if removed:
+            self.update_mongo(removed)
+        if ip_changes:
+            self.update_ips(ip_changes)
+        rec.patch(aws_changes, removed, ip_changes)
+        EVENTS.inc(len(state_changes))
+        CHANGES.inc(len(removed), kind='removed', source='event')
+        CHANGES.inc(len(ip_changes), kind='ip_changed', source='event')
+        log.info('Applied %s events: %s removed, %s ips changed.',
+                len(state_changes), len(removed), len(ip_changes))
+
+        return removed, ip_changes
+
+    def next_sweep_interval(self, interval, missed):
+        """Adapt the time until the next sweep.
+
+        Without an event source the sweep runs at a fixed interval. With one,
+        a sweep that finds nothing the events hadn't already delivered backs
+        the interval off, while a sweep that has to fix things up halves it.
+
+        Args:
+            interval: float, seconds used for the last sweep.
+            missed: int, changes the last sweep made.
+        Returns:
+            float, seconds until the next sweep.
+        """
+        low = self.conf.get('sweep_interval', DEFAULT_SWEEP_INTERVAL)
+        if self.event_source is None:
+            return low
+        high = self.conf.get('sweep_max_interval', DEFAULT_SWEEP_MAX_INTERVAL)
+
+        if missed:
+            return max(low, interval / 2.0)
+        return min(high, interval * 1.5)
+
+    def sweep_targets(self, sweeps):
+        """Choose the targets this replica reconciles on a given sweep.
+
+        Without coordination that is every target. With it, targets are
+        shared out among live replicas, and every global_sweep_every sweeps
+        the leader reconciles all of them, so that instances no replica could
+        vouch for (e.g. never seen in any target) are still cleared.
+
+        Args:
+            sweeps: int, number of sweeps this replica has run so far.
+        Returns:
+            list of dict, targets to reconcile.
+        """
+        if self.coordinator is None:
+            return self.targets
+
+        every = self.conf['coordination'].get(
+                'global_sweep_every', DEFAULT_GLOBAL_SWEEP_EVERY)
+        if self.coordinator.leader and sweeps % every == 0:
+            return self.targets
+
+        owned = set(self.coordinator.assign(
+                [target['name'] for target in self.targets]))
+        return [target for target in self.targets if target['name'] in owned]
+
+    def run(self):
+        """Apply events as they come and sweep the inventory now and then."""
+        try:
+            while 1:
+                self.run_once()
+        finally:
+            if self.coordinator is not None:
+                self.coordinator.resign()
+
+    def run_once(self):
+        """One pass of run(): heartbeat, sweep if due, then wait for events."""
+        if self.coordinator is not None:
+            self.coordinator.heartbeat()
+            self.coordinator.acquire_leadership()
+
+        if time.time() >= self.next_sweep:
+            if not self.offline:
+                removed, ip_changes = self.reconcile(
+                        self.sweep_targets(self.sweeps))
+                self.sweep_interval = self.next_sweep_interval(
+                        self.sweep_interval, len(removed) + len(ip_changes))
+            self.sweeps += 1
+            self.next_sweep = time.time() + self.sweep_interval
+
+            every = (self.conf.get('compaction') or {}).get(
+                    'every', DEFAULT_COMPACT_EVERY)
+            if (self.compactor is not None and self.sweeps % every == 0 and
+                    (self.coordinator is None or self.coordinator.leader)):
+                self.compact()
+
+            # Catch writes to servers that bypassed storage while running.
+            every = self.conf.get('masters_rebuild_every',
+                    DEFAULT_MASTERS_REBUILD_EVERY)
+            if (self.masters is not None and self.sweeps % every == 0 and
+                    (self.coordinator is None or self.coordinator.leader)):
+                self.masters.rebuild()
+
+            self.publish()
+
+            profile = self.conf.get('profile') or {}
+            if profile and not self.offline and self.sweeps % profile.get(
+                    'summary_every', DEFAULT_PROFILE_SUMMARY_EVERY) == 0:
+                self.aerostat_db.profiler.log_summary(reset=True)
+
+            if (self.conf.get('metrics') or {}).get('textfile'):
+                metrics.REGISTRY.write_textfile(
+                        self.conf['metrics']['textfile'])
+
+        wait = max(self.next_sweep - time.time(), 0)
+        if self.coordinator is not None:
+            # Heartbeat well before the lease runs out.
+            wait = min(wait, self.coordinator.lease_seconds / 3.0)
+
+        if self.event_source is None:
+            time.sleep(wait)
+            return
+
+        state_changes = self.event_source.poll(wait)
+        if state_changes and not self.offline:
+            try:
+                removed, ip_changes = self.apply_events(state_changes)
+            except Exception, e:
+                # The next sweep catches up on whatever this batch missed.
+                log.error('Unable to apply %s events: %r',
+                        len(state_changes), e)
+                return
+            if removed or ip_changes:
+                self.publish(set(removed) | set(ip_changes))
+
 
 def main():
     """Main."""
-    logging.info('Starting aerostatd %s' % __version__)
+    log.info('Starting aerostatd %s', __version__)
 
     usage = 'usage: %prog [options] arg1 arg2'
     parser = OptionParser(usage=usage)
     parser.add_option(
             '--offline', action='store_true', dest='offline', default=False,
             help='Run in offline mode (No AWS).')
+    parser.add_option(
+            '--compact', action='store_true', dest='compact', default=False,
+            help='Archive unneeded tombstones once and exit.')
+    parser.add_option(
+            '--dryrun', action='store_true', dest='dry_run', default=False,
+            help='With --compact, only report what would be archived.')
 
     (options, args) = parser.parse_args()
+    if options.compact and options.offline:
+        parser.error('--compact needs MongoDB; it cannot run --offline.')
 
     now = None
     run_time = None
-    aerostatd = Aerostatd(options.offline)
-    while 1:
-        mongo_ids = aerostatd.get_mongo_instance_ids()
-        if not options.offline:
-            aws_ids = aerostatd.get_aws_instance_ids()
-            diffs = aerostatd.get_mongo_aws_diff(mongo_ids, aws_ids)
-            aerostatd.update_mongo(diffs)
-        time.sleep(60)
+    try:
+        aerostatd = Aerostatd(options.offline)
+    except ValueError, e:
+        parser.error(str(e))
+    if options.compact:
+        if aerostatd.compactor is None:
+            parser.error('--compact needs MongoDB storage.')
+        aerostatd.compact(options.dry_run)
+        return
+
+    aerostatd.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""
+Compactor - Archive blanked server documents that are no longer useful.
+
+When an instance goes away aerostatd only blanks its instance_id and ip, so
+that the hostname can be reused. Gaps below a service's highest live hostname
+are worth keeping: Registrar fills them first. Everything else (tombstones
+above the high-water mark, and blanked documents that don't follow the naming
+scheme at all) just slows down every query on servers, so it is moved to the
+servers_history collection, where a TTL index expires it.
+"""
+
+import datetime
+
+import aerostat
+import logs
+
+log = logs.get_logger('compactor')
+
+
+# Seconds archived documents are kept in servers_history.
+DEFAULT_HISTORY_TTL = 30 * 24 * 3600
+
+# Documents moved per round trip.
+DEFAULT_BATCH_SIZE = 500
+
+
+class Compactor(object):
+    """Move unneeded tombstones from servers to servers_history."""
+
+    def __init__(self, db, history_ttl=DEFAULT_HISTORY_TTL,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        """Initialize object.
+
+        Args:
+            db: mongodb db reference.
+            history_ttl: int, seconds to keep archived documents.
+            batch_size: int, documents moved per round trip.
+        """
+        self.db = db
+        self.history_ttl = history_ttl
+        self.batch_size = batch_size
+
+    def ensure_indexes(self):
+        """Expire archived documents after history_ttl."""
+        self.db.servers_history.ensure_index(
+                'archived_at', expireAfterSeconds=self.history_ttl)
+
+    def high_water_marks(self):
+        """Return a dict of service -> highest position held by a live host."""
+        marks = {}
+        for result in self.db.servers.find(
+                {'instance_id': {'$ne': ''}}, {'service': 1, 'hostname': 1}):
+            number = aerostat.hostname_number(
+                    result.get('service'), result.get('hostname') or '')
+            if number is not None:
+                marks[result['service']] = max(
+                        marks.get(result['service'], -1), number)
+
+        return marks
+
+    def plan(self):
+        """Sort tombstones into gaps to keep and documents to archive.
+
+        Returns:
+            tuple of (list of ObjectId, documents to archive; dict of service
+            -> [kept, archived] counts).
+        """
+        marks = self.high_water_marks()
+        archive = []
+        counts = {}
+        for result in self.db.servers.find(
+                {'instance_id': ''}, {'service': 1, 'hostname': 1}):
+            service = result.get('service')
+            number = aerostat.hostname_number(
+                    service, result.get('hostname') or '')
+            keep = number is not None and number <= marks.get(service, -1)
+            tally = counts.setdefault(service, [0, 0])
+            if keep:
+                tally[0] += 1
+            else:
+                tally[1] += 1
+                archive.append(result['_id'])
+
+        return archive, counts
+
+    def compact(self, dry_run=False):
+        """Archive every tombstone that isn't a needed gap.
+
+        Args:
+            dry_run: bool, only report what would be archived.
+        Returns:
+            dict with 'kept' and 'archived' totals and per 'services' counts.
+        """
+        archive, counts = self.plan()
+        archived = 0
+        if not dry_run:
+            for i in range(0, len(archive), self.batch_size):
+                archived += self.archive(archive[i:i + self.batch_size])
+
+        report = {
+            'kept': sum(kept for kept, _ in counts.itervalues()),
+            'archived': dry_run and len(archive) or archived,
+            'services': counts,
+        }
+        log.info('%sCompaction kept %s gaps and archived %s documents.',
+                dry_run and 'DRY RUN: ' or '', report['kept'],
+                report['archived'])
+
+        return report
+
+    def archive(self, ids):
+        """Copy documents to servers_history, then remove them from servers.
+
+        Only documents that are still blank are removed, so a slot that gets
+        taken while we work is left where it is.
+
+        Returns:
+            int, number of documents removed from servers.
+        """
+        now = datetime.datetime.utcnow()
+        spec = {'_id': {'$in': ids}, 'instance_id': ''}
+        docs = list(self.db.servers.find(spec))
+        if not docs:
+            return 0
+        for doc in docs:
+            doc['server_id'] = doc.pop('_id')
+            doc['archived_at'] = now
+        self.db.servers_history.insert(docs, w=1)
+        result = self.db.servers.remove(spec, w=1)
+
+        return result and result.get('n', 0) or 0
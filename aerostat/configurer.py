@@ -0,0 +1,641 @@
+#!/usr/bin/env python
+
+"""
+Configurer - Render config files from templates and Aerostat data.
+
+Config definitions live in the configs collection of the configs database:
+
+    {'name': 'haproxy',
+     'path': '/etc/haproxy/haproxy.cfg',
+     'template': '...jinja2 source...',
+     'vars': {'port': 8080},
+     'reload': 'service haproxy reload'}
+
+Templates see Aerostat's data as 'aerostat' (members, masters, hostnames),
+the config's 'vars', and the config's 'name':
+
+    {% for host in aerostat.members('web') %}
+    server {{ host.hostname }} {{ host.ip }}:{{ vars.port }}
+    {% endfor %}
+
+Templates may instead live in a git repo (see repository), named by a
+'template_path' in place of 'template'. A template whose path hasn't changed
+in the repo since a config was last rendered isn't read again.
+
+Compiled templates are cached by a hash of their source, in memory and as
+bytecode on disk, so an unchanged template is never compiled twice.
+
+Every Aerostat lookup a template makes while rendering is recorded with a
+fingerprint of its result. On later runs only those lookups are repeated; a
+config is re-rendered when its template or one of their results has changed,
+written only when the output differs, and its reload command run only when it
+was written.
+
+A run is planned up front: the lookups recorded for every selected config are
+answered in one batched fetch, the stale configs are rendered concurrently by
+a small pool of threads, and their files are staged before any is renamed
+into place. A config whose file can't be written is reported and skipped;
+with atomic set, it stops the whole batch instead.
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import jinja2
+
+import aerostat
+import logs
+import metrics
+
+log = logs.get_logger('configurer')
+
+
+# Per-node record of what each config was last rendered from.
+DEFAULT_STATE_FILE = '/var/lib/aerostat/configs.json'
+
+# Compiled template bytecode, shared between runs.
+DEFAULT_CACHE_DIR = '/var/cache/aerostat/templates'
+
+# Configs rendered at once.
+DEFAULT_WORKERS = 4
+
+# Fields templates see for a server.
+FIELDS = {'hostname': 1, 'ip': 1, 'instance_id': 1, 'aliases': 1, '_id': 0}
+
+RENDER_SECONDS = metrics.histogram(
+        'aerostat_config_render_seconds', 'Time taken to render a config.')
+
+
+def content_hash(content):
+    """Return a hex digest identifying content."""
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+
+    return hashlib.sha1(content).hexdigest()
+
+
+def write_atomic(path, content, mode=None):
+    """Replace path with content, unless it already holds exactly that.
+
+    The new file is written beside the old one and renamed over it, so
+    readers never see a partial file.
+
+    Args:
+        path: str, file to write.
+        content: str, new contents.
+        mode: int, permissions for the file; defaults to the old file's.
+    Returns:
+        bool, whether the file was written.
+    """
+    tmp_path = stage(path, content, mode)
+    if tmp_path is None:
+        return False
+    os.rename(tmp_path, path)
+
+    return True
+
+
+def stage(path, content, mode=None):
+    """Write content beside path, ready to be renamed over it.
+
+    Args:
+        path: str, file to replace.
+        content: str, new contents.
+        mode: int, permissions for the file; defaults to the old file's.
+    Returns:
+        str, the staged file; or None if path already holds content.
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    try:
+        current = open(path, 'rb')
+        try:
+            if current.read() == content:
+                return None
+        finally:
+            current.close()
+        if mode is None:
+            mode = os.stat(path).st_mode & 0777
+    except (IOError, OSError):
+        pass
+
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(
+            prefix='.%s.' % os.path.basename(path), dir=directory)
+    try:
+        try:
+            os.write(fd, content)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.chmod(tmp_path, mode if mode is not None else 0644)
+    except:
+        os.remove(tmp_path)
+        raise
+
+    return tmp_path
+
+
+class HashLoader(jinja2.BaseLoader):
+    """Load templates registered under the hash of their source.
+
+    Naming templates by content lets jinja2's own caches (compiled templates
+    in memory, bytecode on disk) do the work: the same source always maps to
+    the same name, and a changed source to a new one.
+    """
+
+    def __init__(self):
+        self.sources = {}
+
+    def add(self, source):
+        name = content_hash(source)
+        self.sources[name] = source
+        return name
+
+    def get_source(self, environment, name):
+        if name not in self.sources:
+            raise jinja2.TemplateNotFound(name)
+        return self.sources[name], None, lambda: True
+
+
+class TemplateCache(object):
+    """Compile each distinct template source once."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        """Initialize object.
+
+        Args:
+            cache_dir: str, directory for compiled bytecode, or None to keep
+            compiled templates in memory only.
+        """
+        self.loader = HashLoader()
+        bytecode_cache = None
+        if cache_dir and (os.path.isdir(cache_dir) or self.make_dir(cache_dir)):
+            bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+        self.environment = jinja2.Environment(loader=self.loader,
+                bytecode_cache=bytecode_cache, auto_reload=False,
+                cache_size=-1, keep_trailing_newline=True)
+
+    @staticmethod
+    def make_dir(path):
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            log.warn('Not caching templates in %s: %s', path, e)
+            return False
+        return True
+
+    def get(self, source):
+        """Return the compiled template for source."""
+
+        return self.environment.get_template(self.loader.add(source))
+
+
+class AerostatData(object):
+    """What templates can ask about the fleet, as 'aerostat'."""
+
+    def __init__(self, db):
+        """Initialize object.
+
+        Args:
+            db: mongodb db reference for the aerostat database.
+        """
+        self.db = db
+
+    def members(self, service):
+        """Return the live servers in a service, sorted by hostname.
+
+        Returns:
+            list of dicts with hostname, ip, instance_id and aliases.
+        """
+        results = self.db.servers.find(
+                {'service': service, 'instance_id': {'$ne': ''}}, FIELDS)
+
+        return sorted(results, key=lambda result: result['hostname'])
+
+    def master(self, service):
+        """Return the master of a masterful service, or None."""
+        master_id = aerostat.get_master(self.db, service)
+        if not master_id:
+            return None
+
+        return self.db.servers.find_one({'instance_id': master_id}, FIELDS)
+
+    def hostname(self, instance_id):
+        """Return the hostname registered for an instance, or None."""
+
+        return aerostat.get_hostname(self.db, instance_id)
+
+    def prefetch(self, keys):
+        """Answer many lookups at once, with one query per kind of lookup.
+
+        Args:
+            keys: iterable of input keys, see input_key().
+        Returns:
+            dict of input key -> result, as the single lookups would return.
+        """
+        wanted = {}
+        for key in keys:
+            lookup = json.loads(key)
+            wanted.setdefault(lookup[0], set()).add(lookup[1])
+        results = {}
+
+        services = sorted(wanted.get('members', ()))
+        if services:
+            members = dict((service, []) for service in services)
+            fields = dict(FIELDS, service=1)
+            for result in self.db.servers.find({'service': {'$in': services},
+                    'instance_id': {'$ne': ''}}, fields):
+                members[result.pop('service')].append(result)
+            for service, servers in members.iteritems():
+                results[input_key('members', [service])] = sorted(
+                        servers, key=lambda server: server['hostname'])
+
+        services = sorted(wanted.get('master', ()))
+        if services:
+            # Masters come from get_master, as in master(), so both give the
+            # same answer; only the server lookups are batched.
+            master_ids = dict((service, aerostat.get_master(self.db, service))
+                              for service in services)
+            masters = {}
+            instance_ids = sorted(set(filter(None, master_ids.values())))
+            if instance_ids:
+                for result in self.db.servers.find(
+                        {'instance_id': {'$in': instance_ids}}, FIELDS):
+                    masters.setdefault(result['instance_id'], result)
+            for service in services:
+                results[input_key('master', [service])] = masters.get(
+                        master_ids[service])
+
+        instance_ids = sorted(wanted.get('hostname', ()))
+        if instance_ids:
+            hostnames = {}
+            for result in self.db.servers.find(
+                    {'instance_id': {'$in': instance_ids}},
+                    {'instance_id': 1, 'hostname': 1, '_id': 0}):
+                hostnames.setdefault(result['instance_id'], result['hostname'])
+            for instance_id in instance_ids:
+                results[input_key('hostname', [instance_id])] = hostnames.get(
+                        instance_id)
+
+        return results
+
+
+def input_key(method, args):
+    """Name a lookup, e.g. members('web'), so it can be stored and replayed."""
+
+    return json.dumps([method] + list(args))
+
+
+def result_hash(result):
+    """Fingerprint a lookup's result."""
+
+    return content_hash(json.dumps(result, sort_keys=True, default=str))
+
+
+class TrackingData(object):
+    """AerostatData for one render, recording every lookup made.
+
+    Lookups are shared through memo between all the configs in a run, so
+    templates asking the same question cost one query.
+    """
+
+    def __init__(self, data, memo):
+        """Initialize object.
+
+        Args:
+            data: AerostatData to answer lookups from.
+            memo: dict of input key -> (result, result hash) for this run.
+        """
+        self.data = data
+        self.memo = memo
+        # input key -> result hash, for each lookup this render made.
+        self.inputs = {}
+
+    def lookup(self, method, *args):
+        key = input_key(method, args)
+        if key not in self.memo:
+            result = getattr(self.data, method)(*args)
+            self.memo[key] = (result, result_hash(result))
+        result, digest = self.memo[key]
+        self.inputs[key] = digest
+
+        return result
+
+    def members(self, service):
+        return self.lookup('members', service)
+
+    def master(self, service):
+        return self.lookup('master', service)
+
+    def hostname(self, instance_id):
+        return self.lookup('hostname', instance_id)
+
+
+class Configurer(object):
+    """Render config files from templates stored in the configs database."""
+
+    def __init__(self, aerostat_db=None, state_file=DEFAULT_STATE_FILE,
+                 cache_dir=DEFAULT_CACHE_DIR, repository=None,
+                 workers=DEFAULT_WORKERS, atomic=False):
+        """Initialize object.
+
+        Args:
+            aerostat_db: mongodb db reference for the aerostat database.
+            state_file: str, where to remember what each config was last
+            rendered from.
+            cache_dir: str, directory for compiled template bytecode.
+            repository: repository.Repository, git repo holding the
+            templates that configs name by template_path, if any.
+            workers: int, configs to render at once.
+            atomic: bool, write no config at all if any one can't be written.
+        """
+        self.data = AerostatData(aerostat_db)
+        self.repository = repository
+        self.state_file = state_file
+        self.templates = TemplateCache(cache_dir)
+        self.workers = workers
+        self.atomic = atomic
+        self.state = None
+        # input key -> (result, result hash), reset every run.
+        self.memo = {}
+
+    def load_state(self):
+        """Read the record of previous renders, if there is one."""
+        try:
+            state_file = open(self.state_file, 'r')
+            try:
+                return json.load(state_file)
+            finally:
+                state_file.close()
+        except (IOError, ValueError):
+            return {}
+
+    def save_state(self):
+        directory = os.path.dirname(self.state_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        write_atomic(self.state_file, json.dumps(self.state, sort_keys=True))
+
+    def input_changed(self, key, digest):
+        """Repeat a recorded lookup and compare its result."""
+        if key not in self.memo:
+            method, args = json.loads(key)[0], json.loads(key)[1:]
+            result = getattr(self.data, method)(*args)
+            self.memo[key] = (result, result_hash(result))
+
+        return self.memo[key][1] != digest
+
+    def template_source(self, config):
+        """Return a config's template source, from the repo if need be.
+
+        Raises:
+            jinja2.TemplateNotFound: if the config has no template, or names
+            a template_path with no template repo to read it from.
+        """
+        if 'template' in config:
+            return config['template']
+        if self.repository is None or not config.get('template_path'):
+            raise jinja2.TemplateNotFound(config.get('template_path'),
+                    'Config %s has no template%s.' % (config.get('name'),
+                        config.get('template_path') and
+                        ' without --template-repo' or ''))
+
+        return self.repository.read(config['template_path'])
+
+    def template_hash(self, config, previous):
+        """Identify a config's template, without reading it if unchanged.
+
+        Args:
+            config: dict, the config definition.
+            previous: dict, the config's state from its last render.
+        """
+        template_path = config.get('template_path')
+        if ('template' not in config and self.repository is not None and
+                previous.get('template_path') == template_path):
+            changed = self.repository.changed_paths(previous.get('commit'))
+            if changed is not None and template_path not in changed:
+                return previous.get('template')
+
+        return content_hash(self.template_source(config))
+
+    def is_current(self, config, previous):
+        """Whether a config's last render still stands.
+
+        Only the lookups recorded for it are repeated, and the first changed
+        one ends the check.
+        """
+        if (previous.get('template') != self.template_hash(config, previous) or
+                previous.get('path') != config['path'] or
+                previous.get('vars') != content_hash(json.dumps(
+                    config.get('vars') or {}, sort_keys=True)) or
+                not os.path.exists(config['path'])):
+            return False
+        for key, digest in (previous.get('inputs') or {}).iteritems():
+            if self.input_changed(key, digest):
+                log.debug('Config %s depends on %s, which changed.',
+                        config['name'], key)
+                return False
+
+        return True
+
+    def render(self, config):
+        """Render a config's template, recording the lookups it makes.
+
+        Returns:
+            tuple of (str, the rendered file; dict of input key -> result
+            hash).
+        """
+        template = self.templates.get(self.template_source(config))
+        data = TrackingData(self.data, self.memo)
+        output = template.render(aerostat=data, name=config['name'],
+                vars=config.get('vars') or {})
+
+        return output, data.inputs
+
+    def do_update(self, conf_db, config_names=None, dry_run=False):
+        """Bring config files up to date.
+
+        Args:
+            conf_db: mongodb db reference for the configs database.
+            config_names: list of str, configs to update; all if empty.
+            dry_run: bool, only log what would be written.
+        Returns:
+            list of str, names of the configs written.
+        """
+        if self.repository is None:
+            return self.update_configs(conf_db, config_names, dry_run)
+        with self.repository.lock():
+            self.repository.sync()
+            return self.update_configs(conf_db, config_names, dry_run)
+
+    def update_configs(self, conf_db, config_names=None, dry_run=False):
+        spec = {}
+        if config_names:
+            spec = {'name': {'$in': config_names}}
+        self.state = self.load_state()
+
+        stale = self.plan(list(conf_db.configs.find(spec)))
+        rendered = self.render_all(stale)
+        if dry_run:
+            for config, output, _, _ in rendered:
+                log.info('DRY RUN: would write %s to %s:\n%s',
+                        config['name'], config['path'], output)
+            return [config['name'] for config, _, _, _ in rendered]
+
+        written = self.commit(rendered)
+        self.save_state()
+        self.reload(written)
+
+        return [config['name'] for config in written]
+
+    def plan(self, configs):
+        """Work out which configs need rendering.
+
+        The lookups recorded for all of the configs are answered up front in
+        one batched fetch, so checking them costs a query per kind of lookup
+        rather than one per template.
+
+        Returns:
+            list of dicts, the configs whose template or inputs changed.
+        """
+        self.memo = {}
+        keys = set()
+        for config in configs:
+            keys.update((self.state.get(config['name']) or {}).get(
+                    'inputs') or {})
+        if keys:
+            for key, result in self.data.prefetch(keys).iteritems():
+                self.memo[key] = (result, result_hash(result))
+
+        stale = []
+        for config in configs:
+            try:
+                if self.is_current(config, self.state.get(config['name']) or {}):
+                    log.debug('Config %s is up to date.', config['name'])
+                    continue
+            except (jinja2.TemplateError, IOError, OSError), e:
+                log.error('Unable to update config %s: %s',
+                        config.get('name'), e)
+                continue
+            stale.append(config)
+
+        return stale
+
+    def render_timed(self, config):
+        """Render a config, timing it.
+
+        Returns:
+            tuple of (dict, the config; str, its output; dict, its inputs;
+            float, seconds taken), or None if it failed to render.
+        """
+        start = time.time()
+        try:
+            output, inputs = self.render(config)
+        except (jinja2.TemplateError, IOError, OSError), e:
+            log.error('Unable to update config %s: %s',
+                    config.get('name'), e)
+            return None
+        seconds = time.time() - start
+        RENDER_SECONDS.observe(seconds)
+
+        return config, output, inputs, seconds
+
+    def render_all(self, configs):
+        """Render configs, up to self.workers at once.
+
+        Returns:
+            list of render_timed() tuples for the configs that rendered.
+        """
+        if self.workers <= 1 or len(configs) <= 1:
+            results = map(self.render_timed, configs)
+        else:
+            pool = ThreadPool(min(self.workers, len(configs)))
+            try:
+                results = pool.map(self.render_timed, configs)
+            finally:
+                pool.close()
+                pool.join()
+
+        return [result for result in results if result is not None]
+
+    def commit(self, rendered):
+        """Write rendered configs as one batch.
+
+        Every changed file is staged beside its target before any is renamed
+        into place. A config that can't be staged (e.g. its directory is
+        missing) is logged and skipped, and the rest are written; with
+        self.atomic, none are.
+
+        Args:
+            rendered: list of render_timed() tuples.
+        Returns:
+            list of dicts, the configs written.
+        """
+        staged = []
+        for result in rendered:
+            config, output = result[:2]
+            mode = config.get('mode')
+            try:
+                staged.append((result, stage(config['path'], output,
+                        mode=int(mode, 8) if isinstance(mode, basestring)
+                        else mode)))
+            except (IOError, OSError, ValueError), e:
+                if not self.atomic:
+                    log.error('Unable to write config %s: %s',
+                            config.get('name'), e)
+                    continue
+                log.error('Unable to write config %s, writing none: %s',
+                        config.get('name'), e)
+                for _, tmp_path in staged:
+                    if tmp_path is not None:
+                        os.remove(tmp_path)
+                return []
+
+        written = []
+        for (config, output, inputs, seconds), tmp_path in staged:
+            if tmp_path is not None:
+                os.rename(tmp_path, config['path'])
+                written.append(config)
+            self.record(config, output, inputs)
+            log.info('%s %s (rendered in %.1fms).',
+                    tmp_path and 'Wrote' or 'No changes to', config['path'],
+                    seconds * 1000)
+
+        return written
+
+    def record(self, config, output, inputs):
+        """Remember what a config was rendered from."""
+        state = {'template': content_hash(self.template_source(config)),
+                 'vars': content_hash(json.dumps(
+                     config.get('vars') or {}, sort_keys=True)),
+                 'inputs': inputs, 'path': config['path'],
+                 'output': content_hash(output)}
+        if 'template' not in config and self.repository is not None:
+            state['template_path'] = config['template_path']
+            state['commit'] = self.repository.head
+        self.state[config['name']] = state
+
+    def reload(self, configs):
+        """Run the reload commands of configs that were written.
+
+        Configs sharing a reload command (e.g. several files for one
+        service) run it once.
+        """
+        commands = []
+        for config in configs:
+            command = config.get('reload')
+            if command and command not in commands:
+                commands.append(command)
+        for command in commands:
+            log.info('Running reload hook: %s', command)
+            retcode = subprocess.call(command, shell=True)
+            if retcode != 0:
+                log.error('Reload hook %r exited with %s.',
+                        command, retcode)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+Coordinator - Let several aerostatd replicas share the reconcile work.
+
+Replicas coordinate through two small collections in the aerostat database:
+
+    replicas: one document per live replica, refreshed by heartbeat().
+    leases:   a single 'leader' document naming the current leader.
+
+Both carry an 'expires' time. A replica that stops heartbeating drops out of
+the live set once its lease runs out, and its share of the work moves to the
+others the next time they call assign(). Leases are judged by the replicas'
+own clocks, so keep lease_seconds well above any clock skew between them.
+"""
+
+import datetime
+import hashlib
+import os
+import socket
+
+import pymongo
+
+import logs
+
+log = logs.get_logger('coordinator')
+
+
+# Seconds a heartbeat or leadership claim stays valid.
+DEFAULT_LEASE_SECONDS = 30
+
+LEADER_ID = 'leader'
+
+
+def default_replica_id():
+    """Name this process uniquely among replicas."""
+
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+def owner(key, replica_ids):
+    """Pick the replica that owns a key, by rendezvous hashing.
+
+    Every replica computes the same owner from the same live set, and when a
+    replica leaves only the keys it owned move elsewhere.
+
+    Args:
+        key: str, the unit of work, e.g. a target name.
+        replica_ids: list of str, live replicas.
+    Returns:
+        str, the owning replica id, or None if there are no replicas.
+    """
+    best = None
+    best_score = None
+    for replica_id in replica_ids:
+        score = hashlib.md5('%s|%s' % (replica_id, key)).hexdigest()
+        if best_score is None or score > best_score:
+            best, best_score = replica_id, score
+
+    return best
+
+
+class Coordinator(object):
+    """Heartbeat, elect a leader and split work between aerostatd replicas."""
+
+    def __init__(self, db, replica_id=None,
+                 lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Initialize object.
+
+        Args:
+            db: mongodb db reference.
+            replica_id: str, unique name for this replica.
+            lease_seconds: int, how long heartbeats and leadership last.
+        """
+        self.db = db
+        self.replica_id = replica_id or default_replica_id()
+        self.lease_seconds = lease_seconds
+        self.leader = False
+
+    def ensure_indexes(self):
+        """Let Mongo drop replicas that are long dead."""
+        self.db.replicas.ensure_index('expires', expireAfterSeconds=3600)
+
+    def expiry(self):
+        """Return when a lease taken now runs out."""
+
+        return datetime.datetime.utcnow() + datetime.timedelta(
+                seconds=self.lease_seconds)
+
+    def heartbeat(self):
+        """Renew this replica's place in the live set."""
+        self.db.replicas.update(
+                {'_id': self.replica_id},
+                {'$set': {'expires': self.expiry(),
+                          'host': socket.gethostname(),
+                          'pid': os.getpid()}},
+                upsert=True)
+
+    def live_replicas(self):
+        """Return the sorted ids of replicas whose heartbeat is current."""
+        now = datetime.datetime.utcnow()
+
+        return sorted(result['_id'] for result in self.db.replicas.find(
+                {'expires': {'$gt': now}}, {'_id': 1}))
+
+    def acquire_leadership(self):
+        """Take or renew the leader lease if it's free or already ours.
+
+        Returns:
+            bool, whether this replica is the leader until the lease expires.
+        """
+        now = datetime.datetime.utcnow()
+        try:
+            result = self.db.leases.find_and_modify(
+                    {'_id': LEADER_ID, '$or': [
+                        {'holder': self.replica_id},
+                        {'expires': {'$lt': now}}]},
+                    {'$set': {'holder': self.replica_id,
+                              'expires': self.expiry()}},
+                    upsert=True, new=True)
+        except pymongo.errors.DuplicateKeyError:
+            # Someone else holds a live lease, so the upsert collided.
+            result = None
+
+        leader = bool(result) and result.get('holder') == self.replica_id
+        if leader != self.leader:
+            log.info('Replica %s %s leadership.',
+                    self.replica_id, leader and 'took' or 'lost')
+        self.leader = leader
+
+        return leader
+
+    def assign(self, keys):
+        """Return the keys this replica owns among the live replicas.
+
+        Args:
+            keys: list of str, units of work to share out.
+        Returns:
+            list of str, keys owned by this replica, in their original order.
+        """
+        replica_ids = self.live_replicas()
+        if self.replica_id not in replica_ids:
+            replica_ids.append(self.replica_id)
+
+        return [key for key in keys if owner(key, replica_ids) ==
+                self.replica_id]
+
+    def resign(self):
+        """Give up leadership and leave the live set, e.g. on shutdown."""
+        self.db.leases.remove({'_id': LEADER_ID, 'holder': self.replica_id})
+        self.db.replicas.remove({'_id': self.replica_id})
+        self.leader = False
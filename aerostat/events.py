@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+"""
+Events - Instance state-change events for aerostatd.
+
+aerostatd can be told about instances starting and stopping as it happens,
+instead of waiting for its next inventory sweep. Events come from a pluggable
+source:
+
+    spool:  a directory; each file holds one JSON event per line.
+    socket: a Unix datagram socket; each datagram is one JSON event.
+    queue:  an in-process Queue, for tests and embedding.
+
+An event is either the flat form {"instance_id": ..., "state": ..., "ip": ...}
+or an EC2 Instance State-change Notification as delivered by CloudWatch Events,
+whose "detail" carries "instance-id" and "state".
+"""
+
+import abc
+import collections
+import errno
+import json
+import os
+import Queue
+import select
+import socket
+import time
+
+import logs
+
+log = logs.get_logger('events')
+
+
+# How often a spool directory is re-listed while waiting for events.
+SPOOL_POLL_INTERVAL = 0.5
+
+# Largest datagram read from an event socket.
+MAX_DATAGRAM = 65536
+
+StateChange = collections.namedtuple('StateChange', 'instance_id state ip')
+
+
+def parse_event(data):
+    """Turn a decoded JSON event into a StateChange.
+
+    Args:
+        data: dict, either the flat form or a CloudWatch Events notification.
+    Returns:
+        StateChange, or None if data isn't a recognisable event.
+    """
+    if not isinstance(data, dict):
+        return None
+    detail = data.get('detail')
+    if isinstance(detail, dict):
+        data = {'instance_id': detail.get('instance-id'),
+                'state': detail.get('state'),
+                'ip': detail.get('private-ip-address')}
+
+    if not data.get('instance_id') or not data.get('state'):
+        return None
+
+    return StateChange(data['instance_id'], data['state'], data.get('ip'))
+
+
+def parse_lines(lines):
+    """Parse JSON events, one per line, skipping anything unreadable."""
+    events = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            event = parse_event(json.loads(line))
+        except ValueError:
+            event = None
+        if event is None:
+            log.warn('Ignoring malformed event: %r', line[:200])
+            continue
+        events.append(event)
+
+    return events
+
+
+class EventSource(object):
+    """Base class for sources of StateChange events."""
+
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def poll(self, timeout):
+        """Wait up to timeout seconds and return whatever events arrived.
+
+        Args:
+            timeout: float, seconds to wait if nothing is pending.
+        Returns:
+            list of StateChange.
+        """
+
+    def close(self):
+        """Release any resources held by the source."""
+        pass
+
+
+class SpoolEventSource(EventSource):
+    """Read events from files dropped into a spool directory.
+
+    Producers should write each file under a name starting with '.' and
+    rename it into place, so that half-written files are never read. Files
+    are processed in name order and removed once read.
+
+    Events can blank hosts, so the directory is kept private to aerostatd's
+    user.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path, 0700)
+        os.chmod(path, 0700)
+
+    def read_pending(self):
+        """Read and remove every complete file in the spool."""
+        events = []
+        for name in sorted(os.listdir(self.path)):
+            if name.startswith('.'):
+                continue
+            file_path = os.path.join(self.path, name)
+            try:
+                spool_file = open(file_path, 'r')
+                lines = spool_file.readlines()
+                spool_file.close()
+                os.remove(file_path)
+            except (IOError, OSError), e:
+                log.error('Unable to read spooled events %s: %s',
+                        file_path, e)
+                continue
+            events.extend(parse_lines(lines))
+
+        return events
+
+    def poll(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            events = self.read_pending()
+            remaining = deadline - time.time()
+            if events or remaining <= 0:
+                return events
+            time.sleep(min(SPOOL_POLL_INTERVAL, remaining))
+
+
+class SocketEventSource(EventSource):
+    """Receive events as datagrams on a Unix socket.
+
+    The socket is only writable by aerostatd's user.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # Set through the umask, so the socket is never open to others.
+        umask = os.umask(0177)
+        try:
+            self.sock.bind(path)
+        finally:
+            os.umask(umask)
+        self.sock.setblocking(0)
+
+    def poll(self, timeout):
+        readable = select.select([self.sock], [], [], max(timeout, 0))[0]
+        if not readable:
+            return []
+
+        lines = []
+        while True:
+            try:
+                lines.append(self.sock.recv(MAX_DATAGRAM))
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+        return parse_lines(lines)
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class QueueEventSource(EventSource):
+    """Take events from an in-process Queue.
+
+    Items may be StateChange tuples or dicts in either event form.
+    """
+
+    def __init__(self, queue=None):
+        self.queue = queue or Queue.Queue()
+
+    def poll(self, timeout):
+        items = []
+        try:
+            items.append(self.queue.get(True, max(timeout, 0)))
+            while True:
+                items.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+
+        events = []
+        for item in items:
+            if not isinstance(item, StateChange):
+                item = parse_event(item)
+            if item is not None:
+                events.append(item)
+
+        return events
+
+
+def get_event_source(conf):
+    """Build the event source described by aerostatd.conf, if any.
+
+    Args:
+        conf: dict, the 'events' section, e.g. {'source': 'spool', 'path':
+        '/var/spool/aerostat'}.
+    Returns:
+        EventSource, or None when events aren't configured.
+    """
+    if not conf or not conf.get('source'):
+        return None
+
+    source = conf['source']
+    if source == 'spool':
+        return SpoolEventSource(conf.get('path', '/var/spool/aerostat'))
+    elif source == 'socket':
+        return SocketEventSource(conf.get('path', '/var/run/aerostatd.sock'))
+    elif source == 'queue':
+        return QueueEventSource()
+
+    log.error('Unknown event source %s; events disabled.', source)
+    return None
+
+
+def send_event(path, instance_id, state, ip=None):
+    """Deliver a single event to a spool directory or event socket.
+
+    Args:
+        path: str, spool directory or socket path.
+        instance_id: str, EC2 instance id.
+        state: str, EC2 instance state, e.g. 'running' or 'terminated'.
+        ip: str, private ip of the instance, if known.
+    """
+    line = json.dumps({'instance_id': instance_id, 'state': state, 'ip': ip})
+    if os.path.isdir(path):
+        name = '%.6f-%s-%s' % (time.time(), os.getpid(), instance_id)
+        tmp_path = os.path.join(path, '.' + name)
+        spool_file = os.fdopen(os.open(tmp_path,
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600), 'w')
+        spool_file.write(line + '\n')
+        spool_file.close()
+        os.rename(tmp_path, os.path.join(path, name))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(line, path)
+        finally:
+            sock.close()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+"""
+Fsck - Check the servers collection for broken invariants, and repair them.
+
+Registrar and aerostatd each assume things about servers that nothing
+enforces: one document per hostname and per instance, one master per
+service, each alias on one host, no missing slots in a service's numbering
+(pick_name names new hosts by counting, so a missing slot means a clash)
+and no tombstones that can never be reused. They only notice, and only log,
+when they happen to trip over a violation.
+
+scan() finds every violation with a few plain aggregations (see PIPELINES),
+so only the grouped results are sent back. repair() fixes them
+with one ordered bulk write, and archives dead documents the way
+compaction does:
+
+    duplicate instance_ids: the oldest document keeps the instance; the
+        others are blanked into gaps.
+    duplicate hostnames (and so multiple masters): a live document keeps
+        the name; the others are blanked and archived, and their instances
+        must register again.
+    alias collisions: the newest live holder keeps the alias, as after a
+        registration.
+    slot gaps: a blank document is added for each missing slot, for
+        Registrar to fill.
+    orphaned tombstones: blank documents whose hostname is empty or off
+        the naming scheme are archived.
+
+Repairs bypass storage, so the masters view is rebuilt afterwards.
+"""
+
+import aerostat
+import compactor
+import logs
+import masters
+
+log = logs.get_logger('fsck')
+
+
+PROBLEMS = ('duplicate_hostnames', 'duplicate_instance_ids',
+            'multiple_masters', 'alias_collisions', 'slot_gaps',
+            'orphaned_tombstones')
+
+# Missing slots listed per service; a mistyped hostname like web-90000
+# shouldn't have repair add ninety thousand documents.
+MAX_SLOT_GAPS = 1000
+
+UNSET = ['', None]
+
+
+def duplicates(key, fields):
+    """Pipeline grouping servers by key, keeping groups of more than one."""
+    return [
+        {'$match': {key: {'$nin': UNSET}}},
+        {'$group': {'_id': '$' + key, 'count': {'$sum': 1},
+                    'servers': {'$push': dict(
+                        (field, '$' + field) for field in fields)}}},
+        {'$match': {'count': {'$gt': 1}}}]
+
+
+# (name, pipeline) pairs, one aggregation each. Only plain $match, $project,
+# $unwind and $group stages, so any server with aggregation cursors (2.6+)
+# runs them; $facet would need 3.4.
+PIPELINES = [
+    ('duplicate_hostnames', duplicates('hostname', ('_id', 'instance_id'))),
+    ('duplicate_instance_ids', duplicates(
+            'instance_id', ('_id', 'hostname'))),
+    ('multiple_masters', [
+        {'$match': {'hostname': {'$regex': '-master$'}}},
+        {'$project': {'service': 1, 'hostname': 1, 'instance_id': 1,
+                      'master': {'$eq': ['$hostname', {'$concat': [
+                          '$service', '-master']}]}}},
+        {'$match': {'master': True}},
+        {'$group': {'_id': '$service', 'count': {'$sum': 1},
+                    'servers': {'$push': {'_id': '$_id',
+                                          'instance_id': '$instance_id'}}}},
+        {'$match': {'count': {'$gt': 1}}}]),
+    ('alias_collisions', [
+        {'$project': {'hostname': 1, 'instance_id': 1, 'aliases': 1}},
+        {'$unwind': '$aliases'},
+        {'$group': {'_id': '$aliases', 'count': {'$sum': 1},
+                    'servers': {'$push': {'_id': '$_id',
+                                          'hostname': '$hostname',
+                                          'instance_id': '$instance_id'}}}},
+        {'$match': {'count': {'$gt': 1}}}]),
+    # Slot gaps and orphans need hostname_number, so the last step of
+    # working them out happens here rather than in the pipeline.
+    ('services', [
+        {'$match': {'hostname': {'$nin': UNSET}}},
+        {'$group': {'_id': '$service',
+                    'service_type': {'$first': '$service_type'},
+                    'hostnames': {'$addToSet': '$hostname'},
+                    # '' stands in for every dead host.
+                    'live': {'$addToSet': {'$cond': [
+                        {'$ne': [{'$ifNull': ['$instance_id', '']}, '']},
+                        '$hostname', '']}}}}]),
+    ('tombstones', [
+        {'$match': {'instance_id': {'$in': UNSET}}},
+        {'$project': {'hostname': 1, 'service': 1}}])]
+
+
+def slot_name(service, service_type, number):
+    if service_type == 'masterful':
+        return '%s-slave-%s' % (service, number)
+    return '%s-%s' % (service, number)
+
+
+def find_slot_gaps(services):
+    """Work out missing slots from each service's hostnames.
+
+    Only slots up to the highest live host count, as in
+    Compactor.high_water_marks: compaction archives tombstones above it, so
+    filling slots up to a dead one would only be undone.
+
+    Masterful services number slaves from 1; a missing master is left to
+    the next registration.
+    """
+    gaps = []
+    for result in services:
+        service = result['_id']
+        numbers = set(aerostat.hostname_number(service, hostname)
+                      for hostname in result['hostnames'])
+        numbers.discard(None)
+        live = set(aerostat.hostname_number(service, hostname)
+                   for hostname in result.get('live', []) if hostname)
+        live.discard(None)
+        if not service or not live:
+            continue
+        first = result.get('service_type') == 'masterful' and 1 or 0
+        missing = sorted(set(range(first, max(live) + 1)) - numbers)
+        if missing:
+            gaps.append({'service': service,
+                         'service_type': result.get('service_type'),
+                         'hostnames': [slot_name(
+                             service, result.get('service_type'), number)
+                             for number in missing[:MAX_SLOT_GAPS]]})
+
+    return gaps
+
+
+def find_orphans(tombstones):
+    """Blank documents no registration will ever reuse."""
+    return [result for result in tombstones
+            if not result.get('hostname') or aerostat.hostname_number(
+                result.get('service'), result['hostname']) is None]
+
+
+def by_id(servers):
+    return sorted(servers, key=lambda server: server['_id'])
+
+
+class Fsck(object):
+    """Find and repair broken invariants in the servers collection."""
+
+    def __init__(self, db):
+        """Initialize object.
+
+        Args:
+            db: mongodb db reference.
+        """
+        self.db = db
+
+    def scan(self):
+        """Find every violation, with one aggregation per kind.
+
+        Returns:
+            dict of problem (see PROBLEMS) -> list of dicts describing each.
+        """
+        result = dict((name, list(self.db.servers.aggregate(
+                pipeline, cursor={}, allowDiskUse=True)))
+                for name, pipeline in PIPELINES)
+        report = dict((problem, result.get(problem, [])) for problem in (
+                'duplicate_hostnames', 'duplicate_instance_ids',
+                'multiple_masters'))
+        # A host may list one alias twice; that is no collision.
+        report['alias_collisions'] = [
+                collision for collision in result.get('alias_collisions', [])
+                if len(set(server['_id'] for server in
+                           collision['servers'])) > 1]
+        report['slot_gaps'] = find_slot_gaps(result.get('services', []))
+        report['orphaned_tombstones'] = find_orphans(
+                result.get('tombstones', []))
+
+        return report
+
+    def log_report(self, report):
+        """Log each violation; return how many there are."""
+        for problem in PROBLEMS:
+            for found in report[problem]:
+                if problem == 'orphaned_tombstones':
+                    log.warn('%s: %r in %r', problem,
+                            found.get('hostname'), found.get('service'))
+                elif problem == 'slot_gaps':
+                    log.warn('%s: %s missing %s', problem,
+                            found['service'], ', '.join(found['hostnames']))
+                else:
+                    log.warn('%s: %s held by %s', problem, found['_id'],
+                            ', '.join(str(server.get('hostname') or
+                                          server.get('instance_id')) for
+                                      server in found['servers']))
+        total = sum(len(report[problem]) for problem in PROBLEMS)
+        log.info('fsck found %s problems: %s.', total, ', '.join(
+                '%s %s' % (len(report[problem]), problem)
+                for problem in PROBLEMS))
+
+        return total
+
+    def plan(self, report):
+        """Work out the writes that repair report.
+
+        Returns:
+            tuple of (list of (str, dict, dict) writes for an ordered bulk:
+            ('update', spec, document) or ('insert', document, None); list of
+            _ids to archive).
+        """
+        writes = []
+        archive = []
+        # _id -> instance_id after the writes planned so far.
+        instances = {}
+
+        for found in report['duplicate_instance_ids']:
+            for server in by_id(found['servers'])[1:]:
+                writes.append(('update',
+                        {'_id': server['_id'], 'instance_id': found['_id']},
+                        {'$set': {'instance_id': '', 'ip': ''}}))
+                instances[server['_id']] = ''
+
+        for found in report['duplicate_hostnames']:
+            servers = by_id(found['servers'])
+            live = [server for server in servers if
+                    instances.get(server['_id'], server.get('instance_id'))]
+            keep = (live or servers)[0]
+            for server in servers:
+                if server is keep:
+                    continue
+                if server in live:
+                    # A nameless live document would still hold its
+                    # instance, so the instance could never register again.
+                    log.warn('%s loses hostname %s; it must register '
+                            'again.', server['instance_id'], found['_id'])
+                    writes.append(('update',
+                            {'_id': server['_id'],
+                             'instance_id': server['instance_id']},
+                            {'$set': {'instance_id': '', 'ip': ''}}))
+                    instances[server['_id']] = ''
+                archive.append(server['_id'])
+
+        for found in report['alias_collisions']:
+            servers = by_id(found['servers'])
+            live = [server for server in servers if
+                    instances.get(server['_id'], server.get('instance_id'))]
+            keep = (live or servers)[-1]
+            for server_id in set(server['_id'] for server in servers):
+                if server_id != keep['_id']:
+                    writes.append(('update', {'_id': server_id},
+                            {'$pull': {'aliases': found['_id']}}))
+
+        for found in report['slot_gaps']:
+            for hostname in found['hostnames']:
+                writes.append(('insert', {
+                        'hostname': hostname, 'ip': '', 'instance_id': '',
+                        'service': found['service'],
+                        'service_type': found['service_type'],
+                        'aliases': []}, None))
+
+        archive.extend(found['_id'] for found in report['orphaned_tombstones'])
+
+        return writes, sorted(set(archive))
+
+    def repair(self, report, dry_run=False):
+        """Repair everything in report.
+
+        Args:
+            report: dict, as returned by scan().
+            dry_run: bool, only log what would be done.
+        Returns:
+            dict with the number of 'writes' and documents 'archived'.
+        """
+        writes, archive = self.plan(report)
+        if dry_run:
+            log.info('DRY RUN: fsck would make %s writes and archive %s '
+                    'documents.', len(writes), len(archive))
+            return {'writes': len(writes), 'archived': len(archive)}
+
+        if writes:
+            bulk = self.db.servers.initialize_ordered_bulk_op()
+            for kind, spec, document in writes:
+                if kind == 'insert':
+                    bulk.insert(spec)
+                else:
+                    bulk.find(spec).update_one(document)
+            bulk.execute({'w': 1})
+        archived = 0
+        if archive:
+            comp = compactor.Compactor(self.db)
+            for i in range(0, len(archive), comp.batch_size):
+                archived += comp.archive(archive[i:i + comp.batch_size])
+        masters.Masters(self.db).rebuild()
+        log.info('fsck made %s writes and archived %s documents.',
+                len(writes), archived)
+
+        return {'writes': len(writes), 'archived': archived}
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+
+"""
+Generations - Versioned server sets and patches between them.
+
+aerostatd publishes the server set as numbered generations. The latest one is
+kept as a full snapshot (see snapshot) in the snapshots collection, and each
+step from one generation to the next as a patch in the patches collection,
+for the last few generations:
+
+    snapshots: {_id: 'current', generation: 42, data: <snapshot>}
+    patches:   {_id: 42, base: 41, data: <patch>}
+
+A client that knows generation 40 fetches patches 41 and 42, folds them into
+one and applies it to its index, so an update costs in proportion to what
+changed rather than to the size of the fleet. A client too far behind (or
+new) fetches the full snapshot instead.
+
+A patch is a small header, the hostnames that were removed and a snapshot of
+the entries that were added or changed, keyed by hostname.
+"""
+
+import bisect
+import struct
+import zlib
+
+import bson
+import pymongo
+
+import logs
+import snapshot
+
+log = logs.get_logger('generations')
+
+
+# Step patches kept in the patches collection.
+DEFAULT_KEEP_GENERATIONS = 20
+
+PATCH_MAGIC = 'APAT'
+PATCH_VERSION = 1
+
+# magic, version, reserved, base generation, generation, removed count,
+# removed section length, crc32 of the removed section.
+PATCH_HEADER = struct.Struct('>4sBxxxQQIII')
+
+CURRENT_ID = 'current'
+
+FIELDS = {'hostname': 1, 'ip': 1, 'service': 1, 'service_type': 1,
+          'instance_id': 1, 'aliases': 1, '_id': 0}
+
+
+def normalize(server):
+    """Reduce a servers document to the fields a snapshot carries."""
+
+    return {'hostname': server.get('hostname') or '',
+            'ip': server.get('ip') or '',
+            'service': server.get('service') or '',
+            'service_type': server.get('service_type') or '',
+            'instance_id': server.get('instance_id') or '',
+            'aliases': list(server.get('aliases') or [])}
+
+
+def diff(old, new):
+    """Work out the patch from one server set to another.
+
+    Args:
+        old: dict of hostname -> server, the earlier set.
+        new: dict of hostname -> server, the later set.
+    Returns:
+        tuple of (list of dicts, servers added or changed; list of str,
+        hostnames removed).
+    """
+    upserts = [server for hostname, server in new.iteritems()
+               if old.get(hostname) != server]
+    removed = [hostname for hostname in old if hostname not in new]
+
+    return upserts, removed
+
+
+def encode_patch(base, generation, upserts, removed, compression='zlib'):
+    """Encode a patch from generation base to generation.
+
+    Returns:
+        str, the patch.
+    """
+    section = ''.join(snapshot.pack_short_string(hostname)
+                      for hostname in removed)
+
+    return PATCH_HEADER.pack(PATCH_MAGIC, PATCH_VERSION, base, generation,
+            len(removed), len(section), zlib.crc32(section) & 0xffffffff) + (
+                section + snapshot.encode(upserts, generation, compression))
+
+
+def decode_patch(data):
+    """Decode a patch.
+
+    Returns:
+        tuple of (int, base generation; int, generation; list of dicts,
+        servers added or changed; list of str, hostnames removed).
+    Raises:
+        snapshot.SnapshotError: if the patch is malformed or corrupt.
+    """
+    if len(data) < PATCH_HEADER.size:
+        raise snapshot.SnapshotError('Patch is truncated.')
+    (magic, version, base, generation, removed_count, length,
+     checksum) = PATCH_HEADER.unpack_from(data, 0)
+    if magic != PATCH_MAGIC or version != PATCH_VERSION:
+        raise snapshot.SnapshotError('Not an Aerostat patch.')
+    section = data[PATCH_HEADER.size:PATCH_HEADER.size + length]
+    if len(section) != length or zlib.crc32(section) & 0xffffffff != checksum:
+        raise snapshot.SnapshotError('Patch checksum mismatch.')
+
+    removed = []
+    position = 0
+    for _ in xrange(removed_count):
+        size = ord(section[position])
+        removed.append(section[position + 1:position + 1 + size])
+        position += 1 + size
+    upserts = list(snapshot.Reader(data[PATCH_HEADER.size + length:]))
+
+    return base, generation, upserts, removed
+
+
+def compose(patches):
+    """Fold consecutive decoded patches into one.
+
+    Args:
+        patches: list of decode_patch() tuples, oldest first.
+    Returns:
+        tuple like decode_patch(), from the first base to the last generation.
+    """
+    upserts = {}
+    removed = set()
+    for _, _, patch_upserts, patch_removed in patches:
+        for hostname in patch_removed:
+            upserts.pop(hostname, None)
+            removed.add(hostname)
+        for server in patch_upserts:
+            removed.discard(server['hostname'])
+            upserts[server['hostname']] = server
+
+    return (patches[0][0], patches[-1][1], upserts.values(),
+            sorted(removed))
+
+
+def host_lines(server):
+    """Render a server's /etc/hosts lines, as Updater does."""
+    if not server['ip']:
+        return []
+
+    return ['%s %s' % (server['ip'], name)
+            for name in [server['hostname']] + list(server['aliases'])]
+
+
+class ServerIndex(object):
+    """A client's copy of the server set, with each host's lines rendered.
+
+    Hostnames are kept sorted, and which of them match the subscription last
+    rendered is kept up to date as patches arrive, so a patch costs only the
+    hosts it names until the subscription itself changes.
+    """
+
+    def __init__(self):
+        self.generation = None
+        # hostname -> server
+        self.servers = {}
+        # hostname -> list of /etc/hosts lines
+        self.lines = {}
+        # Sorted hostnames.
+        self.order = []
+        # The subscription last rendered, and the hostnames it matches.
+        self.subscription = None
+        self.matched = None
+
+    def load_snapshot(self, data):
+        """Replace the index with a full snapshot."""
+        reader = snapshot.Reader(data)
+        self.servers = {}
+        self.lines = {}
+        self.matched = None
+        for server in reader:
+            self.servers[server['hostname']] = server
+            self.lines[server['hostname']] = host_lines(server)
+        self.order = sorted(self.servers)
+        self.generation = reader.generation
+
+    def put(self, server):
+        hostname = server['hostname']
+        if hostname not in self.servers:
+            bisect.insort(self.order, hostname)
+        self.servers[hostname] = server
+        self.lines[hostname] = host_lines(server)
+        if self.matched is not None:
+            if self.subscription is None or self.subscription.matches(server):
+                self.matched.add(hostname)
+            else:
+                self.matched.discard(hostname)
+
+    def remove(self, hostname):
+        if self.servers.pop(hostname, None) is None:
+            return
+        del self.lines[hostname]
+        del self.order[bisect.bisect_left(self.order, hostname)]
+        if self.matched is not None:
+            self.matched.discard(hostname)
+
+    def apply(self, patch):
+        """Apply a decoded patch, touching only the hosts it names.
+
+        Raises:
+            ValueError: if the patch doesn't start at this index's generation.
+        """
+        base, generation, upserts, removed = patch
+        if base != self.generation:
+            raise ValueError('Patch from generation %s does not apply to %s.'
+                    % (base, self.generation))
+        for hostname in removed:
+            self.remove(hostname)
+        for server in upserts:
+            self.put(server)
+        self.generation = generation
+
+    def render(self, subscription=None):
+        """Return the /etc/hosts lines for every (subscribed) host."""
+        if self.matched is None or subscription is not self.subscription:
+            # subscriptions.reload_if_changed() returns a new object when the
+            # file changes, so identity is enough to spot a new subscription.
+            self.subscription = subscription
+            self.matched = set(hostname for hostname, server
+                               in self.servers.iteritems()
+                               if subscription is None or
+                                   subscription.matches(server))
+        lines = []
+        matched = self.matched
+        for hostname in self.order:
+            if hostname in matched:
+                lines.extend(self.lines[hostname])
+
+        return lines
+
+
+class Publisher(object):
+    """Publish generations of the server set from aerostatd."""
+
+    def __init__(self, db, keep=DEFAULT_KEEP_GENERATIONS, compression='zlib',
+                 key=None):
+        """Initialize object.
+
+        Args:
+            db: mongodb db reference.
+            keep: int, step patches to retain.
+            compression: str, snapshot compression, None, 'zlib' or 'zstd'.
+            key: str, shared key to sign snapshots with, so clients can pass
+            them between themselves (see gossip).
+        """
+        self.db = db
+        self.keep = keep
+        self.compression = compression
+        self.key = key
+        self.generation = None
+        self.servers = None
+
+    def load(self):
+        """Pick up the generation already published, e.g. after a restart."""
+        current = self.db.snapshots.find_one({'_id': CURRENT_ID})
+        self.generation = 0
+        self.servers = {}
+        if current:
+            reader = snapshot.Reader(str(current['data']))
+            self.generation = reader.generation
+            self.servers = dict(
+                    (server['hostname'], server) for server in reader)
+
+    def encodable(self, server):
+        """Whether a server fits in a snapshot; the rest are left out."""
+        try:
+            snapshot.check_server(server)
+        except snapshot.SnapshotError, e:
+            log.warning('Leaving %s out of the snapshot: %s',
+                    server['hostname'], e)
+            return False
+
+        return True
+
+    def read_servers(self):
+        """Read the current server set from the servers collection."""
+        servers = {}
+        for result in self.db.servers.find({}, FIELDS):
+            server = normalize(result)
+            if self.encodable(server):
+                servers[server['hostname']] = server
+
+        return servers
+
+    def read_changes(self, instance_ids):
+        """Re-read only the servers some instances hold, or held.
+
+        Args:
+            instance_ids: iterable of str, instances whose documents changed.
+        Returns:
+            tuple like diff(), against the last published server set.
+        """
+        instance_ids = set(instance_ids)
+        held = [hostname for hostname, server in self.servers.iteritems()
+                if server['instance_id'] in instance_ids]
+        found = {}
+        for result in self.db.servers.find({'$or': [
+                {'instance_id': {'$in': sorted(instance_ids)}},
+                {'hostname': {'$in': sorted(held)}}]}, FIELDS):
+            server = normalize(result)
+            if self.encodable(server):
+                found[server['hostname']] = server
+        upserts = [server for hostname, server in found.iteritems()
+                   if self.servers.get(hostname) != server]
+        removed = [hostname for hostname in held if hostname not in found]
+
+        return upserts, removed
+
+    def publish(self, instance_ids=None):
+        """Publish a new generation if the server set has changed.
+
+        The generation is compare-and-set in the snapshots collection: if
+        another replica published since this one last did (e.g. while this
+        one wasn't the leader), the published set is reloaded first, and a
+        replica that loses a race to publish the same generation backs off.
+
+        Args:
+            instance_ids: iterable of str, the only instances that changed
+            since the last publish (e.g. from a batch of events); None re-reads
+            every server.
+        Returns:
+            int, the new generation, or None if nothing changed.
+        """
+        current = self.db.snapshots.find_one(
+                {'_id': CURRENT_ID}, {'generation': 1})
+        published = current and current['generation'] or 0
+        if self.servers is None or published != self.generation:
+            self.load()
+            instance_ids = None
+        if instance_ids is None:
+            servers = self.read_servers()
+            upserts, removed = diff(self.servers, servers)
+        else:
+            upserts, removed = self.read_changes(instance_ids)
+            servers = dict(self.servers)
+            for hostname in removed:
+                del servers[hostname]
+            for server in upserts:
+                servers[server['hostname']] = server
+        if not upserts and not removed:
+            return None
+
+        generation = self.generation + 1
+        try:
+            data = snapshot.encode(servers.itervalues(), generation,
+                    self.compression)
+        except snapshot.SnapshotError, e:
+            # Keep serving the previous generation rather than stop aerostatd.
+            log.error('Unable to encode generation %s: %s', generation, e)
+            return None
+        current = {'_id': CURRENT_ID, 'generation': generation,
+                   'data': bson.Binary(data)}
+        if self.key:
+            current['signature'] = snapshot.sign(self.key, data)
+        try:
+            # Matches nothing, so upserts into a duplicate _id, if another
+            # replica has moved the generation on.
+            self.db.snapshots.update(
+                    {'_id': CURRENT_ID, 'generation': self.generation},
+                    current, upsert=True, w=1)
+        except pymongo.errors.DuplicateKeyError:
+            log.warning('Generation %s was published by another replica.',
+                    generation)
+            self.servers = None
+            return None
+        # A client that sees the new generation before its patch is saved
+        # just loads the snapshot.
+        self.db.patches.save({'_id': generation, 'base': self.generation,
+                'data': bson.Binary(encode_patch(self.generation, generation,
+                    upserts, removed, self.compression))}, w=1)
+        self.db.patches.remove({'_id': {'$lte': generation - self.keep}})
+        log.info('Published generation %s: %s added or changed, %s '
+                'removed.', generation, len(upserts), len(removed))
+        self.generation = generation
+        self.servers = servers
+
+        return generation
+
+
+def patch_since(db, generation, current):
+    """Fold the retained patches from generation up to current into one.
+
+    Returns:
+        decode_patch() tuple, or None if a patch in the range has expired.
+    """
+    results = list(db.patches.find(
+            {'_id': {'$gt': generation, '$lte': current}}).sort('_id', 1))
+    if (len(results) != current - generation or
+            results[0]['base'] != generation):
+        return None
+
+    return compose([decode_patch(str(result['data'])) for result in results])
+
+
+def sync(db, index=None):
+    """Bring a client's index up to the published generation.
+
+    Args:
+        db: mongodb db reference.
+        index: ServerIndex, the client's current index, if any.
+    Returns:
+        ServerIndex, up to date; or None if nothing has been published.
+    """
+    current = db.snapshots.find_one({'_id': CURRENT_ID}, {'generation': 1})
+    if not current:
+        return None
+    if index is not None and index.generation == current['generation']:
+        return index
+
+    if index is not None and index.generation is not None and (
+            index.generation < current['generation']):
+        patch = patch_since(db, index.generation, current['generation'])
+        if patch is not None:
+            index.apply(patch)
+            log.debug('Patched from generation %s to %s.',
+                    patch[0], patch[1])
+            return index
+
+    current = db.snapshots.find_one({'_id': CURRENT_ID})
+    index = ServerIndex()
+    index.load_snapshot(str(current['data']))
+    log.debug('Loaded snapshot of generation %s.', index.generation)
+
+    return index
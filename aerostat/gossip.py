@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+"""
+Gossip - Pass published snapshots between clients instead of all asking Mongo.
+
+In peer mode, each 'aerostat --update --daemon' client keeps the latest
+snapshot aerostatd published (see generations) and serves it to other
+clients over HTTP:
+
+    GET /generation  the generation it holds, as text.
+    GET /snapshot    the snapshot, with its signature in X-Aerostat-Signature.
+
+Every cycle a client asks a few random peers for their generation and pulls
+the snapshot from one that is ahead. Only seeds, a small and stable fraction
+of nodes picked by hashing their id (and never fewer than min_seeds of the
+fleet), read the published snapshot from Mongo every cycle. Any other node
+reads it once at startup, then only after fallback_seconds without news.
+Everything else spreads from peer to peer, so the server sees a few clients
+rather than the whole fleet.
+
+aerostatd signs each snapshot with a key shared with the clients
+(generations: {key_file: ...}). A snapshot is only taken, from Mongo or from
+a peer, if the signature checks out. The signature covers the header and so
+the generation: a peer can't forge a snapshot or pass off an old one as new.
+"""
+
+import hashlib
+import httplib
+import math
+import random
+import socket
+import threading
+import time
+import urllib2
+
+import generations
+import logs
+import metrics
+import snapshot
+
+log = logs.get_logger('gossip')
+
+
+DEFAULT_PORT = 8649
+
+# Peers asked for their generation each cycle.
+DEFAULT_FANOUT = 3
+
+# Fraction of nodes that read from Mongo every cycle.
+DEFAULT_SEED_FRACTION = 0.05
+
+# Seeds in a fleet too small for the fraction to pick any.
+DEFAULT_MIN_SEEDS = 3
+
+# Seconds without news before any node checks Mongo itself.
+DEFAULT_FALLBACK_SECONDS = 600
+
+# Seconds to wait on a peer.
+DEFAULT_TIMEOUT = 2
+
+SERVER_READS = metrics.counter('aerostat_gossip_server_reads_total',
+        'Generation checks against Mongo, by outcome.', ['result'])
+PEER_FETCHES = metrics.counter('aerostat_gossip_peer_fetches_total',
+        'Snapshots pulled from peers, by outcome.', ['result'])
+GENERATION = metrics.gauge('aerostat_gossip_generation',
+        'Generation of the snapshot this node holds.')
+
+
+def read_key(path):
+    """Read the shared signing key from a file."""
+    key_file = open(path, 'r')
+    try:
+        key = key_file.read().strip()
+    finally:
+        key_file.close()
+    if not key:
+        raise ValueError('Signing key file %s is empty.' % path)
+
+    return key
+
+
+def seed_score(node_id):
+    """A stable, evenly spread number for a node id; low scores are seeds."""
+    return int(hashlib.md5(node_id).hexdigest()[:8], 16)
+
+
+def is_seed(node_id, fraction, fleet=None, min_seeds=DEFAULT_MIN_SEEDS):
+    """Whether a node reads from Mongo every cycle.
+
+    Hashing the id keeps the choice stable across restarts and spreads seeds
+    evenly through the fleet. When the fleet is known, the nodes with the
+    lowest scores are seeds, at least min_seeds of them, so a small fleet
+    doesn't end up with none.
+
+    Args:
+        node_id: str, identifies the node.
+        fraction: float, fraction of nodes that are seeds.
+        fleet: iterable of str, ids of every node, or None if unknown.
+        min_seeds: int, fewest seeds in a known fleet.
+    """
+    score = seed_score(node_id)
+    fleet = set(fleet or [])
+    if node_id not in fleet:
+        return score < fraction * 0x100000000
+
+    seeds = max(min_seeds, int(math.ceil(fraction * len(fleet))))
+    lower = len([other for other in fleet if seed_score(other) < score])
+
+    return lower < seeds
+
+
+def mongo_source(db, generation):
+    """Read the published snapshot, if it is newer than generation.
+
+    Only the generation number is read unless there is something new.
+
+    Returns:
+        tuple of (str, the snapshot; str, its signature), or None.
+    """
+    current = db.snapshots.find_one(
+            {'_id': generations.CURRENT_ID}, {'generation': 1})
+    if not current or current['generation'] <= generation:
+        return None
+    current = db.snapshots.find_one({'_id': generations.CURRENT_ID})
+
+    return str(current['data']), current.get('signature')
+
+
+class Node(object):
+    """One client's part in spreading snapshots."""
+
+    def __init__(self, key, peers=None, node_id=None, port=DEFAULT_PORT,
+                 fanout=DEFAULT_FANOUT, seed_fraction=DEFAULT_SEED_FRACTION,
+                 min_seeds=DEFAULT_MIN_SEEDS, fleet=None,
+                 fallback_seconds=DEFAULT_FALLBACK_SECONDS,
+                 timeout=DEFAULT_TIMEOUT, source=mongo_source):
+        """Initialize object.
+
+        Args:
+            key: str, the key aerostatd signs snapshots with.
+            peers: list of str, host:port of peers; by default every server
+            in the snapshot, at port.
+            node_id: str, identifies this node for picking seeds; defaults to
+            the hostname.
+            port: int, port peers serve on.
+            fanout: int, peers asked each cycle.
+            seed_fraction: float, fraction of nodes that are seeds.
+            min_seeds: int, fewest seeds in a known fleet.
+            fleet: list of str, ids of every node; by default the hostnames
+            in the snapshot.
+            fallback_seconds: int, seconds without news before a non-seed
+            checks Mongo.
+            timeout: float, seconds to wait on a peer.
+            source: function of (db, generation) returning a newer snapshot
+            and its signature, or None; mongo_source by default.
+        """
+        self.key = key
+        self.peers = peers
+        self.port = port
+        self.fanout = fanout
+        self.node_id = node_id or socket.gethostname()
+        self.seed_fraction = seed_fraction
+        self.min_seeds = min_seeds
+        self.fleet = fleet
+        self.seed = is_seed(self.node_id, seed_fraction, fleet, min_seeds)
+        self.fallback_seconds = fallback_seconds
+        self.timeout = timeout
+        self.source = source
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.data = None
+        self.signature = None
+        # No news yet: read once at startup rather than wait out the fallback.
+        self.last_news = 0
+
+    def offer(self, data, signature):
+        """Take a snapshot if it is signed and newer than ours.
+
+        Returns:
+            bool, whether it was taken.
+        """
+        if not snapshot.verify(self.key, data, signature):
+            log.warn('Rejected a snapshot with a bad signature.')
+            return False
+        try:
+            generation = snapshot.Reader(data).generation
+        except snapshot.SnapshotError, e:
+            log.warn('Rejected a signed but unreadable snapshot: %s', e)
+            return False
+        with self.lock:
+            if generation <= self.generation:
+                return False
+            self.generation = generation
+            self.data = data
+            self.signature = signature
+            self.last_news = time.time()
+        GENERATION.set(generation)
+        log.debug('Took snapshot of generation %s.', generation)
+
+        return True
+
+    def held(self):
+        """Return (generation, snapshot, signature) for serving to peers."""
+        with self.lock:
+            return self.generation, self.data, self.signature
+
+    def serve(self, port=None, host='0.0.0.0'):
+        """Serve this node's snapshot to peers from a daemon thread.
+
+        Returns:
+            BaseHTTPServer.HTTPServer, already serving.
+        """
+        import BaseHTTPServer
+        import SocketServer
+
+        node = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                generation, data, signature = node.held()
+                if self.path == '/generation':
+                    body = str(generation)
+                elif self.path == '/snapshot' and data is not None:
+                    body = data
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(body)))
+                if self.path == '/snapshot':
+                    self.send_header('X-Aerostat-Signature', signature)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format, *args)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            # Several peers may pull at once; none should wait on another.
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                log.debug('Peer %s:%s went away.', *client_address)
+
+        server = Server((host, self.port if port is None else port), Handler)
+        thread = threading.Thread(target=server.serve_forever,
+                name='aerostat-gossip')
+        thread.daemon = True
+        thread.start()
+        log.info('Serving snapshots on %s:%s.', host, server.server_port)
+
+        return server
+
+    def choose_peers(self, index):
+        """Pick this cycle's peers, from the configured list or the index."""
+        peers = self.peers
+        if peers is None:
+            peers = ['%s:%s' % (server['ip'], self.port) for server in
+                     (index.servers.itervalues() if index else []) if
+                     server['ip']]
+
+        return random.sample(peers, min(self.fanout, len(peers)))
+
+    def gossip(self, index=None):
+        """Ask a few peers for their generation and pull from one ahead.
+
+        Returns:
+            bool, whether a newer snapshot was taken.
+        """
+        ahead = []
+        for peer in self.choose_peers(index):
+            try:
+                generation = int(urllib2.urlopen(
+                        'http://%s/generation' % peer,
+                        timeout=self.timeout).read())
+            except (IOError, ValueError, socket.error,
+                    httplib.HTTPException), e:
+                log.debug('Peer %s unavailable: %s', peer, e)
+                continue
+            if generation > self.generation:
+                ahead.append((generation, peer))
+
+        for generation, peer in sorted(ahead, reverse=True):
+            try:
+                response = urllib2.urlopen('http://%s/snapshot' % peer,
+                        timeout=self.timeout)
+                data = response.read()
+                signature = response.info().getheader('X-Aerostat-Signature')
+            except (IOError, socket.error, httplib.HTTPException), e:
+                PEER_FETCHES.inc(result='failed')
+                log.debug('Unable to fetch from %s: %s', peer, e)
+                continue
+            if self.offer(data, signature):
+                PEER_FETCHES.inc(result='taken')
+                return True
+            PEER_FETCHES.inc(result='rejected')
+
+        return False
+
+    def sync(self, db, index=None):
+        """Bring a client's index up to the newest snapshot heard of.
+
+        Args:
+            db: mongodb db reference, for seeds and fallbacks.
+            index: generations.ServerIndex, the client's current index.
+        Returns:
+            generations.ServerIndex, or None if no snapshot has been seen.
+        """
+        self.gossip(index)
+        if self.seed or time.time() - self.last_news > self.fallback_seconds:
+            newer = self.source(db, self.generation)
+            if newer is None:
+                SERVER_READS.inc(result='current')
+                # Mongo vouches that nothing is newer; that is news too.
+                self.last_news = time.time()
+            else:
+                SERVER_READS.inc(result='newer')
+                self.offer(*newer)
+
+        generation, data, _ = self.held()
+        if data is not None and (index is None or index.generation < generation):
+            index = generations.ServerIndex()
+            index.load_snapshot(data)
+            if self.fleet is None:
+                self.seed = is_seed(self.node_id, self.seed_fraction,
+                        index.servers, self.min_seeds)
+
+        return index
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+Logs - A thin logging facade for Aerostat's hot loops.
+
+Messages take their arguments separately and are only formatted when the
+record is going to be emitted, so debug lines inside per-host loops cost a
+level check when debug is off:
+
+    log = logs.get_logger('updater')
+    log.debug('Parsing mapping for host %s and ip %s', hostname, ip)
+
+Each component logs through its own 'aerostat.<component>' logger, so levels
+can be set per component (see set_levels). Per-record lines can be sampled
+with log.record(), and counted into a Summary that is logged once per cycle in
+place of one line per host.
+"""
+
+import logging
+import threading
+import time
+
+
+LEVELS = {'debug': logging.DEBUG,
+          'info': logging.INFO,
+          'warning': logging.WARNING,
+          'error': logging.ERROR,
+          'critical': logging.CRITICAL}
+
+
+def parse_levels(spec):
+    """Parse a level spec like 'info,updater=debug,registrar=warning'.
+
+    Args:
+        spec: str, an optional default level followed by component=level
+        pairs, comma separated.
+    Returns:
+        tuple of (int or None, default level; dict of component -> int).
+    Raises:
+        ValueError: if a level name is unknown.
+    """
+    default = None
+    components = {}
+    for part in (spec or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        component, _, name = part.rpartition('=')
+        if name.lower() not in LEVELS:
+            raise ValueError('Unknown log level %r.' % name)
+        if component:
+            components[component.strip()] = LEVELS[name.lower()]
+        else:
+            default = LEVELS[name.lower()]
+
+    return default, components
+
+
+def set_levels(components):
+    """Set levels per component, e.g. {'updater': logging.DEBUG}."""
+    for component, level in components.iteritems():
+        logging.getLogger('aerostat.%s' % component).setLevel(level)
+
+
+class Logger(object):
+    """Deferred-formatting wrapper around a component's stdlib logger."""
+
+    def __init__(self, component, sample_every=1):
+        """Initialize object.
+
+        Args:
+            component: str, e.g. 'updater'; logs to 'aerostat.<component>'.
+            sample_every: int, emit one in this many record() lines.
+        """
+        self.component = component
+        self.logger = logging.getLogger('aerostat.%s' % component)
+        self.sample_every = max(int(sample_every), 1)
+        self.records = 0
+
+    def enabled(self, level=logging.DEBUG):
+        """Whether a message at level would be emitted."""
+
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level, msg, *args):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, msg, *args)
+
+    def debug(self, msg, *args):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(msg, *args)
+
+    def info(self, msg, *args):
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(msg, *args)
+
+    def warning(self, msg, *args):
+        if self.logger.isEnabledFor(logging.WARNING):
+            self.logger.warning(msg, *args)
+
+    warn = warning
+
+    def error(self, msg, *args):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self.logger.error(msg, *args)
+
+    def record(self, msg, *args):
+        """Log a per-record debug line, keeping one in sample_every."""
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        self.records += 1
+        if self.sample_every == 1 or self.records % self.sample_every == 1:
+            self.logger.debug(msg, *args)
+
+
+class Summary(object):
+    """Count what happened during a cycle and log it as one line."""
+
+    def __init__(self, name):
+        """Initialize object.
+
+        Args:
+            name: str, what the cycle is, e.g. 'update'.
+        """
+        self.name = name
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.start = time.time()
+
+    def add(self, key, count=1):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + count
+
+    def get(self, key):
+        return self.counts.get(key, 0)
+
+    def log(self, log, level=logging.INFO):
+        """Log the counts as key=value pairs, with the cycle's duration."""
+        if not log.enabled(level):
+            return
+        with self.lock:
+            counts = sorted(self.counts.items())
+        log.log(level, '%s: %s elapsed=%.3fs', self.name,
+                ' '.join('%s=%s' % pair for pair in counts),
+                time.time() - self.start)
+
+
+_loggers = {}
+_sample_every = 1
+
+
+def get_logger(component):
+    """Return the shared Logger for a component."""
+    log = _loggers.get(component)
+    if log is None:
+        log = _loggers[component] = Logger(component, _sample_every)
+
+    return log
+
+
+def set_sample_every(sample_every):
+    """Keep one in sample_every record() lines, for every component."""
+    global _sample_every
+
+    _sample_every = max(int(sample_every), 1)
+    for log in _loggers.itervalues():
+        log.sample_every = _sample_every
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""
+Masters - A materialized view of each service's master.
+
+Finding a master used to mean querying servers by hostname, which has no
+index. The masters collection keeps one document per masterful service,
+keyed by service name:
+
+    {_id: 'db', instance_id: 'i-1234', ip: '10.0.0.3', generation: 7}
+
+MongoStorage updates it right after every write to servers that assigns
+or clears a '<service>-master' hostname: registrations and claims,
+hostname changes (change_master), cleared instances and moved ips. Each
+update is a single atomic upsert that bumps the service's generation,
+so a master lookup is one read by _id. Anything watching for failovers can
+read this small collection and compare generations rather than scan
+servers (see changes()).
+
+Writes to servers made by other tools (or older clients) bypass the view.
+rebuild() recomputes it from servers; aerostatd runs it at startup and every
+masters_rebuild_every sweeps, and 'aerostat --fsck --repair' after
+repairing. A service with no document yet
+is looked up in servers, as before.
+"""
+
+import time
+
+import logs
+
+log = logs.get_logger('masters')
+
+
+# Seconds MongoStorage reuses a master document it has read.
+DEFAULT_MAX_AGE = 5
+
+
+def master_hostname(service):
+    return '%s-master' % service
+
+
+def is_master(server):
+    """Whether a server document holds its service's master hostname."""
+    return bool(server.get('service')) and (
+            server.get('hostname') == master_hostname(server['service']))
+
+
+class Masters(object):
+    """Read and maintain the masters collection."""
+
+    def __init__(self, db):
+        """Initialize object.
+
+        Args:
+            db: mongodb db reference.
+        """
+        self.db = db
+        # service -> (time read, document), for get(max_age=...).
+        self.cache = {}
+        # service -> generation, as of the last changes().
+        self.known = {}
+
+    def ensure_indexes(self):
+        """Index instance_id, for clearing and moving masters by instance."""
+        self.db.masters.ensure_index('instance_id')
+
+    def get(self, service, max_age=None):
+        """Return a service's master document, or None if there is none yet.
+
+        Args:
+            service: str, name of the service.
+            max_age: float, seconds a cached document may be reused for; by
+            default it is always read.
+        """
+        if max_age is not None and service in self.cache:
+            read_at, current = self.cache[service]
+            if time.time() - read_at <= max_age:
+                return current
+        current = self.db.masters.find_one({'_id': service})
+        self.cache[service] = (time.time(), current)
+
+        return current
+
+    def assign(self, service, instance_id, ip):
+        """Record a service's master; empty instance_id and ip clear it."""
+        self.cache.pop(service, None)
+        self.db.masters.update({'_id': service},
+                {'$set': {'instance_id': instance_id, 'ip': ip},
+                 '$inc': {'generation': 1}}, upsert=True)
+
+    def renamed(self, server, hostname):
+        """Follow a server document being given a new hostname.
+
+        Args:
+            server: dict, the document as it was before the change.
+            hostname: str, its new hostname.
+        """
+        service = server.get('service')
+        if hostname == server.get('hostname'):
+            return
+        if is_master(server):
+            self.assign(service, '', '')
+        if service and hostname == master_hostname(service):
+            self.assign(service, server.get('instance_id') or '',
+                        server.get('ip') or '')
+
+    def clear_instances(self, instance_ids, write_concern=None):
+        """Clear the masters whose instances went away."""
+        self.cache.clear()
+        self.db.masters.update({'instance_id': {'$in': instance_ids}},
+                {'$set': {'instance_id': '', 'ip': ''},
+                 '$inc': {'generation': 1}},
+                multi=True, **(write_concern or {}))
+
+    def moved(self, ip_changes):
+        """Follow ip changes; only masters among them are written.
+
+        Args:
+            ip_changes: dict of instance_id -> ip.
+        """
+        self.cache.clear()
+        for current in self.db.masters.find(
+                {'instance_id': {'$in': sorted(ip_changes)}}):
+            self.db.masters.update(
+                    {'_id': current['_id'],
+                     'instance_id': current['instance_id']},
+                    {'$set': {'ip': ip_changes[current['instance_id']]},
+                     '$inc': {'generation': 1}})
+
+    def changes(self):
+        """Return the masters that changed since the last call.
+
+        The first call returns every master.
+
+        Returns:
+            dict of service -> master document.
+        """
+        changed = {}
+        for current in self.db.masters.find():
+            if self.known.get(current['_id']) != current.get('generation'):
+                self.known[current['_id']] = current.get('generation')
+                changed[current['_id']] = current
+
+        return changed
+
+    def rebuild(self):
+        """Recompute the view from servers, writing only what differs.
+
+        Where a service has several masters, a live one is recorded; fsck
+        reports the rest.
+
+        Returns:
+            int, number of services whose master was rewritten.
+        """
+        found = {}
+        for server in self.db.servers.find(
+                {'hostname': {'$regex': '-master$'}},
+                {'hostname': 1, 'service': 1, 'instance_id': 1, 'ip': 1}):
+            if not is_master(server):
+                continue
+            previous = found.get(server['service'])
+            if previous is None or (server.get('instance_id') and
+                                    not previous.get('instance_id')):
+                found[server['service']] = server
+
+        recorded = dict((current['_id'], current) for current in
+                        self.db.masters.find())
+        rewritten = 0
+        for service in sorted(set(found) | set(recorded)):
+            server = found.get(service, {})
+            wanted = (server.get('instance_id') or '', server.get('ip') or '')
+            current = recorded.get(service)
+            if current is not None and wanted == (current.get('instance_id'),
+                                                  current.get('ip')):
+                continue
+            self.assign(service, *wanted)
+            rewritten += 1
+        if rewritten:
+            log.info('Rebuilt the masters of %s services.', rewritten)
+
+        return rewritten
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+"""
+Metrics - Counters, gauges and histograms in the Prometheus text format.
+
+Everything registers with the module level REGISTRY. Metrics are cheap enough
+to leave on: an update is a dict lookup and an addition under a lock. The
+registry can be scraped over HTTP (serve) or written for node_exporter's
+textfile collector (write_textfile), which suits short-lived runs like
+'aerostat --update' from cron.
+
+    UPDATES = metrics.counter('aerostat_updates_total', 'Updates run.')
+    UPDATES.inc(result='written')
+    with metrics.histogram('aerostat_update_seconds', 'Update time.').time():
+        ...
+"""
+
+import bisect
+import os
+import threading
+import time
+
+import logs
+
+log = logs.get_logger('metrics')
+
+
+# Latency buckets in seconds, from a fast Mongo point read to a slow EC2 page.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(names, values, extra=None):
+    """Format label pairs as {a="1",b="2"}, or '' when there are none."""
+    pairs = zip(names, values)
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace(
+            '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in pairs)
+
+
+def format_value(value):
+    """Format a sample value the way Prometheus expects."""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return '%d' % value
+
+    return repr(value)
+
+
+class Metric(object):
+    """Base for a family of samples sharing a name and label names."""
+
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        """Turn keyword labels into the tuple used to index samples."""
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def samples(self):
+        """Yield (suffix, label values, extra label, value) for rendering."""
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield '', key, None, value
+
+    def render(self):
+        """Return the metric in the Prometheus text format."""
+        lines = ['# HELP %s %s' % (self.name, self.help_text),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, key, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                    format_labels(self.label_names, key, extra),
+                    format_value(value)))
+
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    """A value that can go up and down."""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+
+class Timer(object):
+    """Context manager that observes its elapsed time into a histogram."""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+
+class Histogram(Metric):
+    """Distribution of observed values over fixed buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per-bucket (not cumulative) counts, then sum and count.
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        """Time a block of code: with histogram.time(op='find'): ..."""
+        return Timer(self, labels)
+
+    def get(self, **labels):
+        """Return (sum, count) for a label set."""
+        state = self.values.get(self.key(labels))
+        if state is None:
+            return 0.0, 0
+        return state[1], state[2]
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, (list(state[0]), state[1], state[2]))
+                           for key, state in self.values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield '_bucket', key, ('le', format_value(float(bound))), \
+                        cumulative
+            yield '_bucket', key, ('le', '+Inf'), count
+            yield '_sum', key, None, total
+            yield '_count', key, None, count
+
+
+class Registry(object):
+    """A named collection of metrics."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        """Add a metric, or return the one already registered by that name."""
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError('Metric %s already registered as a %s.' % (
+                            metric.name, existing.kind))
+                return existing
+            self.metrics[metric.name] = metric
+
+        return metric
+
+    def render(self):
+        """Return every metric in the Prometheus text format."""
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+
+        return ''.join(metric.render() + '\n' for _, metric in metrics)
+
+    def write_textfile(self, path):
+        """Atomically write the registry for a textfile collector."""
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        out = open(tmp_path, 'w')
+        out.write(self.render())
+        out.close()
+        os.rename(tmp_path, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve /metrics over HTTP from a daemon thread.
+
+        Returns:
+            BaseHTTPServer.HTTPServer, already serving.
+        """
+        import BaseHTTPServer
+
+        registry = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = registry.render()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                        'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format, *args)
+
+        server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever,
+                name='aerostat-metrics')
+        thread.daemon = True
+        thread.start()
+        log.info('Serving metrics on %s:%s.', host, server.server_port)
+
+        return server
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help_text, labels=()):
+    """Register (or look up) a counter in REGISTRY."""
+    return REGISTRY.register(Counter(name, help_text, labels))
+
+
+def gauge(name, help_text, labels=()):
+    """Register (or look up) a gauge in REGISTRY."""
+    return REGISTRY.register(Gauge(name, help_text, labels))
+
+
+def histogram(name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+    """Register (or look up) a histogram in REGISTRY."""
+    return REGISTRY.register(Histogram(name, help_text, labels, buckets))
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+
+"""
+Namepool - Hostnames computed ahead of time, ready for new nodes to claim.
+
+aerostatd keeps a few free hostnames per service in the name_pool collection:
+the lowest gaps first, then the next unused numbers. A registering node takes
+one with a single find_and_modify, instead of working the name out on the boot
+critical path (see Registrar.pick_name, which remains the fallback).
+
+Claimed entries stay in the pool, marked with the claimant, until the name
+shows up as taken in servers or the claim expires; this stops a refill from
+handing the same name out twice while the claimant is still registering. A
+node that falls back to computing a name reserves it here too (see reserve),
+so it cannot pick a name another node has claimed but not yet registered.
+
+While filling, aerostatd keeps a status document in name_pool_status alive.
+Clients only use the pool while it is (see active_pool); without it, names
+left over from a pool that is no longer filled would not be the lowest free.
+"""
+
+import datetime
+import threading
+
+import pymongo
+
+import aerostat
+import logs
+
+log = logs.get_logger('namepool')
+
+
+# Unclaimed names kept per service.
+DEFAULT_POOL_SIZE = 3
+
+# Seconds a claimed name is reserved for its claimant to register it.
+DEFAULT_CLAIM_TTL = 600
+
+# Seconds between checks for services whose pool is running low.
+DEFAULT_REFILL_INTERVAL = 5
+
+# Refill intervals the pool counts as active after the last fill.
+ACTIVE_INTERVALS = 3
+
+
+def active_pool(db):
+    """Return the pool aerostatd is filling, or None if it isn't filling one.
+
+    Args:
+        db: mongodb db reference.
+    Returns:
+        NamePool with aerostatd's claim_ttl, or None.
+    """
+    status = db.name_pool_status.find_one({'_id': 'filler'})
+    if not status or status['active_until'] < datetime.datetime.utcnow():
+        return None
+
+    return NamePool(db, claim_ttl=status.get('claim_ttl', DEFAULT_CLAIM_TTL))
+
+
+class NamePool(object):
+    """Maintain and hand out pre-computed hostnames per service."""
+
+    def __init__(self, db, size=DEFAULT_POOL_SIZE, claim_ttl=DEFAULT_CLAIM_TTL):
+        """Initialize object.
+
+        Args:
+            db: mongodb db reference.
+            size: int, unclaimed names to keep per service.
+            claim_ttl: int, seconds a claim reserves its name.
+        """
+        self.db = db
+        self.size = size
+        self.claim_ttl = claim_ttl
+
+    def ensure_indexes(self):
+        """Create the indexes claims and refills rely on."""
+        self.db.name_pool.ensure_index('hostname', unique=True)
+        self.db.name_pool.ensure_index(
+                [('service', 1), ('claimed_by', 1), ('rank', 1)])
+
+    def name_for(self, service, service_type, number):
+        """Build the hostname for a position within a service."""
+        if service_type == 'masterful':
+            if number == 0:
+                return '%s-master' % service
+            return '%s-slave-%s' % (service, number)
+
+        return '%s-%s' % (service, number)
+
+    def free_names(self, service, service_type, count):
+        """Work out the lowest free hostnames for a service.
+
+        Args:
+            service: str, name of service.
+            service_type: str, masterful or iterative.
+            count: int, how many names to return.
+        Returns:
+            list of (int, str) tuples, position and hostname, lowest first.
+        """
+        gaps = []
+        highest = -1
+        for result in self.db.servers.find(
+                {'service': service}, {'hostname': 1, 'instance_id': 1}):
+            number = aerostat.hostname_number(service, result['hostname'])
+            if number is None:
+                continue
+            highest = max(highest, number)
+            if not result['instance_id']:
+                gaps.append((number, result['hostname']))
+
+        names = sorted(gaps)[:count]
+        number = highest + 1
+        while len(names) < count:
+            names.append((number, self.name_for(service, service_type, number)))
+            number += 1
+
+        return names
+
+    def refill(self, service, service_type):
+        """Bring a service's pool back up to size.
+
+        Drops unclaimed entries that are no longer free, claims that have
+        been registered or have expired, and adds the lowest free names that
+        are missing.
+
+        Returns:
+            int, number of names added.
+        """
+        now = datetime.datetime.utcnow()
+        expired = now - datetime.timedelta(seconds=self.claim_ttl)
+        existing = list(self.db.name_pool.find({'service': service}))
+        claims = [entry for entry in existing if entry.get('claimed_by') and
+                  entry['claimed_at'] > expired]
+
+        wanted = self.free_names(service, service_type, self.size + len(claims))
+        wanted_names = set(hostname for _, hostname in wanted)
+
+        stale = [entry['_id'] for entry in existing
+                 if entry['hostname'] not in wanted_names or (
+                     entry.get('claimed_by') and entry['claimed_at'] <= expired)]
+        if stale:
+            self.db.name_pool.remove({'_id': {'$in': stale}})
+
+        pooled = set(entry['hostname'] for entry in existing
+                     if entry['_id'] not in stale)
+        added = 0
+        for rank, hostname in wanted:
+            if hostname in pooled:
+                continue
+            try:
+                self.db.name_pool.insert({'service': service,
+                        'service_type': service_type, 'hostname': hostname,
+                        'rank': rank, 'claimed_by': None}, w=1)
+                added += 1
+            except pymongo.errors.DuplicateKeyError:
+                # Another filler got there first.
+                pass
+
+        if added or stale:
+            log.debug('Name pool for %s: %s added, %s dropped.',
+                    service, added, len(stale))
+        return added
+
+    def is_free(self, hostname):
+        """Whether no live instance holds a hostname."""
+        result = self.db.servers.find_one(
+                {'hostname': hostname}, {'instance_id': 1})
+
+        return result is None or not result['instance_id']
+
+    def claim(self, service, instance_id):
+        """Atomically take the lowest pooled name for a service.
+
+        Args:
+            service: str, name of service.
+            instance_id: str, instance that will register the name.
+        Returns:
+            str, the claimed hostname, or None if the pool is empty.
+        """
+        while True:
+            entry = self.db.name_pool.find_and_modify(
+                    {'service': service, 'claimed_by': None},
+                    {'$set': {'claimed_by': instance_id,
+                              'claimed_at': datetime.datetime.utcnow()}},
+                    sort=[('rank', 1)], new=True)
+            if not entry:
+                return None
+            if self.is_free(entry['hostname']):
+                log.info('Claimed %s from the name pool.',
+                        entry['hostname'])
+                return entry['hostname']
+            # Taken behind the pool's back; the next refill will drop it.
+            log.warn('Pooled name %s is already taken.', entry['hostname'])
+
+    def claimed_names(self, service, instance_id):
+        """Return the names other instances have claimed and not given up.
+
+        Args:
+            service: str, name of service.
+            instance_id: str, the instance asking; its own claims don't count.
+        Returns:
+            set of str, hostnames.
+        """
+        expired = datetime.datetime.utcnow() - datetime.timedelta(
+                seconds=self.claim_ttl)
+
+        return set(entry['hostname'] for entry in self.db.name_pool.find(
+                {'service': service,
+                 'claimed_by': {'$nin': [None, instance_id]},
+                 'claimed_at': {'$gt': expired}}, {'hostname': 1}))
+
+    def reserve(self, service, service_type, hostname, instance_id):
+        """Atomically claim a name worked out outside the pool.
+
+        The name is claimed if it is pooled and unclaimed, or added as a
+        claimed entry if it isn't pooled; the unique index on hostname makes
+        either fail if another node got there first.
+
+        Returns:
+            bool, whether instance_id now holds the claim.
+        """
+        now = datetime.datetime.utcnow()
+        if self.db.name_pool.find_and_modify(
+                {'hostname': hostname, 'claimed_by': {'$in': [None,
+                                                              instance_id]}},
+                {'$set': {'claimed_by': instance_id, 'claimed_at': now}}):
+            return True
+        try:
+            self.db.name_pool.insert({'service': service,
+                    'service_type': service_type, 'hostname': hostname,
+                    'rank': aerostat.hostname_number(service, hostname),
+                    'claimed_by': instance_id, 'claimed_at': now}, w=1)
+        except pymongo.errors.DuplicateKeyError:
+            log.warn('%s is claimed by another instance.', hostname)
+            return False
+
+        return True
+
+    def mark_active(self, seconds):
+        """Tell clients the pool is being filled, for the next seconds."""
+        self.db.name_pool_status.update({'_id': 'filler'},
+                {'$set': {'active_until': datetime.datetime.utcnow() +
+                              datetime.timedelta(seconds=seconds),
+                          'claim_ttl': self.claim_ttl}}, upsert=True)
+
+    def services(self):
+        """Return a dict of service -> service_type for every known service."""
+        results = self.db.servers.aggregate([
+            {'$group': {'_id': '$service',
+                        'service_type': {'$first': '$service_type'}}}],
+            cursor={})
+
+        return dict((result['_id'], result['service_type'])
+                    for result in results if result['_id'])
+
+    def unclaimed_counts(self):
+        """Return a dict of service -> number of unclaimed pooled names."""
+        results = self.db.name_pool.aggregate([
+            {'$match': {'claimed_by': None}},
+            {'$group': {'_id': '$service', 'count': {'$sum': 1}}}],
+            cursor={})
+
+        return dict((result['_id'], result['count']) for result in results)
+
+
+class PoolFiller(threading.Thread):
+    """Keep name pools topped up from a background thread."""
+
+    def __init__(self, pool, interval=DEFAULT_REFILL_INTERVAL, active=None):
+        """Initialize object.
+
+        Args:
+            pool: NamePool to maintain.
+            interval: float, seconds between checks for low pools.
+            active: callable returning bool, whether this process should fill
+            pools right now (e.g. only while it is the leader).
+        """
+        threading.Thread.__init__(self, name='aerostat-pool-filler')
+        self.daemon = True
+        self.pool = pool
+        self.interval = interval
+        self.active = active or (lambda: True)
+        self.lock = threading.Lock()
+        self.dirty = set()
+        self.wakeup = threading.Event()
+
+    def mark_dirty(self, services):
+        """Ask for some services to be refilled straight away."""
+        with self.lock:
+            self.dirty.update(services)
+        self.wakeup.set()
+
+    def fill(self):
+        """Refill every service that is low or has been marked dirty."""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+
+        services = self.pool.services()
+        counts = self.pool.unclaimed_counts()
+        added = 0
+        for service, service_type in services.iteritems():
+            if service in dirty or counts.get(service, 0) < self.pool.size:
+                added += self.pool.refill(service, service_type)
+
+        return added
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if not self.active():
+                continue
+            try:
+                self.fill()
+                self.pool.mark_active(self.interval * ACTIVE_INTERVALS)
+            except Exception, e:
+                log.error('Refilling name pools failed: %r', e)
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+
+"""
+Profiler - Time Aerostat's MongoDB operations from the client side.
+
+pymongo 2.x has no command monitoring, so profile() wraps a database in a
+proxy that times every collection call and hands an Operation record to the
+profiler: which collection, what kind of call, the shape of its filter (field
+names and operators, with the values blanked), how long it took, how many
+documents came back and which Aerostat function made it.
+
+    db = profiler.profile(conn.aerostat, sample_rate=0.1, slow_ms=50)
+    ...
+    db.profiler.log_summary()
+
+Sampled operations are added to per-query totals and passed to any hooks.
+Operations slower than slow_ms are always logged, and optionally appended to
+a file as JSON lines, so rare slow queries aren't lost to sampling.
+"""
+
+import collections
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import pymongo.collection
+
+import logs
+
+log = logs.get_logger('profiler')
+
+
+# Fraction of operations added to the totals and passed to hooks.
+DEFAULT_SAMPLE_RATE = 1.0
+
+# Operations slower than this many milliseconds are logged.
+DEFAULT_SLOW_MS = 100
+
+Operation = collections.namedtuple(
+        'Operation', 'collection op shape duration docs caller')
+
+_THIS_FILE = os.path.splitext(__file__)[0]
+
+
+def filter_shape(spec):
+    """Blank the values in a query, keeping its field names and operators.
+
+    {'instance_id': {'$in': [...]}} becomes {"instance_id": {"$in": "?"}}, so
+    the same query with different values adds up under one shape.
+
+    Args:
+        spec: dict or list, a query, update or pipeline.
+    Returns:
+        str, the shape as sorted JSON.
+    """
+
+    def blank(value):
+        if isinstance(value, dict):
+            return dict((key, blank(item)) for key, item in value.iteritems())
+        if isinstance(value, (list, tuple)) and value and all(
+                isinstance(item, dict) for item in value):
+            return [blank(item) for item in value]
+        return '?'
+
+    if spec is None:
+        return '{}'
+
+    return json.dumps(blank(spec), sort_keys=True)
+
+
+def calling_function():
+    """Name the first function up the stack outside this module."""
+    frame = sys._getframe(1)
+    while frame is not None and os.path.splitext(
+            frame.f_code.co_filename)[0] == _THIS_FILE:
+        frame = frame.f_back
+    if frame is None:
+        return None
+
+    return '%s.%s:%s' % (
+            os.path.splitext(os.path.basename(frame.f_code.co_filename))[0],
+            frame.f_code.co_name, frame.f_lineno)
+
+
+class Profiler(object):
+    """Sample operations, total them per query and log the slow ones."""
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE, slow_ms=DEFAULT_SLOW_MS,
+                 slow_log=None, hooks=None):
+        """Initialize object.
+
+        Args:
+            sample_rate: float, fraction of operations to record, 0 to 1.
+            slow_ms: float, log operations slower than this; None disables.
+            slow_log: str, path to append slow operations to as JSON lines.
+            hooks: list of callables, each passed every sampled Operation.
+        """
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self.hooks = list(hooks or [])
+        self.lock = threading.Lock()
+        # (collection, op, shape) -> [count, seconds, max seconds, docs,
+        # callers].
+        self.stats = {}
+
+    def add_hook(self, hook):
+        """Pass every sampled Operation to hook as well."""
+        self.hooks.append(hook)
+
+    def record(self, collection, op, spec, duration, docs):
+        """Take one finished operation through sampling and the slow log."""
+        slow = self.slow_ms is not None and duration * 1000 >= self.slow_ms
+        sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        if not slow and not sampled:
+            return
+
+        operation = Operation(collection, op, filter_shape(spec), duration,
+                docs, calling_function())
+        if slow:
+            self.log_slow(operation)
+        if sampled:
+            self.add(operation)
+            for hook in self.hooks:
+                try:
+                    hook(operation)
+                except Exception, e:
+                    log.error('Profiler hook %r failed: %r', hook, e)
+
+    def add(self, operation):
+        """Add an operation to the per-query totals."""
+        key = (operation.collection, operation.op, operation.shape)
+        with self.lock:
+            stat = self.stats.get(key)
+            if stat is None:
+                stat = self.stats[key] = [0, 0.0, 0.0, 0, set()]
+            stat[0] += 1
+            stat[1] += operation.duration
+            stat[2] = max(stat[2], operation.duration)
+            stat[3] += operation.docs or 0
+            stat[4].add(operation.caller)
+
+    def log_slow(self, operation):
+        """Log a slow operation, and append it to slow_log if set."""
+        log.warn('Slow mongo %s on %s took %.1fms, %s docs, from %s: %s',
+                operation.op, operation.collection, operation.duration * 1000,
+                operation.docs, operation.caller, operation.shape)
+        if not self.slow_log:
+            return
+
+        entry = operation._asdict()
+        entry['time'] = time.time()
+        try:
+            slow_log = open(self.slow_log, 'a')
+            slow_log.write(json.dumps(entry) + '\n')
+            slow_log.close()
+        except (IOError, OSError), e:
+            log.error('Unable to write to %s: %s', self.slow_log, e)
+
+    def summary(self, top=None):
+        """Return the recorded queries, most total time first.
+
+        Returns:
+            list of dicts with collection, op, shape, count, total_ms,
+            max_ms, docs and callers.
+        """
+        with self.lock:
+            items = [(key, list(stat)) for key, stat in self.stats.items()]
+        rows = []
+        for (collection, op, shape), (count, total, longest, docs,
+                                      callers) in items:
+            rows.append({'collection': collection, 'op': op, 'shape': shape,
+                         'count': count, 'total_ms': total * 1000,
+                         'max_ms': longest * 1000, 'docs': docs,
+                         'callers': sorted(caller for caller in callers
+                                           if caller)})
+        rows.sort(key=lambda row: row['total_ms'], reverse=True)
+
+        return rows[:top] if top else rows
+
+    def log_summary(self, top=10, reset=False):
+        """Log the most expensive queries, optionally starting afresh."""
+        for row in self.summary(top):
+            log.info('mongo %(op)s on %(collection)s: %(count)s calls, '
+                    '%(total_ms).1fms total, %(max_ms).1fms max, %(docs)s '
+                    'docs: %(shape)s from %(callers)s', row)
+        if reset:
+            with self.lock:
+                self.stats = {}
+
+
+class ProfiledCursor(object):
+    """Cursor proxy that times iteration and counts documents returned.
+
+    The operation is recorded once the cursor is exhausted, closed or
+    garbage collected, so a cursor abandoned part way through (a limit, an
+    early break) still counts, with the time spent fetching batches rather
+    than the time between them.
+    """
+
+    def __init__(self, cursor, profiler, collection, op, spec):
+        self._cursor = cursor
+        self._profiler = profiler
+        self._collection = collection
+        self._op = op
+        self._spec = spec
+        self._elapsed = 0.0
+        self._docs = 0
+        self._started = False
+        self._recorded = False
+
+    def __iter__(self):
+        return self
+
+    def __del__(self):
+        # A partly read cursor is never exhausted; record it on the way out.
+        if self.__dict__.get('_started') and not self._recorded:
+            self._finish()
+
+    def next(self):
+        self._started = True
+        start = time.time()
+        try:
+            doc = self._cursor.next()
+        except StopIteration:
+            self._elapsed += time.time() - start
+            self._finish()
+            raise
+        self._elapsed += time.time() - start
+        self._docs += 1
+
+        return doc
+
+    def _finish(self):
+        if not self._recorded:
+            self._recorded = True
+            self._profiler.record(self._collection, self._op, self._spec,
+                    self._elapsed, self._docs)
+
+    def close(self):
+        self._finish()
+        return self._cursor.close()
+
+    def count(self, *args, **kwargs):
+        start = time.time()
+        result = self._cursor.count(*args, **kwargs)
+        self._profiler.record(self._collection, 'count', self._spec,
+                time.time() - start, 0)
+
+        return result
+
+    def distinct(self, key):
+        start = time.time()
+        result = self._cursor.distinct(key)
+        self._profiler.record(self._collection, 'distinct', self._spec,
+                time.time() - start, len(result))
+
+        return result
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            # Sets skip and limit on the cursor itself; keep the proxy.
+            self._cursor[index]
+            return self
+
+        # An index runs a query of its own for a single document.
+        start = time.time()
+        try:
+            doc = self._cursor[index]
+        except IndexError:
+            self._profiler.record(self._collection, self._op, self._spec,
+                    time.time() - start, 0)
+            raise
+        self._profiler.record(self._collection, self._op, self._spec,
+                time.time() - start, 1)
+
+        return doc
+
+    def __len__(self):
+        return len(self._cursor)
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        def chained(*args, **kwargs):
+            # sort(), limit() and friends return the cursor; keep the proxy.
+            result = attr(*args, **kwargs)
+            return self if result is self._cursor else result
+
+        return chained
+
+
+class ProfiledBulk(object):
+    """Bulk operation proxy that times execute()."""
+
+    def __init__(self, bulk, profiler, collection):
+        self._bulk = bulk
+        self._profiler = profiler
+        self._collection = collection
+
+    def execute(self, *args, **kwargs):
+        start = time.time()
+        result = self._bulk.execute(*args, **kwargs)
+        docs = 0
+        if result:
+            docs = (result.get('nModified') or 0) + (
+                    result.get('nRemoved') or 0) + (result.get('nInserted') or 0)
+        self._profiler.record(self._collection, 'bulk', None,
+                time.time() - start, docs)
+
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._bulk, name)
+
+
+class ProfiledCollection(object):
+    """Collection proxy that reports each call to a Profiler."""
+
+    def __init__(self, collection, profiler):
+        self._collection = collection
+        self._profiler = profiler
+        self._name = collection.name
+
+    def _timed(self, op, spec, call, docs):
+        start = time.time()
+        result = call()
+        self._profiler.record(
+                self._name, op, spec, time.time() - start, docs(result))
+
+        return result
+
+    def find(self, spec=None, *args, **kwargs):
+        return ProfiledCursor(self._collection.find(spec, *args, **kwargs),
+                self._profiler, self._name, 'find', spec)
+
+    def aggregate(self, pipeline, **kwargs):
+        result = self._collection.aggregate(pipeline, **kwargs)
+        if isinstance(result, dict):
+            # Pre-cursor servers return the whole result at once.
+            return result
+        return ProfiledCursor(
+                result, self._profiler, self._name, 'aggregate', pipeline)
+
+    def find_one(self, spec=None, *args, **kwargs):
+        return self._timed('find_one', spec,
+                lambda: self._collection.find_one(spec, *args, **kwargs),
+                lambda result: result is not None and 1 or 0)
+
+    def find_and_modify(self, query=None, *args, **kwargs):
+        return self._timed('find_and_modify', query,
+                lambda: self._collection.find_and_modify(
+                    query, *args, **kwargs),
+                lambda result: result is not None and 1 or 0)
+
+    def count(self, *args, **kwargs):
+        return self._timed('count', None,
+                lambda: self._collection.count(*args, **kwargs),
+                lambda result: 0)
+
+    def distinct(self, key):
+        return self._timed('distinct', None,
+                lambda: self._collection.distinct(key), len)
+
+    def update(self, spec, document, *args, **kwargs):
+        return self._timed('update', spec,
+                lambda: self._collection.update(
+                    spec, document, *args, **kwargs), written)
+
+    def remove(self, spec_or_id=None, *args, **kwargs):
+        spec = isinstance(spec_or_id, dict) and spec_or_id or None
+        return self._timed('remove', spec,
+                lambda: self._collection.remove(spec_or_id, *args, **kwargs),
+                written)
+
+    def insert(self, doc_or_docs, *args, **kwargs):
+        return self._timed('insert', None,
+                lambda: self._collection.insert(doc_or_docs, *args, **kwargs),
+                lambda result: isinstance(doc_or_docs, list) and
+                    len(doc_or_docs) or 1)
+
+    def initialize_unordered_bulk_op(self):
+        return ProfiledBulk(self._collection.initialize_unordered_bulk_op(),
+                self._profiler, self._name)
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+
+class ProfiledDatabase(object):
+    """Database proxy whose collections report to a Profiler."""
+
+    def __init__(self, db, profiler):
+        self._db = db
+        self.profiler = profiler
+
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if isinstance(attr, pymongo.collection.Collection):
+            return ProfiledCollection(attr, self.profiler)
+        return attr
+
+    def __getitem__(self, name):
+        return ProfiledCollection(self._db[name], self.profiler)
+
+
+def written(result):
+    """Documents affected, from an acknowledged write's result."""
+    if isinstance(result, dict):
+        return result.get('n') or 0
+    return 0
+
+
+def profile(db, sample_rate=DEFAULT_SAMPLE_RATE, slow_ms=DEFAULT_SLOW_MS,
+            slow_log=None, hooks=None):
+    """Wrap a database so that its operations are profiled.
+
+    Args:
+        db: mongodb db reference.
+        sample_rate: float, fraction of operations to record, 0 to 1.
+        slow_ms: float, log operations slower than this; None disables.
+        slow_log: str, path to append slow operations to as JSON lines.
+        hooks: list of callables, each passed every sampled Operation.
+    Returns:
+        ProfiledDatabase, usable wherever db was; its profiler attribute holds
+        the Profiler.
+    """
+
+    return ProfiledDatabase(db, Profiler(sample_rate, slow_ms, slow_log, hooks))
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""
+Reconciler - Incremental bookkeeping for aerostatd's reconcile loop.
+
+The reconciler remembers what Mongo and EC2 looked like at the end of the last
+cycle, so each new cycle only has to look closely at instances that changed:
+ones that appeared, disappeared, or came back with a different private IP.
+"""
+
+import logs
+
+log = logs.get_logger('reconciler')
+
+
+# Re-read the whole servers collection every this many cycles, to pick up
+# registrations for instances we had no reason to look at.
+DEFAULT_FULL_SYNC_EVERY = 30
+
+
+class Reconciler(object):
+    """Track Mongo and AWS snapshots between aerostatd cycles."""
+
+    def __init__(self, full_sync_every=DEFAULT_FULL_SYNC_EVERY):
+        """Initialize object.
+
+        Args:
+            full_sync_every: int, cycles between full reads of Mongo.
+        """
+        self.full_sync_every = full_sync_every
+        self.cycles = 0
+        # instance_id -> ip, as Aerostat has it.
+        self.mongo = {}
+        # instance_id -> (ip, state), as EC2 had it last cycle.
+        self.aws = {}
+
+    def needs_full_sync(self):
+        """Whether this cycle should re-read every document in Mongo."""
+
+        return self.cycles % self.full_sync_every == 0
+
+    def changed_aws_ids(self, aws):
+        """Find instances that are new, or whose ip or state changed.
+
+        Args:
+            aws: dict of instance_id -> (ip, state), this cycle's inventory.
+        Returns:
+            list of str, instance ids whose Mongo entries need a fresh look.
+        """
+        previous = self.aws
+        return [instance_id for instance_id, value in aws.iteritems()
+                if previous.get(instance_id) != value]
+
+    def load_mongo(self, instances, full=False):
+        """Merge (instance_id, ip) pairs read from Mongo into the snapshot.
+
+        Args:
+            instances: iterable of (str, str), instance id and ip.
+            full: bool, whether instances covers the whole collection, in
+            which case the snapshot is replaced rather than merged.
+        """
+        if full:
+            self.mongo = {}
+        for instance_id, ip in instances:
+            if instance_id:
+                self.mongo[instance_id] = ip
+
+    def plan(self, aws, checked_ids=None):
+        """Work out what needs writing this cycle.
+
+        Args:
+            aws: dict of instance_id -> (ip, state), this cycle's inventory.
+            checked_ids: iterable of str, ids to compare ips for; defaults to
+            every id in the Mongo snapshot.
+        Returns:
+            tuple of (set of str, registered ids that are no longer in EC2 and
+            are candidates for removal; dict of instance_id -> ip, Mongo
+            entries whose ip no longer matches EC2).
+        """
+        # Ids EC2 dropped that were never registered have nothing to blank.
+        gone = set(self.mongo)
+        gone.difference_update(aws)
+
+        if checked_ids is None:
+            checked_ids = self.mongo
+        ip_changes = {}
+        for instance_id in checked_ids:
+            if instance_id not in self.mongo or instance_id not in aws:
+                continue
+            ip = aws[instance_id][0]
+            if ip and ip != self.mongo[instance_id]:
+                log.info('Instance %s moved from %s to %s.', instance_id,
+                        self.mongo[instance_id], ip)
+                ip_changes[instance_id] = ip
+
+        return gone, ip_changes
+
+    def commit(self, aws, removed, ip_changes):
+        """Record this cycle's writes and inventory as the new snapshots.
+
+        Args:
+            aws: dict of instance_id -> (ip, state), this cycle's inventory.
+            removed: iterable of str, ids that were blanked in Mongo.
+            ip_changes: dict of instance_id -> ip, ips that were updated.
+        """
+        removed = set(removed)
+        for instance_id in removed:
+            self.mongo.pop(instance_id, None)
+        self.mongo.update(ip_changes)
+
+        # Instances that went missing but were held back (e.g. their target
+        # failed) keep their old entry, so they aren't treated as new later.
+        snapshot = dict(aws)
+        for instance_id, value in self.aws.iteritems():
+            if instance_id not in snapshot and instance_id in self.mongo:
+                snapshot[instance_id] = value
+        self.aws = snapshot
+        self.cycles += 1
+
+    def patch(self, aws_changes, removed, ip_changes):
+        """Apply writes made outside a full cycle, e.g. from events.
+
+        Args:
+            aws_changes: dict of instance_id -> (ip, state), or None for
+            instances EC2 no longer has running.
+            removed: iterable of str, ids that were blanked in Mongo.
+            ip_changes: dict of instance_id -> ip, ips that were updated.
+        """
+        for instance_id, value in aws_changes.iteritems():
+            if value is None:
+                self.aws.pop(instance_id, None)
+            else:
+                self.aws[instance_id] = value
+        for instance_id in removed:
+            self.mongo.pop(instance_id, None)
+        self.mongo.update(ip_changes)
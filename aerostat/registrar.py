@@ -7,10 +7,23 @@ aerostat.
 
 import os
 import operator
+import time
 
 import aerostat
+import logs
+import metrics
+import storage
 
-from aerostat import logging
+log = logs.get_logger('registrar')
+
+
+# Names tried when reserving a computed name loses to other nodes.
+MAX_RESERVE_ATTEMPTS = 5
+
+REGISTER_SECONDS = metrics.histogram('aerostat_register_seconds',
+        'Time taken by a registration or master change.', ['mode'])
+REGISTRATIONS = metrics.counter('aerostat_registrations_total',
+        'Registrations and master changes by outcome.', ['mode', 'result'])
 
 
 class Registrar(object):
@@ -29,11 +42,11 @@ class Registrar(object):
         User_data is set in the installer config.
         """
         aerostat_info_file = os.environ.get('AEROSTAT_INFO','/etc/aerostat_info')
-        logging.debug('get_types(): opening type info from %s.' % aerostat_info_file)
+        log.debug('get_types(): opening type info from %s.', aerostat_info_file)
         server_info = open(aerostat_info_file, 'r')
-        logging.debug('get_types(): reading type info from %s.' % aerostat_info_file)
+        log.debug('get_types(): reading type info from %s.', aerostat_info_file)
         types = server_info.read().strip().split()
-        logging.debug('recovered type info from %s.' % aerostat_info_file)
+        log.debug('recovered type info from %s.', aerostat_info_file)
         server_info.close()
 
         return types
@@ -47,17 +60,24 @@ class Registrar(object):
         Returns:
             bool, whether or not there are duplicates.
         """
-        if db.servers.find({'instance_id': instance_id}).count() > 0:
-            logging.warning('Duplicate instance found: %s' % instance_id)
+        if storage.get(db).exists('instance_id', instance_id):
+            log.warning('Duplicate instance found: %s', instance_id)
             return True
         return False
 
-    def get_smallest_gap(self, db, service):
-        """Check if there's a gap in the hostname numbers."""
-        gaps = list(db.servers.find({'instance_id': '', 'service': service}))
+    def get_smallest_gap(self, db, service, reserved=()):
+        """Check if there's a gap in the hostname numbers.
+
+        Args:
+            db: pymongo DB instance.
+            service: str, name of service.
+            reserved: collection of str, hostnames to pass over.
+        """
+        gaps = [gap for gap in storage.get(db).gaps(service)
+                if gap['hostname'] not in reserved]
         if len(gaps) > 0:
             # There is a gap
-            logging.info('Gap in hostnames detected.')
+            log.info('Gap in hostnames detected.')
             gaps.sort(key=operator.itemgetter('hostname'))
 
             return gaps[0]['hostname']
@@ -65,13 +85,13 @@ class Registrar(object):
     def hostname_instance_exists(self, db, hostname):
         """Check to see if a given hostname has an instance attached."""
 
-        result = db.servers.find_one({'hostname': hostname})
+        result = storage.get(db).first('hostname', hostname)
         # Should only ever have one instance_id in aerostat.
         if result and result['instance_id']:
-            logging.info('Hostname/instance pair exists for %s' % hostname)
+            log.info('Hostname/instance pair exists for %s', hostname)
             return True
         else:
-            logging.info('Hostname/inst pair does\'t exist for %s' % hostname)
+            log.info('Hostname/inst pair does\'t exist for %s', hostname)
             return False
 
     def alias_exists(self, db, aliases):
@@ -83,14 +103,15 @@ class Registrar(object):
         Returns:
             If matches are found, it returns the aliases for those rows.
         """
-        results = list(db.servers.find({'aliases' : { '$in' : aliases}}))
+        results = storage.get(db).by_aliases(aliases)
         if len(results) > 0:
-            logging.info('Detected at least one alias.')
+            log.info('Detected at least one alias.')
             ret_val = []
             [ret_val.extend(result['aliases']) for result in results]
             return ret_val
 
-    def pick_name(self, db, service, service_type, instance_id):
+    def pick_name(self, db, service, service_type, instance_id,
+                  use_pool=False):
         """Check against the names in the aerostat database.
 
         This is the basic logic behind deciding which names are available.
@@ -101,48 +122,87 @@ class Registrar(object):
             services progression.
             3) this function then returns that string value.
 
+        When aerostatd is filling a name pool, a pooled name is claimed
+        first. Failing that, the computed name passes over names other nodes
+        have claimed and is itself reserved in the pool, so two registering
+        nodes never pick the same one.
+
         Args:
             db: a pymongo.Connection.db instance.
             service: str, the name retrieved from /etc/aerostat_info.
             service_type: str, kind of service hierarchy, masterful or iterative.
             instance_id: str, name of instance, to check for dups.
+            use_pool: bool, try to claim a name aerostatd has already worked
+            out (see namepool) before computing one here.
         Returns:
-            str, the appropriate hostname for the client node.
+            str, the appropriate hostname for the client node, or None.
         """
-        hostname = None
         # Check for duplicates. But only if instances have names.
         if self.check_dup(db, instance_id) and aerostat.get_hostname(
                 db, instance_id):
-            logging.warn('Duplicate instance found')
+            log.warn('Duplicate instance found')
             return None
 
-        results = list(db.servers.find({'service': service}))
+        pool = None
+        if use_pool and storage.get(db).db is not None:
+            import namepool
+            pool = namepool.active_pool(storage.get(db).db)
+        if pool is None:
+            return self.compute_name(db, service, service_type)
+
+        hostname = pool.claim(service, instance_id)
+        if hostname:
+            return hostname
+        reserved = pool.claimed_names(service, instance_id)
+        for _ in range(MAX_RESERVE_ATTEMPTS):
+            hostname = self.compute_name(db, service, service_type, reserved)
+            if pool.reserve(service, service_type, hostname, instance_id):
+                return hostname
+            reserved.add(hostname)
+
+        log.error('Gave up reserving a name for %s after %s attempts.',
+                service, MAX_RESERVE_ATTEMPTS)
+        return None
+
+    def compute_name(self, db, service, service_type, reserved=()):
+        """Work out the next name in a service from the servers it has.
+
+        Args:
+            db: a pymongo.Connection.db instance.
+            service: str, name of service.
+            service_type: str, masterful or iterative.
+            reserved: collection of str, hostnames to pass over.
+        Returns:
+            str, hostname.
+        """
+        results = storage.get(db).by_service(service)
         # We only want to count instances in our service with hostnames.
         named_in_service = [item for item in results if item['hostname']]
         num = len(named_in_service)
-        logging.info('%s number of hosts with same service found' % num)
+        log.info('%s number of hosts with same service found', num)
 
         if service_type == 'masterful':
             master_hostname = '%s-master' % (service,)
-            if not named_in_service:
-                hostname = master_hostname  # first instance will be master.
-            elif aerostat.hostname_exists(db,
-                        master_hostname) and not self.hostname_instance_exists(
-                                db, master_hostname):
-                hostname = master_hostname  # replace fallen master.
-            else:
-                smallest_slave_gap = self.get_smallest_gap(db, service)
-                if smallest_slave_gap:
-                    hostname = smallest_slave_gap
-                else:
-                    hostname = '%s-slave-%s' % (service, num)
+            if master_hostname not in reserved:
+                if not named_in_service:
+                    return master_hostname  # first instance will be master.
+                if aerostat.hostname_exists(db, master_hostname) and (
+                        not self.hostname_instance_exists(
+                            db, master_hostname)):
+                    return master_hostname  # replace fallen master.
+            name_format = '%s-slave-%s'
         else:  # We're iterative.
-            smallest_gap = self.get_smallest_gap(db, service)
-            # find out if there are gaps in the hostnames, use smallest.
-            if smallest_gap:
-                hostname = smallest_gap
-            else:
-                hostname =  '%s-%s' % (service, num) # New instance, no gaps.
+            name_format = '%s-%s'
+
+        # find out if there are gaps in the hostnames, use smallest.
+        hostname = self.get_smallest_gap(db, service, reserved)
+        if hostname:
+            return hostname
+
+        hostname = name_format % (service, num)  # New instance, no gaps.
+        while hostname in reserved:
+            num += 1
+            hostname = name_format % (service, num)
 
         return hostname
 
@@ -156,10 +216,11 @@ class Registrar(object):
         Essentially, we remove all individual instances of an alias among
         all conflicting sets of aliases for our servers.
         """
-        for result in db.servers.find({'aliases' : { '$in': conflicts}}):
+        store = storage.get(db)
+        for result in store.by_aliases(conflicts):
             new_aliases = list(set(result['aliases']) - set(conflicts))
-            db.servers.update({'instance_id': result['instance_id']},
-                    {'$set': {'aliases': new_aliases}})
+            store.update('instance_id', result['instance_id'],
+                    {'aliases': new_aliases})
 
         return True
 
@@ -177,7 +238,8 @@ class Registrar(object):
             service_type: str, name of server category.
             aliases: list of str, alternate names.
         Returns:
-            True if registration succeeded.
+            True if registration succeeded; False if another instance claimed
+            the hostname first.
         """
         if aliases:
             aliases = list(set(aliases))  # remove any duplicates.
@@ -186,19 +248,22 @@ class Registrar(object):
                 # Update Aliases in all hosts to not have said alias anymore.
                 self.reset_conflict_aliases(db, conflicting_aliases)
 
+        store = storage.get(db)
         if aerostat.hostname_exists(db, hostname):
-            # hostname already exists, fill in the gap.
-            db.servers.update(
-                    {'hostname': hostname},
-                    {'$set': {
-                        'ip': local_ip,
-                        'service': service,
-                        'service_type': service_type,
-                        'instance_id': instance_id,
-                        'aliases': aliases}})
+            # hostname already exists, fill in the gap, unless another
+            # instance got there first.
+            if not store.claim(hostname, {
+                    'ip': local_ip,
+                    'service': service,
+                    'service_type': service_type,
+                    'instance_id': instance_id,
+                    'aliases': aliases}):
+                log.error('Hostname %s was claimed by another instance.',
+                        hostname)
+                return False
         else:
             # This is a new host being added to the service cluster.
-            db.servers.insert(
+            store.insert(
                     {'hostname': hostname,
                      'ip': local_ip,
                      'service': service,
@@ -254,11 +319,11 @@ class Registrar(object):
         """Change the hostname of the specified instance or hostname."""
 
         if not inst and not host:
-            logging.error('You need to specify either instance or hostname')
+            log.error('You need to specify either instance or hostname')
             return False
 
         if inst and host:
-            logging.error('You cannot specify both inst and hostname')
+            log.error('You cannot specify both inst and hostname')
             return False
 
         key = 'instance_id'
@@ -266,10 +331,7 @@ class Registrar(object):
             key = 'hostname'
 
         param = inst or host
-        db.servers.update(
-                { key: param},
-                {'$set':
-                    {'hostname': value}})
+        storage.get(db).update(key, param, {'hostname': value})
 
         return True
 
@@ -317,28 +379,63 @@ class Registrar(object):
         Returns:
             bool, True if system settings are correctly changed.
         """
+        mode = change_master and 'change_master' or 'register'
+        start = time.time()
+        try:
+            return self._do_registrar(db, dry_run, change_master, offline)
+        finally:
+            REGISTER_SECONDS.observe(time.time() - start, mode=mode)
+
+    def _do_registrar(self, db, dry_run, change_master, offline):
+        """do_registrar, without the timing."""
 
         service, service_type, aliases = self.parse_service_info()
         instance_id, local_ip = aerostat.get_aws_data(offline)
         if change_master:
-            self.change_master(
+            changed = self.change_master(
                     db, service, service_type, instance_id)
+            REGISTRATIONS.inc(mode='change_master',
+                    result=changed and 'changed' or 'unchanged')
 
             return True
 
-        hostname = self.pick_name(db, service, service_type, instance_id)
-        change_host = False
+        hostname = self.pick_name(db, service, service_type, instance_id,
+                use_pool=not dry_run)
         # If we successfully aquired a hostname (not dup) from mongodb
         if dry_run:
-            logging.debug('DRY RUN: you would register with: %s' % hostname)
+            log.debug('DRY RUN: you would register with: %s', hostname)
+            REGISTRATIONS.inc(mode='register', result='dry_run')
 
             return False
 
-        if hostname:
-            change_host = self.set_sys_hostname(hostname)
-        if change_host:
-            self.register_name(
+        # Register before renaming the system, so losing a claim (to another
+        # node, or to the gap being archived under us) never leaves the host
+        # renamed but unregistered. A lost claim picks a fresh name.
+        registered = False
+        tried = set()
+        for _ in range(MAX_RESERVE_ATTEMPTS):
+            if not hostname or hostname in tried:
+                break
+            tried.add(hostname)
+            registered = self.register_name(
                     db, hostname, local_ip, instance_id, service,
                     service_type, aliases)
+            if registered:
+                break
+            hostname = self.pick_name(db, service, service_type, instance_id,
+                    use_pool=True)
+
+        if not registered:
+            if tried:
+                log.error('Gave up registering a name for %s after %s '
+                        'attempts.', service, len(tried))
+            REGISTRATIONS.inc(mode='register',
+                    result=tried and 'claimed' or 'no_name')
+        elif self.set_sys_hostname(hostname):
+            REGISTRATIONS.inc(mode='register', result='registered')
+        else:
+            log.error('Registered %s, but could not set the system hostname.',
+                    hostname)
+            REGISTRATIONS.inc(mode='register', result='hostname_failed')
 
         return True
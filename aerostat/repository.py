@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""
+Repository - Keep a local copy of the git repo that holds config templates.
+
+Configs may name a template in the repo instead of carrying its source:
+
+    {'name': 'haproxy', 'path': '/etc/haproxy/haproxy.cfg',
+     'template_path': 'haproxy/haproxy.cfg.j2', 'vars': {...}}
+
+Each run fetches only the tip of one branch (a shallow, single-branch fetch,
+so only new commits are transferred), checks it out, and asks which paths
+changed since the commit each config was last rendered from. Templates whose
+paths didn't change are never read again.
+
+Concurrent runs on a node share the checkout; lock() serialises them.
+"""
+
+import contextlib
+import fcntl
+import os
+
+import git
+
+import logs
+
+log = logs.get_logger('repository')
+
+
+DEFAULT_REPO_DIR = '/var/lib/aerostat/templates'
+
+DEFAULT_BRANCH = 'master'
+
+
+class Repository(object):
+    """A shallow, single-branch checkout of a template repo."""
+
+    def __init__(self, url, path=DEFAULT_REPO_DIR, branch=DEFAULT_BRANCH):
+        """Initialize object.
+
+        Args:
+            url: str, the origin repo to fetch from.
+            path: str, directory for the local checkout.
+            branch: str, the branch to follow.
+        """
+        self.url = url
+        self.path = path
+        self.branch = branch
+        self.repo = None
+        self.head = None
+        # since commit -> set of changed paths, for the current head.
+        self.changes = {}
+
+    def open(self):
+        """Open the local checkout, creating it if need be."""
+        if not os.path.isdir(os.path.join(self.path, '.git')):
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self.repo = git.Repo.init(self.path)
+        else:
+            self.repo = git.Repo(self.path)
+        if 'origin' not in [remote.name for remote in self.repo.remotes]:
+            self.repo.create_remote('origin', self.url)
+        elif self.repo.remotes.origin.url != self.url:
+            self.repo.git.remote('set-url', 'origin', self.url)
+
+        return self.repo
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold the checkout for the duration of a sync and render."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        lock_file = open(os.path.join(self.path, '.aerostat.lock'), 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            yield self
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
+
+    def sync(self):
+        """Fetch the branch tip and check it out. Call with the lock held.
+
+        If the fetch fails, the checkout is left as it was, so configs still
+        render from the last commit synced.
+
+        Returns:
+            str, the commit now checked out, or None if there is none.
+        """
+        if self.repo is None:
+            self.open()
+        remote_ref = 'refs/remotes/origin/%s' % self.branch
+        try:
+            self.repo.git.fetch('--depth=1', '--no-tags', 'origin',
+                    '+refs/heads/%s:%s' % (self.branch, remote_ref))
+            head = self.repo.git.rev_parse(remote_ref)
+            if head != self.current():
+                self.repo.git.checkout('--force', '-B', self.branch, head)
+                log.info('Template repo %s now at %s.', self.url, head)
+        except git.GitCommandError, e:
+            log.error('Unable to sync template repo %s: %s',
+                    self.url, e)
+            head = self.current()
+        if head != self.head:
+            self.changes = {}
+        self.head = head
+
+        return head
+
+    def current(self):
+        """Return the commit checked out, or None in a new checkout."""
+        try:
+            return self.repo.git.rev_parse('--verify', '-q', 'HEAD')
+        except git.GitCommandError:
+            return None
+
+    def changed_paths(self, since):
+        """List the paths that differ between a commit and the current head.
+
+        Args:
+            since: str, an earlier commit, or None.
+        Returns:
+            set of str, paths relative to the repo; or None if they can't be
+            known (no earlier commit, or it is no longer in the checkout).
+        """
+        if since is None:
+            return None
+        if since == self.head:
+            return set()
+        if since not in self.changes:
+            try:
+                output = self.repo.git.diff(
+                        '--name-only', '--no-renames', since, self.head)
+            except git.GitCommandError:
+                self.changes[since] = None
+            else:
+                self.changes[since] = set(
+                        line for line in output.splitlines() if line)
+
+        return self.changes[since]
+
+    def read(self, template_path):
+        """Return a template's source from the checkout.
+
+        Raises:
+            IOError: if the template can't be read, or template_path is
+            absolute or leads out of the checkout.
+        """
+        if (os.path.isabs(template_path) or
+                os.pardir in template_path.split(os.sep)):
+            raise IOError('Template path %r is outside the template repo.'
+                    % template_path)
+        full_path = os.path.realpath(os.path.join(self.path, template_path))
+        if not full_path.startswith(os.path.realpath(self.path) + os.sep):
+            # e.g. a symlink committed to the repo.
+            raise IOError('Template path %r is outside the template repo.'
+                    % template_path)
+        template_file = open(full_path, 'rb')
+        try:
+            return template_file.read().decode('utf-8')
+        finally:
+            template_file.close()
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+
+"""
+Snapshot - A compact binary encoding of the Aerostat server set.
+
+A snapshot is a fixed header followed by a body, which may be compressed:
+
+    header: magic 'ASNP', format version, compression, generation, entry
+            count, body length and a CRC32 of the uncompressed body.
+    body:   a string table of service names and types (each stored once),
+            then one record per server: service and type as table indexes,
+            the IPv4 address packed into 4 bytes, and length-prefixed
+            hostname, instance id and aliases. An offset table at the end
+            gives each record's position, so any entry can be read directly.
+
+Uncompressed snapshots can be read in place from an mmap (open_snapshot), so
+a client only decodes the records it touches.
+
+    data = snapshot.encode(db.servers.find(), generation=12, compression='zlib')
+    for server in snapshot.Reader(data):
+        ...
+"""
+
+import hashlib
+import hmac
+import mmap
+import os
+import socket
+import struct
+import zlib
+
+
+MAGIC = 'ASNP'
+VERSION = 1
+
+COMPRESSION = {None: 0, 'zlib': 1, 'zstd': 2}
+COMPRESSION_NAMES = dict((value, key) for key, value in COMPRESSION.items())
+
+# magic, version, compression, reserved, generation, count, body length, crc.
+HEADER = struct.Struct('>4sBBHQIII')
+# service index, service_type index, packed ip.
+RECORD = struct.Struct('>HH4s')
+OFFSET = struct.Struct('>I')
+STRING_LENGTH = struct.Struct('>H')
+
+NO_IP = '\0\0\0\0'
+
+class SnapshotError(Exception):
+    """Raised for snapshots that can't be encoded or decoded."""
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise SnapshotError('zstd compression needs the zstandard package.')
+    return zstandard
+
+
+def compress(body, compression):
+    if compression is None:
+        return body
+    if compression == 'zlib':
+        return zlib.compress(body, 6)
+    if compression == 'zstd':
+        return _zstd().ZstdCompressor().compress(body)
+    raise SnapshotError('Unknown compression %r.' % compression)
+
+
+def decompress(body, compression, length):
+    if compression is None:
+        return body
+    if compression == 'zlib':
+        return zlib.decompress(body)
+    if compression == 'zstd':
+        return _zstd().ZstdDecompressor().decompress(
+                body, max_output_size=length)
+    raise SnapshotError('Unknown compression %r.' % compression)
+
+
+def pack_ip(ip):
+    if not ip:
+        return NO_IP
+    try:
+        return socket.inet_aton(ip)
+    except socket.error:
+        raise SnapshotError('%r is not an IPv4 address.' % ip)
+
+
+def unpack_ip(packed):
+    if packed == NO_IP:
+        return ''
+    return socket.inet_ntoa(packed)
+
+
+def pack_short_string(value):
+    value = (value or '').encode('utf-8')
+    if len(value) > 255:
+        raise SnapshotError('%r is too long for a snapshot.' % value)
+    return chr(len(value)) + value
+
+
+def check_server(server):
+    """Raise SnapshotError if a server can't be encoded in a snapshot."""
+    aliases = server.get('aliases') or []
+    if len(aliases) > 255:
+        raise SnapshotError('%s has too many aliases for a snapshot.' % (
+                server.get('hostname'),))
+    pack_ip(server.get('ip'))
+    for value in [server.get('hostname'), server.get('instance_id')] + list(
+            aliases):
+        pack_short_string(value)
+
+
+class StringTable(object):
+    """Intern repeated strings such as service names."""
+
+    def __init__(self):
+        self.strings = []
+        self.index = {}
+
+    def add(self, value):
+        value = value or ''
+        position = self.index.get(value)
+        if position is None:
+            position = self.index[value] = len(self.strings)
+            self.strings.append(value)
+        return position
+
+    def pack(self):
+        parts = [OFFSET.pack(len(self.strings))]
+        for value in self.strings:
+            value = value.encode('utf-8')
+            parts.append(STRING_LENGTH.pack(len(value)))
+            parts.append(value)
+        return ''.join(parts)
+
+
+def encode_body(servers):
+    """Encode servers into an uncompressed body.
+
+    Returns:
+        tuple of (str, body; int, number of entries).
+    """
+    table = StringTable()
+    records = []
+    for server in servers:
+        aliases = server.get('aliases') or []
+        if len(aliases) > 255:
+            raise SnapshotError('%s has too many aliases for a snapshot.' % (
+                    server.get('hostname'),))
+        records.append(''.join([
+                RECORD.pack(table.add(server.get('service')),
+                            table.add(server.get('service_type')),
+                            pack_ip(server.get('ip'))),
+                pack_short_string(server.get('hostname')),
+                pack_short_string(server.get('instance_id')),
+                chr(len(aliases))] +
+                [pack_short_string(alias) for alias in aliases]))
+
+    strings = table.pack()
+    offsets = []
+    position = len(strings)
+    for record in records:
+        offsets.append(OFFSET.pack(position))
+        position += len(record)
+
+    return strings + ''.join(records) + ''.join(offsets), len(records)
+
+
+def encode(servers, generation=0, compression=None):
+    """Encode a server set as a snapshot.
+
+    Args:
+        servers: iterable of dicts, as found in the servers collection.
+        generation: int, version of the server set this snapshot captures.
+        compression: str, None, 'zlib' or 'zstd'.
+    Returns:
+        str, the snapshot.
+    Raises:
+        SnapshotError: if a server can't be encoded, or zstd is unavailable.
+    """
+    if compression not in COMPRESSION:
+        raise SnapshotError('Unknown compression %r.' % compression)
+    body, count = encode_body(servers)
+    checksum = zlib.crc32(body) & 0xffffffff
+
+    return HEADER.pack(MAGIC, VERSION, COMPRESSION[compression], 0,
+            generation, count, len(body), checksum) + compress(
+                    body, compression)
+
+
+class Reader(object):
+    """Random access to the entries of a snapshot.
+
+    data may be a str or an mmap. Uncompressed bodies are read in place;
+    compressed ones are decompressed once, up front. close() releases an
+    mmap once the entries are no longer needed.
+    """
+
+    def __init__(self, data, verify=True):
+        """Initialize object.
+
+        Args:
+            data: str or mmap, an encoded snapshot.
+            verify: bool, check the body against the header's checksum.
+        Raises:
+            SnapshotError: if the snapshot is malformed or corrupt.
+        """
+        self.mapped = data
+        if len(data) < HEADER.size:
+            raise SnapshotError('Snapshot is truncated.')
+        (magic, version, compression, _, self.generation, self.count,
+         length, checksum) = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise SnapshotError('Not an Aerostat snapshot.')
+        if version != VERSION:
+            raise SnapshotError('Unsupported snapshot version %s.' % version)
+        if compression not in COMPRESSION_NAMES:
+            raise SnapshotError('Unknown compression %s.' % compression)
+        self.compression = COMPRESSION_NAMES[compression]
+
+        if self.compression is None:
+            self.data = data
+            self.base = HEADER.size
+            if len(data) - HEADER.size != length:
+                raise SnapshotError('Snapshot is truncated.')
+        else:
+            self.data = decompress(data[HEADER.size:], self.compression, length)
+            self.base = 0
+            if len(self.data) != length:
+                raise SnapshotError('Snapshot body has the wrong length.')
+        self.length = length
+
+        if verify and zlib.crc32(self.body()) & 0xffffffff != checksum:
+            raise SnapshotError('Snapshot checksum mismatch.')
+
+        self.strings = self.read_strings()
+        self.offsets_at = self.base + length - self.count * OFFSET.size
+
+    def close(self):
+        """Unmap the snapshot, if it was read from a file."""
+        if isinstance(self.mapped, mmap.mmap):
+            self.mapped.close()
+
+    def body(self):
+        if self.base == 0:
+            return self.data
+        return buffer(self.data, self.base, self.length)
+
+    def read_strings(self):
+        position = self.base
+        (count,) = OFFSET.unpack_from(self.data, position)
+        position += OFFSET.size
+        strings = []
+        for _ in xrange(count):
+            (length,) = STRING_LENGTH.unpack_from(self.data, position)
+            position += STRING_LENGTH.size
+            strings.append(self.data[position:position + length])
+            position += length
+        return strings
+
+    def read_short_string(self, position):
+        length = ord(self.data[position])
+        position += 1
+        return self.data[position:position + length], position + length
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        """Decode one entry.
+
+        Returns:
+            dict with hostname, ip, service, service_type, instance_id and
+            aliases.
+        """
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('Snapshot entry %s out of range.' % index)
+        (offset,) = OFFSET.unpack_from(
+                self.data, self.offsets_at + index * OFFSET.size)
+        position = self.base + offset
+        service, service_type, ip = RECORD.unpack_from(self.data, position)
+        position += RECORD.size
+        hostname, position = self.read_short_string(position)
+        instance_id, position = self.read_short_string(position)
+        alias_count = ord(self.data[position])
+        position += 1
+        aliases = []
+        for _ in xrange(alias_count):
+            alias, position = self.read_short_string(position)
+            aliases.append(alias)
+
+        return {'hostname': hostname, 'ip': unpack_ip(ip),
+                'service': self.strings[service],
+                'service_type': self.strings[service_type],
+                'instance_id': instance_id, 'aliases': aliases}
+
+    def __iter__(self):
+        # Records are contiguous, so walk them in one pass rather than going
+        # through the offset table for each.
+        if not self.count:
+            return
+        data = self.data
+        strings = self.strings
+        unpack_record = RECORD.unpack_from
+        record_size = RECORD.size
+        (offset,) = OFFSET.unpack_from(data, self.offsets_at)
+        position = self.base + offset
+        for _ in xrange(self.count):
+            service, service_type, ip = unpack_record(data, position)
+            position += record_size
+            length = ord(data[position])
+            hostname = data[position + 1:position + 1 + length]
+            position += 1 + length
+            length = ord(data[position])
+            instance_id = data[position + 1:position + 1 + length]
+            position += 1 + length
+            alias_count = ord(data[position])
+            position += 1
+            aliases = []
+            for _ in xrange(alias_count):
+                length = ord(data[position])
+                aliases.append(data[position + 1:position + 1 + length])
+                position += 1 + length
+            yield {'hostname': hostname,
+                   'ip': ip != NO_IP and socket.inet_ntoa(ip) or '',
+                   'service': strings[service],
+                   'service_type': strings[service_type],
+                   'instance_id': instance_id,
+                   'aliases': aliases}
+
+
+def decode(data, verify=True):
+    """Decode every entry in a snapshot.
+
+    Returns:
+        tuple of (int, generation; list of dicts, the servers).
+    """
+    reader = Reader(data, verify)
+
+    return reader.generation, list(reader)
+
+
+def sign(key, data):
+    """Sign an encoded snapshot with a shared key.
+
+    The header carries the generation, so the signature vouches for it too;
+    a peer can't pass off an old snapshot as a newer one.
+
+    Returns:
+        str, hex HMAC-SHA256 of the snapshot.
+    """
+
+    return hmac.new(key, str(data), hashlib.sha256).hexdigest()
+
+
+def verify(key, data, signature):
+    """Whether signature is the key's signature of data."""
+
+    return hmac.compare_digest(sign(key, data), str(signature or ''))
+
+
+def write_snapshot(path, data):
+    """Atomically write an encoded snapshot to path."""
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    out = open(tmp_path, 'wb')
+    out.write(data)
+    out.close()
+    os.rename(tmp_path, path)
+
+
+def open_snapshot(path, verify=True):
+    """Open a snapshot file for reading, mapped into memory.
+
+    Returns:
+        Reader over the mapped file; close() it when done.
+    Raises:
+        SnapshotError: if the file is empty, malformed or corrupt.
+    """
+    snapshot_file = open(path, 'rb')
+    try:
+        try:
+            data = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # mmap refuses an empty file.
+            raise SnapshotError('Snapshot is truncated.')
+    finally:
+        snapshot_file.close()
+    try:
+        return Reader(data, verify)
+    except Exception:
+        data.close()
+        raise
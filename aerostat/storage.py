@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+
+"""
+Storage - The operations Aerostat performs on the server set, per backend.
+
+The client, registrar, updater and aerostatd reach the server set through a
+Storage rather than through pymongo directly. Two backends ship:
+
+    MongoStorage:  the servers collection of a Mongo database, as before.
+    SQLiteStorage: a single SQLite file in WAL mode, for small sites that
+                   would rather not run Mongo. Every node must be able to
+                   open the file, e.g. aerostatd and its clients on one host.
+
+Callers that are handed a pymongo database wrap it with get(), so existing
+code and tests pass databases around as they always have:
+
+    store = storage.get(db)
+    store.by_hostname('web-0')
+
+Features built on other Mongo collections (coordination, the name pool,
+compaction, generations, change streams and the Configurer) need a
+MongoStorage; SQLiteStorage.db is None.
+"""
+
+import abc
+import contextlib
+import threading
+
+import masters
+
+# sqlite3 and json are imported by SQLiteStorage, so Mongo clients don't load
+# them at startup.
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS servers (
+    id INTEGER PRIMARY KEY,
+    hostname TEXT NOT NULL DEFAULT '',
+    ip TEXT NOT NULL DEFAULT '',
+    instance_id TEXT NOT NULL DEFAULT '',
+    service TEXT NOT NULL DEFAULT '',
+    service_type TEXT NOT NULL DEFAULT '',
+    aliases TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS aliases (
+    server INTEGER NOT NULL REFERENCES servers (id) ON DELETE CASCADE,
+    alias TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS servers_hostname ON servers (hostname);
+CREATE INDEX IF NOT EXISTS servers_instance_id ON servers (instance_id);
+CREATE INDEX IF NOT EXISTS servers_service_instance_id
+    ON servers (service, instance_id);
+CREATE INDEX IF NOT EXISTS aliases_alias ON aliases (alias);
+CREATE INDEX IF NOT EXISTS aliases_server ON aliases (server);
+"""
+
+SQLITE_FIELDS = ('hostname', 'ip', 'instance_id', 'service', 'service_type',
+                 'aliases')
+
+# Ids per IN (...) clause; SQLite allows 999 parameters by default.
+SQLITE_BATCH_SIZE = 500
+
+
+class Storage(object):
+    """The server set operations every backend provides.
+
+    Servers are dicts with hostname, ip, instance_id, service, service_type
+    and aliases. A hostname whose instance is gone keeps its document with
+    an empty instance_id, as a gap for the next registration to fill.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    # The Mongo database behind this storage, if there is one.
+    db = None
+
+    @abc.abstractmethod
+    def exists(self, key, value):
+        """Whether any server's key field equals value."""
+
+    @abc.abstractmethod
+    def first(self, key, value):
+        """Return one server whose key field equals value, or None."""
+
+    @abc.abstractmethod
+    def by_hostname(self, hostname):
+        """Return the servers registered under hostname."""
+
+    @abc.abstractmethod
+    def by_instance(self, instance_id):
+        """Return the servers registered for an instance."""
+
+    @abc.abstractmethod
+    def by_aliases(self, aliases):
+        """Return the servers carrying any of aliases."""
+
+    @abc.abstractmethod
+    def by_service(self, service):
+        """Return the servers in a service, gaps included."""
+
+    @abc.abstractmethod
+    def gaps(self, service):
+        """Return the hostnames in a service waiting for an instance."""
+
+    @abc.abstractmethod
+    def servers(self, subscription=None):
+        """Iterate over every server, or those subscribed to."""
+
+    def master(self, service):
+        """Return the server documents holding service's master hostname."""
+        return self.by_hostname('%s-master' % service)
+
+    @abc.abstractmethod
+    def instance_ids(self):
+        """Return the instance_id of every server, including empty ones."""
+
+    @abc.abstractmethod
+    def instances(self, instance_ids=None, batch_size=1000):
+        """Yield (instance_id, ip) for servers with instances attached.
+
+        Args:
+            instance_ids: list of str, only look these up; by default scan
+            every server with an instance.
+            batch_size: int, ids to look up per query.
+        """
+
+    @abc.abstractmethod
+    def services_of(self, instance_ids):
+        """Return the services the given instances belong to."""
+
+    @abc.abstractmethod
+    def insert(self, server):
+        """Add a server."""
+
+    @abc.abstractmethod
+    def update(self, key, value, fields):
+        """Set fields on the servers whose key field equals value."""
+
+    @abc.abstractmethod
+    def claim(self, hostname, fields):
+        """Atomically take a hostname, if no instance holds it.
+
+        Returns:
+            bool, whether the hostname was claimed.
+        """
+
+    @abc.abstractmethod
+    def clear_instances(self, instance_ids, write_concern=None):
+        """Detach instances from their hostnames, leaving gaps.
+
+        Returns:
+            int, servers cleared, or None if the backend can't tell.
+        """
+
+    @abc.abstractmethod
+    def update_ips(self, ip_changes, write_concern=None):
+        """Set new ips, given a dict of instance_id -> ip, in one batch."""
+
+
+class MongoStorage(Storage):
+    """The servers collection of a Mongo database."""
+
+    def __init__(self, db, master_max_age=masters.DEFAULT_MAX_AGE):
+        """Initialize object.
+
+        Args:
+            db: mongodb db reference for the aerostat database.
+            master_max_age: float, seconds a master read from the masters
+            view is reused for; writes through this storage drop it.
+        """
+        self.db = db
+        self.masters = masters.Masters(db)
+        self.master_max_age = master_max_age
+
+    def exists(self, key, value):
+        return self.db.servers.find({key: value}).count() > 0
+
+    def first(self, key, value):
+        return self.db.servers.find_one({key: value})
+
+    def by_hostname(self, hostname):
+        return list(self.db.servers.find({'hostname': hostname}))
+
+    def by_instance(self, instance_id):
+        return list(self.db.servers.find({'instance_id': instance_id}))
+
+    def by_aliases(self, aliases):
+        return list(self.db.servers.find({'aliases': {'$in': aliases}}))
+
+    def by_service(self, service):
+        return list(self.db.servers.find({'service': service}))
+
+    def gaps(self, service):
+        return list(self.db.servers.find({'instance_id': '', 'service': service}))
+
+    def servers(self, subscription=None):
+        if subscription is not None:
+            return subscription.find(self.db)
+        return self.db.servers.find()
+
+    def instance_ids(self):
+        return [result['instance_id'] for result in self.db.servers.find(
+                {}, {'instance_id': 1, '_id': 0})]
+
+    def instances(self, instance_ids=None, batch_size=1000):
+        fields = {'instance_id': 1, 'ip': 1, '_id': 0}
+        if instance_ids is None:
+            specs = [{'instance_id': {'$ne': ''}}]
+        else:
+            specs = [{'instance_id': {'$in': instance_ids[i:i + batch_size]}}
+                     for i in range(0, len(instance_ids), batch_size)]
+
+        for spec in specs:
+            for result in self.db.servers.find(spec, fields):
+                yield result['instance_id'], result.get('ip', '')
+
+    def services_of(self, instance_ids):
+        return self.db.servers.find(
+                {'instance_id': {'$in': instance_ids}}).distinct('service')
+
+    def master(self, service):
+        current = self.masters.get(service, self.master_max_age)
+        if current is None:
+            # Not in the view yet; see Masters.rebuild.
+            return self.by_hostname(masters.master_hostname(service))
+        return [current]
+
+    def insert(self, server):
+        self.db.servers.insert(server)
+        if masters.is_master(server):
+            self.masters.assign(server['service'],
+                    server.get('instance_id') or '', server.get('ip') or '')
+
+    def update(self, key, value, fields):
+        if 'hostname' not in fields:
+            self.db.servers.update({key: value}, {'$set': fields})
+            return
+        # The document as it was tells whether a master lost its name.
+        previous = self.db.servers.find_and_modify({key: value},
+                {'$set': fields})
+        if previous is not None:
+            self.masters.renamed(previous, fields['hostname'])
+
+    def claim(self, hostname, fields):
+        # None also matches documents with no instance_id at all.
+        result = self.db.servers.update(
+                {'hostname': hostname, 'instance_id': {'$in': ['', None]}},
+                {'$set': fields}, w=1)
+        claimed = bool(result and result.get('n'))
+        if claimed and hostname == masters.master_hostname(
+                fields.get('service')):
+            self.masters.assign(fields['service'],
+                    fields.get('instance_id') or '', fields.get('ip') or '')
+        return claimed
+
+    def clear_instances(self, instance_ids, write_concern=None):
+        result = self.db.servers.update(
+                {'instance_id': {'$in': instance_ids}},
+                {'$set': {'instance_id': '', 'ip': ''}},
+                multi=True, **(write_concern or {}))
+        self.masters.clear_instances(instance_ids, write_concern)
+        return result.get('n') if result else None
+
+    def update_ips(self, ip_changes, write_concern=None):
+        bulk = self.db.servers.initialize_unordered_bulk_op()
+        for instance_id, ip in sorted(ip_changes.items()):
+            bulk.find({'instance_id': instance_id}).update(
+                    {'$set': {'ip': ip}})
+        bulk.execute(write_concern or {})
+        self.masters.moved(ip_changes)
+
+
+class SQLiteStorage(Storage):
+    """The server set in an SQLite database, in WAL mode.
+
+    WAL lets readers (updaters) carry on while a writer (aerostatd or a
+    registration) commits. Aliases are kept in their own indexed table, so
+    alias lookups don't scan every server.
+    """
+
+    def __init__(self, path, timeout=30.0):
+        """Initialize object.
+
+        Args:
+            path: str, the database file; created if missing.
+            timeout: float, seconds to wait for another writer's lock.
+        """
+        import sqlite3
+
+        self.path = path
+        # Transactions are begun explicitly; see transaction().
+        self.conn = sqlite3.connect(path, timeout=timeout,
+                isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        self.conn.executescript(SQLITE_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Take the write lock up front, so reads within see no other writer."""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    @staticmethod
+    def to_server(row):
+        import json
+
+        server = dict((field, row[field]) for field in SQLITE_FIELDS)
+        server['aliases'] = json.loads(server['aliases'])
+        return server
+
+    def select(self, where='', params=(), limit=None):
+        query = 'SELECT %s FROM servers %s ORDER BY id' % (
+                ', '.join(SQLITE_FIELDS), where)
+        if limit is not None:
+            query += ' LIMIT %d' % limit
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [self.to_server(row) for row in rows]
+
+    @staticmethod
+    def check_key(key):
+        if key not in SQLITE_FIELDS or key == 'aliases':
+            raise ValueError('Cannot select servers by %r.' % key)
+
+    def exists(self, key, value):
+        self.check_key(key)
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM servers WHERE %s = ? '
+                    'LIMIT 1' % key, (value,)).fetchone() is not None
+
+    def first(self, key, value):
+        self.check_key(key)
+        servers = self.select('WHERE %s = ?' % key, (value,), limit=1)
+        return servers and servers[0] or None
+
+    def by_hostname(self, hostname):
+        return self.select('WHERE hostname = ?', (hostname,))
+
+    def by_instance(self, instance_id):
+        return self.select('WHERE instance_id = ?', (instance_id,))
+
+    def by_aliases(self, aliases):
+        aliases = list(aliases)
+        if not aliases:
+            return []
+        return self.select('WHERE id IN (SELECT server FROM aliases '
+                'WHERE alias IN (%s))' % ', '.join('?' * len(aliases)),
+                aliases)
+
+    def by_service(self, service):
+        return self.select('WHERE service = ?', (service,))
+
+    def gaps(self, service):
+        return self.select("WHERE service = ? AND instance_id = ''", (service,))
+
+    def servers(self, subscription=None):
+        servers = self.select()
+        if subscription is None:
+            return servers
+        return [server for server in servers if subscription.matches(server)]
+
+    def instance_ids(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute(
+                    'SELECT instance_id FROM servers')]
+
+    def instances(self, instance_ids=None, batch_size=SQLITE_BATCH_SIZE):
+        batch_size = min(batch_size, SQLITE_BATCH_SIZE)
+        if instance_ids is None:
+            queries = [("SELECT instance_id, ip FROM servers "
+                        "WHERE instance_id != ''", ())]
+        else:
+            queries = [('SELECT instance_id, ip FROM servers '
+                        'WHERE instance_id IN (%s)' % ', '.join('?' * len(
+                            instance_ids[i:i + batch_size])),
+                        instance_ids[i:i + batch_size])
+                       for i in range(0, len(instance_ids), batch_size)]
+
+        for query, params in queries:
+            with self.lock:
+                rows = self.conn.execute(query, params).fetchall()
+            for row in rows:
+                yield row[0], row[1]
+
+    def services_of(self, instance_ids):
+        services = set()
+        for i in range(0, len(instance_ids), SQLITE_BATCH_SIZE):
+            batch = instance_ids[i:i + SQLITE_BATCH_SIZE]
+            with self.lock:
+                services.update(row[0] for row in self.conn.execute(
+                        'SELECT DISTINCT service FROM servers '
+                        'WHERE instance_id IN (%s)' % ', '.join('?' * len(
+                            batch)), batch))
+        return sorted(services)
+
+    def set_aliases(self, server_id, aliases):
+        self.conn.execute('DELETE FROM aliases WHERE server = ?', (server_id,))
+        self.conn.executemany('INSERT INTO aliases (server, alias) VALUES (?, ?)',
+                [(server_id, alias) for alias in set(aliases or [])])
+
+    def write(self, where, params, fields):
+        """Set fields on matching servers in one transaction.
+
+        Args:
+            where: str, a WHERE clause over servers.
+            params: sequence, its parameters.
+            fields: dict of field -> new value.
+
+        Returns:
+            int, servers changed.
+        """
+        import json
+
+        columns = dict(fields)
+        aliases = columns.pop('aliases', None)
+        if 'aliases' in fields:
+            columns['aliases'] = json.dumps(aliases or [])
+        assignments = ', '.join('%s = ?' % column for column in sorted(columns))
+        values = [columns[column] for column in sorted(columns)]
+        with self.transaction() as conn:
+            ids = [row[0] for row in conn.execute(
+                    'SELECT id FROM servers %s' % where, params)]
+            for i in range(0, len(ids), SQLITE_BATCH_SIZE):
+                batch = ids[i:i + SQLITE_BATCH_SIZE]
+                conn.execute('UPDATE servers SET %s WHERE id IN (%s)' % (
+                        assignments, ', '.join('?' * len(batch))),
+                        values + batch)
+            if 'aliases' in fields:
+                for server_id in ids:
+                    self.set_aliases(server_id, aliases)
+        return len(ids)
+
+    def insert(self, server):
+        import json
+
+        values = dict((field, server.get(field) or '') for field in
+                      SQLITE_FIELDS)
+        values['aliases'] = json.dumps(server.get('aliases') or [])
+        with self.transaction() as conn:
+            cursor = conn.execute('INSERT INTO servers (%s) VALUES (%s)' % (
+                    ', '.join(SQLITE_FIELDS),
+                    ', '.join('?' * len(SQLITE_FIELDS))),
+                    [values[field] for field in SQLITE_FIELDS])
+            self.set_aliases(cursor.lastrowid, server.get('aliases'))
+
+    def update(self, key, value, fields):
+        self.check_key(key)
+        self.write('WHERE %s = ?' % key, (value,), fields)
+
+    def claim(self, hostname, fields):
+        return self.write("WHERE hostname = ? AND instance_id = ''",
+                (hostname,), fields) > 0
+
+    def clear_instances(self, instance_ids, write_concern=None):
+        cleared = 0
+        for i in range(0, len(instance_ids), SQLITE_BATCH_SIZE):
+            batch = instance_ids[i:i + SQLITE_BATCH_SIZE]
+            cleared += self.write('WHERE instance_id IN (%s)' % ', '.join(
+                    '?' * len(batch)), batch, {'instance_id': '', 'ip': ''})
+        return cleared
+
+    def update_ips(self, ip_changes, write_concern=None):
+        with self.transaction() as conn:
+            conn.executemany('UPDATE servers SET ip = ? WHERE instance_id = ?',
+                    [(ip, instance_id) for instance_id, ip in
+                     sorted(ip_changes.items())])
+
+
+# (db, MongoStorage) last handed out by get(). Callers pass the same
+# database around, so reusing its storage keeps the masters cache warm.
+_last_wrapped = (None, None)
+
+
+def get(db):
+    """Return the Storage for db, wrapping a pymongo database if need be.
+
+    The wrapper is reused while db is the same database object.
+    """
+    global _last_wrapped
+    if isinstance(db, Storage):
+        return db
+
+    last_db, store = _last_wrapped
+    if last_db is not db:
+        store = MongoStorage(db)
+        _last_wrapped = (db, store)
+
+    return store
+
+
+def open_storage(url):
+    """Open a storage backend by URL.
+
+    Args:
+        url: str, 'sqlite:///path/to/aerostat.db'; Mongo databases are
+        connected to as before and wrapped with get().
+    Returns:
+        Storage.
+    Raises:
+        ValueError: for an unknown scheme.
+    """
+    if url.startswith('sqlite://'):
+        return SQLiteStorage(url[len('sqlite://'):])
+
+    raise ValueError('Unknown storage %r; expected sqlite:///path.' % url)
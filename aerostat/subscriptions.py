@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+"""
+Subscriptions - Limit a client's /etc/hosts to the services it talks to.
+
+A subscription file (by default /etc/aerostat_subscriptions) lists what a node
+needs to resolve, one rule per line:
+
+    # The node's own service, from /etc/aerostat_info.
+    own
+    # Whole services, e.g. this node's dependencies.
+    service mongodb memcache
+    # Hosts carrying an alias; * and ? match as in shell globs.
+    alias mongo-primary-* first-prime
+
+The updater then fetches only matching servers, using the indexes aerostatd
+keeps on service and aliases, so the query, the hosts file and the client's
+memory scale with a node's dependencies rather than the whole fleet.
+"""
+
+import os
+import re
+
+import logs
+
+log = logs.get_logger('subscriptions')
+
+
+DEFAULT_SUBSCRIPTIONS_FILE = '/etc/aerostat_subscriptions'
+
+# The only fields the updater renders.
+FIELDS = {'hostname': 1, 'ip': 1, 'aliases': 1, '_id': 0}
+
+
+def glob_to_regex(pattern):
+    """Translate a shell glob into an anchored regex Mongo can run.
+
+    Patterns with a literal prefix (e.g. 'mongo-*') become prefix regexes,
+    which Mongo answers from the aliases index.
+    """
+    parts = ['^']
+    for char in pattern:
+        if char == '*':
+            parts.append('.*')
+        elif char == '?':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+    parts.append('$')
+
+    return ''.join(parts)
+
+
+class Subscription(object):
+    """A set of services and aliases a node wants in /etc/hosts."""
+
+    def __init__(self, services=(), aliases=(), own=False):
+        """Initialize object.
+
+        Args:
+            services: iterable of str, services to include in full.
+            aliases: iterable of str, aliases or alias globs to include.
+            own: bool, also include this node's own service.
+        """
+        self.services = set(services)
+        self.aliases = set(alias for alias in aliases if not self.is_glob(alias))
+        self.patterns = set(alias for alias in aliases if self.is_glob(alias))
+        self.own = own
+        # File this subscription was read from, and its mtime, for reloads.
+        self.path = None
+        self.mtime = None
+
+    @staticmethod
+    def is_glob(alias):
+        return '*' in alias or '?' in alias
+
+    def resolve_own(self, service):
+        """Add the node's own service, if the subscription asked for it."""
+        if self.own and service:
+            self.services.add(service)
+
+    def query(self):
+        """Build the servers query for this subscription.
+
+        Returns:
+            dict, a Mongo query matching subscribed servers.
+        """
+        clauses = []
+        if self.services:
+            clauses.append({'service': {'$in': sorted(self.services)}})
+        if self.aliases:
+            clauses.append({'aliases': {'$in': sorted(self.aliases)}})
+        for pattern in sorted(self.patterns):
+            clauses.append({'aliases': {'$regex': glob_to_regex(pattern)}})
+        if not clauses:
+            # An empty subscription matches nothing, rather than everything.
+            return {'_id': {'$in': []}}
+        if len(clauses) == 1:
+            return clauses[0]
+
+        return {'$or': clauses}
+
+    def matches(self, server):
+        """Whether a server document falls within this subscription."""
+        if server.get('service') in self.services:
+            return True
+        for alias in server.get('aliases') or []:
+            if alias in self.aliases:
+                return True
+            for pattern in self.patterns:
+                if re.match(glob_to_regex(pattern), alias):
+                    return True
+
+        return False
+
+    def find(self, db):
+        """Fetch the subscribed servers.
+
+        Returns:
+            pymongo cursor of dicts with hostname, ip and aliases.
+        """
+
+        return db.servers.find(self.query(), FIELDS)
+
+
+def parse(lines):
+    """Build a Subscription from the lines of a subscription file.
+
+    Raises:
+        ValueError: on an unknown rule.
+    """
+    services = []
+    aliases = []
+    own = False
+    for line in lines:
+        words = line.split('#', 1)[0].split()
+        if not words:
+            continue
+        rule, values = words[0], words[1:]
+        if rule == 'own':
+            own = True
+        elif rule == 'service':
+            services.extend(values)
+        elif rule == 'alias':
+            aliases.extend(values)
+        else:
+            raise ValueError('Unknown subscription rule %r.' % rule)
+
+    return Subscription(services, aliases, own)
+
+
+def load(path=None):
+    """Read a subscription file, if there is one.
+
+    Args:
+        path: str, subscription file; defaults to $AEROSTAT_SUBSCRIPTIONS or
+        /etc/aerostat_subscriptions.
+    Returns:
+        Subscription, or None if the file doesn't exist (subscribe to all).
+    Raises:
+        ValueError: on an unknown rule, or an own rule without a readable
+        /etc/aerostat_info.
+    """
+    path = path or os.environ.get(
+            'AEROSTAT_SUBSCRIPTIONS', DEFAULT_SUBSCRIPTIONS_FILE)
+    try:
+        mtime = os.stat(path).st_mtime
+        subscription_file = open(path, 'r')
+    except (IOError, OSError):
+        return None
+    try:
+        subscription = parse(subscription_file)
+    finally:
+        subscription_file.close()
+
+    if subscription.own:
+        import registrar
+        try:
+            service = registrar.Registrar().get_types()[0]
+        except (IOError, IndexError), e:
+            raise ValueError('The own rule in %s needs a service in '
+                    'aerostat_info: %s' % (path, e or 'file is empty'))
+        subscription.resolve_own(service)
+    subscription.path = path
+    subscription.mtime = mtime
+    log.debug('Subscribed to services %s, aliases %s from %s.',
+            sorted(subscription.services),
+            sorted(subscription.aliases | subscription.patterns), path)
+
+    return subscription
+
+
+def reload_if_changed(subscription):
+    """Re-read a subscription whose file has changed since it was loaded.
+
+    As with load(), a file that has been removed means all hosts. A file
+    that no longer parses keeps the subscription passed in.
+
+    Returns:
+        Subscription, the new one, the one passed in if unchanged, or None
+        if the file is gone.
+    """
+    if subscription is None or subscription.path is None:
+        return subscription
+    try:
+        mtime = os.stat(subscription.path).st_mtime
+    except OSError:
+        log.info('%s is gone; subscribing to all hosts.', subscription.path)
+        return None
+    if mtime == subscription.mtime:
+        return subscription
+    try:
+        return load(subscription.path)
+    except ValueError, e:
+        log.error('Keeping the previous subscription: %s', e)
+        return subscription
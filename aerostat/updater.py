@@ -8,17 +8,52 @@ import os
 import shutil
 import subprocess
 import sys
+import time
 
-from aerostat import logging
+import logs
+import metrics
+
+# storage, snapshot and subscriptions are imported where they are used; the
+# metrics stay here since every do_update records them.
+
+log = logs.get_logger('updater')
+
+
+UPDATE_SECONDS = metrics.histogram(
+        'aerostat_update_seconds', 'Time taken by an /etc/hosts update.')
+HOSTS_ENTRIES = metrics.gauge(
+        'aerostat_hosts_entries', 'Lines in the Aerostat section of /etc/hosts.')
+HOSTS_BYTES = metrics.counter(
+        'aerostat_hosts_bytes_written_total', 'Bytes written to /etc/hosts.')
+UPDATES = metrics.counter(
+        'aerostat_updates_total', 'Updates by outcome.', ['result'])
 
 
 class Updater(object):
     """Update the /etc/hosts file on the localhost."""
 
-    def __init__(self):
-        """Initialize object."""
+    def __init__(self, subscription=None, snapshot_cache=None,
+                 use_generations=False, gossip=None):
+        """Initialize object.
+
+        Args:
+            subscription: subscriptions.Subscription, limits /etc/hosts to
+            the servers a node needs; None writes the whole fleet.
+            snapshot_cache: str, path to keep a snapshot of the last server
+            set fetched, used when mongo can't be reached.
+            use_generations: bool, follow the generations aerostatd publishes,
+            fetching only patches once the first snapshot is loaded.
+            gossip: gossip.Node, get published snapshots from peers rather
+            than from mongo.
+        """
 
         self.hosts_data = ['127.0.0.1 localhost']
+        self.subscription = subscription
+        self.snapshot_cache = snapshot_cache
+        self.use_generations = use_generations
+        self.gossip = gossip
+        # generations.ServerIndex, when following published generations.
+        self.index = None
 
     def append_hosts_line(self, ip, hostname):
         """Format string appropriate for /etc/hosts file.
@@ -30,8 +65,7 @@ class Updater(object):
             self.hosts_data, appends more hostname -> ip mappings. One mapping
             per list item, which translates into one line in the file.
         """
-        logging.debug('Parsing mapping for host %s and ip %s' % (
-                hostname, ip))
+        log.record('Parsing mapping for host %s and ip %s', hostname, ip)
         self.hosts_data.append('%s %s' % (ip, hostname))
 
     def format_aliases(self, ip, aliases):
@@ -60,7 +94,7 @@ class Updater(object):
         preceding = []
         for line in hosts_content:
             if line.strip() == '# AEROSTAT':
-                logging.info('Scanned to Aerostat Section. Removing.')
+                log.info('Scanned to Aerostat Section. Removing.')
                 break
             else:
                 preceding.append(line.strip())
@@ -97,6 +131,50 @@ class Updater(object):
         hosts_file_write.close()
         os.rename('/etc/hosts.tmp', '/etc/hosts')
 
+        return len(hosts_string)
+
+    def fetch_servers(self, db):
+        """Fetch the (subscribed) server set, keeping the snapshot cache.
+
+        Returns:
+            iterable of dicts with at least hostname, ip and aliases.
+        """
+        import storage
+
+        servers = storage.get(db).servers(self.subscription)
+        if not self.snapshot_cache:
+            return servers
+
+        import pymongo
+        import snapshot
+        try:
+            servers = list(servers)
+        except pymongo.errors.AutoReconnect:
+            if not os.path.exists(self.snapshot_cache):
+                raise
+            error = sys.exc_info()
+            log.warning('Unable to reach mongo. Using the servers cached in '
+                    '%s.', self.snapshot_cache)
+            try:
+                cached = snapshot.open_snapshot(self.snapshot_cache)
+            except (IOError, OSError, snapshot.SnapshotError), e:
+                log.error('Unable to read cached servers in %s: %s',
+                        self.snapshot_cache, e)
+                # Report mongo being down, not the cache.
+                raise error[0], error[1], error[2]
+            try:
+                return list(cached)
+            finally:
+                cached.close()
+
+        try:
+            snapshot.write_snapshot(self.snapshot_cache, snapshot.encode(servers))
+        except (IOError, OSError, snapshot.SnapshotError), e:
+            log.error('Unable to cache servers in %s: %s',
+                    self.snapshot_cache, e)
+
+        return servers
+
     def do_update(self, db, dry_run=None, legacy_updater=None):
         """Update /etc/hosts.
 
@@ -108,39 +186,81 @@ class Updater(object):
         Returns:
             bool, True if changes are made to the system.
         """
+        start = time.time()
+        try:
+            result = self._do_update(db, dry_run, legacy_updater)
+        finally:
+            UPDATE_SECONDS.observe(time.time() - start)
+
+        return result
+
+    def _do_update(self, db, dry_run=None, legacy_updater=None):
+        """do_update, without the timing."""
 
         if legacy_updater:
             # Call legacy host updater, allow it to write to /etc/hosts.
             retcode = subprocess.call([legacy_updater])
             if retcode < 0:
-                logging.error('Call to %s failed!' % legacy_updater)
+                log.error('Call to %s failed!', legacy_updater)
                 sys.exit(1)
 
         self.hosts_data = ['127.0.0.1 localhost']  # Reset data, otherwise we append
-        aerostat_data = db.servers.find()
+        summary = logs.Summary('update')
+        if self.subscription is not None:
+            import subscriptions
+            self.subscription = subscriptions.reload_if_changed(
+                    self.subscription)
+        if self.subscription is not None:
+            summary.add('subscribed')
+        if self.gossip is not None:
+            self.index = self.gossip.sync(db, self.index)
+        elif self.use_generations:
+            import generations
+            self.index = generations.sync(db, self.index)
+
+        if self.index is not None:
+            # Only hosts named in a patch were re-rendered.
+            self.hosts_data.extend(self.index.render(self.subscription))
+            summary.add('generation', self.index.generation)
+            aerostat_data = []
+        else:
+            aerostat_data = self.fetch_servers(db)
 
         # extract hostname, ip and aliases
         for item in aerostat_data:
             if item['ip']:
                 self.append_hosts_line(item['ip'], item['hostname'])
+                summary.add('hosts')
+            else:
+                summary.add('no_ip')
             if item['aliases']:
                 self.format_aliases(item['ip'], item['aliases'])
+                if item['ip']:
+                    summary.add('aliases', len(item['aliases']))
 
         if dry_run:
-            dry_run_output = '\n'.join(self.hosts_data) + '\n'
-            logging.debug(
-                    ('DRY RUN: Your /etc/hosts file would look'
-                    'like this: \n%s' % dry_run_output))
+            if log.enabled():
+                log.debug('DRY RUN: Your /etc/hosts file would look like '
+                        'this: \n%s', '\n'.join(self.hosts_data) + '\n')
+            UPDATES.inc(result='dry_run')
+            summary.add('dry_run')
+            summary.log(log)
             return False
 
+        HOSTS_ENTRIES.set(len(self.hosts_data))
         # Only make any changes if there are actual data available to write.
         if self.hosts_data:
-            logging.info('Copying /etc/hosts to /etc/hosts.bak')
+            log.info('Copying /etc/hosts to /etc/hosts.bak')
             shutil.copyfile('/etc/hosts', '/etc/hosts.bak')
-            logging.info('Writing new /etc/hosts file.')
-            self.write_hosts_file()
+            log.info('Writing new /etc/hosts file.')
+            written_bytes = self.write_hosts_file() or 0
+            HOSTS_BYTES.inc(written_bytes)
+            UPDATES.inc(result='written')
+            summary.add('bytes', written_bytes)
         else:
-            logging.error('No data returned from aerostat. Write aborted.')
+            log.error('No data returned from aerostat. Write aborted.')
+            UPDATES.inc(result='no_data')
+        summary.log(log)
 
         return True
 
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+Coordination benchmark - Run several aerostatd replicas against one mongod.
+
+Each replica is a separate process running the real Coordinator against a
+scratch database. Part way through, the current leader is killed; we report
+how long it takes for a new leader to be elected and for its targets to be
+picked up by the survivors, and check that no target is ever owned twice once
+things settle.
+
+Usage:
+    python benchmarks/coordination.py [--server=localhost] [--replicas=3]
+"""
+
+import multiprocessing
+import os
+import Queue
+import sys
+import time
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aerostat import aerostat
+from aerostat import coordinator
+
+
+SCRATCH_DB = 'aerostat_coordination_bench'
+
+
+def replica_loop(replica_id, server, port, keys, lease_seconds, reports):
+    """Heartbeat, contend for leadership and report ownership, forever."""
+    conn = aerostat.db_connect(server, port)
+    coord = coordinator.Coordinator(
+            conn[SCRATCH_DB], replica_id, lease_seconds)
+    while True:
+        coord.heartbeat()
+        leader = coord.acquire_leadership()
+        reports.put((time.time(), replica_id, leader, coord.assign(keys)))
+        time.sleep(lease_seconds / 3.0)
+
+
+def settled(latest, alive, keys):
+    """Whether the live replicas agree on one leader and a clean split."""
+    views = [latest[replica_id] for replica_id in alive if replica_id in latest]
+    if len(views) != len(alive):
+        return False
+    leaders = [view for view in views if view[0]]
+    owned = []
+    for view in views:
+        owned.extend(view[1])
+
+    return len(leaders) == 1 and sorted(owned) == sorted(keys)
+
+
+def main():
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('--server', dest='server', default='localhost')
+    parser.add_option('--port', dest='port', type='int', default=27017)
+    parser.add_option('--replicas', dest='replicas', type='int', default=3)
+    parser.add_option('--targets', dest='targets', type='int', default=12)
+    parser.add_option('--lease', dest='lease', type='float', default=6.0,
+            help='Lease length in seconds.')
+    parser.add_option('--timeout', dest='timeout', type='float', default=60.0,
+            help='Give up waiting for the cluster to settle after this long.')
+    (options, args) = parser.parse_args()
+
+    conn = aerostat.db_connect(options.server, options.port)
+    conn.drop_database(SCRATCH_DB)
+    coordinator.Coordinator(conn[SCRATCH_DB]).ensure_indexes()
+
+    keys = ['target-%s' % i for i in range(options.targets)]
+    reports = multiprocessing.Queue()
+    procs = {}
+    for i in range(options.replicas):
+        replica_id = 'replica-%s' % i
+        procs[replica_id] = multiprocessing.Process(target=replica_loop,
+                args=(replica_id, options.server, options.port, keys,
+                      options.lease, reports))
+        procs[replica_id].start()
+
+    latest = {}
+    alive = set(procs)
+    start = time.time()
+    killed_at = None
+    killed = None
+    try:
+        while time.time() - start < options.timeout:
+            try:
+                stamp, replica_id, leader, owned = reports.get(True, 1)
+            except Queue.Empty:
+                continue
+            if replica_id not in alive:
+                continue
+            latest[replica_id] = (leader, owned, stamp)
+
+            if not settled(latest, alive, keys):
+                continue
+            if killed is None:
+                print('settled with %s replicas after %.2fs' % (
+                        len(alive), time.time() - start))
+                killed = [r for r in alive if latest[r][0]][0]
+                procs[killed].terminate()
+                alive.discard(killed)
+                for replica_id in list(latest):
+                    del latest[replica_id]
+                killed_at = time.time()
+                print('killed leader %s' % killed)
+            else:
+                print('re-settled without %s after %.2fs (lease %.1fs)' % (
+                        killed, time.time() - killed_at, options.lease))
+                break
+        else:
+            print('did not settle within %.0fs' % options.timeout)
+    finally:
+        for proc in procs.values():
+            proc.terminate()
+        conn.drop_database(SCRATCH_DB)
+
+
+if __name__ == '__main__':
+    main()
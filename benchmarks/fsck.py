@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""
+Fsck benchmark - Time a scan and repair of a large servers collection.
+
+Loads a synthetic fleet into a scratch database, breaks a known number of
+invariants of each kind (duplicate hostnames and instance_ids, second
+masters, alias collisions, missing slots, orphaned tombstones), then times
+fsck's scan, its repair, and a second scan that should come back clean.
+The scratch database is dropped afterwards.
+
+Usage:
+    python benchmarks/fsck.py [--servers=100000] [--broken=50]
+        [--server=localhost]
+"""
+
+import os
+import sys
+import time
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aerostat import aerostat
+from aerostat import fsck
+
+
+SCRATCH_DB = 'aerostat_fsck_bench'
+
+
+def fleet(servers, services):
+    """Make a healthy fleet; every fourth service is masterful."""
+    for i in xrange(servers):
+        service = i % services
+        number = i / services
+        if service % 4 == 0:
+            hostname = (number and 'service%s-slave-%s' % (service, number) or
+                        'service%s-master' % service)
+        else:
+            hostname = 'service%s-%s' % (service, number)
+        yield {'hostname': hostname,
+               'ip': '10.%s.%s.%s' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+               'service': 'service%s' % service,
+               'service_type': service % 4 == 0 and 'masterful' or 'iterative',
+               'instance_id': 'i-%08x' % i,
+               'aliases': ['%s-alias' % hostname]}
+
+
+def break_fleet(db, broken, services):
+    """Break broken invariants of each kind."""
+    servers = db.servers
+    for i in range(broken):
+        service = 'service%s' % (i * 4 % services)
+        # A second master (and so a duplicate hostname).
+        servers.insert({'hostname': '%s-master' % service, 'ip': '10.255.0.1',
+                        'service': service, 'service_type': 'masterful',
+                        'instance_id': 'i-master%s' % i, 'aliases': []})
+        # One instance under two names.
+        servers.insert({'hostname': 'dup-%s' % i, 'ip': '10.255.0.2',
+                        'service': 'dup', 'service_type': 'iterative',
+                        'instance_id': 'i-%08x' % i, 'aliases': []})
+        # Aliases held twice.
+        servers.update({'instance_id': 'i-%08x' % (i + broken)},
+                       {'$push': {'aliases': 'shared-%s' % i}})
+        servers.update({'instance_id': 'i-%08x' % (i + 2 * broken)},
+                       {'$push': {'aliases': 'shared-%s' % i}})
+        # Orphaned tombstones.
+        servers.insert({'hostname': '', 'ip': '', 'service': 'gone',
+                        'service_type': 'iterative', 'instance_id': '',
+                        'aliases': []})
+    # Missing slots: take some hosts out of the middle of their services.
+    for i in range(broken):
+        servers.remove({'instance_id': 'i-%08x' % (services * 2 + i)})
+
+
+def timed(label, func, *args):
+    start = time.time()
+    result = func(*args)
+    print('%-8s %8.2fs' % (label, time.time() - start))
+    return result
+
+
+def report(scan):
+    return ', '.join('%s %s' % (len(scan[problem]), problem)
+                     for problem in fsck.PROBLEMS)
+
+
+def main():
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('--servers', dest='servers', type='int', default=100000)
+    parser.add_option('--services', dest='services', type='int', default=400)
+    parser.add_option('--broken', dest='broken', type='int', default=50,
+                      help='invariants broken of each kind.')
+    parser.add_option('--server', dest='server', default='localhost')
+    parser.add_option('--port', dest='port', type='int', default=27017)
+    (options, args) = parser.parse_args()
+
+    conn = aerostat.db_connect(options.server, options.port)
+    conn.drop_database(SCRATCH_DB)
+    db = conn[SCRATCH_DB]
+    try:
+        batch = []
+        for server in fleet(options.servers, options.services):
+            batch.append(server)
+            if len(batch) == 1000:
+                db.servers.insert(batch)
+                batch = []
+        if batch:
+            db.servers.insert(batch)
+        db.servers.ensure_index('instance_id')
+        break_fleet(db, options.broken, options.services)
+        print('%s documents, %s broken invariants of each kind' % (
+                db.servers.count(), options.broken))
+
+        checker = fsck.Fsck(db)
+        scan = timed('scan', checker.scan)
+        print('  found %s' % report(scan))
+        timed('repair', checker.repair, scan)
+        scan = timed('rescan', checker.scan)
+        print('  found %s' % report(scan))
+    finally:
+        conn.drop_database(SCRATCH_DB)
+
+
+if __name__ == '__main__':
+    main()
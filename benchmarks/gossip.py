@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""
+Gossip benchmark - Simulate peer snapshot distribution with local processes.
+
+Runs one process per client, each a real gossip.Node serving on localhost,
+and stands in for Mongo with an HTTP origin in this process that counts
+every read. Each round a new generation is published at the origin, and we
+report how long the fleet takes to converge on it, how many clients read
+the origin, and how many snapshots were downloaded from it versus from
+peers. Clients cycle every --interval seconds, so time is compressed: a
+60s daemon cycle at --interval=0.2 runs 300 times faster.
+
+Usage:
+    python benchmarks/gossip.py [--nodes=50] [--rounds=3] [--interval=0.2]
+"""
+
+import BaseHTTPServer
+import multiprocessing
+import os
+import Queue
+import random
+import sys
+import threading
+import time
+import urllib2
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aerostat import gossip
+from aerostat import snapshot
+
+
+class Origin(object):
+    """Publishes signed generations and counts reads, like aerostatd's Mongo."""
+
+    def __init__(self, key, servers):
+        self.key = key
+        self.servers = servers
+        self.generation = 0
+        self.data = None
+        self.signature = None
+        self.lock = threading.Lock()
+        self.reads = {'/generation': 0, '/snapshot': 0}
+
+    def publish(self):
+        with self.lock:
+            self.generation += 1
+            # Move a few hosts, as a sweep would.
+            for server in random.sample(self.servers, 5):
+                server['ip'] = '10.9.%s.%s' % (random.randrange(256),
+                                               random.randrange(256))
+            self.data = snapshot.encode(self.servers, self.generation, 'zlib')
+            self.signature = snapshot.sign(self.key, self.data)
+        return self.generation
+
+    def serve(self):
+        origin = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                with origin.lock:
+                    origin.reads[self.path] = origin.reads.get(self.path, 0) + 1
+                    if self.path == '/generation':
+                        body = str(origin.generation)
+                    else:
+                        body = origin.data or ''
+                    signature = origin.signature or ''
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('X-Aerostat-Signature', signature)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        server.request_queue_size = 1024
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server.server_port
+
+
+def origin_source(origin_port):
+    """A gossip source reading the origin instead of Mongo."""
+
+    def source(db, generation):
+        base = 'http://127.0.0.1:%s' % origin_port
+        if int(urllib2.urlopen(base + '/generation').read()) <= generation:
+            return None
+        response = urllib2.urlopen(base + '/snapshot')
+        return (response.read(),
+                response.info().getheader('X-Aerostat-Signature'))
+
+    return source
+
+
+def node_loop(i, ports, key, origin_port, options, reports):
+    """Run one client: gossip every interval, report each new generation."""
+    node = gossip.Node(key,
+            peers=['127.0.0.1:%s' % port for port in ports if port != ports[i]],
+            node_id='node-%s' % i, port=ports[i], fanout=options.fanout,
+            seed_fraction=options.seed_fraction, min_seeds=options.min_seeds,
+            fleet=['node-%s' % j for j in range(len(ports))],
+            fallback_seconds=options.fallback, timeout=1,
+            source=origin_source(origin_port))
+    node.serve(host='127.0.0.1')
+    reports.put(('ready', i, node.seed, time.time()))
+    generation = 0
+    index = None
+    while True:
+        time.sleep(options.interval * random.uniform(0.5, 1.5))
+        index = node.sync(None, index)
+        if node.generation != generation:
+            generation = node.generation
+            reports.put(('generation', i, generation, time.time()))
+
+
+def main():
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('--nodes', dest='nodes', type='int', default=50)
+    parser.add_option('--servers', dest='servers', type='int', default=5000,
+                      help='hosts in the simulated server set.')
+    parser.add_option('--rounds', dest='rounds', type='int', default=3)
+    parser.add_option('--interval', dest='interval', type='float', default=0.2,
+                      help='seconds between a client\'s cycles.')
+    parser.add_option('--fanout', dest='fanout', type='int',
+                      default=gossip.DEFAULT_FANOUT)
+    parser.add_option('--seed-fraction', dest='seed_fraction', type='float',
+                      default=gossip.DEFAULT_SEED_FRACTION)
+    parser.add_option('--min-seeds', dest='min_seeds', type='int',
+                      default=gossip.DEFAULT_MIN_SEEDS)
+    parser.add_option('--fallback', dest='fallback', type='float', default=30,
+                      help='seconds without news before a client reads the '
+                      'origin itself.')
+    parser.add_option('--port', dest='port', type='int', default=27100)
+    parser.add_option('--timeout', dest='timeout', type='float', default=60)
+    (options, args) = parser.parse_args()
+
+    key = os.urandom(16).encode('hex')
+    servers = [{'hostname': 'web-%s' % i, 'ip': '10.0.%s.%s' % (i >> 8 & 255,
+                i & 255), 'service': 'web', 'service_type': 'iterative',
+                'instance_id': 'i-%s' % i, 'aliases': []}
+               for i in range(options.servers)]
+    origin = Origin(key, servers)
+    origin_port = origin.serve()
+    ports = [options.port + i for i in range(options.nodes)]
+    reports = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=node_loop,
+            args=(i, ports, key, origin_port, options, reports))
+            for i in range(options.nodes)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+
+    seeds = 0
+    for _ in range(options.nodes):
+        _, _, seed, _ = reports.get(timeout=options.timeout)
+        seeds += seed
+    print('%s nodes, %s seeds, cycle %.2fs, fanout %s' % (
+            options.nodes, seeds, options.interval, options.fanout))
+    print('%-6s %10s %10s %10s %14s %14s %12s' % ('round', 'p50', 'p99',
+            'converged', 'origin reads/s', 'origin snaps', 'peer snaps'))
+
+    try:
+        for _ in range(options.rounds):
+            reads = dict(origin.reads)
+            generation = origin.publish()
+            published = time.time()
+            arrivals = []
+            while len(arrivals) < options.nodes:
+                try:
+                    kind, i, node_generation, at = reports.get(
+                            timeout=max(published + options.timeout -
+                                        time.time(), 0.01))
+                except Queue.Empty:
+                    break
+                if kind == 'generation' and node_generation == generation:
+                    arrivals.append(at - published)
+            elapsed = time.time() - published
+            arrivals.sort()
+            origin_snapshots = origin.reads['/snapshot'] - reads['/snapshot']
+            if arrivals:
+                print('%-6s %9.2fs %9.2fs %6s/%-3s %14.1f %14s %12s' % (
+                        generation, arrivals[len(arrivals) / 2],
+                        arrivals[int(len(arrivals) * 0.99)],
+                        len(arrivals), options.nodes,
+                        (origin.reads['/generation'] - reads['/generation']) /
+                            elapsed,
+                        origin_snapshots, len(arrivals) - origin_snapshots))
+            else:
+                print('%-6s no node converged within %ss' % (
+                        generation, options.timeout))
+            # Let stragglers' reports drain before the next round.
+            time.sleep(options.interval * 2)
+        print('Without gossip every node reads the origin each cycle: '
+              '%.1f reads/s.' % (options.nodes / options.interval))
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
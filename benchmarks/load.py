@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+
+"""
+Load benchmark - Simulate a fleet of Aerostat clients against one backend.
+
+Runs simulated 'aerostat --update --daemon' clients, each a real Updater
+doing a dry run every --interval seconds, alongside a stream of
+registrations through the real Registrar (each replacing a terminated
+instance, so the fleet keeps its size) and change_master churn in masterful
+services. Some services are alias heavy: their hosts carry many aliases and
+registrations take over shared ones, so alias conflicts are resolved too.
+
+Clients are spread over worker processes and threads, each thread with its
+own connection, and operations are scheduled open loop: they fall due at
+fixed rates whether or not earlier ones have finished. Load is ramped in
+--steps equal steps up to the full --daemons and --registrations. Each step
+reports throughput offered and achieved, storage calls per second (and
+Mongo's opcounters when running against a mongod) and p50/p99 latency per
+operation. Throughput saturates at the first step that leaves more than 10%
+of the operations that fell due unrun when the step ends.
+
+SQLite always runs, in a scratch file; with --server the run is against
+a scratch database on that mongod instead, dropped afterwards.
+
+Usage:
+    python benchmarks/load.py [--daemons=500] [--interval=5]
+        [--registrations=5] [--server=localhost]
+"""
+
+import heapq
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aerostat import aerostat
+from aerostat import logs
+from aerostat import registrar
+from aerostat import storage
+from aerostat import updater
+
+
+SCRATCH_DB = 'aerostat_load_bench'
+
+OPERATIONS = ('update', 'register', 'terminate', 'change_master')
+
+# The storage operations the client, updater and registrar use.
+STORAGE_CALLS = ('exists', 'first', 'by_hostname', 'by_instance',
+                 'by_aliases', 'by_service', 'gaps', 'servers', 'master',
+                 'instance_ids', 'instances', 'services_of', 'insert',
+                 'update', 'claim', 'clear_instances', 'update_ips')
+
+# Shared aliases per alias heavy service, fought over by registrations.
+SHARED_ALIASES = 8
+
+# A step saturates when more than this share of what fell due never ran.
+SATURATED = 0.1
+
+
+def counted(name):
+    def call(self, *args, **kwargs):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        return getattr(self.store, name)(*args, **kwargs)
+    return call
+
+
+class CountingStorage(object):
+    """Counts calls on a storage: the load its backend serves."""
+
+    def __init__(self, store):
+        self.store = store
+        self.db = store.db
+        self.calls = {}
+
+
+for _name in STORAGE_CALLS:
+    setattr(CountingStorage, _name, counted(_name))
+# Storage is abstract; its methods are only set once the class exists.
+storage.Storage.register(CountingStorage)
+
+
+def service_names(services, alias_heavy):
+    """Return (name, service_type, alias heavy) per service.
+
+    Every fourth service is masterful.
+    """
+    return [('service%s' % i, i % 4 == 0 and 'masterful' or 'iterative',
+             i < services * alias_heavy) for i in range(services)]
+
+
+def fleet(servers, services, aliases):
+    """Make a fleet of servers spread over services."""
+    for i in xrange(servers):
+        name, service_type, heavy = services[i % len(services)]
+        number = i / len(services)
+        if service_type == 'masterful':
+            hostname = (number and '%s-slave-%s' % (name, number) or
+                        '%s-master' % name)
+        else:
+            hostname = '%s-%s' % (name, number)
+        host_aliases = []
+        if heavy:
+            host_aliases = ['%s-alias-%s' % (hostname, j)
+                            for j in range(aliases)]
+            if number < SHARED_ALIASES:
+                host_aliases.append('%s-vip-%s' % (name, number))
+        yield {'hostname': hostname,
+               'ip': '10.%s.%s.%s' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+               'service': name, 'service_type': service_type,
+               'instance_id': 'i-%08x' % i, 'aliases': host_aliases}
+
+
+class Client(object):
+    """One thread's share of the simulated fleet and its operations."""
+
+    def __init__(self, store, name, services, daemons, options, scale):
+        self.store = CountingStorage(store)
+        self.name = name
+        self.services = services
+        self.masterful = [service for service in services
+                          if service[1] == 'masterful']
+        self.updaters = [updater.Updater() for _ in range(daemons)]
+        self.registrar = registrar.Registrar()
+        self.interval = options.interval
+        self.aliases = options.aliases
+        self.register_rate = options.registrations * scale
+        self.change_master_rate = options.change_masters * scale
+        self.registered = 0
+        self.latencies = dict((operation, []) for operation in OPERATIONS)
+        self.lag = []
+        self.ran = 0
+        self.missed = 0
+
+    def update(self, i):
+        self.updaters[i].do_update(self.store, dry_run=True)
+
+    def terminate(self, service):
+        """Clear a random instance of service, as aerostatd would."""
+        instance_ids = [server['instance_id'] for server in
+                        self.store.by_service(service) if
+                        server['instance_id']]
+        if instance_ids:
+            self.store.clear_instances([random.choice(instance_ids)])
+
+    def register(self, service, service_type, heavy):
+        self.registered += 1
+        instance_id = 'i-%s-%06x' % (self.name, self.registered)
+        aliases = []
+        if heavy:
+            aliases = random.sample(['%s-vip-%s' % (service, j) for j in
+                                     range(SHARED_ALIASES)], 2)
+        hostname = self.registrar.pick_name(
+                self.store, service, service_type, instance_id)
+        if hostname:
+            aliases.extend('%s-alias-%s' % (hostname, j)
+                           for j in range(heavy and self.aliases or 0))
+            self.registrar.register_name(self.store, hostname, '10.255.0.1',
+                    instance_id, service, service_type, aliases)
+
+    def change_master(self, service):
+        """Promote a random slave of service."""
+        slaves = [server['instance_id'] for server in
+                  self.store.by_service(service) if server['instance_id'] and
+                  server['hostname'] != '%s-master' % service]
+        if slaves:
+            self.registrar.change_master(self.store, service, 'masterful',
+                    random.choice(slaves))
+
+    def timed(self, operation, func, *args):
+        start = time.time()
+        func(*args)
+        self.latencies[operation].append(time.time() - start)
+
+    def run(self, start, duration):
+        """Run operations as they fall due until start + duration."""
+        end = start + duration
+        due = [(start + random.uniform(0, self.interval), 'update', i)
+               for i in range(len(self.updaters))]
+        if self.register_rate:
+            due.append((start + random.expovariate(self.register_rate),
+                        'register', None))
+        if self.change_master_rate and self.masterful:
+            due.append((start + random.expovariate(self.change_master_rate),
+                        'change_master', None))
+        heapq.heapify(due)
+        # Stop on time even when behind: what was missed is the shortfall.
+        while due and due[0][0] < end and time.time() < end:
+            at, kind, i = heapq.heappop(due)
+            now = time.time()
+            if at > now:
+                time.sleep(at - now)
+            else:
+                self.lag.append(now - at)
+            self.ran += 1
+            if kind == 'update':
+                self.timed('update', self.update, i)
+                heapq.heappush(due, (at + self.interval, kind, i))
+            elif kind == 'register':
+                service = random.choice(self.services)
+                self.timed('terminate', self.terminate, service[0])
+                self.timed('register', self.register, *service)
+                heapq.heappush(due, (at + random.expovariate(
+                        self.register_rate), kind, i))
+            else:
+                service = random.choice(self.masterful)
+                self.timed('change_master', self.change_master, service[0])
+                heapq.heappush(due, (at + random.expovariate(
+                        self.change_master_rate), kind, i))
+        # Each stream left behind missed its next operation and, on average,
+        # one more for every period it was late by.
+        rates = {'update': 1.0 / self.interval,
+                 'register': self.register_rate,
+                 'change_master': self.change_master_rate}
+        for at, kind, _ in due:
+            if at < end:
+                self.missed += 1 + int((end - at) * rates[kind])
+
+
+def open_store(options, url):
+    if options.server:
+        conn = aerostat.db_connect(options.server, options.port)
+        return storage.MongoStorage(conn[SCRATCH_DB])
+
+    return storage.open_storage(url)
+
+
+def worker(worker_id, options, url, services, daemons, scale, start, results):
+    """Run a worker process's threads, then report what they measured."""
+    logs.set_levels(dict((component, logging.ERROR) for component in
+                         ('client', 'registrar', 'updater')))
+    random.seed()
+    threads = options.threads
+    clients = [Client(open_store(options, url), '%s-%s' % (worker_id, t),
+                      services, daemons / threads + (t < daemons % threads),
+                      options, scale / (options.workers * threads))
+               for t in range(threads)]
+    runners = [threading.Thread(target=client.run,
+                                args=(start, options.duration))
+               for client in clients]
+    for runner in runners:
+        runner.start()
+    for runner in runners:
+        runner.join()
+
+    for client in clients:
+        results.put((client.latencies, client.lag, client.store.calls,
+                     client.ran, client.missed))
+
+
+def opcounters(options):
+    """Mongo's server side operation counts, if running against a mongod."""
+    if not options.server:
+        return {}
+    conn = aerostat.db_connect(options.server, options.port)
+    return dict(conn.admin.command('serverStatus')['opcounters'])
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run_step(options, url, services, fraction):
+    """Run one step at fraction of the full load.
+
+    Returns:
+        dict of operation -> latencies, list of lags, dict of storage calls,
+        operations run and missed, and dict of opcounters deltas.
+    """
+    daemons = int(options.daemons * fraction)
+    # Give the workers a second to connect before the clock starts.
+    start = time.time() + 1
+    before = opcounters(options)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker,
+            args=(w, options, url, services,
+                  daemons / options.workers + (w < daemons % options.workers),
+                  fraction, start, results))
+            for w in range(options.workers)]
+    for process in processes:
+        process.start()
+
+    latencies = dict((operation, []) for operation in OPERATIONS)
+    lag = []
+    calls = {}
+    ran = missed = 0
+    for _ in range(options.workers * options.threads):
+        (client_latencies, client_lag, client_calls, client_ran,
+         client_missed) = results.get()
+        ran += client_ran
+        missed += client_missed
+        for operation, values in client_latencies.iteritems():
+            latencies[operation].extend(values)
+        lag.extend(client_lag)
+        for name, count in client_calls.iteritems():
+            calls[name] = calls.get(name, 0) + count
+    for process in processes:
+        process.join()
+    after = opcounters(options)
+
+    return {'daemons': daemons, 'latencies': latencies, 'lag': sorted(lag),
+            'calls': calls, 'ran': ran, 'missed': missed,
+            'opcounters': dict((name, after[name] - before.get(name, 0))
+                               for name in after)}
+
+
+def report(options, step, result):
+    """Print a step.
+
+    Returns:
+        tuple of (float, achieved operations per second; float, share of the
+        operations that fell due but never ran).
+    """
+    duration = float(options.duration)
+    offered = (result['daemons'] / float(options.interval) +
+               (options.registrations * 2 + options.change_masters) *
+               step / options.steps)
+    achieved = sum(len(values) for values in
+                   result['latencies'].itervalues()) / duration
+    missed = result['missed'] / float(result['ran'] + result['missed'] or 1)
+    print('step %s: %s daemons, %.1f ops/s offered, %.1f achieved, '
+          'p99 lag %.3fs, %.1f%% missed' % (
+              step, result['daemons'], offered, achieved,
+              percentile(result['lag'], 0.99), missed * 100))
+    print('  storage calls %8.1f/s  %s' % (
+            sum(result['calls'].values()) / duration,
+            ' '.join('%s=%.1f' % (name, count / duration) for name, count in
+                     sorted(result['calls'].items()))))
+    if result['opcounters']:
+        print('  mongod ops    %8.1f/s  %s' % (
+                sum(result['opcounters'].values()) / duration,
+                ' '.join('%s=%.1f' % (name, count / duration) for name, count
+                         in sorted(result['opcounters'].items()))))
+    for operation in OPERATIONS:
+        values = sorted(result['latencies'][operation])
+        if values:
+            print('  %-14s %8s ops %8.1f/s  p50 %8.2fms  p99 %8.2fms' % (
+                    operation, len(values), len(values) / duration,
+                    percentile(values, 0.5) * 1000,
+                    percentile(values, 0.99) * 1000))
+
+    return achieved, missed
+
+
+def main():
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('--daemons', dest='daemons', type='int', default=500,
+                      help='simulated update daemons at full load.')
+    parser.add_option('--interval', dest='interval', type='float', default=5,
+                      help='seconds between a daemon\'s updates.')
+    parser.add_option('--registrations', dest='registrations', type='float',
+                      default=5, help='registrations per second at full load.')
+    parser.add_option('--change-masters', dest='change_masters',
+                      type='float', default=0.5,
+                      help='change_master calls per second at full load.')
+    parser.add_option('--servers', dest='servers', type='int', default=2000)
+    parser.add_option('--services', dest='services', type='int', default=40)
+    parser.add_option('--alias-heavy', dest='alias_heavy', type='float',
+                      default=0.25,
+                      help='fraction of services whose hosts carry aliases.')
+    parser.add_option('--aliases', dest='aliases', type='int', default=10,
+                      help='aliases per host in alias heavy services.')
+    parser.add_option('--steps', dest='steps', type='int', default=4)
+    parser.add_option('--duration', dest='duration', type='float', default=20,
+                      help='seconds per step.')
+    parser.add_option('--workers', dest='workers', type='int',
+                      default=multiprocessing.cpu_count())
+    parser.add_option('--threads', dest='threads', type='int', default=4,
+                      help='threads per worker, each with a connection.')
+    parser.add_option('--server', dest='server', default=None,
+                      help='mongod to run against instead of SQLite.')
+    parser.add_option('--port', dest='port', type='int', default=27017)
+    (options, args) = parser.parse_args()
+
+    services = service_names(options.services, options.alias_heavy)
+    scratch = tempfile.mkdtemp()
+    url = 'sqlite://' + os.path.join(scratch, 'aerostat.db')
+    if options.server:
+        conn = aerostat.db_connect(options.server, options.port)
+        conn.drop_database(SCRATCH_DB)
+        for field in ('hostname', 'instance_id', 'service', 'aliases'):
+            conn[SCRATCH_DB].servers.ensure_index(field)
+    store = open_store(options, url)
+    for server in fleet(options.servers, services, options.aliases):
+        store.insert(server)
+
+    print('%s: %s servers in %s services, %s workers x %s threads, '
+          '%.0fs steps' % (options.server and 'mongo' or 'sqlite',
+                           options.servers, options.services, options.workers,
+                           options.threads, options.duration))
+    try:
+        saturated = None
+        sustained = 0.0
+        for step in range(1, options.steps + 1):
+            result = run_step(options, url, services,
+                              step / float(options.steps))
+            achieved, missed = report(options, step, result)
+            # Poisson arrivals make the achieved count noisy at low rates;
+            # only operations left unrun show the backend falling behind.
+            if missed > SATURATED:
+                saturated = step
+                break
+            sustained = achieved
+        if saturated == 1:
+            print('Throughput saturates at step 1; lower --daemons or '
+                  '--registrations.')
+        elif saturated:
+            print('Throughput saturates at step %s: %.1f ops/s sustained '
+                  'before it.' % (saturated, sustained))
+        else:
+            print('No saturation up to %.1f ops/s; raise --daemons or '
+                  'lower --interval.' % sustained)
+    finally:
+        if options.server:
+            conn.drop_database(SCRATCH_DB)
+        shutil.rmtree(scratch)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""
+Snapshot benchmark - Compare the snapshot format with BSON for a server set.
+
+Builds a synthetic fleet (no mongod needed) and reports, for BSON documents
+and for each snapshot compression, the encoded size, encode time, the time to
+decode every entry, and the time to open the snapshot and read one entry.
+
+Usage:
+    python benchmarks/snapshot.py [--servers=100000] [--services=200]
+"""
+
+import os
+import random
+import sys
+import time
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bson
+
+from aerostat import snapshot
+
+
+def fleet(servers, services):
+    """Make a plausible server set: iterative and masterful services."""
+    counts = {}
+    for i in xrange(servers):
+        service = 'service%s' % random.randrange(services)
+        number = counts[service] = counts.get(service, -1) + 1
+        yield {'hostname': '%s-%s' % (service, number),
+               'ip': '10.%s.%s.%s' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+               'service': service, 'service_type': 'iterative',
+               'instance_id': 'i-%08x' % random.getrandbits(32),
+               'aliases': number == 0 and ['%s-primary' % service] or []}
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main():
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('--servers', dest='servers', type='int', default=100000)
+    parser.add_option('--services', dest='services', type='int', default=200)
+    (options, args) = parser.parse_args()
+
+    servers = list(fleet(options.servers, options.services))
+    print('%s servers in %s services' % (len(servers), options.services))
+    print('%-14s %12s %10s %12s %12s' % (
+            'format', 'bytes', 'encode', 'decode all', 'read one'))
+
+    data, encode_time = timed(
+            lambda: ''.join(bson.BSON.encode(server) for server in servers))
+    _, decode_time = timed(bson.decode_all, data)
+    print('%-14s %12s %9.3fs %11.3fs %12s' % (
+            'bson', len(data), encode_time, decode_time, '-'))
+
+    for compression in (None, 'zlib', 'zstd'):
+        try:
+            data, encode_time = timed(
+                    snapshot.encode, servers, 1, compression)
+        except snapshot.SnapshotError, e:
+            print('%-14s %s' % (compression, e))
+            continue
+        _, decode_time = timed(snapshot.decode, data)
+        _, read_time = timed(
+                lambda: snapshot.Reader(data, verify=False)[len(servers) / 2])
+        print('%-14s %12s %9.3fs %11.3fs %11.4fs' % (
+                'snapshot/%s' % (compression or 'raw'), len(data),
+                encode_time, decode_time, read_time))
+
+
+if __name__ == '__main__':
+    main()
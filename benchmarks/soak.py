@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+"""
+Soak benchmark - Run thousands of daemon cycles and watch for slow leaks.
+
+Runs the two long lived loops back to back, with no sleeping between
+cycles, over a synthetic fleet that changes every cycle (instances
+terminated, launched and registered through the real Registrar, and moved
+to new ips):
+
+    client:    one Updater reused across cycles, as 'aerostat --update
+               --daemon' does, with a snapshot cache and a metrics textfile
+               written each cycle. It does dry runs, since the real write
+               path is /etc/hosts.
+    aerostatd: one Aerostatd calling run_once() with a zero sweep interval,
+               sweeping a fake EC2 inventory into its storage.
+
+Each loop runs in its own process against its own scratch SQLite file, or,
+for the client, a scratch database on --server, reusing one connection
+for the whole run. Every cycle records resident memory, live objects
+tracked by the garbage collector, open file descriptors and cycle time. After
+a warmup the run is cut into quarters, and a loop fails if the median of
+any measure in the last quarter has grown beyond its tolerance over the
+first. The script then prints the object types that grew most and exits
+non-zero.
+
+Linux only: memory and descriptors are read from /proc/self.
+
+Usage:
+    python benchmarks/soak.py [--cycles=2000] [--servers=2000]
+        [--loops=client,aerostatd] [--server=localhost]
+"""
+
+import gc
+import logging
+import multiprocessing
+import os
+import Queue
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aerostat import aerostat
+from aerostat import aerostat_server
+from aerostat import logs
+from aerostat import metrics
+from aerostat import registrar
+from aerostat import storage
+from aerostat import updater
+
+
+SCRATCH_DB = 'aerostat_soak_bench'
+
+LOOPS = ('client', 'aerostatd')
+
+MEASURES = ('rss_mb', 'objects', 'fds', 'cycle_ms')
+
+# Growth allowed from the first quarter's median to the last's, as a
+# fraction of the first plus an absolute slack. Cycle time is noisy, so it
+# gets the widest margin.
+DEFAULT_TOLERANCES = {'rss_mb': (0.05, 2.0), 'objects': (0.02, 100),
+                      'fds': (0.0, 0), 'cycle_ms': (0.25, 1.0)}
+
+# Types listed when a loop fails.
+TOP_GROWERS = 10
+
+
+def rss_mb():
+    """Resident memory of this process, in MB."""
+    statm = open('/proc/self/statm')
+    try:
+        pages = int(statm.read().split()[1])
+    finally:
+        statm.close()
+
+    return pages * resource.getpagesize() / float(1 << 20)
+
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd')) - 1  # Less listdir's own.
+
+
+def type_counts():
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+
+    return counts
+
+
+class Fleet(object):
+    """A synthetic fleet: what EC2 runs, registered through the Registrar."""
+
+    def __init__(self, store, servers, services):
+        self.store = store
+        self.services = ['service%s' % i for i in range(services)]
+        self.registrar = registrar.Registrar()
+        self.launched = 0
+        # instance_id -> (ip, service), as EC2 has it.
+        self.running = {}
+        for _ in xrange(servers):
+            self.launch()
+
+    def new_ip(self):
+        return '10.%s.%s.%s' % (random.randrange(256), random.randrange(256),
+                                random.randrange(1, 255))
+
+    def launch(self):
+        """Start an instance and register it, as the client would."""
+        self.launched += 1
+        instance_id = 'i-%08x' % self.launched
+        service = random.choice(self.services)
+        ip = self.new_ip()
+        hostname = self.registrar.pick_name(
+                self.store, service, 'iterative', instance_id)
+        self.registrar.register_name(self.store, hostname, ip, instance_id,
+                service, 'iterative', ['%s-alias' % hostname])
+        self.running[instance_id] = (ip, service)
+
+    def churn(self, count, apply_to_store=False):
+        """Terminate, launch and move count instances each.
+
+        Args:
+            count: int, instances of each kind of change.
+            apply_to_store: bool, also clear and move them in storage, when
+            no aerostatd is sweeping this fleet.
+        """
+        terminated = random.sample(list(self.running), count)
+        for instance_id in terminated:
+            del self.running[instance_id]
+        moved = {}
+        for instance_id in random.sample(list(self.running), count):
+            moved[instance_id] = self.new_ip()
+            self.running[instance_id] = (moved[instance_id],
+                                         self.running[instance_id][1])
+        if apply_to_store:
+            self.store.clear_instances(terminated)
+            self.store.update_ips(moved)
+        for _ in range(count):
+            self.launch()
+
+    def inventory(self):
+        return [aerostat_server.AwsInstance(instance_id, ip, 'running', {})
+                for instance_id, (ip, _) in self.running.iteritems()]
+
+
+class SoakAerostatd(aerostat_server.Aerostatd):
+    """aerostatd with EC2 replaced by a synthetic fleet."""
+
+    fleet = None
+
+    def fetch_target(self, target):
+        return [self.fleet.inventory()]
+
+
+def client_loop(options, scratch):
+    """Set up the client loop; return a function running one cycle."""
+    if options.server:
+        conn = aerostat.db_connect(options.server, options.port)
+        conn.drop_database(SCRATCH_DB)
+        store = storage.MongoStorage(conn[SCRATCH_DB])
+    else:
+        store = storage.open_storage(
+                'sqlite://' + os.path.join(scratch, 'client.db'))
+    fleet = Fleet(store, options.servers, options.services)
+    update = updater.Updater(
+            snapshot_cache=os.path.join(scratch, 'servers.snapshot'))
+    textfile = os.path.join(scratch, 'client.prom')
+
+    def cycle():
+        fleet.churn(options.churn, apply_to_store=True)
+        start = time.time()
+        update.do_update(store, dry_run=True)
+        metrics.REGISTRY.write_textfile(textfile)
+        return time.time() - start
+
+    return cycle
+
+
+def aerostatd_loop(options, scratch):
+    """Set up the aerostatd loop; return a function running one cycle."""
+    url = 'sqlite://' + os.path.join(scratch, 'aerostatd.db')
+    conf_path = os.path.join(scratch, 'aerostatd.conf')
+    conf_file = open(conf_path, 'w')
+    conf_file.write('storage: %s\nsweep_interval: 0\n'
+                    'metrics: {textfile: %s}\n' % (
+                        url, os.path.join(scratch, 'aerostatd.prom')))
+    conf_file.close()
+    os.environ['AEROSTATD_CONF'] = conf_path
+
+    aerostatd = SoakAerostatd()
+    aerostatd.fleet = Fleet(aerostatd.aerostat_db, options.servers,
+                            options.services)
+
+    def cycle():
+        aerostatd.fleet.churn(options.churn)
+        start = time.time()
+        aerostatd.run_once()
+        return time.time() - start
+
+    return cycle
+
+
+def soak(loop, options, scratch, results):
+    """Run one loop for options.cycles cycles, sampling every cycle."""
+    logging.getLogger().setLevel(logging.WARNING)
+    logs.set_levels(dict((component, logging.WARNING) for component in
+                         ('client', 'registrar', 'updater', 'reconciler')))
+    random.seed(0)
+    cycle = {'client': client_loop,
+             'aerostatd': aerostatd_loop}[loop](options, scratch)
+
+    samples = []
+    types = None
+    warmup = int(options.cycles * options.warmup)
+    for i in xrange(options.cycles):
+        elapsed = cycle()
+        if i == warmup:
+            gc.collect()
+            types = type_counts()
+        samples.append((rss_mb(), len(gc.get_objects()), open_fds(),
+                        elapsed * 1000))
+
+    gc.collect()
+    after = type_counts()
+    growth = sorted(((after[name] - types.get(name, 0), name)
+                     for name in after), reverse=True)
+    results.put((loop, samples[warmup:], growth[:TOP_GROWERS]))
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+def check(loop, samples, growth, tolerances):
+    """Report a loop's trends; return whether it passed."""
+    quarter = len(samples) / 4
+    passed = True
+    print('%s: %s cycles after warmup' % (loop, len(samples)))
+    print('  %-9s %10s %10s %10s %10s  %s' % (
+            'measure', 'q1', 'q2', 'q3', 'q4', 'verdict'))
+    for i, measure in enumerate(MEASURES):
+        medians = [median([sample[i] for sample in
+                           samples[q * quarter:(q + 1) * quarter]])
+                   for q in range(4)]
+        fraction, slack = tolerances[measure]
+        limit = medians[0] * (1 + fraction) + slack
+        verdict = medians[3] <= limit and 'ok' or 'GROWING (limit %.1f)' % limit
+        passed = passed and medians[3] <= limit
+        print('  %-9s %10.1f %10.1f %10.1f %10.1f  %s' % (
+                (measure,) + tuple(medians) + (verdict,)))
+    if not passed:
+        print('  Object types that grew most since warmup:')
+        for count, name in growth:
+            if count > 0:
+                print('    %-30s %+d' % (name, count))
+
+    return passed
+
+
+def main():
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('--cycles', dest='cycles', type='int', default=2000)
+    parser.add_option('--servers', dest='servers', type='int', default=2000)
+    parser.add_option('--services', dest='services', type='int', default=20)
+    parser.add_option('--churn', dest='churn', type='int', default=10,
+                      help='instances terminated, launched and moved per '
+                      'cycle.')
+    parser.add_option('--warmup', dest='warmup', type='float', default=0.1,
+                      help='fraction of cycles left out of the trends.')
+    parser.add_option('--loops', dest='loops', default=','.join(LOOPS))
+    parser.add_option('--server', dest='server', default=None,
+                      help='mongod for the client loop instead of SQLite.')
+    parser.add_option('--port', dest='port', type='int', default=27017)
+    (options, args) = parser.parse_args()
+
+    loops = [loop for loop in options.loops.split(',') if loop]
+    for loop in loops:
+        if loop not in LOOPS:
+            parser.error('Unknown loop %r; expected %s.' % (
+                    loop, ', '.join(LOOPS)))
+
+    scratch = tempfile.mkdtemp()
+    results = multiprocessing.Queue()
+    passed = True
+    try:
+        for loop in loops:
+            process = multiprocessing.Process(target=soak,
+                    args=(loop, options, scratch, results))
+            process.start()
+            while True:
+                try:
+                    loop, samples, growth = results.get(timeout=5)
+                    break
+                except Queue.Empty:
+                    if not process.is_alive():
+                        sys.exit('The %s loop died.' % loop)
+            process.join()
+            passed = check(loop, samples, growth,
+                           DEFAULT_TOLERANCES) and passed
+    finally:
+        if options.server:
+            aerostat.db_connect(options.server, options.port).drop_database(
+                    SCRATCH_DB)
+        shutil.rmtree(scratch)
+
+    if not passed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+"""
+Startup benchmark - Measure interpreter startup and import cost per subcommand.
+
+Every subcommand is measured in a fresh interpreter, so nothing is shared
+between runs. Each one runs the real main() of aerostat or aerostatd with its
+command line, so the modules loaded are exactly those the mode imports. I/O
+is stubbed: the database is a stand-in that accepts any call, sockets refuse
+to connect (and boto doesn't retry) and the first sleep of a daemon loop
+ends the run. We report the
+wall time of the whole process and an import-time profile: which modules got
+loaded, and how long each took on its own (self) and including everything it
+pulled in (cumulative).
+
+Usage:
+    python benchmarks/startup.py [--runs=N] [--top=N]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+
+# (label, module whose main() runs, its arguments). Modes that would write
+# run dry.
+SUBCOMMANDS = [
+    ('aerostat --update', 'aerostat.aerostat', ['--update', '--dryrun']),
+    ('aerostat --register', 'aerostat.aerostat',
+     ['--register', '--dryrun', '--offline']),
+    ('aerostat --change-master', 'aerostat.aerostat',
+     ['--change-master', '--dryrun', '--offline']),
+    ('aerostat --update-configs', 'aerostat.aerostat',
+     ['--update-configs', '--dryrun']),
+    ('aerostatd --offline', 'aerostat.aerostat_server', ['--offline']),
+    ('aerostatd', 'aerostat.aerostat_server', []),
+]
+
+# A minimal aerostatd.conf, so aerostatd reads its conf and builds an EC2
+# connection as it does when deployed, and the service info a registering
+# host reads.
+AEROSTATD_CONF = 'ec2_creds: %s\n'
+AEROSTAT_INFO = 'web iterative\n'
+BOTO_CONFIG = '[Boto]\nnum_retries = 0\nmax_retry_delay = 0\n'
+# Run inside the child interpreter. Wraps __import__ so that every top level
+# import records its own time, minus the time spent in nested imports, then
+# runs the subcommand's main() with I/O stubbed.
+CHILD_SOURCE = r'''
+import sys
+import time
+import __builtin__
+
+_real_import = __builtin__.__import__
+_stack = []
+_timings = {}
+
+def _timed_import(name, *args, **kwargs):
+    before = set(sys.modules)
+    start = time.time()
+    _stack.append(0.0)
+    try:
+        return _real_import(name, *args, **kwargs)
+    finally:
+        nested = _stack.pop()
+        elapsed = time.time() - start
+        if _stack:
+            _stack[-1] += elapsed
+        # Implicit relative imports load 'package.name', not 'name'.
+        # Python 2 also leaves None entries for the relative names tried.
+        for loaded in set(sys.modules) - before:
+            if ((loaded == name or loaded.endswith('.' + name)) and
+                    sys.modules[loaded] is not None and
+                    loaded not in _timings):
+                _timings[loaded] = (elapsed - nested, elapsed)
+
+__builtin__.__import__ = _timed_import
+
+
+class Stop(BaseException):
+    pass
+
+
+class Anything(object):
+    # Stands in for a connection, database, collection or cursor.
+    def __getattr__(self, name):
+        return self
+    def __getitem__(self, key):
+        return self
+    def __call__(self, *args, **kwargs):
+        return self
+    def __iter__(self):
+        return iter([])
+    def __len__(self):
+        return 0
+
+
+def refuse(*args, **kwargs):
+    raise socket.error('refused by the startup benchmark')
+
+
+def stop(*args, **kwargs):
+    # Worker threads (EC2 fetches, pool housekeeping) sleep as usual.
+    if threading.current_thread().name != 'MainThread':
+        return _real_sleep(*args, **kwargs)
+    raise Stop('sleep')
+
+
+# Imported first so that they bind the real sleep.
+import socket
+import threading
+_real_sleep = time.sleep
+socket.create_connection = refuse
+socket.socket.connect = refuse
+time.sleep = stop
+
+module, sys.argv = sys.argv[1], [sys.argv[1]] + sys.argv[2:]
+__import__('aerostat.aerostat')
+sys.modules['aerostat.aerostat'].db_connect = lambda *args, **kwargs: Anything()
+__import__(module)
+ended = 'returned'
+try:
+    sys.modules[module].main()
+except Stop, e:
+    ended = 'stopped at %s' % e
+except SystemExit, e:
+    ended = 'exited %s' % e.code
+except Exception, e:
+    ended = 'raised %s: %s' % (type(e).__name__, e)
+
+__builtin__.__import__ = _real_import
+for name, (self_time, cumulative) in _timings.items():
+    sys.stdout.write('%s %f %f\n' % (name, self_time, cumulative))
+sys.stdout.write('! %s\n' % ended)
+'''
+
+
+def profile_subcommand(module, args, scratch, python=sys.executable):
+    """Run a subcommand's main() in a fresh interpreter.
+
+    Args:
+        module: str, module whose main() to run, or None for a bare
+        interpreter.
+        args: list of str, its command line arguments.
+        scratch: str, directory holding aerostatd.conf, aerostat_info and
+        boto.cfg.
+        python: str, interpreter to run.
+    Returns:
+        tuple of (wall seconds, dict of module -> (self, cumulative), str of
+        how main() ended).
+    """
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+            [root] + [p for p in [env.get('PYTHONPATH')] if p])
+    env['AEROSTATD_CONF'] = os.path.join(scratch, 'aerostatd.conf')
+    env['AEROSTAT_INFO'] = os.path.join(scratch, 'aerostat_info')
+    env['BOTO_CONFIG'] = os.path.join(scratch, 'boto.cfg')
+    command = [python, '-c', 'pass']
+    if module:
+        command = [python, '-c', CHILD_SOURCE, module] + args
+
+    start = time.time()
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+            stderr=open(os.devnull, 'w'), env=env)
+    output = proc.communicate()[0]
+    wall = time.time() - start
+
+    timings = {}
+    ended = None
+    for line in output.splitlines():
+        if line.startswith('! '):
+            ended = line[2:]
+            continue
+        name, self_time, cumulative = line.split()
+        timings[name] = (float(self_time), float(cumulative))
+
+    return wall, timings, ended or 'died (exit status %s)' % proc.returncode
+
+
+def format_report(label, walls, timings, ended, top):
+    """Format one subcommand's results as a block of text."""
+    lines = ['== %s' % label]
+    lines.append('   wall: min %.1fms, max %.1fms over %d runs, %d modules' % (
+            min(walls) * 1000, max(walls) * 1000, len(walls), len(timings)))
+    lines.append('   main() %s' % ended)
+
+    lines.append('   %10s %10s  %s' % ('self ms', 'cumul ms', 'module'))
+    ranked = sorted(timings.items(), key=lambda item: item[1][0], reverse=True)
+    for name, (self_time, cumulative) in ranked[:top]:
+        lines.append('   %10.2f %10.2f  %s' % (
+                self_time * 1000, cumulative * 1000, name))
+
+    return '\n'.join(lines)
+
+
+def main():
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage=usage)
+    parser.add_option(
+            '--runs', action='store', dest='runs', type='int', default=5,
+            help='Fresh interpreters to start per subcommand.')
+    parser.add_option(
+            '--top', action='store', dest='top', type='int', default=15,
+            help='How many of the slowest imports to list.')
+    (options, args) = parser.parse_args()
+
+    scratch = tempfile.mkdtemp()
+    try:
+        creds_path = os.path.join(scratch, 'ec2')
+        for name, content in (('ec2', 'key-id key-secret keypair\n'),
+                              ('aerostatd.conf', AEROSTATD_CONF % creds_path),
+                              ('aerostat_info', AEROSTAT_INFO),
+                              ('boto.cfg', BOTO_CONFIG)):
+            scratch_file = open(os.path.join(scratch, name), 'w')
+            scratch_file.write(content)
+            scratch_file.close()
+
+        # Baseline: a bare interpreter, so that import cost can be read off.
+        bare = [profile_subcommand(None, [], scratch)[0]
+                for _ in range(options.runs)]
+        print('== python (no imports)\n   wall: min %.1fms, max %.1fms' % (
+                min(bare) * 1000, max(bare) * 1000))
+
+        for label, module, args in SUBCOMMANDS:
+            walls = []
+            timings = ended = None
+            for _ in range(options.runs):
+                wall, timings, ended = profile_subcommand(
+                        module, args, scratch)
+                walls.append(wall)
+            print(format_report(label, walls, timings, ended, options.top))
+    finally:
+        shutil.rmtree(scratch)
+
+if __name__ == '__main__':
+    main()
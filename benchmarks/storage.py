@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""
+Storage benchmark - Run the same workload against each storage backend.
+
+Loads a synthetic fleet, then times the operations the client, registrar and
+aerostatd perform: hostname, instance and alias lookups, gap queries, full
+instance scans, registrations (pick_name and register_name), bulk ip updates
+and clearing instances. SQLite always runs, in a scratch file; Mongo runs too
+when --server is given, in a scratch database that is dropped afterwards.
+
+Usage:
+    python benchmarks/storage.py [--servers=20000] [--server=localhost]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aerostat import aerostat
+from aerostat import registrar
+from aerostat import storage
+
+
+SCRATCH_DB = 'aerostat_storage_bench'
+
+
+def fleet(servers, services):
+    """Make a fleet with a gap in every tenth slot."""
+    counts = {}
+    for i in xrange(servers):
+        service = 'service%s' % (i % services)
+        number = counts[service] = counts.get(service, -1) + 1
+        gap = number % 10 == 9
+        yield {'hostname': '%s-%s' % (service, number),
+               'ip': not gap and '10.%s.%s.%s' % (
+                   i >> 16 & 255, i >> 8 & 255, i & 255) or '',
+               'service': service, 'service_type': 'iterative',
+               'instance_id': not gap and 'i-%08x' % i or '',
+               'aliases': number == 0 and ['%s-primary' % service] or []}
+
+
+def run(store, servers, operations):
+    """Time each operation against store.
+
+    Returns:
+        list of (str, operation; int, calls; float, seconds).
+    """
+    reg = registrar.Registrar()
+    hostnames = [server['hostname'] for server in servers]
+    instance_ids = [server['instance_id'] for server in servers
+                    if server['instance_id']]
+    services = sorted(set(server['service'] for server in servers))
+    random.seed(0)
+
+    def registration(i):
+        service = random.choice(services)
+        instance_id = 'i-new%06x' % i
+        hostname = reg.pick_name(store, service, 'iterative', instance_id)
+        reg.register_name(store, hostname, '10.255.0.1', instance_id,
+                service, 'iterative', [])
+
+    workload = [
+        ('by_hostname', lambda i: store.by_hostname(random.choice(hostnames))),
+        ('by_instance', lambda i: store.by_instance(
+            random.choice(instance_ids))),
+        ('by_aliases', lambda i: store.by_aliases(
+            ['%s-primary' % random.choice(services)])),
+        ('gaps', lambda i: store.gaps(random.choice(services))),
+        ('register', registration),
+    ]
+    results = []
+    for name, func in workload:
+        start = time.time()
+        for i in xrange(operations):
+            func(i)
+        results.append((name, operations, time.time() - start))
+
+    start = time.time()
+    scanned = sum(1 for _ in store.instances())
+    results.append(('instances scan', scanned, time.time() - start))
+    changes = dict((instance_id, '10.254.0.1')
+                   for instance_id in instance_ids[:1000])
+    start = time.time()
+    store.update_ips(changes)
+    results.append(('update_ips', len(changes), time.time() - start))
+    start = time.time()
+    store.clear_instances(instance_ids[:1000])
+    results.append(('clear_instances', 1000, time.time() - start))
+
+    return results
+
+
+def load(store, servers):
+    start = time.time()
+    for server in servers:
+        store.insert(dict(server))
+    return time.time() - start
+
+
+def report(backend, load_time, results):
+    print('%s (load %.2fs)' % (backend, load_time))
+    for name, calls, seconds in results:
+        print('  %-16s %8s calls %9.3fs %10.1fus/call' % (
+                name, calls, seconds, seconds / max(calls, 1) * 1e6))
+
+
+def main():
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('--servers', dest='servers', type='int', default=20000)
+    parser.add_option('--services', dest='services', type='int', default=100)
+    parser.add_option('--operations', dest='operations', type='int',
+                      default=2000)
+    parser.add_option('--server', dest='server', default=None,
+                      help='mongod to benchmark as well.')
+    parser.add_option('--port', dest='port', type='int', default=27017)
+    (options, args) = parser.parse_args()
+
+    servers = list(fleet(options.servers, options.services))
+    print('%s servers in %s services, %s operations of each kind' % (
+            len(servers), options.services, options.operations))
+
+    scratch = tempfile.mkdtemp()
+    try:
+        store = storage.open_storage(
+                'sqlite://' + os.path.join(scratch, 'aerostat.db'))
+        load_time = load(store, servers)
+        report('sqlite', load_time, run(store, servers, options.operations))
+        store.close()
+    finally:
+        shutil.rmtree(scratch)
+
+    if options.server:
+        conn = aerostat.db_connect(options.server, options.port)
+        db = conn[SCRATCH_DB]
+        try:
+            for field in ('hostname', 'instance_id', 'service', 'aliases'):
+                db.servers.ensure_index(field)
+            store = storage.MongoStorage(db)
+            load_time = load(store, servers)
+            report('mongo', load_time, run(store, servers, options.operations))
+        finally:
+            conn.drop_database(SCRATCH_DB)
+
+
+if __name__ == '__main__':
+    main()
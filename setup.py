@@ -29,5 +29,8 @@ setup(
         'PyYAML',
         'GitPython',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     zip_safe=False,
 )
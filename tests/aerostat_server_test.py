@@ -8,13 +8,28 @@ __author__ = 'Gavin McQuillan (gavin@urbanairship.com)'
 import os
 import StringIO
 import sys
+import threading
+import time
 import unittest
 
+import boto.ec2.connection
 import mox
 import pymongo
 import yaml
 
+from boto.ec2.regioninfo import RegionInfo
+
 from aerostat import aerostat_server
+from aerostat import events
+
+
+class FakeResultSet(list):
+    """Stand-in for a page of boto reservations."""
+
+    def __init__(self, items, next_token=None):
+        list.__init__(self, items)
+        self.next_token = next_token
+
 
 class AerostatServerTest(mox.MoxTestBase):
 
@@ -65,7 +80,8 @@ class AerostatServerTest(mox.MoxTestBase):
         fake_conn.aerostat.AndReturn(fake_db)
         fake_db.servers = self.mox.CreateMockAnything()
 
-        fake_db.servers.find().AndReturn([fake_row])
+        fake_db.servers.find({}, {'instance_id': 1, '_id': 0}).AndReturn(
+                [fake_row])
 
         fake_aerostatd = aerostat_server.Aerostatd(offline=True)
         fake_aerostatd.mongo_conn = fake_conn
@@ -84,19 +100,19 @@ class AerostatServerTest(mox.MoxTestBase):
         fake_inst1 = self.mox.CreateMockAnything()
         fake_inst1.id = 'i-test1'
         fake_inst1.state = 'running'
+        fake_inst1.private_ip_address = '10.0.0.1'
+        fake_inst1.tags = {}
         fake_req1.instances = [fake_inst1]
-        fake_req2 = self.mox.CreateMockAnything()
-        fake_inst2 = self.mox.CreateMockAnything()
-        fake_inst2.id = 'i-test2'
-        fake_inst2.state = 'terminated'
-        fake_req2.instances = [fake_inst2]
+        fake_page = FakeResultSet([fake_req1])
 
         fake_connection = self.mox.CreateMockAnything()
-        fake_connection.get_all_instances().AndReturn(
-                [fake_req1, fake_req2])
+        fake_connection.get_all_reservations(
+                filters={'instance-state-name':
+                    aerostat_server.DEFAULT_EC2_STATES},
+                max_results=1000, next_token=None).AndReturn(fake_page)
 
         fake_aerostatd = aerostat_server.Aerostatd(offline=True)
-        fake_aerostatd.aws_conn = fake_connection
+        fake_aerostatd.aws_conns['default'] = fake_connection
 
         self.mox.ReplayAll()
 
@@ -104,6 +120,207 @@ class AerostatServerTest(mox.MoxTestBase):
 
         self.assertEqual(test_output, expected_output)
 
+    def test_iter_aws_instances_pages(self):
+        """Test that iter_aws_instances follows next_token across pages."""
+
+        fake_reqs = []
+        for inst_id, ip in [('i-test1', '10.0.0.1'), ('i-test2', '10.0.0.2')]:
+            fake_inst = self.mox.CreateMockAnything()
+            fake_inst.id = inst_id
+            fake_inst.state = 'running'
+            fake_inst.private_ip_address = ip
+            fake_inst.tags = {'Name': inst_id}
+            fake_req = self.mox.CreateMockAnything()
+            fake_req.instances = [fake_inst]
+            fake_reqs.append(fake_req)
+
+        fake_connection = self.mox.CreateMockAnything()
+        fake_connection.get_all_reservations(
+                filters={'instance-state-name':
+                    aerostat_server.DEFAULT_EC2_STATES},
+                max_results=5, next_token=None).AndReturn(
+                        FakeResultSet([fake_reqs[0]], 'token-1'))
+        fake_connection.get_all_reservations(
+                filters={'instance-state-name':
+                    aerostat_server.DEFAULT_EC2_STATES},
+                max_results=5, next_token='token-1').AndReturn(
+                        FakeResultSet([fake_reqs[1]]))
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+
+        self.mox.ReplayAll()
+
+        test_output = list(fake_aerostatd.iter_aws_instances(
+                fake_connection, page_size=5))
+
+        self.assertEqual(test_output, [
+            aerostat_server.AwsInstance(
+                'i-test1', '10.0.0.1', 'running', {'Name': 'i-test1'}),
+            aerostat_server.AwsInstance(
+                'i-test2', '10.0.0.2', 'running', {'Name': 'i-test2'})])
+
+    def test_aws_connect_endpoint(self):
+        """Test that aws_connect honours an endpoint override."""
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.conf = {'ec2_region': 'fake-region',
+                'ec2_endpoint': 'localhost', 'ec2_port': 5000,
+                'ec2_is_secure': False}
+        fake_aerostatd.targets = fake_aerostatd.get_targets()
+
+        self.mox.StubOutWithMock(fake_aerostatd, '_read_creds')
+        fake_aerostatd._read_creds(None).AndReturn(
+                ('test-id', 'test-sec', None))
+        self.mox.StubOutWithMock(boto.ec2.connection, 'EC2Connection')
+        boto.ec2.connection.EC2Connection(
+                'test-id', 'test-sec', region=mox.IsA(RegionInfo), port=5000,
+                is_secure=False).AndReturn('fake-conn')
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_aerostatd.aws_connect(), 'fake-conn')
+
+    def test_get_targets(self):
+        """Test that targets inherit top level settings."""
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.conf = {'ec2_timeout': 10, 'targets': [
+            {'account': 'prod', 'region': 'us-east-1',
+             'creds': '/root/installer/.ec2-prod'},
+            {'account': 'prod', 'region': 'eu-west-1', 'timeout': 5}]}
+
+        self.mox.ReplayAll()
+
+        targets = fake_aerostatd.get_targets()
+
+        self.assertEqual([t['name'] for t in targets],
+                ['prod/us-east-1', 'prod/eu-west-1'])
+        self.assertEqual([t['timeout'] for t in targets], [10, 5])
+        self.assertEqual(targets[0]['creds'], '/root/installer/.ec2-prod')
+        self.assertEqual(targets[1]['creds'], None)
+        self.assertEqual(targets[1]['states'],
+                aerostat_server.DEFAULT_EC2_STATES)
+
+    def test_fetch_targets_isolates_failures(self):
+        """Test that one failing target doesn't spoil the others."""
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.conf = {'targets': [{'name': 'good'}, {'name': 'bad'}]}
+        fake_aerostatd.targets = fake_aerostatd.get_targets()
+
+        self.mox.StubOutWithMock(fake_aerostatd, 'fetch_target')
+        fake_aerostatd.fetch_target(fake_aerostatd.targets[0]).InAnyOrder(
+                ).AndReturn([
+                    [aerostat_server.AwsInstance(
+                        'i-test1', '10.0.0.1', 'running', {})],
+                    [aerostat_server.AwsInstance(
+                        'i-test2', '10.0.0.2', 'running', {})]])
+        fake_aerostatd.fetch_target(fake_aerostatd.targets[1]).InAnyOrder(
+                ).AndRaise(IOError('connection refused'))
+
+        self.mox.ReplayAll()
+
+        aws, failed = fake_aerostatd.fetch_targets()
+
+        self.assertEqual(aws, {'i-test1': ('10.0.0.1', 'running'),
+                               'i-test2': ('10.0.0.2', 'running')})
+        self.assertEqual(failed, set(['bad']))
+        self.assertEqual(fake_aerostatd.instance_targets,
+                {'i-test1': 'good', 'i-test2': 'good'})
+
+    def test_get_targets_duplicate_names(self):
+        """Test that two targets may not share a name."""
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.conf = {'targets': [
+            {'account': 'prod', 'region': 'us-east-1'},
+            {'name': 'prod/us-east-1'}]}
+
+        self.mox.ReplayAll()
+
+        self.assertRaises(ValueError, fake_aerostatd.get_targets)
+
+    def test_fetch_targets_timeout(self):
+        """Test that a slow target times out alone, and isn't fetched again
+        while its last fetch is still running."""
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.conf = {'targets': [
+            {'name': 'fast', 'timeout': 5}, {'name': 'slow', 'timeout': 0.1}]}
+        fake_aerostatd.targets = fake_aerostatd.get_targets()
+        release = threading.Event()
+        fetched = []
+
+        def fake_fetch_target(target):
+            fetched.append(target['name'])
+            if target['name'] == 'slow':
+                release.wait(5)
+            return [[aerostat_server.AwsInstance(
+                    'i-%s' % target['name'], '10.0.0.1', 'running', {})]]
+
+        fake_aerostatd.fetch_target = fake_fetch_target
+
+        self.mox.ReplayAll()
+
+        try:
+            aws, failed = fake_aerostatd.fetch_targets()
+            self.assertEqual(aws, {'i-fast': ('10.0.0.1', 'running')})
+            self.assertEqual(failed, set(['slow']))
+
+            aws, failed = fake_aerostatd.fetch_targets()
+            self.assertEqual(failed, set(['slow']))
+            self.assertEqual(sorted(fetched), ['fast', 'fast', 'slow'])
+        finally:
+            release.set()
+            fake_aerostatd.pool.close()
+            fake_aerostatd.pool.join()
+
+    def test_fetch_targets_streams_pages(self):
+        """Test that pages are merged as they arrive, so a target that
+        times out mid-fetch still contributes the pages it sent."""
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.conf = {'targets': [{'name': 'slow', 'timeout': 0.2}]}
+        fake_aerostatd.targets = fake_aerostatd.get_targets()
+        release = threading.Event()
+
+        def fake_fetch_target(target):
+            yield [aerostat_server.AwsInstance(
+                    'i-first', '10.0.0.1', 'running', {})]
+            release.wait(5)
+            yield [aerostat_server.AwsInstance(
+                    'i-last', '10.0.0.2', 'running', {})]
+
+        fake_aerostatd.fetch_target = fake_fetch_target
+
+        self.mox.ReplayAll()
+
+        try:
+            aws, failed = fake_aerostatd.fetch_targets()
+            self.assertEqual(aws, {'i-first': ('10.0.0.1', 'running')})
+            self.assertEqual(failed, set(['slow']))
+            # Only a target that finished vouches for its instances.
+            self.assertEqual(fake_aerostatd.instance_targets, {})
+        finally:
+            release.set()
+            fake_aerostatd.pool.close()
+            fake_aerostatd.pool.join()
+
+    def test_get_mongo_aws_diff_failed_targets(self):
+        """Test that ids which may live in a failed target are held back."""
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.instance_targets = {
+            'i-gone-good': 'good', 'i-gone-bad': 'bad', 'i-alive': 'good'}
+
+        self.mox.ReplayAll()
+
+        test_output = fake_aerostatd.get_mongo_aws_diff(
+                ['i-gone-good', 'i-gone-bad', 'i-alive', 'i-unknown'],
+                ['i-alive'], set(['bad']))
+
+        self.assertEqual(test_output, set(['i-gone-good']))
+
     def test_get_mongo_aws_diff(self):
 
         expected_output = set(['test1'])
@@ -120,29 +337,359 @@ class AerostatServerTest(mox.MoxTestBase):
 
         self.assertEqual(test_output, expected_output)
 
+        test_output = fake_aerostatd.get_mongo_aws_diff(
+                fake_mongo_ids, iter(fake_aws_ids))
+
+        self.assertEqual(test_output, expected_output)
+
     def test_update_mongo(self):
 
         fake_conn = self.mox.CreateMockAnything()
         fake_db = self.mox.CreateMockAnything()
         fake_conn.aerostat = fake_db
         fake_db.servers = self.mox.CreateMockAnything()
-        fake_ids = ['i-test1', 'i-test2']
+        fake_db.masters = self.mox.CreateMockAnything()
+        fake_ids = ['i-test3', 'i-test1', '', 'i-test2']
 
         fake_db.servers.update(
-                {'instance_id': 'i-test1'},
-                        {'$set': {'instance_id': '', 'ip': ''}}).AndReturn(None)
+                {'instance_id': {'$in': ['i-test1', 'i-test2']}},
+                {'$set': {'instance_id': '', 'ip': ''}},
+                multi=True, w=1).AndReturn({'n': 2, 'ok': 1.0})
+        fake_db.masters.update(
+                {'instance_id': {'$in': ['i-test1', 'i-test2']}},
+                {'$set': {'instance_id': '', 'ip': ''},
+                 '$inc': {'generation': 1}},
+                multi=True, w=1)
         fake_db.servers.update(
-                {'instance_id': 'i-test2'},
-                        {'$set': {'instance_id': '', 'ip': ''}}).AndReturn(None)
+                {'instance_id': {'$in': ['i-test3']}},
+                {'$set': {'instance_id': '', 'ip': ''}},
+                multi=True, w=1).AndReturn({'n': 1, 'ok': 1.0})
+        fake_db.masters.update(
+                {'instance_id': {'$in': ['i-test3']}},
+                {'$set': {'instance_id': '', 'ip': ''},
+                 '$inc': {'generation': 1}},
+                multi=True, w=1)
 
         fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.conf = {'mongo_batch_size': 2,
+                'mongo_write_concern': {'w': 1}}
         fake_aerostatd.mongo_conn = fake_conn
         fake_aerostatd.aerostat_db = fake_db
 
         self.mox.ReplayAll()
 
-        self.assertEqual(fake_aerostatd.update_mongo(
-                fake_ids), None)
+        batches = fake_aerostatd.update_mongo(fake_ids)
+        self.assertEqual([batch[:2] for batch in batches], [(2, 2), (1, 1)])
+
+    def test_get_mongo_instances(self):
+        """Test full and targeted reads of registered instances."""
+
+        fields = {'instance_id': 1, 'ip': 1, '_id': 0}
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.servers = self.mox.CreateMockAnything()
+        fake_db.servers.find({'instance_id': {'$ne': ''}}, fields).AndReturn(
+                [{'instance_id': 'i-test1', 'ip': '10.0.0.1'}])
+        fake_db.servers.find(
+                {'instance_id': {'$in': ['i-test1', 'i-test2']}},
+                fields).AndReturn([{'instance_id': 'i-test2', 'ip': ''}])
+        fake_db.servers.find(
+                {'instance_id': {'$in': ['i-test3']}}, fields).AndReturn([])
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.conf = {'mongo_batch_size': 2}
+        fake_aerostatd.aerostat_db = fake_db
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(list(fake_aerostatd.get_mongo_instances()),
+                [('i-test1', '10.0.0.1')])
+        self.assertEqual(list(fake_aerostatd.get_mongo_instances(
+                ['i-test1', 'i-test2', 'i-test3'])), [('i-test2', '')])
+
+    def test_update_ips(self):
+        """Test that moved instances get their ips rewritten in one bulk op."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.servers = self.mox.CreateMockAnything()
+        fake_db.masters = self.mox.CreateMockAnything()
+        fake_bulk = self.mox.CreateMockAnything()
+        fake_find1 = self.mox.CreateMockAnything()
+        fake_find2 = self.mox.CreateMockAnything()
+        fake_db.servers.initialize_unordered_bulk_op().AndReturn(fake_bulk)
+        fake_bulk.find({'instance_id': 'i-test1'}).AndReturn(fake_find1)
+        fake_find1.update({'$set': {'ip': '10.0.0.11'}})
+        fake_bulk.find({'instance_id': 'i-test2'}).AndReturn(fake_find2)
+        fake_find2.update({'$set': {'ip': '10.0.0.12'}})
+        fake_bulk.execute({}).AndReturn({'nModified': 2})
+        # i-test2 is a master.
+        fake_db.masters.find(
+                {'instance_id': {'$in': ['i-test1', 'i-test2']}}).AndReturn(
+                [{'_id': 'db', 'instance_id': 'i-test2', 'ip': '10.0.0.2'}])
+        fake_db.masters.update({'_id': 'db', 'instance_id': 'i-test2'},
+                {'$set': {'ip': '10.0.0.12'}, '$inc': {'generation': 1}})
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.aerostat_db = fake_db
+
+        self.mox.ReplayAll()
+
+        batches = fake_aerostatd.update_ips(
+                {'i-test2': '10.0.0.12', 'i-test1': '10.0.0.11'})
+        self.assertEqual([batch[0] for batch in batches], [2])
+
+    def test_reconcile(self):
+        """Test a full cycle followed by an incremental one."""
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        self.mox.StubOutWithMock(fake_aerostatd, 'fetch_targets')
+        self.mox.StubOutWithMock(fake_aerostatd, 'get_mongo_instances')
+        self.mox.StubOutWithMock(fake_aerostatd, 'update_mongo')
+        self.mox.StubOutWithMock(fake_aerostatd, 'update_ips')
+
+        # First cycle reads all of Mongo; i-test3 is gone from EC2.
+        fake_aerostatd.fetch_targets(fake_aerostatd.targets).AndReturn((
+            {'i-test1': ('10.0.0.1', 'running'),
+             'i-test2': ('10.0.0.2', 'running')}, set()))
+        fake_aerostatd.get_mongo_instances().AndReturn([
+            ('i-test1', '10.0.0.1'), ('i-test2', '10.0.0.2'),
+            ('i-test3', '10.0.0.3')])
+        fake_aerostatd.update_mongo(set(['i-test3']))
+
+        # Second cycle only looks up i-test2, which came back on a new ip.
+        fake_aerostatd.fetch_targets(fake_aerostatd.targets).AndReturn((
+            {'i-test1': ('10.0.0.1', 'running'),
+             'i-test2': ('10.0.0.22', 'running')}, set()))
+        fake_aerostatd.get_mongo_instances(['i-test2']).AndReturn([
+            ('i-test2', '10.0.0.2')])
+        fake_aerostatd.update_ips({'i-test2': '10.0.0.22'})
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_aerostatd.reconcile(), (set(['i-test3']), {}))
+        self.assertEqual(fake_aerostatd.reconcile(),
+                (set(), {'i-test2': '10.0.0.22'}))
+
+    def test_apply_events(self):
+        """Test that events blank terminated instances and fix moved ips, and
+        that stopped instances keep their names."""
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.reconciler.mongo = {'i-test1': '10.0.0.1',
+                'i-test2': '10.0.0.2', 'i-test3': '10.0.0.3'}
+        fake_aerostatd.reconciler.aws = {
+            'i-test1': ('10.0.0.1', 'running'),
+            'i-test2': ('10.0.0.2', 'running'),
+            'i-test3': ('10.0.0.3', 'running')}
+        self.mox.StubOutWithMock(fake_aerostatd, 'update_mongo')
+        self.mox.StubOutWithMock(fake_aerostatd, 'update_ips')
+        fake_aerostatd.update_mongo(set(['i-test3']))
+        fake_aerostatd.update_ips({'i-test2': '10.0.0.22'})
+        # i-test1 starts again somewhere else.
+        fake_aerostatd.update_ips({'i-test1': '10.0.0.11'})
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_aerostatd.apply_events([
+            events.StateChange('i-test1', 'stopping', '10.0.0.1'),
+            events.StateChange('i-test1', 'stopped', None),
+            events.StateChange('i-test2', 'running', '10.0.0.22'),
+            events.StateChange('i-test3', 'terminated', None),
+            events.StateChange('i-test4', 'pending', None)]),
+            (set(['i-test3']), {'i-test2': '10.0.0.22'}))
+        self.assertEqual(fake_aerostatd.reconciler.mongo,
+                {'i-test1': '10.0.0.1', 'i-test2': '10.0.0.22'})
+        self.assertEqual(fake_aerostatd.reconciler.aws,
+                {'i-test1': (None, 'stopped'),
+                 'i-test2': ('10.0.0.22', 'running')})
+
+        self.assertEqual(fake_aerostatd.apply_events([
+            events.StateChange('i-test1', 'running', '10.0.0.11')]),
+            (set(), {'i-test1': '10.0.0.11'}))
+
+    def test_run_once_survives_bad_events(self):
+        """Test that a batch of events that fails to apply is logged and
+        left to the sweep."""
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.offline = False
+        fake_aerostatd.next_sweep = time.time() + 60
+        fake_aerostatd.event_source = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(fake_aerostatd, 'apply_events')
+        self.mox.StubOutWithMock(fake_aerostatd, 'publish')
+        fake_changes = [events.StateChange('i-test1', 'terminated', None)]
+        fake_aerostatd.event_source.poll(mox.IsA(float)).AndReturn(
+                fake_changes)
+        fake_aerostatd.apply_events(fake_changes).AndRaise(
+                pymongo.errors.AutoReconnect('connection refused'))
+
+        self.mox.ReplayAll()
+
+        fake_aerostatd.run_once()
+
+    def test_run_once_rebuilds_masters(self):
+        """Test that the masters view is rebuilt every few sweeps."""
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.conf = {'masters_rebuild_every': 2}
+        fake_aerostatd.masters = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(fake_aerostatd, 'publish')
+        self.mox.StubOutWithMock(time, 'sleep')
+        fake_aerostatd.publish()
+        time.sleep(mox.IsA(float))
+        fake_aerostatd.masters.rebuild().AndReturn(0)
+        fake_aerostatd.publish()
+        time.sleep(mox.IsA(float))
+
+        self.mox.ReplayAll()
+
+        for _ in range(2):
+            fake_aerostatd.next_sweep = 0
+            fake_aerostatd.run_once()
+
+    def test_next_sweep_interval(self):
+        """Test that the sweep backs off only when events are configured."""
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.conf = {'sweep_interval': 60,
+                'sweep_max_interval': 120}
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_aerostatd.next_sweep_interval(60, 0), 60)
+        fake_aerostatd.event_source = events.QueueEventSource()
+        self.assertEqual(fake_aerostatd.next_sweep_interval(60, 0), 90)
+        self.assertEqual(fake_aerostatd.next_sweep_interval(90, 0), 120)
+        self.assertEqual(fake_aerostatd.next_sweep_interval(120, 3), 60)
+
+    def test_reconcile_owned_targets(self):
+        """Test that instances outside this replica's targets are held."""
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.conf = {'targets': [{'name': 'mine'}, {'name': 'theirs'}]}
+        fake_aerostatd.targets = fake_aerostatd.get_targets()
+        fake_aerostatd.instance_targets = {'i-gone': 'mine', 'i-other': 'theirs'}
+        self.mox.StubOutWithMock(fake_aerostatd, 'fetch_targets')
+        self.mox.StubOutWithMock(fake_aerostatd, 'get_mongo_instances')
+        self.mox.StubOutWithMock(fake_aerostatd, 'update_mongo')
+
+        fake_aerostatd.fetch_targets(fake_aerostatd.targets[:1]).AndReturn(
+                ({'i-test1': ('10.0.0.1', 'running')}, set()))
+        fake_aerostatd.get_mongo_instances().AndReturn([
+            ('i-test1', '10.0.0.1'), ('i-gone', '10.0.0.2'),
+            ('i-other', '10.0.0.3')])
+        fake_aerostatd.update_mongo(set(['i-gone']))
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_aerostatd.reconcile(fake_aerostatd.targets[:1]),
+                (set(['i-gone']), {}))
+        self.assertEqual(fake_aerostatd.reconcile([]), (set(), {}))
+
+    def test_sweep_targets(self):
+        """Test target sharing between coordinated replicas."""
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.conf = {'coordination': {'global_sweep_every': 5},
+                'targets': [{'name': 'a'}, {'name': 'b'}]}
+        fake_aerostatd.targets = fake_aerostatd.get_targets()
+        self.assertEqual(fake_aerostatd.sweep_targets(0), fake_aerostatd.targets)
+
+        fake_coordinator = self.mox.CreateMockAnything()
+        fake_coordinator.leader = True
+        fake_coordinator.assign(['a', 'b']).AndReturn(['b'])
+        fake_aerostatd.coordinator = fake_coordinator
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_aerostatd.sweep_targets(5), fake_aerostatd.targets)
+        self.assertEqual(fake_aerostatd.sweep_targets(6),
+                fake_aerostatd.targets[1:])
+
+    def test_update_mongo_marks_pools_dirty(self):
+        """Test that freed slots ask for their services' pools to refill."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.servers = self.mox.CreateMockAnything()
+        fake_db.masters = self.mox.CreateMockAnything()
+        fake_cursor = self.mox.CreateMockAnything()
+        fake_filler = self.mox.CreateMockAnything()
+
+        fake_db.servers.find(
+                {'instance_id': {'$in': ['i-test1']}}).AndReturn(fake_cursor)
+        fake_cursor.distinct('service').AndReturn(['web'])
+        fake_filler.mark_dirty(['web'])
+        fake_db.servers.update(
+                {'instance_id': {'$in': ['i-test1']}},
+                {'$set': {'instance_id': '', 'ip': ''}},
+                multi=True).AndReturn(None)
+        fake_db.masters.update(
+                {'instance_id': {'$in': ['i-test1']}},
+                {'$set': {'instance_id': '', 'ip': ''},
+                 '$inc': {'generation': 1}},
+                multi=True)
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.aerostat_db = fake_db
+        fake_aerostatd.pool_filler = fake_filler
+
+        self.mox.ReplayAll()
+
+        fake_aerostatd.update_mongo(['i-test1'])
+
+    def test_compact(self):
+        """Test that compaction refreshes pools of services it touched."""
+
+        fake_compactor = self.mox.CreateMockAnything()
+        fake_filler = self.mox.CreateMockAnything()
+        fake_compactor.compact(False).AndReturn({'kept': 1, 'archived': 2,
+                'services': {'web': [1, 2], 'db': [3, 0]}})
+        fake_filler.mark_dirty(['web'])
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.compactor = fake_compactor
+        fake_aerostatd.pool_filler = fake_filler
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_aerostatd.compact()['archived'], 2)
+
+    def test_main_compact_offline(self):
+        """Test that --compact refuses to run without MongoDB."""
+
+        self.mox.StubOutWithMock(sys, 'argv')
+        sys.argv = ['aerostatd', '--compact', '--offline']
+        self.mox.StubOutWithMock(sys, 'stderr')
+        sys.stderr = StringIO.StringIO()
+
+        self.mox.ReplayAll()
+
+        self.assertRaises(SystemExit, aerostat_server.main)
+        self.assertTrue('--compact needs MongoDB' in sys.stderr.getvalue())
+
+    def test_update_mongo_unacknowledged(self):
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.servers = self.mox.CreateMockAnything()
+        fake_db.masters = self.mox.CreateMockAnything()
+
+        fake_db.servers.update(
+                {'instance_id': {'$in': ['i-test1']}},
+                {'$set': {'instance_id': '', 'ip': ''}},
+                multi=True).AndReturn(None)
+        fake_db.masters.update(
+                {'instance_id': {'$in': ['i-test1']}},
+                {'$set': {'instance_id': '', 'ip': ''},
+                 '$inc': {'generation': 1}},
+                multi=True)
+
+        fake_aerostatd = aerostat_server.Aerostatd(offline=True)
+        fake_aerostatd.aerostat_db = fake_db
+
+        self.mox.ReplayAll()
+
+        batches = fake_aerostatd.update_mongo(['i-test1'])
+        self.assertEqual([batch[:2] for batch in batches], [(1, None)])
+        self.assertEqual(fake_aerostatd.update_mongo([]), [])
 
 
 if __name__ == '__main__':
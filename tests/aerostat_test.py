@@ -81,30 +81,49 @@ class AerostatTest(mox.MoxTestBase):
                 aerostat.get_hostname(fake_db, 'test-inst-id'))
 
 
+    def test_hostname_number(self):
+        """Test hostname_number for both naming schemes."""
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(aerostat.hostname_number('web', 'web-12'), 12)
+        self.assertEqual(aerostat.hostname_number('mongodb', 'mongodb-master'), 0)
+        self.assertEqual(aerostat.hostname_number(
+                'mongodb', 'mongodb-slave-3'), 3)
+        self.assertEqual(aerostat.hostname_number('web', 'web-api-1'), None)
+        self.assertEqual(aerostat.hostname_number('web', 'db-1'), None)
+
+
     def test_get_master(self):
         """Test get_master function."""
 
         expected_output1 = 'master-instance-id'
         expected_output2 = None
 
-        fake_row1 = {'hostname': 'testing-master',
-                'instance_id': 'master-instance-id', 'service': 'testing'}
-
         fake_db = self.mox.CreateMockAnything()
         fake_db.servers = self.mox.CreateMockAnything()
-
-        fake_db.servers.find({'hostname': 'testing-master'}).AndReturn(
-                [fake_row1])
-        fake_db.servers.find({'hostname': 'testing-master'}).AndReturn(
+        fake_db.masters = self.mox.CreateMockAnything()
+        fake_db2 = self.mox.CreateMockAnything()
+        fake_db2.servers = self.mox.CreateMockAnything()
+        fake_db2.masters = self.mox.CreateMockAnything()
+
+        # Read once; the second lookup in the same db is cached.
+        fake_db.masters.find_one({'_id': 'testing'}).AndReturn(
+                {'_id': 'testing', 'instance_id': 'master-instance-id',
+                 'ip': '10.0.0.1', 'generation': 1})
+        # A service missing from the view is looked up in servers.
+        fake_db2.masters.find_one({'_id': 'testing'}).AndReturn(None)
+        fake_db2.servers.find({'hostname': 'testing-master'}).AndReturn(
                 [])
 
         self.mox.ReplayAll()
 
         self.assertEqual(expected_output1,
                 aerostat.get_master(fake_db, 'testing'))
-        self.assertEqual(expected_output2,
+        self.assertEqual(expected_output1,
                 aerostat.get_master(fake_db, 'testing'))
-
+        self.assertEqual(expected_output2,
+                aerostat.get_master(fake_db2, 'testing'))
 
     def test_check_master(self):
         """Test check_master funciton."""
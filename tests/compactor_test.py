@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""
+Unittests for Aerostat Compactor.
+"""
+
+import datetime
+import unittest
+
+import mox
+
+from aerostat import compactor
+
+
+class CompactorTest(mox.MoxTestBase):
+    """Test the Compactor class."""
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.fake_db = self.mox.CreateMockAnything()
+        self.fake_db.servers = self.mox.CreateMockAnything()
+        self.fake_db.servers_history = self.mox.CreateMockAnything()
+
+    def expect_scan(self):
+        self.fake_db.servers.find({'instance_id': {'$ne': ''}},
+                {'service': 1, 'hostname': 1}).AndReturn([
+                    {'service': 'web', 'hostname': 'web-0'},
+                    {'service': 'web', 'hostname': 'web-3'},
+                    {'service': 'db', 'hostname': 'db-master'}])
+        self.fake_db.servers.find({'instance_id': ''},
+                {'service': 1, 'hostname': 1}).AndReturn([
+                    {'_id': 1, 'service': 'web', 'hostname': 'web-1'},
+                    {'_id': 2, 'service': 'web', 'hostname': 'web-4'},
+                    {'_id': 3, 'service': 'db', 'hostname': 'db-slave-1'},
+                    {'_id': 4, 'service': 'cache', 'hostname': 'cache-0'},
+                    {'_id': 5, 'service': 'web', 'hostname': ''}])
+
+    def test_plan(self):
+        """Test that only gaps below the high-water mark are kept."""
+
+        self.expect_scan()
+
+        self.mox.ReplayAll()
+
+        archive, counts = compactor.Compactor(self.fake_db).plan()
+        self.assertEqual(archive, [2, 3, 4, 5])
+        self.assertEqual(counts, {'web': [1, 2], 'db': [0, 1], 'cache': [0, 1]})
+
+    def test_compact(self):
+        """Test that archived documents are copied before removal."""
+
+        self.expect_scan()
+        spec = {'_id': {'$in': [2, 3, 4, 5]}, 'instance_id': ''}
+        self.fake_db.servers.find(spec).AndReturn([
+            {'_id': 2, 'service': 'web', 'hostname': 'web-4'}])
+        self.fake_db.servers_history.insert([
+            {'server_id': 2, 'service': 'web', 'hostname': 'web-4',
+             'archived_at': mox.IsA(datetime.datetime)}], w=1)
+        self.fake_db.servers.remove(spec, w=1).AndReturn({'n': 1})
+
+        self.mox.ReplayAll()
+
+        report = compactor.Compactor(self.fake_db).compact()
+        self.assertEqual(report['kept'], 1)
+        self.assertEqual(report['archived'], 1)
+
+    def test_compact_dry_run(self):
+        """Test that a dry run only reports."""
+
+        self.expect_scan()
+
+        self.mox.ReplayAll()
+
+        report = compactor.Compactor(self.fake_db).compact(dry_run=True)
+        self.assertEqual(report['archived'], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+"""
+Unittests for Aerostat Configurer.
+"""
+
+import json
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import mox
+
+from aerostat import aerostat
+from aerostat import configurer
+
+
+FAKE_TEMPLATE = ('{% for host in aerostat.members("web") %}'
+                 'server {{ host.hostname }} {{ host.ip }}:{{ vars.port }}\n'
+                 '{% endfor %}')
+
+FAKE_MEMBERS = [{'hostname': 'web-0', 'ip': '10.0.0.1'},
+                {'hostname': 'web-1', 'ip': '10.0.0.2'}]
+
+
+class FakeData(object):
+    """Stands in for AerostatData, counting lookups."""
+
+    def __init__(self, members):
+        self.fake_members = members
+        self.calls = []
+
+    def members(self, service):
+        self.calls.append(('members', service))
+        return self.fake_members
+
+    def master(self, service):
+        self.calls.append(('master', service))
+        return None
+
+    def prefetch(self, keys):
+        self.calls.append(('prefetch', sorted(keys)))
+        return {configurer.input_key('members', ['web']): self.fake_members}
+
+
+class ConfigurerTest(mox.MoxTestBase):
+    """Test the Configurer class."""
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.fake_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.fake_dir)
+
+    def fake_config(self):
+        return {'name': 'haproxy', 'template': FAKE_TEMPLATE,
+                'path': os.path.join(self.fake_dir, 'haproxy.cfg'),
+                'vars': {'port': 80}}
+
+    def fake_configurer(self):
+        fake_configurer = configurer.Configurer(
+                state_file=os.path.join(self.fake_dir, 'state.json'),
+                cache_dir=os.path.join(self.fake_dir, 'cache'))
+        fake_configurer.data = FakeData(FAKE_MEMBERS)
+        return fake_configurer
+
+    def test_write_atomic(self):
+        """Test that unchanged files are left alone and modes are kept."""
+
+        fake_path = os.path.join(self.fake_dir, 'fake.conf')
+
+        self.mox.ReplayAll()
+
+        self.assertTrue(configurer.write_atomic(fake_path, 'a\n', 0600))
+        self.assertFalse(configurer.write_atomic(fake_path, 'a\n'))
+        self.assertTrue(configurer.write_atomic(fake_path, 'b\n'))
+        self.assertEqual(open(fake_path).read(), 'b\n')
+        self.assertEqual(stat.S_IMODE(os.stat(fake_path).st_mode), 0600)
+        self.assertEqual(os.listdir(self.fake_dir), ['fake.conf'])
+
+    def test_template_cache(self):
+        """Test that a template source is compiled once."""
+
+        fake_cache = configurer.TemplateCache(None)
+
+        self.mox.ReplayAll()
+
+        self.assertTrue(fake_cache.get(FAKE_TEMPLATE) is
+                fake_cache.get(FAKE_TEMPLATE))
+        self.assertFalse(fake_cache.get(FAKE_TEMPLATE) is
+                fake_cache.get(FAKE_TEMPLATE + ' '))
+
+    def test_do_update(self):
+        """Test rendering, then skipping a config whose inputs are unchanged."""
+
+        fake_config = self.fake_config()
+        fake_conf_db = self.mox.CreateMockAnything()
+        fake_conf_db.configs = self.mox.CreateMockAnything()
+        fake_conf_db.configs.find({'name': {'$in': ['haproxy']}}).AndReturn(
+                [fake_config])
+        fake_conf_db.configs.find({'name': {'$in': ['haproxy']}}).AndReturn(
+                [fake_config])
+
+        fake_configurer = self.fake_configurer()
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_configurer.do_update(
+                fake_conf_db, ['haproxy']), ['haproxy'])
+        self.assertEqual(open(fake_config['path']).read(),
+                'server web-0 10.0.0.1:80\nserver web-1 10.0.0.2:80\n')
+        self.assertEqual(fake_configurer.do_update(
+                fake_conf_db, ['haproxy']), [])
+        # The second run only repeated the one lookup the template made.
+        self.assertEqual(fake_configurer.data.calls,
+                [('members', 'web'), ('prefetch', ['["members", "web"]'])])
+
+    def test_do_update_batch(self):
+        """Test that a config that can't be written is skipped."""
+
+        fake_config = self.fake_config()
+        fake_other = {'name': 'other', 'template': 'static\n',
+                      'path': os.path.join(self.fake_dir, 'missing', 'other')}
+        fake_conf_db = self.mox.CreateMockAnything()
+        fake_conf_db.configs = self.mox.CreateMockAnything()
+        fake_conf_db.configs.find({}).AndReturn([fake_other, fake_config])
+
+        fake_configurer = self.fake_configurer()
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_configurer.do_update(fake_conf_db), ['haproxy'])
+        self.assertEqual(sorted(os.listdir(self.fake_dir)),
+                ['cache', 'haproxy.cfg', 'state.json'])
+        self.assertEqual(sorted(json.load(open(os.path.join(
+                self.fake_dir, 'state.json')))), ['haproxy'])
+
+    def test_do_update_atomic(self):
+        """Test that if one config can't be written, none are."""
+
+        fake_config = self.fake_config()
+        fake_other = {'name': 'other', 'template': 'static\n',
+                      'path': os.path.join(self.fake_dir, 'missing', 'other')}
+        fake_conf_db = self.mox.CreateMockAnything()
+        fake_conf_db.configs = self.mox.CreateMockAnything()
+        fake_conf_db.configs.find({}).AndReturn([fake_config, fake_other])
+
+        fake_configurer = self.fake_configurer()
+        fake_configurer.atomic = True
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_configurer.do_update(fake_conf_db), [])
+        self.assertEqual(sorted(os.listdir(self.fake_dir)),
+                ['cache', 'state.json'])
+        self.assertEqual(json.load(open(os.path.join(
+                self.fake_dir, 'state.json'))), {})
+
+    def test_do_update_without_repo(self):
+        """Test that a template_path config is skipped without a repo."""
+
+        fake_config = self.fake_config()
+        fake_repo_config = {'name': 'repo', 'template_path': 'repo.j2',
+                            'path': os.path.join(self.fake_dir, 'repo.cfg')}
+        fake_conf_db = self.mox.CreateMockAnything()
+        fake_conf_db.configs = self.mox.CreateMockAnything()
+        fake_conf_db.configs.find({}).AndReturn(
+                [fake_repo_config, fake_config])
+
+        fake_configurer = self.fake_configurer()
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_configurer.do_update(fake_conf_db), ['haproxy'])
+        self.assertFalse(os.path.exists(fake_repo_config['path']))
+
+    def test_prefetch(self):
+        """Test that lookups are answered with one query per kind."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.servers = self.mox.CreateMockAnything()
+        fields = dict(configurer.FIELDS, service=1)
+        fake_db.servers.find({'service': {'$in': ['db', 'web']},
+                              'instance_id': {'$ne': ''}}, fields).AndReturn([
+                dict(FAKE_MEMBERS[1], service='web'),
+                dict(FAKE_MEMBERS[0], service='web')])
+        self.mox.StubOutWithMock(aerostat, 'get_master')
+        aerostat.get_master(fake_db, 'db').AndReturn('i-3')
+        aerostat.get_master(fake_db, 'queue').AndReturn(None)
+        fake_db.servers.find({'instance_id': {'$in': ['i-3']}},
+                configurer.FIELDS).AndReturn([
+                {'hostname': 'db-master', 'ip': '10.0.0.3',
+                 'instance_id': 'i-3', 'aliases': []}])
+        fake_db.servers.find({'instance_id': {'$in': ['i-9']}},
+                {'instance_id': 1, 'hostname': 1, '_id': 0}).AndReturn([])
+
+        fake_data = configurer.AerostatData(fake_db)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_data.prefetch([
+                configurer.input_key('members', ['web']),
+                configurer.input_key('members', ['db']),
+                configurer.input_key('master', ['db']),
+                configurer.input_key('master', ['queue']),
+                configurer.input_key('hostname', ['i-9'])]), {
+                '["members", "web"]': FAKE_MEMBERS,
+                '["members", "db"]': [],
+                '["master", "db"]': {'hostname': 'db-master',
+                                     'ip': '10.0.0.3', 'instance_id': 'i-3',
+                                     'aliases': []},
+                '["master", "queue"]': None,
+                '["hostname", "i-9"]': None})
+
+    def test_do_update_changed_input(self):
+        """Test that a changed lookup re-renders and reloads the config."""
+
+        fake_config = self.fake_config()
+        fake_config['reload'] = 'service haproxy reload'
+        fake_other = {'name': 'other', 'template': 'static\n',
+                      'path': os.path.join(self.fake_dir, 'other.cfg'),
+                      'reload': 'service other reload'}
+        fake_conf_db = self.mox.CreateMockAnything()
+        fake_conf_db.configs = self.mox.CreateMockAnything()
+        fake_conf_db.configs.find({}).AndReturn([fake_config, fake_other])
+        fake_conf_db.configs.find({}).AndReturn([fake_config, fake_other])
+
+        self.mox.StubOutWithMock(configurer.subprocess, 'call')
+        configurer.subprocess.call(
+                'service haproxy reload', shell=True).AndReturn(0)
+        configurer.subprocess.call(
+                'service other reload', shell=True).AndReturn(0)
+        configurer.subprocess.call(
+                'service haproxy reload', shell=True).AndReturn(0)
+
+        fake_configurer = self.fake_configurer()
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_configurer.do_update(fake_conf_db),
+                ['haproxy', 'other'])
+        fake_configurer.data.fake_members = FAKE_MEMBERS[:1]
+        self.assertEqual(fake_configurer.do_update(fake_conf_db),
+                ['haproxy'])
+        self.assertEqual(open(fake_config['path']).read(),
+                'server web-0 10.0.0.1:80\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
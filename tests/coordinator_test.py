@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+Unittests for Aerostat Coordinator.
+"""
+
+import datetime
+import unittest
+
+import mox
+import pymongo
+
+from aerostat import coordinator
+
+
+class CoordinatorTest(mox.MoxTestBase):
+    """Test the Coordinator class."""
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.fake_db = self.mox.CreateMockAnything()
+        self.fake_db.replicas = self.mox.CreateMockAnything()
+        self.fake_db.leases = self.mox.CreateMockAnything()
+
+    def test_owner(self):
+        """Test that ownership only moves off a replica that leaves."""
+
+        self.mox.ReplayAll()
+
+        keys = ['target-%s' % i for i in range(50)]
+        replicas = ['r1', 'r2', 'r3']
+        before = dict((key, coordinator.owner(key, replicas)) for key in keys)
+        after = dict((key, coordinator.owner(key, ['r1', 'r3']))
+                     for key in keys)
+
+        self.assertEqual(set(before.values()), set(replicas))
+        for key in keys:
+            if before[key] != 'r2':
+                self.assertEqual(before[key], after[key])
+        self.assertEqual(coordinator.owner('target-0', []), None)
+
+    def test_heartbeat(self):
+        """Test that heartbeats upsert this replica's lease."""
+
+        self.fake_db.replicas.update({'_id': 'r1'},
+                {'$set': {'expires': mox.IsA(datetime.datetime),
+                          'host': mox.IsA(str), 'pid': mox.IsA(int)}},
+                upsert=True)
+
+        self.mox.ReplayAll()
+
+        coordinator.Coordinator(self.fake_db, 'r1').heartbeat()
+
+    def test_acquire_leadership(self):
+        """Test winning, keeping and losing the leader lease."""
+
+        query = {'_id': 'leader', '$or': [
+            {'holder': 'r1'}, {'expires': {'$lt': mox.IsA(datetime.datetime)}}]}
+        update = {'$set': {'holder': 'r1',
+                           'expires': mox.IsA(datetime.datetime)}}
+        self.fake_db.leases.find_and_modify(query, update, upsert=True,
+                new=True).AndReturn({'_id': 'leader', 'holder': 'r1'})
+        self.fake_db.leases.find_and_modify(query, update, upsert=True,
+                new=True).AndRaise(pymongo.errors.DuplicateKeyError('dup'))
+
+        self.mox.ReplayAll()
+
+        coord = coordinator.Coordinator(self.fake_db, 'r1')
+        self.assertTrue(coord.acquire_leadership())
+        self.assertTrue(coord.leader)
+        self.assertFalse(coord.acquire_leadership())
+        self.assertFalse(coord.leader)
+
+    def test_assign(self):
+        """Test that live replicas split the keys between them."""
+
+        keys = ['target-%s' % i for i in range(20)]
+        for _ in range(2):
+            self.fake_db.replicas.find(
+                    {'expires': {'$gt': mox.IsA(datetime.datetime)}},
+                    {'_id': 1}).AndReturn([{'_id': 'r2'}, {'_id': 'r1'}])
+
+        self.mox.ReplayAll()
+
+        mine = coordinator.Coordinator(self.fake_db, 'r1').assign(keys)
+        theirs = coordinator.Coordinator(self.fake_db, 'r2').assign(keys)
+
+        self.assertEqual(sorted(mine + theirs), sorted(keys))
+        self.assertFalse(set(mine) & set(theirs))
+
+    def test_resign(self):
+        """Test giving up leadership on shutdown."""
+
+        self.fake_db.leases.remove({'_id': 'leader', 'holder': 'r1'})
+        self.fake_db.replicas.remove({'_id': 'r1'})
+
+        self.mox.ReplayAll()
+
+        coord = coordinator.Coordinator(self.fake_db, 'r1')
+        coord.leader = True
+        coord.resign()
+        self.assertFalse(coord.leader)
+
+
+if __name__ == '__main__':
+    unittest.main()
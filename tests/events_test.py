@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+Unittests for Aerostat Events.
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import mox
+
+from aerostat import events
+
+
+class EventsTest(mox.MoxTestBase):
+    """Test event parsing and the event sources."""
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        mox.MoxTestBase.tearDown(self)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parse_event(self):
+        """Test the flat and CloudWatch event forms."""
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(events.parse_event(
+                {'instance_id': 'i-test1', 'state': 'running',
+                 'ip': '10.0.0.1'}),
+                events.StateChange('i-test1', 'running', '10.0.0.1'))
+        self.assertEqual(events.parse_event(
+                {'detail-type': 'EC2 Instance State-change Notification',
+                 'detail': {'instance-id': 'i-test2', 'state': 'stopped'}}),
+                events.StateChange('i-test2', 'stopped', None))
+        self.assertEqual(events.parse_event({'state': 'running'}), None)
+        self.assertEqual(events.parse_event(['i-test1']), None)
+
+    def test_parse_lines(self):
+        """Test that malformed lines are skipped."""
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(events.parse_lines([
+            '{"instance_id": "i-test1", "state": "terminated"}\n',
+            '\n', 'not json\n', '{"instance_id": "i-test2"}\n']),
+            [events.StateChange('i-test1', 'terminated', None)])
+
+    def test_spool_event_source(self):
+        """Test that spooled files are read once, in order."""
+
+        spool = events.SpoolEventSource(self.tmp_dir)
+        events.send_event(self.tmp_dir, 'i-test1', 'stopped')
+        events.send_event(self.tmp_dir, 'i-test2', 'running', '10.0.0.2')
+        open(os.path.join(self.tmp_dir, '.partial'), 'w').close()
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(spool.poll(0), [
+            events.StateChange('i-test1', 'stopped', None),
+            events.StateChange('i-test2', 'running', '10.0.0.2')])
+        self.assertEqual(spool.poll(0), [])
+        self.assertEqual(os.listdir(self.tmp_dir), ['.partial'])
+        self.assertEqual(stat.S_IMODE(os.stat(self.tmp_dir).st_mode), 0700)
+
+    def test_socket_event_source(self):
+        """Test events sent over a Unix datagram socket."""
+
+        path = os.path.join(self.tmp_dir, 'aerostatd.sock')
+        source = events.SocketEventSource(path)
+        events.send_event(path, 'i-test1', 'terminated')
+        events.send_event(path, 'i-test2', 'terminated')
+
+        self.mox.ReplayAll()
+
+        try:
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0600)
+            self.assertEqual(source.poll(1), [
+                events.StateChange('i-test1', 'terminated', None),
+                events.StateChange('i-test2', 'terminated', None)])
+            self.assertEqual(source.poll(0), [])
+        finally:
+            source.close()
+
+    def test_queue_event_source(self):
+        """Test the in-process queue source."""
+
+        source = events.QueueEventSource()
+        source.queue.put({'instance_id': 'i-test1', 'state': 'stopped'})
+        source.queue.put(events.StateChange('i-test2', 'running', None))
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(source.poll(0), [
+            events.StateChange('i-test1', 'stopped', None),
+            events.StateChange('i-test2', 'running', None)])
+        self.assertEqual(source.poll(0), [])
+
+    def test_event_source_is_abstract(self):
+        """Test that a source must implement poll."""
+
+        class NoPoll(events.EventSource):
+            pass
+
+        self.mox.ReplayAll()
+
+        self.assertRaises(TypeError, NoPoll)
+
+    def test_get_event_source(self):
+        """Test building sources from config."""
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(events.get_event_source(None), None)
+        self.assertEqual(events.get_event_source({'source': 'carrier-pigeon'}),
+                None)
+        self.assertTrue(isinstance(events.get_event_source(
+                {'source': 'spool', 'path': self.tmp_dir}),
+                events.SpoolEventSource))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""
+Unittests for Aerostat Fsck.
+"""
+
+import datetime
+import unittest
+
+import mox
+
+from aerostat import fsck
+
+
+FAKE_FACETS = {
+    'duplicate_hostnames': [
+        {'_id': 'web-0', 'count': 3, 'servers': [
+            {'_id': 1, 'instance_id': 'i-0'},
+            {'_id': 2, 'instance_id': ''},
+            {'_id': 3, 'instance_id': 'i-3'}]},
+        {'_id': 'db-master', 'count': 2, 'servers': [
+            {'_id': 5, 'instance_id': 'i-5'},
+            {'_id': 6, 'instance_id': 'i-6'}]}],
+    'duplicate_instance_ids': [
+        {'_id': 'i-0', 'count': 2, 'servers': [
+            {'_id': 4, 'hostname': 'web-1'},
+            {'_id': 1, 'hostname': 'web-0'}]}],
+    'multiple_masters': [
+        {'_id': 'db', 'count': 2, 'servers': [
+            {'_id': 5, 'instance_id': 'i-5'},
+            {'_id': 6, 'instance_id': 'i-6'}]}],
+    'alias_collisions': [
+        {'_id': 'mongo', 'count': 2, 'servers': [
+            {'_id': 5, 'hostname': 'db-master', 'instance_id': 'i-5'},
+            {'_id': 7, 'hostname': 'db-slave-1', 'instance_id': 'i-7'}]},
+        {'_id': 'twice', 'count': 2, 'servers': [
+            {'_id': 7, 'hostname': 'db-slave-1', 'instance_id': 'i-7'},
+            {'_id': 7, 'hostname': 'db-slave-1', 'instance_id': 'i-7'}]}],
+    'services': [
+        {'_id': 'web', 'service_type': 'iterative',
+         'hostnames': ['web-0', 'web-1', 'web-4'],
+         'live': ['web-0', 'web-4', '']},
+        {'_id': 'db', 'service_type': 'masterful',
+         'hostnames': ['db-master', 'db-slave-1', 'db-slave-3'],
+         'live': ['db-master', 'db-slave-1', 'db-slave-3']},
+        # Only a tombstone sits above api-0; compaction archives it, so
+        # there is nothing to fill.
+        {'_id': 'api', 'service_type': 'iterative',
+         'hostnames': ['api-0', 'api-3'], 'live': ['api-0', '']}],
+    'tombstones': [
+        {'_id': 2, 'hostname': 'web-0', 'service': 'web'},
+        {'_id': 8, 'hostname': '', 'service': 'web'},
+        {'_id': 9, 'hostname': 'legacy-box', 'service': 'web'}]}
+
+
+class FsckTest(mox.MoxTestBase):
+    """Test the Fsck class."""
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.fake_db = self.mox.CreateMockAnything()
+        self.fake_db.servers = self.mox.CreateMockAnything()
+        self.fake_db.servers_history = self.mox.CreateMockAnything()
+        self.fake_db.masters = self.mox.CreateMockAnything()
+
+    def expect_scan(self):
+        for name, pipeline in fsck.PIPELINES:
+            self.fake_db.servers.aggregate(pipeline, cursor={},
+                    allowDiskUse=True).AndReturn(iter(FAKE_FACETS[name]))
+
+    def test_scan(self):
+        """Test that the aggregations find every kind of problem."""
+
+        self.expect_scan()
+
+        self.mox.ReplayAll()
+
+        report = fsck.Fsck(self.fake_db).scan()
+        self.assertEqual(len(report['duplicate_hostnames']), 2)
+        self.assertEqual(len(report['multiple_masters']), 1)
+        self.assertEqual([found['_id'] for found in
+                          report['alias_collisions']], ['mongo'])
+        self.assertEqual(report['slot_gaps'], [
+            {'service': 'web', 'service_type': 'iterative',
+             'hostnames': ['web-2', 'web-3']},
+            {'service': 'db', 'service_type': 'masterful',
+             'hostnames': ['db-slave-2']}])
+        self.assertEqual([found['_id'] for found in
+                          report['orphaned_tombstones']], [8, 9])
+
+    def test_plan(self):
+        """Test the writes that repair a report."""
+
+        self.expect_scan()
+
+        self.mox.ReplayAll()
+
+        checker = fsck.Fsck(self.fake_db)
+        writes, archive = checker.plan(checker.scan())
+        self.assertEqual(writes, [
+            # The newer copy of i-0 becomes a gap.
+            ('update', {'_id': 4, 'instance_id': 'i-0'},
+             {'$set': {'instance_id': '', 'ip': ''}}),
+            # i-3 loses web-0 to the older i-0 and is blanked; it and the
+            # blank copy are archived.
+            ('update', {'_id': 3, 'instance_id': 'i-3'},
+             {'$set': {'instance_id': '', 'ip': ''}}),
+            ('update', {'_id': 6, 'instance_id': 'i-6'},
+             {'$set': {'instance_id': '', 'ip': ''}}),
+            # The newest holder keeps the alias.
+            ('update', {'_id': 5}, {'$pull': {'aliases': 'mongo'}}),
+            ('insert', {'hostname': 'web-2', 'ip': '', 'instance_id': '',
+                        'service': 'web', 'service_type': 'iterative',
+                        'aliases': []}, None),
+            ('insert', {'hostname': 'web-3', 'ip': '', 'instance_id': '',
+                        'service': 'web', 'service_type': 'iterative',
+                        'aliases': []}, None),
+            ('insert', {'hostname': 'db-slave-2', 'ip': '', 'instance_id': '',
+                        'service': 'db', 'service_type': 'masterful',
+                        'aliases': []}, None)])
+        self.assertEqual(archive, [2, 3, 6, 8, 9])
+
+    def test_repair(self):
+        """Test that writes go in one ordered bulk, dead documents are
+        archived and the masters view is rebuilt."""
+
+        report = dict((problem, []) for problem in fsck.PROBLEMS)
+        report['duplicate_instance_ids'] = FAKE_FACETS['duplicate_instance_ids']
+        report['orphaned_tombstones'] = [{'_id': 8, 'hostname': ''}]
+        fake_bulk = self.mox.CreateMockAnything()
+        fake_op = self.mox.CreateMockAnything()
+        self.fake_db.servers.initialize_ordered_bulk_op().AndReturn(fake_bulk)
+        fake_bulk.find({'_id': 4, 'instance_id': 'i-0'}).AndReturn(fake_op)
+        fake_op.update_one({'$set': {'instance_id': '', 'ip': ''}})
+        fake_bulk.execute({'w': 1})
+        spec = {'_id': {'$in': [8]}, 'instance_id': ''}
+        self.fake_db.servers.find(spec).AndReturn([{'_id': 8, 'hostname': ''}])
+        self.fake_db.servers_history.insert([
+            {'server_id': 8, 'hostname': '',
+             'archived_at': mox.IsA(datetime.datetime)}], w=1)
+        self.fake_db.servers.remove(spec, w=1).AndReturn({'n': 1})
+        self.fake_db.servers.find({'hostname': {'$regex': '-master$'}},
+                mox.IgnoreArg()).AndReturn([])
+        self.fake_db.masters.find().AndReturn([])
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fsck.Fsck(self.fake_db).repair(report),
+                {'writes': 1, 'archived': 1})
+
+    def test_repair_dry_run(self):
+        """Test that a dry run writes nothing."""
+
+        self.expect_scan()
+
+        self.mox.ReplayAll()
+
+        checker = fsck.Fsck(self.fake_db)
+        self.assertEqual(checker.repair(checker.scan(), dry_run=True),
+                {'writes': 7, 'archived': 5})
+
+
+if __name__ == '__main__':
+    unittest.main()
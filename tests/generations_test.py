@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+"""
+Unittests for Aerostat Generations.
+"""
+
+import unittest
+
+import bson
+import mox
+import pymongo
+
+from aerostat import generations
+from aerostat import snapshot
+from aerostat import subscriptions
+
+
+def fake_server(hostname, ip, service='web', aliases=()):
+    return {'hostname': hostname, 'ip': ip, 'service': service,
+            'service_type': 'iterative', 'instance_id': 'i-%s' % hostname,
+            'aliases': list(aliases)}
+
+
+class FakeCursor(list):
+    """A list that can be sorted like a pymongo cursor."""
+
+    def sort(self, key, direction):
+        return self
+
+
+class GenerationsTest(mox.MoxTestBase):
+    """Test patches, the client index and publishing."""
+
+    def test_diff(self):
+        """Test finding added, changed and removed servers."""
+
+        old = {'web-0': fake_server('web-0', '10.0.0.1'),
+               'web-1': fake_server('web-1', '10.0.0.2')}
+        new = {'web-0': fake_server('web-0', '10.0.0.9'),
+               'web-2': fake_server('web-2', '10.0.0.3')}
+
+        self.mox.ReplayAll()
+
+        upserts, removed = generations.diff(old, new)
+        self.assertEqual(sorted(server['hostname'] for server in upserts),
+                ['web-0', 'web-2'])
+        self.assertEqual(removed, ['web-1'])
+
+    def test_patch_round_trip(self):
+        """Test encoding and decoding a patch."""
+
+        upserts = [fake_server('web-0', '10.0.0.1', aliases=['www'])]
+
+        self.mox.ReplayAll()
+
+        data = generations.encode_patch(3, 4, upserts, ['web-1'])
+        self.assertEqual(generations.decode_patch(data),
+                (3, 4, upserts, ['web-1']))
+        self.assertRaises(snapshot.SnapshotError, generations.decode_patch,
+                data[:generations.PATCH_HEADER.size + 2])
+
+    def test_compose(self):
+        """Test folding patches, later changes winning."""
+
+        first = (1, 2, [fake_server('web-0', '10.0.0.1'),
+                        fake_server('web-1', '10.0.0.2')], ['web-5'])
+        second = (2, 3, [fake_server('web-5', '10.0.0.5')], ['web-1'])
+
+        self.mox.ReplayAll()
+
+        base, generation, upserts, removed = generations.compose(
+                [first, second])
+        self.assertEqual((base, generation), (1, 3))
+        self.assertEqual(sorted(server['hostname'] for server in upserts),
+                ['web-0', 'web-5'])
+        self.assertEqual(removed, ['web-1'])
+
+    def test_index_apply(self):
+        """Test that patches update the index and its rendered lines."""
+
+        fake_index = generations.ServerIndex()
+        fake_index.load_snapshot(snapshot.encode([
+                fake_server('web-0', '10.0.0.1', aliases=['www']),
+                fake_server('web-1', '10.0.0.2'),
+                fake_server('db-0', '10.0.0.3', service='db')], 5))
+
+        self.mox.ReplayAll()
+
+        fake_index.apply((5, 6, [fake_server('web-1', '10.0.0.7')], ['db-0']))
+        self.assertEqual(fake_index.generation, 6)
+        self.assertEqual(fake_index.render(), [
+                '10.0.0.1 web-0', '10.0.0.1 www', '10.0.0.7 web-1'])
+        fake_subscription = subscriptions.Subscription(aliases=['w*'])
+        self.assertEqual(fake_index.render(fake_subscription),
+                ['10.0.0.1 web-0', '10.0.0.1 www'])
+        self.assertRaises(ValueError, fake_index.apply, (5, 7, [], []))
+
+        # Patches keep the subscription's matches up to date.
+        fake_index.apply((6, 7, [fake_server('api-0', '10.0.0.8',
+                aliases=['www2']), fake_server('web-0', '10.0.0.1')], []))
+        self.assertEqual(fake_index.render(fake_subscription),
+                ['10.0.0.8 api-0', '10.0.0.8 www2'])
+        self.assertEqual(fake_index.render(), ['10.0.0.8 api-0',
+                '10.0.0.8 www2', '10.0.0.1 web-0', '10.0.0.7 web-1'])
+
+    def test_publish(self):
+        """Test that a changed server set becomes a new generation."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.snapshots = self.mox.CreateMockAnything()
+        fake_db.servers = self.mox.CreateMockAnything()
+        fake_db.patches = self.mox.CreateMockAnything()
+
+        fake_db.snapshots.find_one({'_id': 'current'}, {'generation': 1}
+                ).AndReturn({'generation': 7})
+        fake_db.snapshots.find_one({'_id': 'current'}).AndReturn({
+                '_id': 'current', 'generation': 7,
+                'data': bson.Binary(snapshot.encode(
+                    [fake_server('web-0', '10.0.0.1')], 7))})
+        fake_db.servers.find({}, generations.FIELDS).AndReturn([
+                fake_server('web-0', '10.0.0.1'),
+                fake_server('web-1', '10.0.0.2')])
+        fake_db.snapshots.update({'_id': 'current', 'generation': 7},
+                mox.ContainsKeyValue('generation', 8), upsert=True, w=1)
+        fake_db.patches.save(mox.ContainsKeyValue('_id', 8), w=1)
+        fake_db.patches.remove({'_id': {'$lte': 6}})
+
+        # Events for one instance re-read only what it holds.
+        fake_db.snapshots.find_one({'_id': 'current'}, {'generation': 1}
+                ).AndReturn({'generation': 8})
+        fake_db.servers.find({'$or': [{'instance_id': {'$in': ['i-web-1']}},
+                {'hostname': {'$in': ['web-1']}}]},
+                generations.FIELDS).AndReturn([
+                    fake_server('web-1', '10.0.0.2')])
+
+        # Another replica published 9 meanwhile; this one reloads, and then
+        # loses the race for 10.
+        fake_db.snapshots.find_one({'_id': 'current'}, {'generation': 1}
+                ).AndReturn({'generation': 9})
+        fake_db.snapshots.find_one({'_id': 'current'}).AndReturn({
+                '_id': 'current', 'generation': 9,
+                'data': bson.Binary(snapshot.encode(
+                    [fake_server('web-0', '10.0.0.1')], 9))})
+        fake_db.servers.find({}, generations.FIELDS).AndReturn([
+                fake_server('web-2', '10.0.0.3')])
+        fake_db.snapshots.update({'_id': 'current', 'generation': 9},
+                mox.ContainsKeyValue('generation', 10), upsert=True,
+                w=1).AndRaise(pymongo.errors.DuplicateKeyError('dup'))
+
+        fake_publisher = generations.Publisher(fake_db, keep=2)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_publisher.publish(), 8)
+        self.assertEqual(fake_publisher.publish(['i-web-1']), None)
+        self.assertEqual(fake_publisher.publish(['i-web-2']), None)
+        self.assertEqual(fake_publisher.servers, None)
+
+    def test_publish_unencodable(self):
+        """Test that a server a snapshot can't carry is left out."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.snapshots = self.mox.CreateMockAnything()
+        fake_db.servers = self.mox.CreateMockAnything()
+        fake_db.patches = self.mox.CreateMockAnything()
+
+        fake_db.snapshots.find_one({'_id': 'current'}, {'generation': 1}
+                ).AndReturn(None)
+        fake_db.snapshots.find_one({'_id': 'current'}).AndReturn(None)
+        # As the offline registrar stores it.
+        fake_db.servers.find({}, generations.FIELDS).AndReturn([
+                fake_server('web-0', '10.0.0.1'),
+                fake_server('web-1', 'test_local_ip')])
+        fake_db.snapshots.update({'_id': 'current', 'generation': 0},
+                mox.ContainsKeyValue('generation', 1), upsert=True, w=1)
+        fake_db.patches.save(mox.ContainsKeyValue('_id', 1), w=1)
+        fake_db.patches.remove({'_id': {'$lte': -1}})
+
+        fake_publisher = generations.Publisher(fake_db, keep=2)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_publisher.publish(), 1)
+        self.assertEqual(sorted(fake_publisher.servers), ['web-0'])
+
+    def test_sync_patch(self):
+        """Test that a client close behind is patched forward."""
+
+        fake_index = generations.ServerIndex()
+        fake_index.load_snapshot(snapshot.encode(
+                [fake_server('web-0', '10.0.0.1')], 3))
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.snapshots = self.mox.CreateMockAnything()
+        fake_db.patches = self.mox.CreateMockAnything()
+
+        fake_db.snapshots.find_one({'_id': 'current'}, {'generation': 1}
+                ).AndReturn({'generation': 5})
+        fake_db.patches.find({'_id': {'$gt': 3, '$lte': 5}}).AndReturn(
+                FakeCursor([
+                    {'_id': 4, 'base': 3, 'data': generations.encode_patch(
+                        3, 4, [fake_server('web-1', '10.0.0.2')], [])},
+                    {'_id': 5, 'base': 4, 'data': generations.encode_patch(
+                        4, 5, [], ['web-0'])}]))
+
+        self.mox.ReplayAll()
+
+        fake_index = generations.sync(fake_db, fake_index)
+        self.assertEqual(fake_index.generation, 5)
+        self.assertEqual(sorted(fake_index.servers), ['web-1'])
+
+    def test_sync_expired(self):
+        """Test that a client whose generation expired gets a snapshot."""
+
+        fake_index = generations.ServerIndex()
+        fake_index.generation = 1
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.snapshots = self.mox.CreateMockAnything()
+        fake_db.patches = self.mox.CreateMockAnything()
+
+        fake_db.snapshots.find_one({'_id': 'current'}, {'generation': 1}
+                ).AndReturn({'generation': 9})
+        fake_db.patches.find({'_id': {'$gt': 1, '$lte': 9}}).AndReturn(
+                FakeCursor([{'_id': 9, 'base': 8, 'data': ''}]))
+        fake_db.snapshots.find_one({'_id': 'current'}).AndReturn({
+                'generation': 9, 'data': snapshot.encode(
+                    [fake_server('web-3', '10.0.0.4')], 9)})
+
+        self.mox.ReplayAll()
+
+        fake_index = generations.sync(fake_db, fake_index)
+        self.assertEqual(fake_index.generation, 9)
+        self.assertEqual(fake_index.render(), ['10.0.0.4 web-3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
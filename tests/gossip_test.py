@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+Unittests for Aerostat Gossip.
+"""
+
+import socket
+import threading
+import unittest
+
+import bson
+import mox
+
+from aerostat import generations
+from aerostat import gossip
+from aerostat import snapshot
+
+
+FAKE_KEY = 'fake-key'
+
+FAKE_SERVERS = [{'hostname': 'web-0', 'ip': '10.0.0.1', 'service': 'web',
+                 'service_type': 'iterative', 'instance_id': 'i-0',
+                 'aliases': []}]
+
+
+def fake_snapshot(generation, key=FAKE_KEY):
+    data = snapshot.encode(FAKE_SERVERS, generation, 'zlib')
+    return data, snapshot.sign(key, data)
+
+
+def serve_hangups(answer_generation):
+    """A peer that hangs up without replying, but for /generation if asked.
+
+    Returns:
+        tuple of (str, host:port; socket, to close).
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+
+    def serve():
+        while True:
+            try:
+                conn = listener.accept()[0]
+            except socket.error:
+                return
+            request = conn.recv(4096)
+            if answer_generation and request.startswith('GET /generation'):
+                conn.sendall('HTTP/1.0 200 OK\r\nContent-Length: 1\r\n'
+                             '\r\n9')
+            conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+
+    return '127.0.0.1:%s' % listener.getsockname()[1], listener
+
+
+class GossipTest(mox.MoxTestBase):
+    """Test signed snapshots passing between nodes."""
+
+    def serve(self, node):
+        server = node.serve(port=0, host='127.0.0.1')
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return '127.0.0.1:%s' % server.server_port
+
+    def test_is_seed(self):
+        """Test that seeds are picked by fraction."""
+
+        self.mox.ReplayAll()
+
+        self.assertFalse(gossip.is_seed('web-0', 0))
+        self.assertTrue(gossip.is_seed('web-0', 1))
+        seeds = len([i for i in range(1000)
+                     if gossip.is_seed('web-%s' % i, 0.05)])
+        self.assertTrue(30 < seeds < 70)
+        # A fleet too small for the fraction still gets min_seeds seeds.
+        fleet = ['web-%s' % i for i in range(10)]
+        seeds = [node for node in fleet if gossip.is_seed(node, 0.05, fleet)]
+        self.assertEqual(len(seeds), gossip.DEFAULT_MIN_SEEDS)
+        self.assertEqual(len([node for node in fleet
+                              if gossip.is_seed(node, 0.05, fleet, 1)]), 1)
+        fleet = ['web-%s' % i for i in range(1000)]
+        self.assertEqual(len([node for node in fleet
+                              if gossip.is_seed(node, 0.05, fleet)]), 50)
+
+    def test_offer(self):
+        """Test that only signed, newer snapshots are taken."""
+
+        fake_node = gossip.Node(FAKE_KEY, peers=[])
+
+        self.mox.ReplayAll()
+
+        self.assertTrue(fake_node.offer(*fake_snapshot(2)))
+        self.assertFalse(fake_node.offer(*fake_snapshot(1)))
+        self.assertFalse(fake_node.offer(*fake_snapshot(3, 'other-key')))
+        data, signature = fake_snapshot(3)
+        self.assertFalse(fake_node.offer(data[:-1] + 'x', signature))
+        self.assertEqual(fake_node.generation, 2)
+
+    def test_gossip(self):
+        """Test that a node pulls a newer snapshot from a peer."""
+
+        fake_seed = gossip.Node(FAKE_KEY, peers=[], seed_fraction=1,
+                source=lambda db, generation: fake_snapshot(4))
+        fake_node = gossip.Node(FAKE_KEY, peers=[self.serve(fake_seed)],
+                seed_fraction=0, source=lambda db, generation: None)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_node.sync(None), None)
+        self.assertEqual(fake_seed.sync(None).generation, 4)
+        fake_index = fake_node.sync(None)
+        self.assertEqual(fake_index.generation, 4)
+        self.assertEqual(fake_index.render(), ['10.0.0.1 web-0'])
+        # Nothing newer: the index is kept as is.
+        self.assertTrue(fake_node.sync(None, fake_index) is fake_index)
+
+    def test_gossip_forged(self):
+        """Test that a peer can't pass on a snapshot aerostatd didn't sign."""
+
+        fake_peer = gossip.Node(FAKE_KEY, peers=[])
+        fake_peer.generation, fake_peer.data, fake_peer.signature = (
+                (5,) + fake_snapshot(5, 'other-key'))
+        fake_node = gossip.Node(FAKE_KEY, peers=[self.serve(fake_peer)],
+                seed_fraction=0)
+
+        self.mox.ReplayAll()
+
+        self.assertFalse(fake_node.gossip())
+        self.assertEqual(fake_node.generation, 0)
+
+    def test_gossip_hangup(self):
+        """Test that a peer closing without a reply is skipped."""
+
+        silent, silent_listener = serve_hangups(False)
+        self.addCleanup(silent_listener.close)
+        teasing, teasing_listener = serve_hangups(True)
+        self.addCleanup(teasing_listener.close)
+        fake_node = gossip.Node(FAKE_KEY, peers=[silent, teasing],
+                seed_fraction=0)
+
+        self.mox.ReplayAll()
+
+        self.assertFalse(fake_node.gossip())
+        self.assertEqual(fake_node.generation, 0)
+
+    def test_mongo_source(self):
+        """Test that the snapshot is only read when it is newer."""
+
+        data, signature = fake_snapshot(7)
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.snapshots = self.mox.CreateMockAnything()
+        fake_db.snapshots.find_one({'_id': generations.CURRENT_ID},
+                {'generation': 1}).AndReturn({'generation': 7})
+        fake_db.snapshots.find_one({'_id': generations.CURRENT_ID},
+                {'generation': 1}).AndReturn({'generation': 7})
+        fake_db.snapshots.find_one({'_id': generations.CURRENT_ID}).AndReturn(
+                {'generation': 7, 'data': bson.Binary(data),
+                 'signature': signature})
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(gossip.mongo_source(fake_db, 7), None)
+        self.assertEqual(gossip.mongo_source(fake_db, 6), (data, signature))
+
+
+if __name__ == '__main__':
+    unittest.main()
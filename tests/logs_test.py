@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""
+Unittests for Aerostat Logs.
+"""
+
+import logging
+import unittest
+
+import mox
+
+from aerostat import logs
+
+
+class FakeHandler(logging.Handler):
+    """Keep formatted messages in a list."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class Unformattable(object):
+    """Fails the test if anything tries to format it."""
+
+    def __str__(self):
+        raise AssertionError('Formatted a message that was not emitted.')
+
+
+class LogsTest(mox.MoxTestBase):
+    """Test the logging facade."""
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.fake_handler = FakeHandler()
+        self.fake_log = logs.Logger('fake')
+        self.fake_log.logger.addHandler(self.fake_handler)
+        self.fake_log.logger.propagate = False
+        self.fake_log.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.fake_log.logger.removeHandler(self.fake_handler)
+        self.fake_log.logger.propagate = True
+        self.fake_log.logger.setLevel(logging.NOTSET)
+        mox.MoxTestBase.tearDown(self)
+
+    def test_parse_levels(self):
+        """Test parsing a default level with per-component overrides."""
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(logs.parse_levels('info,updater=debug'),
+                (logging.INFO, {'updater': logging.DEBUG}))
+        self.assertEqual(logs.parse_levels(None), (None, {}))
+        self.assertRaises(ValueError, logs.parse_levels, 'updater=loud')
+
+    def test_deferred(self):
+        """Test that disabled messages are never formatted."""
+
+        self.mox.ReplayAll()
+
+        self.fake_log.debug('host %s', Unformattable())
+        self.fake_log.record('host %s', Unformattable())
+        self.fake_log.info('host %s', 'a-1')
+        self.assertEqual(self.fake_handler.messages, ['host a-1'])
+
+    def test_record(self):
+        """Test that per-record lines are sampled."""
+
+        self.fake_log.logger.setLevel(logging.DEBUG)
+        self.fake_log.sample_every = 3
+
+        self.mox.ReplayAll()
+
+        for number in range(7):
+            self.fake_log.record('host %s', number)
+        self.assertEqual(self.fake_handler.messages,
+                ['host 0', 'host 3', 'host 6'])
+
+    def test_summary(self):
+        """Test that a summary is logged as one key=value line."""
+
+        summary = logs.Summary('update')
+        summary.add('hosts', 3)
+        summary.add('aliases')
+        summary.add('hosts')
+
+        self.mox.ReplayAll()
+
+        summary.log(self.fake_log)
+        self.assertEqual(len(self.fake_handler.messages), 1)
+        self.assertTrue(self.fake_handler.messages[0].startswith(
+                'update: aliases=1 hosts=4 elapsed='))
+
+
+if __name__ == '__main__':
+    unittest.main()
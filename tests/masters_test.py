@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""
+Unittests for Aerostat Masters.
+"""
+
+import unittest
+
+import mox
+
+from aerostat import masters
+
+
+def assignment(instance_id, ip):
+    return {'$set': {'instance_id': instance_id, 'ip': ip},
+            '$inc': {'generation': 1}}
+
+
+class MastersTest(mox.MoxTestBase):
+    """Test the Masters class."""
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.fake_db = self.mox.CreateMockAnything()
+        self.fake_db.servers = self.mox.CreateMockAnything()
+        self.fake_db.masters = self.mox.CreateMockAnything()
+
+    def test_is_master(self):
+        """Test is_master function."""
+
+        self.assertTrue(masters.is_master(
+                {'hostname': 'db-master', 'service': 'db'}))
+        self.assertFalse(masters.is_master(
+                {'hostname': 'db-master', 'service': 'web'}))
+        self.assertFalse(masters.is_master({'hostname': '-master'}))
+
+    def test_get(self):
+        """Test that documents are reused only within max_age."""
+
+        fake_master = {'_id': 'db', 'instance_id': 'i-1', 'generation': 1}
+        self.fake_db.masters.find_one({'_id': 'db'}).AndReturn(fake_master)
+        self.fake_db.masters.find_one({'_id': 'db'}).AndReturn(None)
+
+        self.mox.ReplayAll()
+
+        view = masters.Masters(self.fake_db)
+        self.assertEqual(view.get('db'), fake_master)
+        self.assertEqual(view.get('db', max_age=60), fake_master)
+        self.assertEqual(view.get('db'), None)
+
+    def test_renamed(self):
+        """Test that renames into and out of a master hostname are followed."""
+
+        self.fake_db.masters.update({'_id': 'db'}, assignment('', ''),
+                upsert=True)
+        self.fake_db.masters.update({'_id': 'db'},
+                assignment('i-2', '10.0.0.2'), upsert=True)
+
+        self.mox.ReplayAll()
+
+        view = masters.Masters(self.fake_db)
+        view.renamed({'hostname': 'db-master', 'service': 'db',
+                      'instance_id': 'i-1'}, 'db-slave-1')
+        view.renamed({'hostname': 'db-slave-2', 'service': 'db',
+                      'instance_id': 'i-2', 'ip': '10.0.0.2'}, 'db-master')
+        # Neither name is a master.
+        view.renamed({'hostname': 'db-slave-2', 'service': 'db',
+                      'instance_id': 'i-2'}, 'db-slave-3')
+
+    def test_clear_instances_and_moved(self):
+        """Test that terminations and ip changes reach only masters."""
+
+        self.fake_db.masters.update({'instance_id': {'$in': ['i-1', 'i-2']}},
+                assignment('', ''), multi=True, w=1)
+        self.fake_db.masters.find({'instance_id': {'$in': ['i-3', 'i-4']}}
+                ).AndReturn([{'_id': 'db', 'instance_id': 'i-4'}])
+        self.fake_db.masters.update({'_id': 'db', 'instance_id': 'i-4'},
+                {'$set': {'ip': '10.0.0.4'}, '$inc': {'generation': 1}})
+
+        self.mox.ReplayAll()
+
+        view = masters.Masters(self.fake_db)
+        view.clear_instances(['i-1', 'i-2'], {'w': 1})
+        view.moved({'i-4': '10.0.0.4', 'i-3': '10.0.0.3'})
+
+    def test_changes(self):
+        """Test that only masters with a new generation are returned."""
+
+        self.fake_db.masters.find().AndReturn([
+                {'_id': 'db', 'instance_id': 'i-1', 'generation': 1},
+                {'_id': 'queue', 'instance_id': 'i-2', 'generation': 4}])
+        self.fake_db.masters.find().AndReturn([
+                {'_id': 'db', 'instance_id': 'i-5', 'generation': 2},
+                {'_id': 'queue', 'instance_id': 'i-2', 'generation': 4}])
+
+        self.mox.ReplayAll()
+
+        view = masters.Masters(self.fake_db)
+        self.assertEqual(sorted(view.changes()), ['db', 'queue'])
+        self.assertEqual(view.changes(), {'db':
+                {'_id': 'db', 'instance_id': 'i-5', 'generation': 2}})
+
+    def test_rebuild(self):
+        """Test that only services that differ from servers are rewritten."""
+
+        self.fake_db.servers.find({'hostname': {'$regex': '-master$'}},
+                {'hostname': 1, 'service': 1, 'instance_id': 1,
+                 'ip': 1}).AndReturn([
+                    {'hostname': 'db-master', 'service': 'db',
+                     'instance_id': 'i-1', 'ip': '10.0.0.1'},
+                    # A second, dead master doesn't displace the live one.
+                    {'hostname': 'db-master', 'service': 'db',
+                     'instance_id': '', 'ip': ''},
+                    {'hostname': 'queue-master', 'service': 'queue',
+                     'instance_id': 'i-2', 'ip': '10.0.0.2'},
+                    {'hostname': 'web-master', 'service': 'mail'}])
+        self.fake_db.masters.find().AndReturn([
+                {'_id': 'db', 'instance_id': 'i-1', 'ip': '10.0.0.1'},
+                {'_id': 'queue', 'instance_id': 'i-9', 'ip': '10.0.0.9'},
+                {'_id': 'gone', 'instance_id': 'i-8', 'ip': '10.0.0.8'}])
+        self.fake_db.masters.update({'_id': 'gone'}, assignment('', ''),
+                upsert=True)
+        self.fake_db.masters.update({'_id': 'queue'},
+                assignment('i-2', '10.0.0.2'), upsert=True)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(masters.Masters(self.fake_db).rebuild(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""
+Unittests for Aerostat Metrics.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mox
+
+from aerostat import metrics
+
+
+class MetricsTest(mox.MoxTestBase):
+    """Test counters, gauges, histograms and the registry."""
+
+    def test_counter(self):
+        """Test that counters add up per label set."""
+
+        fake_counter = metrics.Counter(
+                'fake_total', 'Fake things.', ['result'])
+
+        self.mox.ReplayAll()
+
+        fake_counter.inc(result='ok')
+        fake_counter.inc(2, result='ok')
+        fake_counter.inc(result='failed')
+        self.assertEqual(fake_counter.get(result='ok'), 3)
+        self.assertEqual(fake_counter.render(),
+                '# HELP fake_total Fake things.\n'
+                '# TYPE fake_total counter\n'
+                'fake_total{result="failed"} 1\n'
+                'fake_total{result="ok"} 3')
+
+    def test_gauge(self):
+        """Test that gauges keep the last value set."""
+
+        fake_gauge = metrics.Gauge('fake_entries', 'Fake entries.')
+
+        self.mox.ReplayAll()
+
+        fake_gauge.set(5)
+        fake_gauge.set(3)
+        self.assertEqual(fake_gauge.render().splitlines()[-1],
+                'fake_entries 3')
+
+    def test_histogram(self):
+        """Test that histogram buckets are rendered cumulatively."""
+
+        fake_histogram = metrics.Histogram(
+                'fake_seconds', 'Fake latency.', buckets=(0.1, 1.0))
+
+        self.mox.ReplayAll()
+
+        fake_histogram.observe(0.05)
+        fake_histogram.observe(0.5)
+        fake_histogram.observe(5)
+        self.assertEqual(fake_histogram.get(), (5.55, 3))
+        self.assertEqual(fake_histogram.render().splitlines()[2:], [
+                'fake_seconds_bucket{le="0.1"} 1',
+                'fake_seconds_bucket{le="1"} 2',
+                'fake_seconds_bucket{le="+Inf"} 3',
+                'fake_seconds_sum 5.55',
+                'fake_seconds_count 3'])
+
+    def test_register(self):
+        """Test that registering a name twice returns the first metric."""
+
+        fake_registry = metrics.Registry()
+        fake_counter = fake_registry.register(
+                metrics.Counter('fake_total', 'Fake things.'))
+
+        self.mox.ReplayAll()
+
+        self.assertTrue(fake_registry.register(
+                metrics.Counter('fake_total', 'Fake things.')) is fake_counter)
+        self.assertRaises(ValueError, fake_registry.register,
+                metrics.Gauge('fake_total', 'Fake things.'))
+
+    def test_write_textfile(self):
+        """Test that the registry is written out in the text format."""
+
+        fake_registry = metrics.Registry()
+        fake_registry.register(
+                metrics.Counter('fake_total', 'Fake things.')).inc()
+        fake_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, fake_dir)
+        fake_path = os.path.join(fake_dir, 'aerostat.prom')
+
+        self.mox.ReplayAll()
+
+        fake_registry.write_textfile(fake_path)
+        self.assertEqual(open(fake_path).read(), fake_registry.render())
+        self.assertEqual(os.listdir(fake_dir), ['aerostat.prom'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""
+Unittests for Aerostat Namepool.
+"""
+
+import datetime
+import unittest
+
+import mox
+import pymongo
+
+from aerostat import namepool
+
+
+class NamePoolTest(mox.MoxTestBase):
+    """Test the NamePool and PoolFiller classes."""
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.fake_db = self.mox.CreateMockAnything()
+        self.fake_db.servers = self.mox.CreateMockAnything()
+        self.fake_db.name_pool = self.mox.CreateMockAnything()
+
+    def test_free_names_iterative(self):
+        """Test that gaps come first, then the next numbers."""
+
+        self.fake_db.servers.find({'service': 'web'},
+                {'hostname': 1, 'instance_id': 1}).AndReturn([
+                    {'hostname': 'web-0', 'instance_id': 'i-0'},
+                    {'hostname': 'web-10', 'instance_id': ''},
+                    {'hostname': 'web-2', 'instance_id': ''},
+                    {'hostname': 'web-11', 'instance_id': 'i-11'}])
+
+        self.mox.ReplayAll()
+
+        pool = namepool.NamePool(self.fake_db)
+        self.assertEqual(pool.free_names('web', 'iterative', 4), [
+            (2, 'web-2'), (10, 'web-10'), (12, 'web-12'), (13, 'web-13')])
+
+    def test_free_names_masterful(self):
+        """Test that a new masterful service starts with its master."""
+
+        self.fake_db.servers.find({'service': 'mongodb'},
+                {'hostname': 1, 'instance_id': 1}).AndReturn([])
+
+        self.mox.ReplayAll()
+
+        pool = namepool.NamePool(self.fake_db)
+        self.assertEqual(pool.free_names('mongodb', 'masterful', 2), [
+            (0, 'mongodb-master'), (1, 'mongodb-slave-1')])
+
+    def test_refill(self):
+        """Test that refill drops stale entries and tops the pool up."""
+
+        now = datetime.datetime.utcnow()
+        self.fake_db.name_pool.find({'service': 'web'}).AndReturn([
+            {'_id': 1, 'hostname': 'web-1', 'claimed_by': None},
+            {'_id': 2, 'hostname': 'web-2', 'claimed_by': 'i-new',
+             'claimed_at': now},
+            {'_id': 3, 'hostname': 'web-3', 'claimed_by': 'i-old',
+             'claimed_at': now - datetime.timedelta(days=1)}])
+        self.fake_db.servers.find({'service': 'web'},
+                {'hostname': 1, 'instance_id': 1}).AndReturn([
+                    {'hostname': 'web-0', 'instance_id': 'i-0'},
+                    {'hostname': 'web-1', 'instance_id': 'i-1'}])
+        self.fake_db.name_pool.remove({'_id': {'$in': [1, 3]}})
+        self.fake_db.name_pool.insert({'service': 'web',
+                'service_type': 'iterative', 'hostname': 'web-3', 'rank': 3,
+                'claimed_by': None}, w=1)
+
+        self.mox.ReplayAll()
+
+        pool = namepool.NamePool(self.fake_db, size=1)
+        self.assertEqual(pool.refill('web', 'iterative'), 1)
+
+    def test_claim(self):
+        """Test claiming, skipping names taken behind the pool's back."""
+
+        query = {'service': 'web', 'claimed_by': None}
+        update = {'$set': {'claimed_by': 'i-test1',
+                           'claimed_at': mox.IsA(datetime.datetime)}}
+        self.fake_db.name_pool.find_and_modify(query, update,
+                sort=[('rank', 1)], new=True).AndReturn({'hostname': 'web-1'})
+        self.fake_db.servers.find_one({'hostname': 'web-1'},
+                {'instance_id': 1}).AndReturn({'instance_id': 'i-other'})
+        self.fake_db.name_pool.find_and_modify(query, update,
+                sort=[('rank', 1)], new=True).AndReturn({'hostname': 'web-2'})
+        self.fake_db.servers.find_one({'hostname': 'web-2'},
+                {'instance_id': 1}).AndReturn(None)
+        self.fake_db.name_pool.find_and_modify(query, update,
+                sort=[('rank', 1)], new=True).AndReturn(None)
+
+        self.mox.ReplayAll()
+
+        pool = namepool.NamePool(self.fake_db)
+        self.assertEqual(pool.claim('web', 'i-test1'), 'web-2')
+        self.assertEqual(pool.claim('web', 'i-test1'), None)
+
+    def test_active_pool(self):
+        """Test that clients only use a pool aerostatd is filling."""
+
+        self.fake_db.name_pool_status = self.mox.CreateMockAnything()
+        now = datetime.datetime.utcnow()
+        self.fake_db.name_pool_status.find_one({'_id': 'filler'}).AndReturn(
+                None)
+        self.fake_db.name_pool_status.find_one({'_id': 'filler'}).AndReturn(
+                {'active_until': now - datetime.timedelta(seconds=1)})
+        self.fake_db.name_pool_status.find_one({'_id': 'filler'}).AndReturn(
+                {'active_until': now + datetime.timedelta(seconds=15),
+                 'claim_ttl': 60})
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(namepool.active_pool(self.fake_db), None)
+        self.assertEqual(namepool.active_pool(self.fake_db), None)
+        self.assertEqual(namepool.active_pool(self.fake_db).claim_ttl, 60)
+
+    def test_reserve(self):
+        """Test reserving a pooled name, a new one, and a name already
+        claimed by another node."""
+
+        update = {'$set': {'claimed_by': 'i-test1',
+                           'claimed_at': mox.IsA(datetime.datetime)}}
+        for hostname in ('web-2', 'web-3', 'web-4'):
+            self.fake_db.name_pool.find_and_modify(
+                    {'hostname': hostname,
+                     'claimed_by': {'$in': [None, 'i-test1']}},
+                    update).AndReturn(hostname == 'web-2' and {'hostname': hostname} or
+                        None)
+            if hostname == 'web-2':
+                continue
+            insert = self.fake_db.name_pool.insert({'service': 'web',
+                    'service_type': 'iterative', 'hostname': hostname,
+                    'rank': int(hostname[-1]), 'claimed_by': 'i-test1',
+                    'claimed_at': mox.IsA(datetime.datetime)}, w=1)
+            if hostname == 'web-4':
+                insert.AndRaise(pymongo.errors.DuplicateKeyError('taken'))
+
+        self.mox.ReplayAll()
+
+        pool = namepool.NamePool(self.fake_db)
+        self.assertTrue(pool.reserve('web', 'iterative', 'web-2', 'i-test1'))
+        self.assertTrue(pool.reserve('web', 'iterative', 'web-3', 'i-test1'))
+        self.assertFalse(pool.reserve('web', 'iterative', 'web-4', 'i-test1'))
+
+    def test_claimed_names(self):
+        """Test that live claims by other instances are listed."""
+
+        self.fake_db.name_pool.find({'service': 'web',
+                'claimed_by': {'$nin': [None, 'i-test1']},
+                'claimed_at': {'$gt': mox.IsA(datetime.datetime)}},
+                {'hostname': 1}).AndReturn([{'hostname': 'web-2'}])
+
+        self.mox.ReplayAll()
+
+        pool = namepool.NamePool(self.fake_db)
+        self.assertEqual(pool.claimed_names('web', 'i-test1'), set(['web-2']))
+
+    def test_fill(self):
+        """Test that only low or dirty services are refilled."""
+
+        fake_pool = self.mox.CreateMock(namepool.NamePool)
+        fake_pool.size = 2
+        fake_pool.services().AndReturn(
+                {'web': 'iterative', 'db': 'masterful', 'cache': 'iterative'})
+        fake_pool.unclaimed_counts().AndReturn({'web': 2, 'db': 1, 'cache': 2})
+        fake_pool.refill('db', 'masterful').InAnyOrder().AndReturn(1)
+        fake_pool.refill('cache', 'iterative').InAnyOrder().AndReturn(0)
+
+        self.mox.ReplayAll()
+
+        filler = namepool.PoolFiller(fake_pool)
+        filler.mark_dirty(['cache'])
+        self.assertEqual(filler.fill(), 1)
+        self.assertEqual(filler.dirty, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+Unittests for Aerostat Profiler.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mox
+import pymongo.collection
+
+from aerostat import profiler
+
+
+class ProfilerTest(mox.MoxTestBase):
+    """Test the Profiler and its database proxies."""
+
+    def test_filter_shape(self):
+        """Test that values are blanked but fields and operators kept."""
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(profiler.filter_shape(
+                {'instance_id': {'$in': ['i-1', 'i-2']}, 'service': 'db'}),
+                '{"instance_id": {"$in": "?"}, "service": "?"}')
+        self.assertEqual(profiler.filter_shape(
+                {'$or': [{'holder': 'a'}, {'expires': {'$lt': 1}}]}),
+                '{"$or": [{"holder": "?"}, {"expires": {"$lt": "?"}}]}')
+        self.assertEqual(profiler.filter_shape(None), '{}')
+
+    def test_record(self):
+        """Test that sampled operations are totalled per query shape."""
+
+        fake_hook = self.mox.CreateMockAnything()
+        fake_hook(mox.IsA(profiler.Operation))
+        fake_hook(mox.IsA(profiler.Operation))
+        fake_profiler = profiler.Profiler(slow_ms=None, hooks=[fake_hook])
+
+        self.mox.ReplayAll()
+
+        fake_profiler.record('servers', 'find', {'service': 'a'}, 0.5, 2)
+        fake_profiler.record('servers', 'find', {'service': 'b'}, 1.5, 3)
+        summary = fake_profiler.summary()
+        self.assertEqual(len(summary), 1)
+        self.assertEqual(summary[0]['count'], 2)
+        self.assertEqual(summary[0]['total_ms'], 2000)
+        self.assertEqual(summary[0]['max_ms'], 1500)
+        self.assertEqual(summary[0]['docs'], 5)
+        self.assertEqual(summary[0]['callers'][0].split(':')[0],
+                'profiler_test.test_record')
+
+    def test_record_unsampled(self):
+        """Test that unsampled operations are dropped unless slow."""
+
+        fake_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, fake_dir)
+        fake_log = os.path.join(fake_dir, 'slow.log')
+        fake_profiler = profiler.Profiler(
+                sample_rate=0, slow_ms=100, slow_log=fake_log)
+
+        self.mox.ReplayAll()
+
+        fake_profiler.record('servers', 'find', {'service': 'a'}, 0.01, 1)
+        fake_profiler.record('servers', 'update', {'hostname': 'a'}, 0.2, 1)
+        self.assertEqual(fake_profiler.summary(), [])
+        entries = [json.loads(line) for line in open(fake_log)]
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['op'], 'update')
+        self.assertEqual(entries[0]['shape'], '{"hostname": "?"}')
+
+    def test_profiled_find(self):
+        """Test that a find is recorded once its cursor is exhausted."""
+
+        fake_collection = self.mox.CreateMock(pymongo.collection.Collection)
+        fake_collection.name = 'servers'
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.servers = fake_collection
+        fake_collection.find({'service': 'db'}).AndReturn(
+                iter([{'hostname': 'db-0'}, {'hostname': 'db-1'}]))
+
+        self.mox.ReplayAll()
+
+        db = profiler.profile(fake_db, slow_ms=None)
+        cursor = db.servers.find({'service': 'db'})
+        self.assertEqual(db.profiler.summary(), [])
+        self.assertEqual(len(list(cursor)), 2)
+        summary = db.profiler.summary()
+        self.assertEqual(summary[0]['op'], 'find')
+        self.assertEqual(summary[0]['docs'], 2)
+
+    def test_profiled_find_partly_read(self):
+        """Test that a cursor abandoned part way through is still recorded."""
+
+        fake_collection = self.mox.CreateMock(pymongo.collection.Collection)
+        fake_collection.name = 'servers'
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.servers = fake_collection
+        fake_collection.find({'service': 'db'}).AndReturn(
+                iter([{'hostname': 'db-0'}, {'hostname': 'db-1'}]))
+        fake_collection.find({'service': 'web'}).AndReturn(
+                iter([{'hostname': 'web-0'}]))
+
+        self.mox.ReplayAll()
+
+        db = profiler.profile(fake_db, slow_ms=None)
+        for doc in db.servers.find({'service': 'db'}):
+            break
+        # Never read, so never queried.
+        db.servers.find({'service': 'web'})
+        summary = db.profiler.summary()
+        self.assertEqual(len(summary), 1)
+        self.assertEqual(summary[0]['docs'], 1)
+        self.assertEqual(summary[0]['shape'], '{"service": "?"}')
+
+    def test_profiled_cursor_indexing(self):
+        """Test that indexing and len() reach the wrapped cursor."""
+
+        fake_cursor = self.mox.CreateMockAnything()
+        fake_cursor.__getitem__(slice(0, 5, None)).AndReturn(fake_cursor)
+        fake_cursor.__getitem__(2).AndReturn({'hostname': 'db-2'})
+        fake_cursor.__getitem__(9).AndRaise(IndexError('no such item'))
+        fake_cursor.__len__().AndReturn(5)
+
+        self.mox.ReplayAll()
+
+        fake_profiler = profiler.Profiler(slow_ms=None)
+        cursor = profiler.ProfiledCursor(
+                fake_cursor, fake_profiler, 'servers', 'find', None)
+        self.assertTrue(cursor[0:5] is cursor)
+        self.assertEqual(cursor[2], {'hostname': 'db-2'})
+        self.assertRaises(IndexError, lambda: cursor[9])
+        self.assertEqual(len(cursor), 5)
+        summary = fake_profiler.summary()
+        self.assertEqual(summary[0]['count'], 2)
+        self.assertEqual(summary[0]['docs'], 1)
+
+    def test_profiled_update(self):
+        """Test that writes are recorded with the documents they touched."""
+
+        fake_collection = self.mox.CreateMock(pymongo.collection.Collection)
+        fake_collection.name = 'servers'
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.servers = fake_collection
+        fake_collection.update({'instance_id': 'i-1'},
+                {'$set': {'ip': ''}}, w=1).AndReturn({'n': 1})
+
+        self.mox.ReplayAll()
+
+        db = profiler.profile(fake_db, slow_ms=None)
+        db.servers.update({'instance_id': 'i-1'}, {'$set': {'ip': ''}}, w=1)
+        summary = db.profiler.summary()
+        self.assertEqual(summary[0]['op'], 'update')
+        self.assertEqual(summary[0]['docs'], 1)
+        self.assertEqual(summary[0]['shape'], '{"instance_id": "?"}')
+
+
+if __name__ == '__main__':
+    unittest.main()
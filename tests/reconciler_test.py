@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+Unittests for Aerostat Reconciler.
+"""
+
+import unittest
+
+import mox
+
+from aerostat import reconciler
+
+
+class ReconcilerTest(mox.MoxTestBase):
+    """Test the Reconciler class."""
+
+    def test_needs_full_sync(self):
+        """Test that full syncs come around every full_sync_every cycles."""
+
+        fake_reconciler = reconciler.Reconciler(full_sync_every=2)
+
+        self.mox.ReplayAll()
+
+        results = []
+        for _ in range(4):
+            results.append(fake_reconciler.needs_full_sync())
+            fake_reconciler.commit({}, [], {})
+        self.assertEqual(results, [True, False, True, False])
+
+    def test_changed_aws_ids(self):
+        """Test that only new or changed instances are reported."""
+
+        fake_reconciler = reconciler.Reconciler()
+        fake_reconciler.aws = {'i-same': ('10.0.0.1', 'running'),
+                               'i-moved': ('10.0.0.2', 'running')}
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(sorted(fake_reconciler.changed_aws_ids(
+                {'i-same': ('10.0.0.1', 'running'),
+                 'i-moved': ('10.0.0.22', 'running'),
+                 'i-new': ('10.0.0.3', 'running')})), ['i-moved', 'i-new'])
+
+    def test_load_mongo(self):
+        """Test merging and replacing the Mongo snapshot."""
+
+        fake_reconciler = reconciler.Reconciler()
+        fake_reconciler.mongo = {'i-old': '10.0.0.1'}
+
+        self.mox.ReplayAll()
+
+        fake_reconciler.load_mongo([('i-new', '10.0.0.2'), ('', '')])
+        self.assertEqual(fake_reconciler.mongo,
+                {'i-old': '10.0.0.1', 'i-new': '10.0.0.2'})
+        fake_reconciler.load_mongo([('i-new', '10.0.0.2')], full=True)
+        self.assertEqual(fake_reconciler.mongo, {'i-new': '10.0.0.2'})
+
+    def test_plan(self):
+        """Test removal candidates and ip drift."""
+
+        fake_reconciler = reconciler.Reconciler()
+        fake_reconciler.mongo = {'i-gone': '10.0.0.1', 'i-moved': '10.0.0.2',
+                                 'i-same': '10.0.0.3', 'i-stopped': '10.0.0.5'}
+        fake_reconciler.aws = {'i-unregistered': ('10.0.0.4', 'running')}
+        aws = {'i-moved': ('10.0.0.22', 'running'),
+               'i-same': ('10.0.0.3', 'running'),
+               'i-stopped': (None, 'stopped')}
+
+        self.mox.ReplayAll()
+
+        gone, ip_changes = fake_reconciler.plan(aws)
+        # Stopped instances keep their names; unregistered ones need no write.
+        self.assertEqual(gone, set(['i-gone']))
+        self.assertEqual(ip_changes, {'i-moved': '10.0.0.22'})
+
+        gone, ip_changes = fake_reconciler.plan(aws, ['i-same'])
+        self.assertEqual(ip_changes, {})
+
+    def test_commit(self):
+        """Test that held back instances survive into the next snapshot."""
+
+        fake_reconciler = reconciler.Reconciler()
+        fake_reconciler.mongo = {'i-gone': '10.0.0.1', 'i-moved': '10.0.0.2',
+                                 'i-held': '10.0.0.5'}
+        fake_reconciler.aws = {'i-gone': ('10.0.0.1', 'running'),
+                               'i-held': ('10.0.0.5', 'running'),
+                               'i-unregistered': ('10.0.0.6', 'running')}
+
+        self.mox.ReplayAll()
+
+        fake_reconciler.commit({'i-moved': ('10.0.0.22', 'running')},
+                ['i-gone'], {'i-moved': '10.0.0.22'})
+        self.assertEqual(fake_reconciler.mongo,
+                {'i-moved': '10.0.0.22', 'i-held': '10.0.0.5'})
+        self.assertEqual(fake_reconciler.aws,
+                {'i-moved': ('10.0.0.22', 'running'),
+                 'i-held': ('10.0.0.5', 'running')})
+        self.assertEqual(fake_reconciler.cycles, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
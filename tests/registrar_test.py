@@ -4,6 +4,7 @@
 Aerostat Registrar Unittests
 """
 
+import datetime
 import os
 import StringIO
 import sys
@@ -12,6 +13,7 @@ import unittest
 import mox
 
 from aerostat import aerostat
+from aerostat import namepool
 from aerostat import registrar
 
 class RegistrarTest(mox.MoxTestBase):
@@ -172,11 +174,18 @@ class RegistrarTest(mox.MoxTestBase):
         fake_host = 'fake_host'
         fake_db = self.mox.CreateMockAnything()
         fake_db.servers = self.mox.CreateMockAnything()
-        fake_db.servers.update(
+        fake_db.masters = self.mox.CreateMockAnything()
+        fake_db.servers.find_and_modify(
                 {'instance_id': fake_inst},
                 {'$set':
-                    {'hostname': fake_host}}).AndReturn(None)
-        fake_db.servers.update(
+                    {'hostname': fake_host}}).AndReturn(
+                {'hostname': 'fake-master', 'service': 'fake',
+                 'instance_id': fake_inst, 'ip': '10.0.0.1'})
+        # It was fake's master, so the view loses it.
+        fake_db.masters.update({'_id': 'fake'},
+                {'$set': {'instance_id': '', 'ip': ''},
+                 '$inc': {'generation': 1}}, upsert=True)
+        fake_db.servers.find_and_modify(
                 {'hostname': fake_host},
                 {'$set':
                     {'hostname': fake_host}}).AndReturn(None)
@@ -270,7 +279,7 @@ class RegistrarTest(mox.MoxTestBase):
         fake_registrar.hostname_instance_exists(
                 fake_db, 'mongodb-master').AndReturn(True)
         fake_registrar.check_dup(fake_db, fake_instance_id).AndReturn(False)
-        fake_registrar.get_smallest_gap(fake_db, fake_service).AndReturn('mongodb-slave-1')
+        fake_registrar.get_smallest_gap(fake_db, fake_service, ()).AndReturn('mongodb-slave-1')
 
         # I'm cheating here by using a list instead of an iterable obj.
         fake_db.servers.find(
@@ -283,6 +292,95 @@ class RegistrarTest(mox.MoxTestBase):
 
         self.assertEqual(test_hostname, expected_hostname)
 
+    def test_pick_name_from_pool(self):
+        """Test that pick_name takes a pooled name when one is available."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.name_pool_status = self.mox.CreateMockAnything()
+        fake_registrar = registrar.Registrar()
+        self.mox.StubOutWithMock(fake_registrar, 'check_dup')
+        fake_registrar.check_dup(fake_db, 'i-test1').AndReturn(False)
+        fake_db.name_pool_status.find_one({'_id': 'filler'}).AndReturn(
+                {'active_until': datetime.datetime.utcnow() +
+                    datetime.timedelta(seconds=15), 'claim_ttl': 60})
+        self.mox.StubOutWithMock(namepool.NamePool, 'claim')
+        namepool.NamePool.claim('web', 'i-test1').AndReturn('web-4')
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_registrar.pick_name(
+                fake_db, 'web', 'iterative', 'i-test1', use_pool=True), 'web-4')
+
+    def test_pick_name_reserves_fallback(self):
+        """Test that a computed name skips and reserves pool claims."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.name_pool_status = self.mox.CreateMockAnything()
+        fake_registrar = registrar.Registrar()
+        self.mox.StubOutWithMock(fake_registrar, 'check_dup')
+        self.mox.StubOutWithMock(fake_registrar, 'compute_name')
+        self.mox.StubOutWithMock(namepool.NamePool, 'claim')
+        self.mox.StubOutWithMock(namepool.NamePool, 'claimed_names')
+        self.mox.StubOutWithMock(namepool.NamePool, 'reserve')
+        fake_registrar.check_dup(fake_db, 'i-test1').AndReturn(False)
+        fake_db.name_pool_status.find_one({'_id': 'filler'}).AndReturn(
+                {'active_until': datetime.datetime.utcnow() +
+                    datetime.timedelta(seconds=15)})
+        namepool.NamePool.claim('web', 'i-test1').AndReturn(None)
+        namepool.NamePool.claimed_names('web', 'i-test1').AndReturn(
+                set(['web-2']))
+        fake_registrar.compute_name(fake_db, 'web', 'iterative',
+                set(['web-2'])).AndReturn('web-3')
+        # Another node reserved web-3 in between.
+        namepool.NamePool.reserve('web', 'iterative', 'web-3',
+                'i-test1').AndReturn(False)
+        fake_registrar.compute_name(fake_db, 'web', 'iterative',
+                set(['web-2', 'web-3'])).AndReturn('web-4')
+        namepool.NamePool.reserve('web', 'iterative', 'web-4',
+                'i-test1').AndReturn(True)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_registrar.pick_name(
+                fake_db, 'web', 'iterative', 'i-test1', use_pool=True), 'web-4')
+
+    def test_pick_name_without_active_pool(self):
+        """Test that the pool is left alone when aerostatd isn't filling it."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.name_pool_status = self.mox.CreateMockAnything()
+        fake_registrar = registrar.Registrar()
+        self.mox.StubOutWithMock(fake_registrar, 'check_dup')
+        self.mox.StubOutWithMock(fake_registrar, 'compute_name')
+        fake_registrar.check_dup(fake_db, 'i-test1').AndReturn(False)
+        fake_db.name_pool_status.find_one({'_id': 'filler'}).AndReturn(
+                {'active_until': datetime.datetime.utcnow() -
+                    datetime.timedelta(seconds=1)})
+        fake_registrar.compute_name(fake_db, 'web', 'iterative').AndReturn(
+                'web-1')
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_registrar.pick_name(
+                fake_db, 'web', 'iterative', 'i-test1', use_pool=True), 'web-1')
+
+    def test_compute_name_reserved(self):
+        """Test that reserved names are passed over."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.servers = self.mox.CreateMockAnything()
+        fake_registrar = registrar.Registrar()
+        self.mox.StubOutWithMock(fake_registrar, 'get_smallest_gap')
+        fake_db.servers.find({'service': 'web'}).AndReturn([
+            {'hostname': 'web-0'}, {'hostname': 'web-1'}])
+        fake_registrar.get_smallest_gap(fake_db, 'web',
+                set(['web-2', 'web-3'])).AndReturn(None)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_registrar.compute_name(fake_db, 'web',
+                'iterative', set(['web-2', 'web-3'])), 'web-4')
+
     def test_pick_name_duplicate_inst(self):
         """test pick_name function when there is a duplicate."""
 
@@ -372,7 +470,7 @@ class RegistrarTest(mox.MoxTestBase):
                 fake_db, 'mongodb-master').AndReturn(True)
 
         self.mox.StubOutWithMock(fake_registrar, 'get_smallest_gap')
-        fake_registrar.get_smallest_gap(fake_db, fake_service).AndReturn(expected_hostname2)
+        fake_registrar.get_smallest_gap(fake_db, fake_service, ()).AndReturn(expected_hostname2)
 
         self.mox.ReplayAll()
 
@@ -451,6 +549,108 @@ class RegistrarTest(mox.MoxTestBase):
 
         self.assertTrue(test_value)
 
+    def test_register_name_claimed(self):
+        """Test that a gap taken by another instance isn't overwritten."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.servers = self.mox.CreateMockAnything()
+        fake_db.servers.update(
+                {'hostname': 'mongodb-slave-1',
+                 'instance_id': {'$in': ['', None]}},
+                {'$set': {'ip': '12.123.234.5', 'service': 'mongodb',
+                          'service_type': 'masterful',
+                          'instance_id': 'i-23426', 'aliases': []}},
+                w=1).AndReturn({'n': 0})
+
+        fake_registrar = registrar.Registrar()
+        self.mox.StubOutWithMock(aerostat, 'hostname_exists')
+        aerostat.hostname_exists(fake_db, 'mongodb-slave-1').AndReturn(True)
+
+        self.mox.ReplayAll()
+
+        self.assertFalse(fake_registrar.register_name(
+                fake_db, 'mongodb-slave-1', '12.123.234.5', 'i-23426',
+                'mongodb', 'masterful', []))
+
+    def test_do_registrar(self):
+        """Test that the system is only renamed once the name is claimed."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_registrar = registrar.Registrar()
+        self.mox.StubOutWithMock(fake_registrar, 'parse_service_info')
+        self.mox.StubOutWithMock(aerostat, 'get_aws_data')
+        self.mox.StubOutWithMock(fake_registrar, 'pick_name')
+        self.mox.StubOutWithMock(fake_registrar, 'register_name')
+        self.mox.StubOutWithMock(fake_registrar, 'set_sys_hostname')
+        fake_registrar.parse_service_info().AndReturn(
+                ('web', 'iterative', None))
+        aerostat.get_aws_data(False).AndReturn(('i-test1', '10.0.0.1'))
+        fake_registrar.pick_name(fake_db, 'web', 'iterative', 'i-test1',
+                use_pool=True).AndReturn('web-1')
+        fake_registrar.register_name(fake_db, 'web-1', '10.0.0.1', 'i-test1',
+                'web', 'iterative', None).AndReturn(True)
+        fake_registrar.set_sys_hostname('web-1').AndReturn(True)
+
+        self.mox.ReplayAll()
+
+        self.assertTrue(fake_registrar.do_registrar(
+                fake_db, False, False, False))
+
+    def test_do_registrar_claim_lost(self):
+        """Test that a lost claim picks another name before renaming."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_registrar = registrar.Registrar()
+        self.mox.StubOutWithMock(fake_registrar, 'parse_service_info')
+        self.mox.StubOutWithMock(aerostat, 'get_aws_data')
+        self.mox.StubOutWithMock(fake_registrar, 'pick_name')
+        self.mox.StubOutWithMock(fake_registrar, 'register_name')
+        self.mox.StubOutWithMock(fake_registrar, 'set_sys_hostname')
+        fake_registrar.parse_service_info().AndReturn(
+                ('web', 'iterative', None))
+        aerostat.get_aws_data(False).AndReturn(('i-test1', '10.0.0.1'))
+        fake_registrar.pick_name(fake_db, 'web', 'iterative', 'i-test1',
+                use_pool=True).AndReturn('web-1')
+        # Another instance took web-1 in between.
+        fake_registrar.register_name(fake_db, 'web-1', '10.0.0.1', 'i-test1',
+                'web', 'iterative', None).AndReturn(False)
+        fake_registrar.pick_name(fake_db, 'web', 'iterative', 'i-test1',
+                use_pool=True).AndReturn('web-2')
+        fake_registrar.register_name(fake_db, 'web-2', '10.0.0.1', 'i-test1',
+                'web', 'iterative', None).AndReturn(True)
+        fake_registrar.set_sys_hostname('web-2').AndReturn(True)
+
+        self.mox.ReplayAll()
+
+        self.assertTrue(fake_registrar.do_registrar(
+                fake_db, False, False, False))
+
+    def test_do_registrar_gives_up(self):
+        """Test that the system isn't renamed when no claim succeeds."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_registrar = registrar.Registrar()
+        self.mox.StubOutWithMock(fake_registrar, 'parse_service_info')
+        self.mox.StubOutWithMock(aerostat, 'get_aws_data')
+        self.mox.StubOutWithMock(fake_registrar, 'pick_name')
+        self.mox.StubOutWithMock(fake_registrar, 'register_name')
+        self.mox.StubOutWithMock(fake_registrar, 'set_sys_hostname')
+        fake_registrar.parse_service_info().AndReturn(
+                ('web', 'iterative', None))
+        aerostat.get_aws_data(False).AndReturn(('i-test1', '10.0.0.1'))
+        fake_registrar.pick_name(fake_db, 'web', 'iterative', 'i-test1',
+                use_pool=True).AndReturn('web-1')
+        fake_registrar.register_name(fake_db, 'web-1', '10.0.0.1', 'i-test1',
+                'web', 'iterative', None).AndReturn(False)
+        # The same name comes back, so there's nothing left to try.
+        fake_registrar.pick_name(fake_db, 'web', 'iterative', 'i-test1',
+                use_pool=True).AndReturn('web-1')
+
+        self.mox.ReplayAll()
+
+        self.assertTrue(fake_registrar.do_registrar(
+                fake_db, False, False, False))
+
     def test_set_sys_hostname(self):
         """test set_sys_hostname."""
 
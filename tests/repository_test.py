@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""
+Unittests for the Aerostat template Repository.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import git
+import mox
+
+from aerostat import configurer
+from aerostat import repository
+
+
+FAKE_ACTOR = git.Actor('Fake Author', 'fake@example.com')
+
+
+class RepositoryTest(mox.MoxTestBase):
+    """Test the Repository class against a local bare repo."""
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.fake_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.fake_dir)
+        self.fake_url = 'file://' + os.path.join(self.fake_dir, 'origin.git')
+        git.Repo.init(os.path.join(self.fake_dir, 'origin.git'), bare=True)
+        self.fake_work = git.Repo.clone_from(
+                self.fake_url, os.path.join(self.fake_dir, 'work'))
+
+    def fake_commit(self, files):
+        """Commit files (path -> contents) to the origin's master."""
+        for path, contents in files.items():
+            full_path = os.path.join(self.fake_work.working_dir, path)
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            open(full_path, 'w').write(contents)
+        self.fake_work.index.add(files.keys())
+        commit = self.fake_work.index.commit(
+                'fake', author=FAKE_ACTOR, committer=FAKE_ACTOR)
+        self.fake_work.git.push('origin', 'HEAD:refs/heads/master')
+        return commit.hexsha
+
+    def fake_repository(self):
+        return repository.Repository(
+                self.fake_url, os.path.join(self.fake_dir, 'checkout'))
+
+    def test_sync(self):
+        """Test that syncs check out the tip and report changed paths."""
+
+        first = self.fake_commit({'haproxy.j2': 'a\n', 'nginx/site.j2': 'b\n'})
+        fake_repository = self.fake_repository()
+
+        self.mox.ReplayAll()
+
+        with fake_repository.lock():
+            self.assertEqual(fake_repository.sync(), first)
+        self.assertEqual(fake_repository.read('nginx/site.j2'), 'b\n')
+        self.assertEqual(fake_repository.changed_paths(None), None)
+        self.assertEqual(fake_repository.changed_paths(first), set())
+
+        second = self.fake_commit({'nginx/site.j2': 'c\n'})
+        with fake_repository.lock():
+            self.assertEqual(fake_repository.sync(), second)
+        self.assertEqual(fake_repository.read('nginx/site.j2'), 'c\n')
+        self.assertEqual(fake_repository.changed_paths(first),
+                set(['nginx/site.j2']))
+        # Only the tip is fetched.
+        self.assertTrue(os.path.exists(os.path.join(
+                self.fake_dir, 'checkout', '.git', 'shallow')))
+
+    def test_sync_unreachable(self):
+        """Test that a failed fetch keeps the last checkout."""
+
+        first = self.fake_commit({'haproxy.j2': 'a\n'})
+        fake_repository = self.fake_repository()
+        with fake_repository.lock():
+            fake_repository.sync()
+        shutil.rmtree(os.path.join(self.fake_dir, 'origin.git'))
+
+        self.mox.ReplayAll()
+
+        with fake_repository.lock():
+            self.assertEqual(fake_repository.sync(), first)
+        self.assertEqual(fake_repository.read('haproxy.j2'), 'a\n')
+
+    def test_read_outside(self):
+        """Test that template paths can't leave the checkout."""
+
+        self.fake_commit({'haproxy.j2': 'a\n'})
+        fake_repository = self.fake_repository()
+        with fake_repository.lock():
+            fake_repository.sync()
+        os.symlink('/etc/passwd', os.path.join(
+                fake_repository.path, 'passwd.j2'))
+
+        self.mox.ReplayAll()
+
+        for fake_path in ('/etc/passwd', '../origin.git/config',
+                          'sub/../../origin.git/config', 'passwd.j2'):
+            self.assertRaises(IOError, fake_repository.read, fake_path)
+
+    def test_configurer(self):
+        """Test that the Configurer reads only templates that changed."""
+
+        self.fake_commit({'haproxy.j2': 'port {{ vars.port }}\n',
+                          'other.j2': 'other\n'})
+        fake_repository = self.fake_repository()
+        fake_config = {'name': 'haproxy', 'template_path': 'haproxy.j2',
+                       'path': os.path.join(self.fake_dir, 'haproxy.cfg'),
+                       'vars': {'port': 80}}
+        fake_conf_db = self.mox.CreateMockAnything()
+        fake_conf_db.configs = self.mox.CreateMockAnything()
+        for _ in range(3):
+            fake_conf_db.configs.find({}).AndReturn([fake_config])
+        fake_configurer = configurer.Configurer(
+                state_file=os.path.join(self.fake_dir, 'state.json'),
+                cache_dir=None, repository=fake_repository)
+        reads = []
+        read = fake_repository.read
+        fake_repository.read = lambda path: reads.append(path) or read(path)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_configurer.do_update(fake_conf_db), ['haproxy'])
+        self.assertEqual(open(fake_config['path']).read(), 'port 80\n')
+        reads[:] = []
+
+        # A commit that doesn't touch the template leaves it unread.
+        self.fake_commit({'other.j2': 'changed\n'})
+        self.assertEqual(fake_configurer.do_update(fake_conf_db), [])
+        self.assertEqual(reads, [])
+
+        self.fake_commit({'haproxy.j2': 'listen {{ vars.port }}\n'})
+        self.assertEqual(fake_configurer.do_update(fake_conf_db), ['haproxy'])
+        self.assertEqual(open(fake_config['path']).read(), 'listen 80\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
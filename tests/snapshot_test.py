@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+Unittests for Aerostat Snapshot.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mox
+
+from aerostat import snapshot
+
+
+FAKE_SERVERS = [
+    {'hostname': 'mongodb-master', 'ip': '10.0.0.1', 'service': 'mongodb',
+     'service_type': 'masterful', 'instance_id': 'i-1',
+     'aliases': ['mongo-primary', 'first-prime']},
+    {'hostname': 'mongodb-slave-1', 'ip': '10.0.0.2', 'service': 'mongodb',
+     'service_type': 'masterful', 'instance_id': 'i-2', 'aliases': []},
+    {'hostname': 'web-0', 'ip': '', 'service': 'web',
+     'service_type': 'iterative', 'instance_id': '', 'aliases': []},
+]
+
+
+class SnapshotTest(mox.MoxTestBase):
+    """Test encoding and decoding snapshots."""
+
+    def test_round_trip(self):
+        """Test that servers survive encoding, with and without zlib."""
+
+        self.mox.ReplayAll()
+
+        for compression in (None, 'zlib'):
+            data = snapshot.encode(FAKE_SERVERS, 7, compression)
+            self.assertEqual(snapshot.decode(data), (7, FAKE_SERVERS))
+
+    def test_random_access(self):
+        """Test reading single entries by index."""
+
+        fake_reader = snapshot.Reader(snapshot.encode(FAKE_SERVERS))
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(len(fake_reader), 3)
+        self.assertEqual(fake_reader[2], FAKE_SERVERS[2])
+        self.assertEqual(fake_reader[-3], FAKE_SERVERS[0])
+        self.assertRaises(IndexError, fake_reader.__getitem__, 3)
+
+    def test_interned(self):
+        """Test that repeated service names are stored once."""
+
+        self.mox.ReplayAll()
+
+        data = snapshot.encode(FAKE_SERVERS)
+        self.assertEqual(data.count('masterful'), 1)
+        self.assertEqual(snapshot.Reader(data).strings,
+                ['mongodb', 'masterful', 'web', 'iterative'])
+
+    def test_corrupt(self):
+        """Test that damaged snapshots are refused."""
+
+        data = snapshot.encode(FAKE_SERVERS)
+
+        self.mox.ReplayAll()
+
+        self.assertRaises(snapshot.SnapshotError, snapshot.Reader,
+                data[:-1] + chr(ord(data[-1]) ^ 1))
+        self.assertRaises(snapshot.SnapshotError, snapshot.Reader, data[:-1])
+        self.assertRaises(snapshot.SnapshotError, snapshot.Reader,
+                'XXXX' + data[4:])
+        self.assertRaises(snapshot.SnapshotError, snapshot.encode,
+                [{'hostname': 'v6', 'ip': 'fe80::1'}])
+        self.assertRaises(snapshot.SnapshotError, snapshot.check_server,
+                {'hostname': 'local', 'ip': 'test_local_ip'})
+        self.assertRaises(snapshot.SnapshotError, snapshot.check_server,
+                {'hostname': 'web-0', 'aliases': ['x' * 256]})
+        snapshot.check_server(FAKE_SERVERS[0])
+
+    def test_open_snapshot(self):
+        """Test reading a snapshot file through mmap."""
+
+        fake_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, fake_dir)
+        fake_path = os.path.join(fake_dir, 'servers.snap')
+
+        self.mox.ReplayAll()
+
+        snapshot.write_snapshot(fake_path, snapshot.encode(FAKE_SERVERS, 3))
+        fake_reader = snapshot.open_snapshot(fake_path)
+        self.assertEqual(fake_reader.generation, 3)
+        self.assertEqual(list(fake_reader), FAKE_SERVERS)
+        fake_reader.close()
+        self.assertRaises(ValueError, fake_reader.mapped.read, 1)
+
+        # Empty and truncated files are SnapshotErrors, like bad data.
+        open(fake_path, 'w').close()
+        self.assertRaises(snapshot.SnapshotError, snapshot.open_snapshot,
+                fake_path)
+        snapshot.write_snapshot(fake_path, 'ASN')
+        self.assertRaises(snapshot.SnapshotError, snapshot.open_snapshot,
+                fake_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
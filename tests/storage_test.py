@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""
+Unittests for Aerostat Storage backends.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mox
+
+from aerostat import registrar
+from aerostat import storage
+from aerostat import subscriptions
+
+
+FAKE_SERVERS = [
+        {'hostname': 'web-0', 'ip': '10.0.0.1', 'instance_id': 'i-0',
+         'service': 'web', 'service_type': 'iterative',
+         'aliases': ['web-primary']},
+        {'hostname': 'web-1', 'ip': '', 'instance_id': '',
+         'service': 'web', 'service_type': 'iterative', 'aliases': []},
+        {'hostname': 'db-master', 'ip': '10.0.0.3', 'instance_id': 'i-3',
+         'service': 'db', 'service_type': 'masterful',
+         'aliases': ['db-primary', 'mongo']}]
+
+
+class SQLiteStorageTest(mox.MoxTestBase):
+    """Test the SQLite backend against a real database file."""
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.fake_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.fake_dir)
+        self.fake_storage = storage.open_storage(
+                'sqlite://' + os.path.join(self.fake_dir, 'aerostat.db'))
+        self.addCleanup(self.fake_storage.close)
+        for server in FAKE_SERVERS:
+            self.fake_storage.insert(server)
+
+    def test_lookups(self):
+        """Test lookups by hostname, instance, alias and service."""
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(self.fake_storage.by_hostname('web-0'),
+                [FAKE_SERVERS[0]])
+        self.assertEqual(self.fake_storage.by_instance('i-3'),
+                [FAKE_SERVERS[2]])
+        self.assertTrue(self.fake_storage.exists('hostname', 'web-1'))
+        self.assertFalse(self.fake_storage.exists('instance_id', 'i-9'))
+        self.assertEqual(self.fake_storage.first('service', 'web'),
+                FAKE_SERVERS[0])
+        self.assertEqual(self.fake_storage.first('hostname', 'web-9'), None)
+        self.assertRaises(ValueError, self.fake_storage.first, 'aliases', 'x')
+        self.assertEqual(self.fake_storage.by_aliases(['mongo', 'web-primary']),
+                [FAKE_SERVERS[0], FAKE_SERVERS[2]])
+        self.assertEqual(self.fake_storage.by_service('web'), FAKE_SERVERS[:2])
+        self.assertEqual(self.fake_storage.gaps('web'), [FAKE_SERVERS[1]])
+        self.assertEqual(list(self.fake_storage.servers(
+                subscriptions.Subscription(aliases=['db-*']))),
+                [FAKE_SERVERS[2]])
+        self.assertEqual(sorted(self.fake_storage.instance_ids()),
+                ['', 'i-0', 'i-3'])
+        self.assertEqual(sorted(self.fake_storage.instances()),
+                [('i-0', '10.0.0.1'), ('i-3', '10.0.0.3')])
+        self.assertEqual(list(self.fake_storage.instances(['i-3', 'i-9'])),
+                [('i-3', '10.0.0.3')])
+        self.assertTrue(os.path.exists(
+                os.path.join(self.fake_dir, 'aerostat.db-wal')))
+
+    def test_writes(self):
+        """Test claims, alias updates and bulk updates."""
+
+        self.mox.ReplayAll()
+
+        self.assertTrue(self.fake_storage.claim('web-1',
+                {'instance_id': 'i-1', 'ip': '10.0.0.2'}))
+        self.assertFalse(self.fake_storage.claim('web-1',
+                {'instance_id': 'i-9', 'ip': '10.0.0.9'}))
+        self.assertEqual(self.fake_storage.by_hostname('web-1')[0]['ip'],
+                '10.0.0.2')
+
+        self.fake_storage.update('instance_id', 'i-3', {'aliases': ['mongo']})
+        self.assertEqual(self.fake_storage.by_aliases(['db-primary']), [])
+
+        self.fake_storage.update_ips({'i-0': '10.1.0.1', 'i-1': '10.1.0.2'})
+        self.assertEqual(self.fake_storage.services_of(['i-0', 'i-3']),
+                ['db', 'web'])
+        self.assertEqual(self.fake_storage.clear_instances(['i-0', 'i-1']), 2)
+        self.assertEqual(sorted(self.fake_storage.instances()),
+                [('i-3', '10.0.0.3')])
+        self.assertEqual([server['hostname'] for server in
+                          self.fake_storage.gaps('web')], ['web-0', 'web-1'])
+
+    def test_registrar(self):
+        """Test that the Registrar names and registers hosts in SQLite."""
+
+        fake_registrar = registrar.Registrar()
+
+        self.mox.ReplayAll()
+
+        hostname = fake_registrar.pick_name(
+                self.fake_storage, 'web', 'iterative', 'i-5', use_pool=True)
+        self.assertEqual(hostname, 'web-1')
+        self.assertTrue(fake_registrar.register_name(self.fake_storage,
+                hostname, '10.0.0.5', 'i-5', 'web', 'iterative', ['mongo']))
+        self.assertEqual(fake_registrar.pick_name(
+                self.fake_storage, 'web', 'iterative', 'i-6'), 'web-2')
+        # The alias moved to the new host.
+        self.assertEqual([server['hostname'] for server in
+                          self.fake_storage.by_aliases(['mongo'])], ['web-1'])
+
+
+class GetTest(mox.MoxTestBase):
+    """Test wrapping databases in storage."""
+
+    def test_get(self):
+        """Test that Mongo databases are wrapped and storage passed through."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_storage = storage.SQLiteStorage(':memory:')
+        self.addCleanup(fake_storage.close)
+
+        self.mox.ReplayAll()
+
+        self.assertTrue(storage.get(fake_db).db is fake_db)
+        self.assertTrue(storage.get(fake_db) is storage.get(fake_db))
+        self.assertTrue(storage.get(fake_storage) is fake_storage)
+        # Backends must provide every operation.
+        self.assertRaises(TypeError, storage.Storage)
+        self.assertRaises(ValueError, storage.open_storage, 'postgres://x')
+
+    def test_mongo_master(self):
+        """Test that Mongo masters are cached until a write assigns one."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.servers = self.mox.CreateMockAnything()
+        fake_db.masters = self.mox.CreateMockAnything()
+        fake_master = {'_id': 'db', 'instance_id': 'i-1', 'generation': 1}
+        fake_db.masters.find_one({'_id': 'db'}).AndReturn(fake_master)
+        fake_db.servers.insert({'hostname': 'db-master', 'service': 'db',
+                                'instance_id': 'i-2', 'ip': '10.0.0.2'})
+        fake_db.masters.update({'_id': 'db'},
+                {'$set': {'instance_id': 'i-2', 'ip': '10.0.0.2'},
+                 '$inc': {'generation': 1}}, upsert=True)
+        fake_db.masters.find_one({'_id': 'db'}).AndReturn(None)
+        fake_db.servers.find({'hostname': 'db-master'}).AndReturn([])
+
+        self.mox.ReplayAll()
+
+        fake_storage = storage.get(fake_db)
+        self.assertEqual(fake_storage.master('db'), [fake_master])
+        self.assertEqual(fake_storage.master('db'), [fake_master])
+        fake_storage.insert({'hostname': 'db-master', 'service': 'db',
+                             'instance_id': 'i-2', 'ip': '10.0.0.2'})
+        self.assertEqual(fake_storage.master('db'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
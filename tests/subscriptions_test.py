@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+Unittests for Aerostat Subscriptions.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mox
+
+from aerostat import subscriptions
+
+
+class SubscriptionsTest(mox.MoxTestBase):
+    """Test parsing subscriptions and building their queries."""
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.fake_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.fake_dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.fake_dir, name)
+        out = open(path, 'w')
+        out.write(content)
+        out.close()
+        return path
+
+    def test_glob_to_regex(self):
+        """Test that globs become anchored regexes."""
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(subscriptions.glob_to_regex('mongo-*'),
+                '^mongo\\-.*$')
+        self.assertEqual(subscriptions.glob_to_regex('db?.a'), '^db.\\.a$')
+
+    def test_parse(self):
+        """Test parsing rules and comments."""
+
+        self.mox.ReplayAll()
+
+        fake_subscription = subscriptions.parse([
+                '# dependencies', 'own', 'service mongodb memcache',
+                'alias first-prime mongo-*  # primaries', ''])
+        self.assertTrue(fake_subscription.own)
+        self.assertEqual(fake_subscription.services,
+                set(['mongodb', 'memcache']))
+        self.assertEqual(fake_subscription.aliases, set(['first-prime']))
+        self.assertEqual(fake_subscription.patterns, set(['mongo-*']))
+        self.assertRaises(ValueError, subscriptions.parse, ['host web-1'])
+
+    def test_query(self):
+        """Test the servers queries built for subscriptions."""
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(subscriptions.Subscription(['web']).query(),
+                {'service': {'$in': ['web']}})
+        self.assertEqual(subscriptions.Subscription(
+                ['web', 'db'], ['first-prime', 'mongo-*']).query(),
+                {'$or': [{'service': {'$in': ['db', 'web']}},
+                         {'aliases': {'$in': ['first-prime']}},
+                         {'aliases': {'$regex': '^mongo\\-.*$'}}]})
+        self.assertEqual(subscriptions.Subscription().query(),
+                {'_id': {'$in': []}})
+
+    def test_matches(self):
+        """Test matching server documents against a subscription."""
+
+        fake_subscription = subscriptions.Subscription(
+                ['web'], ['first-prime', 'mongo-*'])
+
+        self.mox.ReplayAll()
+
+        self.assertTrue(fake_subscription.matches({'service': 'web'}))
+        self.assertTrue(fake_subscription.matches(
+                {'service': 'db', 'aliases': ['mongo-primary']}))
+        self.assertFalse(fake_subscription.matches(
+                {'service': 'db', 'aliases': ['primary-mongo']}))
+
+    def test_load(self):
+        """Test loading a subscription file, resolving the own service."""
+
+        fake_info = self.write('aerostat_info', 'web iterative www\n')
+        fake_path = self.write('subscriptions', 'own\nservice mongodb\n')
+        self.mox.StubOutWithMock(os, 'environ')
+        os.environ.get('AEROSTAT_INFO', '/etc/aerostat_info').AndReturn(
+                fake_info)
+
+        self.mox.ReplayAll()
+
+        fake_subscription = subscriptions.load(fake_path)
+        self.assertEqual(fake_subscription.services, set(['web', 'mongodb']))
+        self.assertEqual(fake_subscription.path, fake_path)
+        self.assertEqual(subscriptions.load(
+                os.path.join(self.fake_dir, 'missing')), None)
+
+    def test_load_own_without_info(self):
+        """Test that an own rule without aerostat_info is a ValueError."""
+
+        fake_path = self.write('subscriptions', 'own\n')
+        self.mox.StubOutWithMock(os, 'environ')
+        os.environ.get('AEROSTAT_INFO', '/etc/aerostat_info').AndReturn(
+                os.path.join(self.fake_dir, 'missing'))
+
+        self.mox.ReplayAll()
+
+        self.assertRaises(ValueError, subscriptions.load, fake_path)
+
+    def test_reload_if_changed(self):
+        """Test that a changed file is re-read."""
+
+        fake_path = self.write('subscriptions', 'service mongodb\n')
+        fake_subscription = subscriptions.load(fake_path)
+        self.write('subscriptions', 'service web\n')
+        os.utime(fake_path, (0, 0))
+
+        self.mox.ReplayAll()
+
+        fake_subscription = subscriptions.reload_if_changed(fake_subscription)
+        self.assertEqual(fake_subscription.services, set(['web']))
+        self.assertTrue(subscriptions.reload_if_changed(None) is None)
+
+        # A bad edit keeps the old rules.
+        self.write('subscriptions', 'services web\n')
+        os.utime(fake_path, (1, 1))
+        self.assertTrue(subscriptions.reload_if_changed(
+                fake_subscription) is fake_subscription)
+
+        # A removed file means all hosts, as it does at startup.
+        os.remove(fake_path)
+        self.assertTrue(subscriptions.reload_if_changed(
+                fake_subscription) is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,8 +10,12 @@ import sys
 import unittest
 
 import mox
+import pymongo
 import shutil
+import tempfile
 
+from aerostat import snapshot
+from aerostat import subscriptions
 from aerostat import updater
 
 
@@ -169,6 +173,120 @@ class UpdaterTest(mox.MoxTestBase):
         fake_updater.do_update(fake_db, False)
         self.assertEqual(fake_updater.hosts_data, expected_output)
 
+    def test_do_update_metrics(self):
+        """Test that do_update records bytes, entries, outcome and time."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.servers = self.mox.CreateMockAnything()
+
+        fake_data = [{
+                'hostname': 'mongodb-slave-1',
+                'ip': '12.123.234.5',
+                'aliases': ['first-prime']}]
+
+        fake_db.servers.find().AndReturn(fake_data)
+        fake_db.servers.find().AndReturn(fake_data)
+
+        self.mox.StubOutWithMock(shutil, 'copyfile')
+        shutil.copyfile('/etc/hosts', '/etc/hosts.bak').AndReturn(0)
+
+        fake_updater = updater.Updater()
+
+        self.mox.StubOutWithMock(fake_updater, 'write_hosts_file')
+        fake_updater.write_hosts_file().AndReturn(64)
+
+        bytes_before = updater.HOSTS_BYTES.get()
+        written_before = updater.UPDATES.get(result='written')
+        dry_run_before = updater.UPDATES.get(result='dry_run')
+        count_before = updater.UPDATE_SECONDS.get()[1]
+
+        self.mox.ReplayAll()
+
+        self.assertTrue(fake_updater.do_update(fake_db, False))
+        self.assertEqual(updater.HOSTS_BYTES.get(), bytes_before + 64)
+        self.assertEqual(updater.HOSTS_ENTRIES.get(), 3)
+        self.assertEqual(updater.UPDATES.get(result='written'),
+                written_before + 1)
+
+        # A dry run writes nothing, and says so.
+        self.assertFalse(fake_updater.do_update(fake_db, True))
+        self.assertEqual(updater.HOSTS_BYTES.get(), bytes_before + 64)
+        self.assertEqual(updater.UPDATES.get(result='written'),
+                written_before + 1)
+        self.assertEqual(updater.UPDATES.get(result='dry_run'),
+                dry_run_before + 1)
+        self.assertEqual(updater.UPDATE_SECONDS.get()[1], count_before + 2)
+
+    def test_do_update_subscribed(self):
+        """Test that a subscribed updater only fetches what it needs."""
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.servers = self.mox.CreateMockAnything()
+        fake_subscription = subscriptions.Subscription(['mongodb'])
+
+        fake_db.servers.find({'service': {'$in': ['mongodb']}},
+                subscriptions.FIELDS).AndReturn([{
+                    'hostname': 'mongodb-slave-1',
+                    'ip': '12.123.234.5',
+                    'aliases': []}])
+
+        fake_updater = updater.Updater(fake_subscription)
+
+        self.mox.ReplayAll()
+
+        fake_updater.do_update(fake_db, True)
+        self.assertEqual(fake_updater.hosts_data,
+                ['127.0.0.1 localhost', '12.123.234.5 mongodb-slave-1'])
+
+    def test_fetch_servers_cached(self):
+        """Test that the snapshot cache is kept, and used without mongo."""
+
+        fake_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, fake_dir)
+        fake_cache = os.path.join(fake_dir, 'servers.snap')
+        fake_data = [{
+                'hostname': 'mongodb-slave-1',
+                'ip': '12.123.234.5',
+                'aliases': ['first-prime']}]
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.servers = self.mox.CreateMockAnything()
+        fake_db.servers.find().AndReturn(iter(fake_data))
+        fake_cursor = self.mox.CreateMockAnything()
+        fake_db.servers.find().AndReturn(fake_cursor)
+        fake_cursor.__iter__().AndRaise(pymongo.errors.AutoReconnect())
+
+        fake_updater = updater.Updater(snapshot_cache=fake_cache)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(fake_updater.fetch_servers(fake_db), fake_data)
+        cached = list(fake_updater.fetch_servers(fake_db))
+        self.assertEqual([(server['hostname'], server['ip'], server['aliases'])
+                          for server in cached],
+                [('mongodb-slave-1', '12.123.234.5', ['first-prime'])])
+
+    def test_fetch_servers_bad_cache(self):
+        """Test that an unreadable cache re-raises the mongo error."""
+
+        fake_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, fake_dir)
+        fake_cache = os.path.join(fake_dir, 'servers.snap')
+        open(fake_cache, 'w').close()
+
+        fake_db = self.mox.CreateMockAnything()
+        fake_db.servers = self.mox.CreateMockAnything()
+        fake_cursor = self.mox.CreateMockAnything()
+        fake_db.servers.find().AndReturn(fake_cursor)
+        fake_cursor.__iter__().AndRaise(pymongo.errors.AutoReconnect())
+
+        fake_updater = updater.Updater(snapshot_cache=fake_cache)
+
+        self.mox.ReplayAll()
+
+        self.assertRaises(pymongo.errors.AutoReconnect,
+                fake_updater.fetch_servers, fake_db)
+
 
 if __name__ == '__main__':
     unittest.main()